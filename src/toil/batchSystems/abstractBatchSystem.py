@@ -21,6 +21,7 @@ from builtins import object
 import os
 import shutil
 import logging
+import signal
 from abc import ABCMeta, abstractmethod
 from collections import namedtuple
 from contextlib import contextmanager
@@ -49,6 +50,37 @@ WorkerCleanupInfo = namedtuple('WorkerCleanupInfo', (
     'cleanWorkDir'))
 
 
+class BatchJobExitReason(object):
+    """
+    The known causes of the failure of a job. Each names the requirement of the job that was
+    exceeded, see :meth:`toil.jobGraph.JobGraph.setupJobAfterFailure`.
+    """
+    MEMLIMIT = 'memory'
+    """The job ran out of memory"""
+
+    DISKLIMIT = 'disk'
+    """The job used more disk than it requested"""
+
+    oomExitStatus = 128 + signal.SIGKILL
+    """
+    The exit status of a job killed by the kernel's OOM killer or by a batch system enforcing its
+    memory limit. Batch systems that learn about an out-of-memory failure some other way should
+    report the job as having exited with this status.
+    """
+
+    @classmethod
+    def fromExitStatus(cls, exitStatus):
+        """
+        :param int exitStatus: the exit status of a failed job, as reported by a batch system
+        :return: the cause of the failure, or None if it can't be told from the exit status
+        :rtype: str|None
+        """
+        # Popen reports a process killed by a signal with the negated signal number
+        if exitStatus in (cls.oomExitStatus, -signal.SIGKILL):
+            return cls.MEMLIMIT
+        return None
+
+
 class AbstractBatchSystem(with_metaclass(ABCMeta, object)):
     """
     An abstract (as far as Python currently allows) base class to represent the interface the batch
@@ -44,6 +44,7 @@ from mesos.interface import mesos_pb2
 
 from toil import resolveEntryPoint
 from toil.batchSystems.abstractBatchSystem import (AbstractScalableBatchSystem,
+                                                   BatchJobExitReason,
                                                    BatchSystemLocalSupport,
                                                    NodeInfo)
 from toil.batchSystems.mesos import ToilJob, ResourceRequirement, TaskData, JobQueue
@@ -573,13 +574,19 @@ class MesosBatchSystem(BatchSystemLocalSupport,
         if update.state == mesos_pb2.TASK_FINISHED:
             jobEnded(0, wallTime=unpack('d', update.data)[0])
         elif update.state == mesos_pb2.TASK_FAILED:
-            try:
-                exitStatus = int(update.message)
-            except ValueError:
-                exitStatus = 255
-                log.warning("Job %i failed with message '%s'", jobID, update.message)
+            if update.reason == mesos_pb2.TaskStatus.REASON_CONTAINER_LIMITATION_MEMORY:
+                # Report the job like one killed by the OOM killer so that it is retried with
+                # more memory
+                exitStatus = BatchJobExitReason.oomExitStatus
+                log.warning('Job %i exceeded its memory limit', jobID)
             else:
-                log.warning('Job %i failed with exit status %i', jobID, exitStatus)
+                try:
+                    exitStatus = int(update.message)
+                except ValueError:
+                    exitStatus = 255
+                    log.warning("Job %i failed with message '%s'", jobID, update.message)
+                else:
+                    log.warning('Job %i failed with exit status %i', jobID, exitStatus)
             jobEnded(exitStatus)
         elif update.state in (mesos_pb2.TASK_LOST, mesos_pb2.TASK_KILLED, mesos_pb2.TASK_ERROR):
             log.warning("Job %i is in unexpected state %s with message '%s'.",
@@ -28,6 +28,7 @@ from six.moves.queue import Empty, Queue
 from six import iteritems
 
 from toil.batchSystems import MemoryString
+from toil.batchSystems.abstractBatchSystem import BatchJobExitReason
 from toil.batchSystems.abstractGridEngineBatchSystem import AbstractGridEngineBatchSystem
 
 logger = logging.getLogger(__name__)
@@ -90,6 +91,9 @@ class SlurmBatchSystem(AbstractGridEngineBatchSystem):
             # If Job is in a running state, return None to indicate we don't have an update                                 
             if state in ('PENDING', 'RUNNING', 'CONFIGURING', 'COMPLETING', 'RESIZING', 'SUSPENDED'):
                 return None
+            # Report a job killed for exceeding its memory limit so that it is retried with more
+            if state == 'OUT_OF_MEMORY':
+                return BatchJobExitReason.oomExitStatus
             
             return rc
             
@@ -0,0 +1,263 @@
+# Copyright (C) 2015-2018 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Caching of the return values of jobs across runs of a workflow, see the --callCache option.
+"""
+
+from __future__ import absolute_import
+
+import errno
+import hashlib
+import inspect
+import logging
+import os
+import shutil
+import tempfile
+from io import BytesIO
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from toil.fileStore import FileID
+
+logger = logging.getLogger(__name__)
+
+
+class _UncacheableValue(Exception):
+    pass
+
+
+class CallCache(object):
+    """
+    A cache of the return values of jobs in a directory that is shared by the runs of a workflow.
+
+    A job's entry is keyed by a hash of the source code of its user modules, its class, the
+    pickled values of its attributes and the workflow's configuration, except for the attributes
+    and options that don't affect its return value, like resource requirements. Dicts and sets
+    are pickled with their items in a canonical order. Files that are passed to the job as
+    :class:`toil.fileStore.FileID` instances are hashed by their content instead of by their ID,
+    which differs between runs. Only the modules the job is defined in are hashed, not the
+    modules they import.
+
+    Only the return values of jobs that added no successors or services, aren't checkpoints and
+    didn't return a promise are cached. The files referenced by the return value through
+    :class:`toil.fileStore.FileID` instances are copied into the cache and are imported into the
+    job store of the run that uses the cached value.
+    """
+    version = 2
+    """
+    The format of the keys and entries, part of each key
+    """
+
+    # Attributes that don't affect the return value of a job, or that differ between runs
+    _ignoredAttributes = frozenset((
+        '_memory', '_cores', '_disk', '_preemptable', 'unitName', 'displayName', 'checkpoint',
+        '_children', '_followOns', '_services', '_directPredecessors', 'userModule',
+        'userFunctionModule', '_rvs', '_promiseJobStore', '_fileStore', '_tempDir', '_config',
+        '_callCacheHit'))
+
+    # Configuration options that don't affect the return value of a job, or that differ between
+    # runs. Options added later affect the key until they are listed here.
+    _ignoredOptions = frozenset((
+        'workflowID', 'workflowAttemptNumber', 'jobStore', 'logLevel', 'workDir', 'stats', 'clean',
+        'cleanWorkDir', 'clusterStats', 'restart', 'batchSystem', 'disableAutoDeployment',
+        'statePollingWait', 'maxLocalJobs', 'scale', 'linkImports', 'mesosMasterAddress',
+        'parasolCommand', 'parasolMaxBatches', 'provisioner', 'nodeTypes', 'nodeOptions',
+        'minNodes', 'maxNodes', 'targetTime', 'betaInertia', 'scaleInterval',
+        'preemptableCompensation', 'runtimeModel', 'runtimeEstimate', 'nodeStorage', 'metrics',
+        'maxPreemptableServiceJobs', 'maxServiceJobs', 'deadlockWait', 'defaultMemory',
+        'defaultCores', 'defaultDisk', 'defaultPreemptable', 'maxCores', 'maxMemory', 'maxDisk',
+        'retryCount', 'retryResourceFactor', 'maxJobDuration', 'rescueJobsFrequency',
+        'disableCaching', 'disableChaining', 'maxLogFileSize', 'writeLogs', 'writeLogsGzip',
+        'sseKey', 'cseKey', 'servicePollingInterval', 'useAsync', 'forceDockerAppliance',
+        'deduplicateFiles', 'compressFiles', 'compactJobs', 'peerCache', 'peerCacheHost',
+        'fileJobStoreIndex', 'memJobStoreSpillSize', 'referenceImports', 'callCache',
+        'refreshCallCache', 'debugWorker', 'badWorker', 'badWorkerFailInterval'))
+
+    # Maps the paths of source files to their hashes
+    _sourceHashes = {}
+
+    # Maps the IDs of files in the job store to the hashes of their content
+    _contentHashes = {}
+
+    def __init__(self, path):
+        """
+        :param str path: the directory holding the cache, created if it doesn't exist
+        """
+        self.path = path
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def run(self, job, jobGraph, fileStore, refresh=False):
+        """
+        Run the given job unless its return value is cached, and cache its return value if
+        possible. Sets the job's _callCacheHit attribute to whether the value was cached.
+
+        :param toil.job.Job job: the job
+        :param bool refresh: if True, run the job even if its return value is cached
+        :return: the return value of the job
+        """
+        try:
+            key = self._getKey(job, fileStore)
+        except _UncacheableValue:
+            logger.debug('Not caching the return value of %s, its attributes are cyclic.', job)
+            job._callCacheHit = False
+            return job._run(jobGraph, fileStore)
+        entryPath = os.path.join(self.path, key[:2], key)
+        if not refresh and os.path.exists(entryPath):
+            try:
+                returnValue = self._load(job, entryPath, fileStore)
+            except (IOError, OSError) as e:
+                # The entry may have been removed after we checked for it
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                logger.info('Using the cached return value of %s.', job)
+                job._callCacheHit = True
+                return returnValue
+        job._callCacheHit = False
+        returnValue = job._run(jobGraph, fileStore)
+        if job._children or job._followOns or job._services:
+            logger.debug('Not caching the return value of %s, it added successors.', job)
+        else:
+            try:
+                self._save(entryPath, returnValue, fileStore, replace=refresh)
+            except _UncacheableValue:
+                logger.debug('Not caching the return value of %s, it is a promise.', job)
+        return returnValue
+
+    def _getKey(self, job, fileStore):
+        sourceHashes = []
+        for userModule in {job.userModule, job.getUserScript()}:
+            module = job._loadUserModule(userModule)
+            try:
+                sourcePath = inspect.getsourcefile(module)
+            except TypeError:
+                sourcePath = None
+            sourceHashes.append((userModule.name, self._hashSource(sourcePath)))
+        attributes = sorted((name, value) for name, value in vars(job).items()
+                            if name not in self._ignoredAttributes)
+        options = sorted((name, value) for name, value in vars(fileStore.jobStore.config).items()
+                         if name not in self._ignoredOptions)
+        # The IDs of the dicts and sets being pickled in a canonical order
+        canonicalizing = set()
+
+        def dumps(obj):
+            buf = BytesIO()
+            pickler = pickle.Pickler(buf, 2)
+            pickler.persistent_id = persistent_id
+            pickler.dump(obj)
+            return buf.getvalue()
+
+        def persistent_id(obj):
+            if isinstance(obj, FileID):
+                return 'file', self._hashContent(obj, fileStore)
+            if type(obj) in (dict, set, frozenset):
+                # The order of their items depends on the hashes of the items, which may be
+                # randomized, and for dicts on the order of insertion. Since each item is pickled
+                # on its own, a cycle through the container would never end.
+                if id(obj) in canonicalizing:
+                    raise _UncacheableValue()
+                canonicalizing.add(id(obj))
+                try:
+                    items = obj.items() if type(obj) is dict else obj
+                    return type(obj).__name__, sorted(dumps(item) for item in items)
+                finally:
+                    canonicalizing.discard(id(obj))
+            return None
+
+        return hashlib.sha256(dumps((self.version, sorted(sourceHashes), type(job).__module__,
+                                     type(job).__name__, attributes, options))).hexdigest()
+
+    @classmethod
+    def _hashSource(cls, path):
+        if path is None:
+            return None
+        sourceHash = cls._sourceHashes.get(path)
+        if sourceHash is None:
+            with open(path, 'rb') as f:
+                sourceHash = cls._sourceHashes[path] = hashlib.sha256(f.read()).hexdigest()
+        return sourceHash
+
+    @classmethod
+    def _hashContent(cls, fileID, fileStore):
+        contentHash = cls._contentHashes.get(fileID)
+        if contentHash is None:
+            contentHash = hashlib.sha256()
+            with fileStore.readGlobalFileStream(fileID) as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    contentHash.update(chunk)
+            contentHash = cls._contentHashes[fileID] = contentHash.hexdigest()
+        return contentHash
+
+    def _save(self, entryPath, returnValue, fileStore, replace):
+        from toil.job import Promise
+        tempPath = tempfile.mkdtemp(prefix='tmp-', dir=self.path)
+        try:
+            fileIDs = []
+
+            def persistent_id(obj):
+                if isinstance(obj, Promise):
+                    raise _UncacheableValue()
+                if isinstance(obj, FileID):
+                    fileIDs.append(obj)
+                    return 'file', len(fileIDs) - 1
+                return None
+
+            with open(os.path.join(tempPath, 'value'), 'wb') as f:
+                pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+                pickler.persistent_id = persistent_id
+                pickler.dump(returnValue)
+            for i, fileID in enumerate(fileIDs):
+                with fileStore.readGlobalFileStream(fileID) as src:
+                    with open(os.path.join(tempPath, str(i)), 'wb') as dst:
+                        shutil.copyfileobj(src, dst)
+            try:
+                os.makedirs(os.path.dirname(entryPath))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            if replace:
+                shutil.rmtree(entryPath, ignore_errors=True)
+            try:
+                os.rename(tempPath, entryPath)
+            except OSError as e:
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+                # Another job with the same key cached its return value first
+                shutil.rmtree(tempPath)
+        except:
+            shutil.rmtree(tempPath, ignore_errors=True)
+            raise
+
+    def _load(self, job, entryPath, fileStore):
+        from toil.job import Job
+
+        def persistent_load(persistentID):
+            _, i = persistentID
+            # Write a copy, the file store may move or link the file it is given
+            localPath = fileStore.getLocalTempFileName()
+            shutil.copyfile(os.path.join(entryPath, str(i)), localPath)
+            return fileStore.writeGlobalFile(localPath)
+
+        with open(os.path.join(entryPath, 'value'), 'rb') as f:
+            unpickler = Job._getUnpickler(job._loadUserModule(job.getUserScript()), f)
+            unpickler.persistent_load = persistent_load
+            return unpickler.load()
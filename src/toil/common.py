@@ -39,6 +39,7 @@ except ImportError:
 # Python 3 compatibility imports
 from six import iteritems
 
+from toil.lib.diskUsage import getDirSize
 from toil.lib.humanize import bytes2human
 from toil.lib.retry import retry
 
@@ -99,6 +100,8 @@ class Config(object):
         self.betaInertia = 0.1
         self.scaleInterval = 60
         self.preemptableCompensation = 0.0
+        self.runtimeModel = None
+        self.runtimeEstimate = 'mean'
         self.nodeStorage = 50
         self.metrics = False
 
@@ -120,6 +123,7 @@ class Config(object):
 
         # Retrying/rescuing jobs
         self.retryCount = 1
+        self.retryResourceFactor = 2.0
         self.maxJobDuration = sys.maxsize
         self.rescueJobsFrequency = 3600
 
@@ -134,6 +138,16 @@ class Config(object):
         self.servicePollingInterval = 60
         self.useAsync = True
         self.forceDockerAppliance = False
+        self.deduplicateFiles = False
+        self.compressFiles = None
+        self.compactJobs = False
+        self.peerCache = False
+        self.peerCacheHost = None
+        self.fileJobStoreIndex = False
+        self.memJobStoreSpillSize = None
+        self.referenceImports = False
+        self.callCache = None
+        self.refreshCallCache = False
 
         # Debug options
         self.debugWorker = False
@@ -244,6 +258,21 @@ class Config(object):
         if not 0.0 <= self.preemptableCompensation <= 1.0:
             raise RuntimeError('preemptableCompensation (%f) must be between 0.0 and 1.0!'
                                '' % self.preemptableCompensation)
+        setOption("runtimeModel", os.path.abspath)
+
+        def parseRuntimeEstimate(s):
+            if s in ('mean', 'ewma'):
+                return s
+            try:
+                quantile = float(s)
+            except ValueError:
+                quantile = None
+            if quantile is None or not 0.0 < quantile <= 1.0:
+                raise RuntimeError("runtimeEstimate (%s) must be 'mean', 'ewma' or a number "
+                                   "between 0.0 and 1.0!" % s)
+            return quantile
+
+        setOption("runtimeEstimate", parseRuntimeEstimate)
         setOption("nodeStorage", int)
 
         # Parameters to limit service jobs / detect deadlocks
@@ -264,6 +293,7 @@ class Config(object):
 
         # Retrying/rescuing jobs
         setOption("retryCount", int, iC(1))
+        setOption("retryResourceFactor", float, fC(1.0))
         setOption("maxJobDuration", int, iC(1))
         setOption("rescueJobsFrequency", int, iC(1))
 
@@ -283,6 +313,21 @@ class Config(object):
         setOption("cseKey", checkFn=checkSse)
         setOption("servicePollingInterval", float, fC(0.0))
         setOption("forceDockerAppliance")
+        setOption("deduplicateFiles")
+
+        def checkCodec(codec):
+            from toil.lib.compression import codecs
+            assert codec in codecs
+
+        setOption("compressFiles", checkFn=checkCodec)
+        setOption("compactJobs")
+        setOption("peerCache")
+        setOption("peerCacheHost")
+        setOption("fileJobStoreIndex")
+        setOption("memJobStoreSpillSize", h2b, iC(0))
+        setOption("referenceImports")
+        setOption("callCache", os.path.abspath)
+        setOption("refreshCallCache")
 
         # Debug options
         setOption("debugWorker")
@@ -307,6 +352,8 @@ jobStoreLocatorHelp = ("A job store holds persistent information about the jobs
                        "AWS resources in use by job store, e.g. S3 buckets.\n\n "
                        "azure:<account>:<prefix>\n\n"
                        "google:<project_id>:<prefix> TODO: explain\n\n"
+                       "mem:<name> keeps the job store in the memory of the leader process and "
+                       "requires the singleMachine batch system with --debugWorker.\n\n"
                        "For backwards compatibility, you may also specify ./foo (equivalent to "
                        "file:./foo or just file:foo) or /bar (equivalent to file:/bar).")
 
@@ -433,6 +480,20 @@ def _addOptions(addGroupFn, config):
                       "missing preemptable nodes with a non-preemptable one. A value of 1.0 "
                       "replaces every missing pre-emptable node with a non-preemptable one." %
                       config.preemptableCompensation))
+    addOptionFn("--runtimeModel", dest="runtimeModel", default=None,
+                help=("The path to a file in which the runtimes of completed jobs are kept "
+                      "across runs of workflows. The autoscaler estimates the runtimes of queued "
+                      "jobs from the runtimes of earlier jobs of the same name, so it starts with "
+                      "the runtimes recorded in this file by earlier runs. Several workflows may "
+                      "share the file. By default, only the runtimes of jobs of the current run "
+                      "are used."))
+    addOptionFn("--runtimeEstimate", dest="runtimeEstimate", default=None,
+                help=("How the autoscaler estimates the runtime of a queued job from the runtimes "
+                      "of earlier jobs of the same name: 'mean' for their mean, 'ewma' for an "
+                      "exponentially weighted moving average that favors the most recent ones, or "
+                      "a number between 0.0 and 1.0 for that quantile, e.g. 0.9 to expect "
+                      "jobs to take as long as nine in ten earlier jobs did at most. "
+                      "default=%s" % config.runtimeEstimate))
     addOptionFn("--nodeStorage", dest="nodeStorage", default=50,
                 help=("Specify the size of the root volume of worker nodes when they are launched "
                       "in gigabytes. You may want to set this if your jobs require a lot of disk "
@@ -511,6 +572,11 @@ def _addOptions(addGroupFn, config):
     addOptionFn("--retryCount", dest="retryCount", default=None,
                 help=("Number of times to retry a failing job before giving up and "
                       "labeling job failed. default=%s" % config.retryCount))
+    addOptionFn("--retryResourceFactor", dest="retryResourceFactor", default=None,
+                help=("Factor by which to increase the memory or disk requirement of a job "
+                      "that failed because it ran out of memory or disk, up to the largest "
+                      "node shape. Later jobs with the same name start from the increased "
+                      "requirement. Use 1 to disable. default=%s" % config.retryResourceFactor))
     addOptionFn("--maxJobDuration", dest="maxJobDuration", default=None,
                 help=("Maximum runtime of a job (in seconds) before we kill it "
                       "(this is a lower bound, and the actual time before killing "
@@ -571,6 +637,60 @@ def _addOptions(addGroupFn, config):
                 default=False,
                 help='Disables sanity checking the existence of the docker image specified by '
                 'TOIL_APPLIANCE_SELF, which Toil uses to provision mesos for autoscaling.')
+    addOptionFn('--deduplicateFiles', dest='deduplicateFiles', action='store_true',
+                default=False,
+                help='Store files written to the job store by the SHA-256 hash of their content '
+                     'so that files with identical content share a single stored copy. Only '
+                     'supported by the file and AWS job stores.')
+    addOptionFn('--compressFiles', dest='compressFiles', default=None, metavar='CODEC',
+                help="Transparently compress files written to the job store with the given "
+                     "codec, one of 'zlib', 'zstd' or 'lz4'. The latter two require the "
+                     "zstandard or lz4 package, respectively. Files that are already compressed "
+                     "are stored as they are. Only supported by the file and AWS job stores.")
+    addOptionFn('--compactJobs', dest='compactJobs', action='store_true', default=False,
+                help='Store the descriptions of jobs in a compact binary encoding instead of '
+                     'pickling them. Its records are 20 to 40 percent smaller, which lets more '
+                     'jobs fit into an AWS SimpleDB item without spilling to S3, but it takes '
+                     'about three times as long to encode and decode. Jobs stored either way '
+                     'can always be read.')
+    addOptionFn('--peerCache', dest='peerCache', action='store_true', default=False,
+                help='Let worker nodes download files from the caches of other nodes instead of '
+                     'from the job store. Each node serves its cache over HTTP on its private '
+                     'address to requests bearing a secret token, and the job store keeps track '
+                     'of which nodes hold which files. Requires caching.')
+    addOptionFn('--peerCacheHost', dest='peerCacheHost', default=None,
+                help='The address under which nodes serve and advertise their peer cache, mainly '
+                     'useful when simulating several nodes on one machine. Defaults to the '
+                     'private address of each node, i.e. one in 10.0.0.0/8, 172.16.0.0/12 or '
+                     '192.168.0.0/16. Nodes without a private address don\'t use the peer cache.')
+    addOptionFn('--fileJobStoreIndex', dest='fileJobStoreIndex', action='store_true',
+                default=False,
+                help='Keep the jobs of a file job store in a SQLite database instead of one file '
+                     'per job, which makes enumerating jobs on restart fast. Restarting a '
+                     'workflow with this option migrates its job store. The file system holding '
+                     'the job store must support POSIX locks.')
+    addOptionFn('--memJobStoreSpillSize', dest='memJobStoreSpillSize', default=None,
+                help='Keep files larger than this in a temporary directory instead of in memory '
+                     'when using the in-memory job store. By default, all files are kept in '
+                     'memory.')
+    addOptionFn('--referenceImports', dest='referenceImports', action='store_true',
+                default=False,
+                help='Import local files into a file job store without copying them. A file on '
+                     'the same file system as the job store is reflinked if that is supported. '
+                     'Any other file is referenced by its path and copied when it is read. '
+                     'Reading a referenced file fails if the original was modified or deleted '
+                     'after it was imported.')
+    addOptionFn('--callCache', dest='callCache', default=None,
+                help='The path to a directory in which to cache the return values of jobs, '
+                     'including the files they reference, across runs of the workflow. A job '
+                     'whose code, arguments and argument files match an earlier run of a job '
+                     'that added no successors is not run again, its cached return value is '
+                     'used instead. Only use this for workflows whose jobs have no effects other '
+                     'than their return values.')
+    addOptionFn('--refreshCallCache', dest='refreshCallCache', action='store_true',
+                default=False,
+                help='Run all jobs even if their return values are in the call cache and replace '
+                     'the cached return values with the new ones.')
     #
     # Debug options
     #
@@ -706,6 +826,10 @@ class Toil(object):
         setLoggingFromOptions(self.options)
         config = Config()
         config.setOptions(self.options)
+        if (self.parseLocator(config.jobStore)[0] == 'mem' and
+                not (config.batchSystem == 'singleMachine' and config.debugWorker)):
+            raise RuntimeError('The in-memory job store is only visible to the leader process. It '
+                               'requires the singleMachine batch system and --debugWorker.')
         jobStore = self.getJobStore(config.jobStore)
         if not config.restart:
             config.workflowAttemptNumber = 0
@@ -717,6 +841,10 @@ class Toil(object):
             config.setOptions(self.options)
             config.workflowAttemptNumber += 1
             jobStore.writeConfig()
+        if config.peerCache:
+            # FIXME Can't do this at the top because of loopy (circular) import errors
+            from toil.peerCache import PeerCache
+            PeerCache.createToken(jobStore)
         self.config = config
         self._jobStore = jobStore
         self._inContextManager = True
@@ -851,6 +979,9 @@ class Toil(object):
         elif name == 'google':
             from toil.jobStores.googleJobStore import GoogleJobStore
             return GoogleJobStore(rest)
+        elif name == 'mem':
+            from toil.jobStores.memoryJobStore import MemoryJobStore
+            return MemoryJobStore(rest)
         else:
             raise RuntimeError("Unknown job store implementation '%s'" % name)
 
@@ -975,6 +1106,26 @@ class Toil(object):
         self._assertContextManagerUsed()
         self._jobStore.exportFile(jobStoreFileID, dstUrl)
 
+    def importFiles(self, srcUrls):
+        """
+        Imports the files at the given URLs into the job store concurrently.
+
+        See :func:`toil.jobStores.abstractJobStore.AbstractJobStore.importFiles` for a
+        full description
+        """
+        self._assertContextManagerUsed()
+        return self._jobStore.importFiles(srcUrls)
+
+    def exportFiles(self, pairs):
+        """
+        Exports files to the destinations pointed at by the given URLs concurrently.
+
+        See :func:`toil.jobStores.abstractJobStore.AbstractJobStore.exportFiles` for a
+        full description
+        """
+        self._assertContextManagerUsed()
+        return self._jobStore.exportFiles(pairs)
+
     def _setBatchSystemEnvVars(self):
         """
         Sets the environment variables required by the job store and those passed on command line.
@@ -1303,29 +1454,21 @@ def cacheDirName(workflowID):
 def getDirSizeRecursively(dirPath):
     """
     This method will return the cumulative number of bytes occupied by the files
-    on disk in the directory and its subdirectories.
+    on disk in the directory and its subdirectories. Files with several hard
+    links in the directory are counted once.
 
-    This method will raise a 'subprocess.CalledProcessError' if it is unable to
-    access a folder or file because of insufficient permissions.  Therefore this
-    method should only be called on the jobStore, and will alert the user if some
-    portion is inaccessible.  Everything in the jobStore should have appropriate
+    This method will raise an OSError if it is unable to access a folder or
+    file because of insufficient permissions.  Therefore this method should only
+    be called on the jobStore, and will alert the user if some portion is
+    inaccessible.  Everything in the jobStore should have appropriate
     permissions as there is no way to read the filesize without permissions.
 
-    The environment variable 'BLOCKSIZE'='512' is set instead of the much cleaner
-    --block-size=1 because Apple can't handle it.
-
     :param str dirPath: A valid path to a directory or file.
     :return: Total size, in bytes, of the file or directory at dirPath.
     """
-
-    # du is often faster than using os.lstat(), sometimes significantly so.
-
-    # The call: 'du -s /some/path' should give the number of 512-byte blocks
-    # allocated with the environment variable: BLOCKSIZE='512' set, and we
-    # multiply this by 512 to return the filesize in bytes.
-    return int(subprocess.check_output(['du', '-s', dirPath],
-                                       env=dict(os.environ, BLOCKSIZE='512')).split()[0].decode(
-        'ascii')) * 512
+    # Scanning the directory in-process is much cheaper than forking du, particularly for jobs
+    # that leave few files behind, which is the common case.
+    return getDirSize(dirPath)
 
 
 def getFileSystemSize(dirPath):
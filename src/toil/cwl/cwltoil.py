@@ -338,6 +338,27 @@ def uploadFile(uploadfunc, fileindex, existing, uf, skip_broken=False):
                                uf["location"])
 
 
+def collectImport(fileindex, srcUrls, uf):
+    """Add the location of a file object to srcUrls if uploadFile would import it."""
+
+    location = uf["location"]
+    if (location and not location.startswith("toilfs:") and not location.startswith("_:")
+            and location not in fileindex and os.path.isfile(location[7:])):
+        srcUrls.append(location)
+
+
+def importCollected(imported, importFunc, url):
+    """Look up a file imported by Toil.importFiles, importing it with importFunc if it wasn't."""
+
+    fileID = imported.get(url)
+    if fileID is None:
+        return importFunc(url)
+    elif isinstance(fileID, Exception):
+        raise fileID
+    else:
+        return fileID
+
+
 def writeGlobalFileWrapper(fileStore, fileuri):
     """Wrap writeGlobalFile to accepts file:// URIs"""
     return fileStore.writeGlobalFile(schema_salad.ref_resolver.uri_file_path(fileuri))
@@ -1025,8 +1046,13 @@ def main(args=None, stdout=sys.stdout):
                 adjustDirObjs(tool, functools.partial(get_listing,
                                                       cwltool.stdfsaccess.StdFsAccess(""),
                                                       recursive=True))
+                # Import the files concurrently before pointing the file objects at them
+                srcUrls = []
+                adjustFileObjs(tool, functools.partial(collectImport, fileindex, srcUrls))
+                importFunc = functools.partial(importCollected, toil.importFiles(srcUrls),
+                                               toil.importFile)
                 adjustFileObjs(tool, functools.partial(uploadFile,
-                                                       toil.importFile,
+                                                       importFunc,
                                                        fileindex, existing, skip_broken=True))
 
             t.visit(importFiles)
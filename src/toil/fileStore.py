@@ -29,6 +29,7 @@ from collections import namedtuple, defaultdict
 import dill
 import errno
 import logging
+import mmap
 import os
 import shutil
 import stat
@@ -48,6 +49,7 @@ from six.moves import xrange
 
 from toil.lib.humanize import bytes2human
 from toil.common import cacheDirName, getDirSizeRecursively, getFileSystemSize
+from toil.lib.diskUsage import DiskUsageTracker
 from toil.lib.bioio import makePublicDir
 from toil.resource import ModuleDescriptor
 from future.utils import with_metaclass
@@ -117,12 +119,70 @@ class FileStore(with_metaclass(ABCMeta, object)):
         self.loggingMessages = []
         self.filesToDelete = set()
         self.jobsToDelete = set()
+        # Tracks the disk usage of the job's local temp dir while the job runs
+        self.diskUsage = None
+        # Whether the job was seen using more disk than it requested
+        self.diskExceeded = False
 
     @staticmethod
     def createFileStore(jobStore, jobGraph, localTempDir, inputBlockFn, caching):
         fileStoreCls = CachingFileStore if caching else NonCachingFileStore
         return fileStoreCls(jobStore, jobGraph, localTempDir, inputBlockFn)
 
+    # How often, in seconds, the disk usage of a running job is compared to its disk requirement
+    diskCheckInterval = 30
+
+    @contextmanager
+    def _trackDiskUsage(self, job):
+        """
+        Track the disk space used in the job's local temp dir while the job runs and warn the
+        leader as soon as the job exceeds its disk requirement. Files created by the user are
+        picked up by watching the directory, where supported, so the periodic checks don't have
+        to scan the directory.
+
+        :param toil.job.Job job: The job instance of the toil job to run.
+        """
+        self.diskUsage = DiskUsageTracker(self.localTempDir)
+        stop = Event()
+
+        def check():
+            try:
+                while not stop.wait(self.diskCheckInterval):
+                    diskUsed = self.diskUsage.getUsage()
+                    if diskUsed > job.disk:
+                        self.diskExceeded = True
+                        self.logToMaster("Job {jobName} is using {humanDisk}B [{disk}B] of disk "
+                                         "while running, more than the {humanRequestedDisk}B "
+                                         "[{requestedDisk}B] it requested.".format(
+                                             jobName=self.jobName,
+                                             humanDisk=bytes2human(diskUsed),
+                                             disk=diskUsed,
+                                             humanRequestedDisk=bytes2human(job.disk),
+                                             requestedDisk=job.disk),
+                                         level=logging.WARNING)
+                        return
+            except:
+                logger.exception('Failed to check the disk usage of job %s.', self.jobName)
+
+        monitor = Thread(target=check)
+        monitor.daemon = True
+        monitor.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            monitor.join()
+            self.diskUsage.stop()
+            self.diskUsage = None
+
+    def _updateDiskUsage(self, localFilePath):
+        """
+        Record the current size of a file in the local temp dir, if it still exists, or forget
+        about it otherwise.
+        """
+        if self.diskUsage is not None:
+            self.diskUsage.record(localFilePath)
+
     @abstractmethod
     @contextmanager
     def open(self, job):
@@ -231,6 +291,35 @@ class FileStore(with_metaclass(ABCMeta, object)):
         """
         raise NotImplementedError()
 
+    @contextmanager
+    def readGlobalFileMapped(self, fileStoreID):
+        """
+        Similar to readGlobalFile, but yields a read-only memory map of the file instead of a path
+        to it. Nothing is copied into the address space of the job, pages are faulted in from the
+        local copy as they are accessed.
+
+        The local copy is made by an immutable, cached :meth:`readGlobalFile`, so it is a hard
+        link to the cached copy (or to the job store copy when the FileJobStore is used on the same
+        device). While that link exists the cached copy is considered in use and is not evicted.
+        The link is removed by :meth:`deleteLocalFile` or at the end of the job, whichever comes
+        first. An existing mapping stays valid even after that.
+
+        :param toil.fileStore.FileID fileStoreID: job store id for the file
+        :return: a context manager yielding a read-only :class:`mmap.mmap`, or an empty
+                 memoryview if the file is empty. The map is closed on exit.
+        """
+        localFilePath = self.readGlobalFile(fileStoreID, cache=True, mutable=False)
+        with open(localFilePath, 'rb') as fileHandle:
+            if os.fstat(fileHandle.fileno()).st_size == 0:
+                # mmap refuses to map empty files
+                yield memoryview(b'')
+                return
+            mapped = mmap.mmap(fileHandle.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mapped
+        finally:
+            mapped.close()
+
     @abstractmethod
     def deleteLocalFile(self, fileStoreID):
         """
@@ -255,9 +344,15 @@ class FileStore(with_metaclass(ABCMeta, object)):
     def importFile(self, srcUrl, sharedFileName=None):
         return self.jobStore.importFile(srcUrl, sharedFileName=sharedFileName)
 
+    def importFiles(self, srcUrls):
+        return self.jobStore.importFiles(srcUrls)
+
     def exportFile(self, jobStoreFileID, dstUrl):
         raise NotImplementedError()
 
+    def exportFiles(self, pairs):
+        raise NotImplementedError()
+
     # A utility method for accessing filenames
     def _resolveAbsoluteLocalPath(self, filePath):
         """
@@ -466,6 +561,18 @@ class CachingFileStore(FileStore):
         # Now that we've setup all the required variables, setup the cache directory for the
         # job if required.
         self._setupCache()
+        # Lets this node download files from the caches of other nodes and vice versa
+        self.peerCache = None
+        config = self.jobStore.config
+        if config.peerCache:
+            # FIXME Can't do this at the top because of loopy (circular) import errors
+            from toil.peerCache import PeerCache, getPrivateIP
+            host = config.peerCacheHost or getPrivateIP()
+            if host is None:
+                logger.warn('This node has no private address to serve its cache to peers on, '
+                            'not using the peer cache.')
+            else:
+                self.peerCache = PeerCache(self.jobStore, self.localCacheDir, host)
 
     @contextmanager
     def open(self, job):
@@ -494,7 +601,8 @@ class CachingFileStore(FileStore):
         self.cleanCache(jobReqs)
         try:
             os.chdir(self.localTempDir)
-            yield
+            with self._trackDiskUsage(job):
+                yield
         finally:
             diskUsed = getDirSizeRecursively(self.localTempDir)
             logString = ("Job {jobName} used {percent:.2f}% ({humanDisk}B [{disk}B] used, "
@@ -508,6 +616,7 @@ class CachingFileStore(FileStore):
                                            requestedDisk=jobReqs))
             self.logToMaster(logString, level=logging.DEBUG)
             if diskUsed > jobReqs:
+                self.diskExceeded = True
                 self.logToMaster("Job used more disk than requested. Please reconsider modifying "
                                  "the user script to avoid the chance  of failure due to "
                                  "incorrectly requested resources. " + logString,
@@ -618,6 +727,9 @@ class CachingFileStore(FileStore):
                                '%s' % fileStoreID)
         # Get the name of the file as it would be in the cache
         cachedFileName = self.encodedFileID(fileStoreID)
+        # If the job store deduplicates files, a file with the same content may have been
+        # cached under a different ID.
+        contentHash = self.jobStore.getFileContentHash(fileStoreID) if cache else None
         # setup the harbinger variable for the file.  This is an identifier that the file is
         # currently being downloaded by another job and will be in the cache shortly. It is used
         # to prevent multiple jobs from simultaneously downloading the same file from the file
@@ -638,7 +750,13 @@ class CachingFileStore(FileStore):
         # First check whether the file is in cache.  If it is, then hardlink the file to
         # userPath. Cache operations can only occur on local files.
         with self.cacheLock() as lockFileHandle:
-            if fileIsLocal and self._fileIsCached(fileStoreID):
+            if fileIsLocal and not self._fileIsCached(fileStoreID) and contentHash is not None:
+                contentIndexFile = self._contentIndexFile(contentHash)
+                if os.path.exists(contentIndexFile):
+                    logger.debug('CACHE: Found cached file with the content of file with ID '
+                                 '\'%s\'.' % fileStoreID)
+                    cachedFileName = os.readlink(contentIndexFile)
+            if fileIsLocal and os.path.exists(cachedFileName):
                 logger.debug('CACHE: Cache hit on file with ID \'%s\'.' % fileStoreID)
                 assert not os.path.exists(localFilePath)
                 if mutable:
@@ -680,8 +798,11 @@ class CachingFileStore(FileStore):
                     # Use try:finally: so that the .harbinger file is removed whether the
                     # download succeeds or not.
                     try:
-                        self.jobStore.readFile(fileStoreID,
-                                               '/.'.join(os.path.split(cachedFileName)))
+                        if not (self.peerCache is not None and self.peerCache.download(
+                                fileStoreID, cachedFileName,
+                                '/.'.join(os.path.split(cachedFileName)))):
+                            self.jobStore.readFile(fileStoreID,
+                                                   '/.'.join(os.path.split(cachedFileName)))
                     except:
                         if os.path.exists('/.'.join(os.path.split(cachedFileName))):
                             os.remove('/.'.join(os.path.split(cachedFileName)))
@@ -692,6 +813,11 @@ class CachingFileStore(FileStore):
                         if os.path.exists('/.'.join(os.path.split(cachedFileName))):
                             os.rename('/.'.join(os.path.split(cachedFileName)), cachedFileName)
                             self.addToCache(localFilePath, fileStoreID, 'read', mutable)
+                            if contentHash is not None:
+                                self._indexCachedContent(contentHash, cachedFileName)
+                            # Unless the cache had to evict it right away, share the file
+                            if self.peerCache is not None and os.path.exists(cachedFileName):
+                                self.peerCache.advertise(fileStoreID, cachedFileName, contentHash)
                             # We don't need to return the file size here because addToCache
                             # already does it for us
                     finally:
@@ -721,6 +847,7 @@ class CachingFileStore(FileStore):
                             self._accountForNlinkEquals2(localFilePath)
                         self._JobState.updateJobSpecificFiles(self, fileStoreID, localFilePath,
                                                               0.0, False)
+        self._updateDiskUsage(localFilePath)
         return localFilePath
 
     def exportFile(self, jobStoreFileID, dstUrl):
@@ -730,6 +857,14 @@ class CachingFileStore(FileStore):
             time.sleep(1)
         self.jobStore.exportFile(jobStoreFileID, dstUrl)
 
+    def exportFiles(self, pairs):
+        pairs = list(pairs)
+        while any(jobStoreFileID in self._pendingFileWrites for jobStoreFileID, _ in pairs):
+            # Some of the files are still being written to the job store - wait for this to
+            # finish prior to exporting them
+            time.sleep(1)
+        return self.jobStore.exportFiles(pairs)
+
     def readGlobalFileStream(self, fileStoreID):
         if fileStoreID in self.filesToDelete:
             raise RuntimeError(
@@ -774,6 +909,7 @@ class CachingFileStore(FileStore):
                     if len(allOwnedFiles[fileToDelete]) == 1:
                         try:
                             os.remove(fileToDelete)
+                            self._updateDiskUsage(fileToDelete)
                         except OSError as err:
                             if err.errno == errno.ENOENT and fileSize == -1:
                                 logger.debug('%s was read mutably and deleted by the user',
@@ -797,6 +933,7 @@ class CachingFileStore(FileStore):
                 # Remove the file and return file size to the job
                 if len(allOwnedFiles[fileToDelete]) == 1:
                     os.remove(fileToDelete)
+                    self._updateDiskUsage(fileToDelete)
                 cacheInfo.sigmaJob += fileSize
                 filesToDelete.pop(fileToDelete)
                 allOwnedFiles[fileToDelete].remove(fileStoreID)
@@ -838,6 +975,9 @@ class CachingFileStore(FileStore):
         cachedFile = self.encodedFileID(fileStoreID)
         if os.path.exists(cachedFile):
             self.removeSingleCachedFile(fileStoreID)
+        # Peers must not be pointed to copies of a deleted file
+        if self.peerCache is not None:
+            self.peerCache.deleteIndexes(self.jobStore, [fileStoreID])
         # Add the file to the list of files to be deleted once the run method completes.
         self.filesToDelete.add(fileStoreID)
         self.logToMaster('Added file with ID \'%s\' to the list of files to be' % fileStoreID +
@@ -955,6 +1095,33 @@ class CachingFileStore(FileStore):
         """
         return os.path.exists(self.encodedFileID(jobStoreFileID))
 
+    def _contentIndexFile(self, contentHash):
+        """
+        Returns the path of the hidden symlink in the cache that points to a cached file with
+        the given content hash. The link dangles once that file has been evicted.
+
+        :param str contentHash: A hash returned by the job store's getFileContentHash()
+        :rtype: str
+        """
+        return os.path.join(self.localCacheDir, '_sha256-' + contentHash)
+
+    def _indexCachedContent(self, contentHash, cachedFile):
+        """
+        Records the given cached file as holding the content with the given hash so that reads
+        of other files with the same content can be served from it.
+
+        :param str contentHash: A hash returned by the job store's getFileContentHash()
+        :param str cachedFile: Path to the cached file
+        """
+        contentIndexFile = self._contentIndexFile(contentHash)
+        with self.cacheLock():
+            if not os.path.exists(cachedFile) or os.path.exists(contentIndexFile):
+                return
+            if os.path.lexists(contentIndexFile):
+                # Replace the link to an evicted file
+                os.remove(contentIndexFile)
+            os.symlink(cachedFile, contentIndexFile)
+
     def decodedFileID(self, cachedFilePath):
         """
         Decode a cached fileName back to a job store file ID.
@@ -1187,7 +1354,10 @@ class CachingFileStore(FileStore):
     def setNlinkThreshold(self):
         # FIXME Can't do this at the top because of loopy (circular) import errors
         from toil.jobStores.fileJobStore import FileJobStore
+        # A deduplicating or compressing FileJobStore hands out copies instead of links, see its
+        # readFile(). The cache then holds the uncompressed content.
         if (isinstance(self.jobStore, FileJobStore) and
+                    self.jobStore._canLinkFiles() and
                     os.stat(os.path.dirname(self.localCacheDir)).st_dev == os.stat(
                     self.jobStore.jobStoreDir).st_dev):
             self.nlinkThreshold = 2
@@ -1531,10 +1701,10 @@ class CachingFileStore(FileStore):
                 self.jobStore.update(self.jobGraph)
 
                 # Delete any remnant jobs
-                list(map(self.jobStore.delete, self.jobsToDelete))
+                self.jobStore.deleteMany(list(self.jobsToDelete))
 
                 # Delete any remnant files
-                list(map(self.jobStore.deleteFile, self.filesToDelete))
+                self.jobStore.deleteFiles(list(self.filesToDelete))
 
                 # Remove the files to delete list, having successfully removed the files
                 if len(self.filesToDelete) > 0:
@@ -1617,7 +1787,8 @@ class NonCachingFileStore(FileStore):
                            self.jobName)
         try:
             os.chdir(self.localTempDir)
-            yield
+            with self._trackDiskUsage(job):
+                yield
         finally:
             diskUsed = getDirSizeRecursively(self.localTempDir)
             logString = ("Job {jobName} used {percent:.2f}% ({humanDisk}B [{disk}B] used, "
@@ -1631,6 +1802,7 @@ class NonCachingFileStore(FileStore):
                                            requestedDisk=jobReqs))
             self.logToMaster(logString, level=logging.DEBUG)
             if diskUsed > jobReqs:
+                self.diskExceeded = True
                 self.logToMaster("Job used more disk than requested. Consider modifying the user "
                                  "script to avoid the chance of failure due to incorrectly "
                                  "requested resources. " + logString, level=logging.WARNING)
@@ -1660,6 +1832,7 @@ class NonCachingFileStore(FileStore):
 
         self.jobStore.readFile(fileStoreID, localFilePath, symlink=symlink)
         self.localFileMap[fileStoreID].append(localFilePath)
+        self._updateDiskUsage(localFilePath)
         return localFilePath
 
     @contextmanager
@@ -1670,6 +1843,9 @@ class NonCachingFileStore(FileStore):
     def exportFile(self, jobStoreFileID, dstUrl):
         self.jobStore.exportFile(jobStoreFileID, dstUrl)
 
+    def exportFiles(self, pairs):
+        return self.jobStore.exportFiles(pairs)
+
     def deleteLocalFile(self, fileStoreID):
         try:
             localFilePaths = self.localFileMap.pop(fileStoreID)
@@ -1678,6 +1854,7 @@ class NonCachingFileStore(FileStore):
         else:
             for localFilePath in localFilePaths:
                 os.remove(localFilePath)
+                self._updateDiskUsage(localFilePath)
 
     def deleteGlobalFile(self, fileStoreID):
         try:
@@ -1702,9 +1879,9 @@ class NonCachingFileStore(FileStore):
             # Complete the job
             self.jobStore.update(self.jobGraph)
             # Delete any remnant jobs
-            list(map(self.jobStore.delete, self.jobsToDelete))
+            self.jobStore.deleteMany(list(self.jobsToDelete))
             # Delete any remnant files
-            list(map(self.jobStore.deleteFile, self.filesToDelete))
+            self.jobStore.deleteFiles(list(self.filesToDelete))
             # Remove the files to delete list, having successfully removed the files
             if len(self.filesToDelete) > 0:
                 self.jobGraph.filesToDelete = []
@@ -22,9 +22,11 @@ from builtins import str
 from builtins import object
 from builtins import super
 import collections
+import hashlib
 import importlib
 import inspect
 import logging
+import numbers
 import os
 import time
 import dill
@@ -41,13 +43,15 @@ from contextlib import contextmanager
 from io import BytesIO
 
 # Python 3 compatibility imports
-from six import iteritems, string_types
+from six import iteritems, itervalues, string_types
 
 from toil.lib.expando import Expando
 from toil.lib.humanize import human2bytes
 
-from toil.common import Toil, addOptions, safeUnpickleFromStream
-from toil.fileStore import DeferredFunction
+from toil.callCache import CallCache
+from toil.common import Toil, addOptions
+from toil.fileStore import DeferredFunction, FileID
+from toil.jobStores.utils import mapConcurrently
 from toil.lib.bioio import (setLoggingFromOptions,
                             getTotalCpuTimeAndMemoryUsage,
                             getTotalCpuTime)
@@ -301,7 +305,8 @@ class Job(BaseJob):
         # defined in a different module.
         self.userModule = ModuleDescriptor.forModule(self.__module__).globalize()
         # Maps index paths into composite return values to lists of IDs of files containing
-        # promised values for those return value items. An index path is a tuple of indices that
+        # promised values for those return value items. All values this job promises to the same
+        # job share a file, which maps the index paths to the values. An index path is a tuple of indices that
         # traverses a nested data structure of lists, dicts, tuples or any other type supporting
         # the __getitem__() protocol.. The special key `()` (the empty tuple) represents the
         # entire return value.
@@ -309,6 +314,8 @@ class Job(BaseJob):
         self._promiseJobStore = None
         self._fileStore = None
         self._tempDir = None
+        # Whether the return value of this job was taken from the call cache, see Job._runner
+        self._callCacheHit = None
 
     def run(self, fileStore):
         """
@@ -471,6 +478,34 @@ class Job(BaseJob):
         else:
             return self.addFollowOn(JobFunctionWrappingJob(fn, *args, **kwargs))
 
+    def addChildMap(self, fn, items, *args, **kwargs):
+        """
+        Adds a child job that calls a function on each of the given items, in chunks of items
+        that are each processed by a child job of its own. This is much cheaper than adding a
+        child job per item with :meth:`.addChildFn`.
+
+        :param fn: Function to be called as ``fn(item, *args, **kwargs)`` for each item. See
+               :class:`toil.job.MapJob` for reserved keyword arguments used to specify the
+               resource requirements of the chunks and their size.
+        :param items: An iterable of the items to call the function on.
+        :return: The new child job. Its return value is the list of the function's return
+                 values, in the order of the items.
+        :rtype: toil.job.MapJob
+        """
+        return self.addChild(MapJob(fn, items, *args, **kwargs))
+
+    def addChildJobMap(self, fn, items, *args, **kwargs):
+        """
+        Like :meth:`.addChildMap` but for a job function, which is called as ``fn(job, item,
+        *args, **kwargs)`` with the job processing the item's chunk as the first argument. See
+        :class:`toil.job.JobFunctionWrappingJob` for a definition of a job function.
+
+        :return: The new child job. Its return value is the list of the function's return
+                 values, in the order of the items.
+        :rtype: toil.job.JobMapJob
+        """
+        return self.addChild(JobMapJob(fn, items, *args, **kwargs))
+
     @property
     def tempDir(self):
         """
@@ -567,9 +602,14 @@ class Job(BaseJob):
         if self._promiseJobStore is None:
             raise RuntimeError('Trying to pass a promise from a promising job that is not a ' +
                                'predecessor of the job receiving the promise')
-        with self._promiseJobStore.writeFileStream() as (fileHandle, jobStoreFileID):
-            promise = UnfulfilledPromiseSentinel(str(self), False)
-            pickle.dump(promise, fileHandle, pickle.HIGHEST_PROTOCOL)
+        promissorFiles = Promise._promissorFiles
+        jobStoreFileID = None if promissorFiles is None else promissorFiles.get(self)
+        if jobStoreFileID is None:
+            with self._promiseJobStore.writeFileStream() as (fileHandle, jobStoreFileID):
+                promise = UnfulfilledPromiseSentinel(str(self), False)
+                pickle.dump(promise, fileHandle, pickle.HIGHEST_PROTOCOL)
+            if promissorFiles is not None:
+                promissorFiles[self] = jobStoreFileID
         self._rvs[path].append(jobStoreFileID)
         return self._promiseJobStore.config.jobStore, jobStoreFileID
 
@@ -926,7 +966,23 @@ class Job(BaseJob):
         :param fileHandle: An open, binary-mode file handle.
         :returns:
         """
-        
+        unpickler = cls._getUnpickler(userModule, fileHandle)
+        runnable = unpickler.load()
+        if not isinstance(runnable, BaseJob):
+            # The job is preceded by the files holding the values promised to it, fetch them all
+            # at once instead of one by one as its promises are unpickled
+            Promise._prefetch(*runnable)
+            runnable = unpickler.load()
+        assert isinstance(runnable, BaseJob)
+        runnable._config = config
+        return runnable
+
+    @staticmethod
+    def _getUnpickler(userModule, fileHandle):
+        """
+        Returns an unpickler for the given file handle that loads symbols referencing the
+        __main__ module from the given userModule instead.
+        """
         def filter_main(module_name, class_name):
             try:
                 if module_name == '__main__':
@@ -940,6 +996,9 @@ class Job(BaseJob):
                     logger.debug('Failed getting %s from module %s.', class_name, module_name)
                 raise
 
+        def persistent_load(persistentID):
+            return _SharedValues.load(persistentID, userModule)
+
         try:
             unpickler = pickle.Unpickler(fileHandle)
             # In Python 2 with cPickle we set "find_global"
@@ -954,11 +1013,8 @@ class Job(BaseJob):
                     return filter_main(module, name)
                     
             unpickler = FilteredUnpickler(fileHandle)
-            
-        runnable = unpickler.load()
-        assert isinstance(runnable, BaseJob)
-        runnable._config = config
-        return runnable
+        unpickler.persistent_load = persistent_load
+        return unpickler
 
     def getUserScript(self):
         return self.userModule
@@ -967,6 +1023,8 @@ class Job(BaseJob):
         """
         Sets the values for promises using the return values from this job's run() function.
         """
+        # Maps the ID of each file to the values it holds, by index path
+        promisedValues = collections.defaultdict(_PromisedValues)
         for path, promiseFileStoreIDs in iteritems(self._rvs):
             if not path:
                 # Note that its possible for returnValues to be a promise, not an actual return
@@ -985,11 +1043,24 @@ class Job(BaseJob):
                     for index in path:
                         promisedValue = promisedValue[index]
             for promiseFileStoreID in promiseFileStoreIDs:
-                # File may be gone if the job is a service being re-run and the accessing job is
-                # already complete.
-                if jobStore.fileExists(promiseFileStoreID):
-                    with jobStore.updateFileStream(promiseFileStoreID) as fileHandle:
-                        pickle.dump(promisedValue, fileHandle, pickle.HIGHEST_PROTOCOL)
+                promisedValues[promiseFileStoreID][path] = promisedValue
+        if not promisedValues:
+            return
+        # Pickle the values here so that the threads only write them
+        promisedValues = [(promiseFileStoreID, pickle.dumps(values, pickle.HIGHEST_PROTOCOL))
+                          for promiseFileStoreID, values in iteritems(promisedValues)]
+
+        def fulfill(item):
+            promiseFileStoreID, data = item
+            # File may be gone if the job is a service being re-run and the accessing job is
+            # already complete.
+            if jobStore.fileExists(promiseFileStoreID):
+                with jobStore.updateFileStream(promiseFileStoreID) as fileHandle:
+                    fileHandle.write(data)
+
+        for _ in mapConcurrently(fulfill, promisedValues,
+                                 min(Promise.transferThreads, len(promisedValues))):
+            pass
 
     # Functions associated with Job.checkJobGraphAcyclic to establish that the job graph does not
     # contain any cycles of dependencies:
@@ -1106,9 +1177,12 @@ class Job(BaseJob):
         getRunOrder(self)
         return ordering
 
-    def _serialiseJob(self, jobStore, jobsToJobGraphs, rootJobGraph):
+    def _serialiseJob(self, jobStore, jobsToJobGraphs, rootJobGraph, sharedValues=None):
         """
         Pickle a job and its jobGraph to disk.
+
+        :param _SharedValues sharedValues: the values shared by the jobs being serialised, which
+               are referenced by the pickle instead of being stored in it
         """
         # Pickle the job so that its run method can be run at a later time.
         # Drop out the children/followOns/predecessors/services - which are
@@ -1119,8 +1193,17 @@ class Job(BaseJob):
         # The pickled job is "run" as the command of the job, see worker
         # for the mechanism which unpickles the job and executes the Job.run
         # method.
+        with Promise._sharingFiles() as promissorFiles:
+            if sharedValues is None:
+                pickledJob = pickle.dumps(self, pickle.HIGHEST_PROTOCOL)
+            else:
+                pickledJob = sharedValues.dumps(self)
         with jobStore.writeFileStream(rootJobGraph.jobStoreID) as (fileHandle, fileStoreID):
-            pickle.dump(self, fileHandle, pickle.HIGHEST_PROTOCOL)
+            if promissorFiles:
+                # Let _unpickle() fetch the promised values before it unpickles the job
+                pickle.dump((jobStore.config.jobStore, sorted(promissorFiles.values())),
+                            fileHandle, pickle.HIGHEST_PROTOCOL)
+            fileHandle.write(pickledJob)
         # Note that getUserScript() may have been overridden. This is intended. If we used
         # self.userModule directly, we'd be getting a reference to job.py if the job was
         # specified as a function (as opposed to a class) since that is where FunctionWrappingJob
@@ -1176,12 +1259,13 @@ class Job(BaseJob):
             assert serviceJob._services == []
             #service = serviceJob.service
 
-            # Pickle the job
-            serviceJob.pickledService = pickle.dumps(serviceJob.service, protocol=pickle.HIGHEST_PROTOCOL)
-            serviceJob.service = None
+            with Promise._sharingFiles():
+                # Pickle the job
+                serviceJob.pickledService = pickle.dumps(serviceJob.service, protocol=pickle.HIGHEST_PROTOCOL)
+                serviceJob.service = None
 
-            # Serialise the service job and job wrapper
-            serviceJob._serialiseJob(jobStore, { serviceJob:serviceJobGraph }, rootJobGraph)
+                # Serialise the service job and job wrapper
+                serviceJob._serialiseJob(jobStore, { serviceJob:serviceJobGraph }, rootJobGraph)
 
             # Restore values
             #serviceJob.service = service
@@ -1211,6 +1295,9 @@ class Job(BaseJob):
         assert len(ordering) == len(jobsToJobGraphs)
 
         with jobStore.batch():
+            # Store the values shared by the jobs that are pickled below once
+            sharedValues = _SharedValues(jobStore, jobGraph.jobStoreID)
+            sharedValues.add(ordering if firstJob else ordering[1:])
             # Temporarily set the jobStore locators for the promise call back functions
             for job in ordering:
                 job.prepareForPromiseRegistration(jobStore)
@@ -1229,7 +1316,7 @@ class Job(BaseJob):
                     # Pickle the services for the job
                     job._serialiseServices(jobStore, jobsToJobGraphs[job], jobGraph)
                     # Now pickle the job
-                    job._serialiseJob(jobStore, jobsToJobGraphs, jobGraph)
+                    job._serialiseJob(jobStore, jobsToJobGraphs, jobGraph, sharedValues)
             else:
                 #We store the return values at this point, because if a return value
                 #is a promise from another job, we need to register the promise
@@ -1240,7 +1327,7 @@ class Job(BaseJob):
                     # Pickle the services for the job
                     job._serialiseServices(jobStore, jobsToJobGraphs[job], jobGraph)
                     # Pickle the job itself
-                    job._serialiseJob(jobStore, jobsToJobGraphs, jobGraph)
+                    job._serialiseJob(jobStore, jobsToJobGraphs, jobGraph, sharedValues)
                 # Pickle any services for the job
                 self._serialiseServices(jobStore, jobGraph, jobGraph)
 
@@ -1317,6 +1404,7 @@ class Job(BaseJob):
             # Else copy them to the job wrapper to delete later
             jobGraph.checkpointFilesToDelete = list(Promise.filesToDelete)
         Promise.filesToDelete.clear()
+        Promise._values.clear()
         # Now indicate the asynchronous update of the job can happen
         fileStore._updateJobWhenDone()
         # Change dir back to cwd dir, if changed by job (this is a safety issue)
@@ -1327,12 +1415,15 @@ class Job(BaseJob):
             totalCpuTime, totalMemoryUsage = getTotalCpuTimeAndMemoryUsage()
             stats.jobs.append(
                 Expando(
+                    start=str(startTime),
                     time=str(time.time() - startTime),
                     clock=str(totalCpuTime - startClock),
                     class_name=self._jobName(),
                     memory=str(totalMemoryUsage)
                 )
             )
+            if self._callCacheHit is not None:
+                stats.jobs[-1].call_cache_hit = self._callCacheHit
 
     def _runner(self, jobGraph, jobStore, fileStore):
         """
@@ -1347,7 +1438,12 @@ class Job(BaseJob):
         # Make fileStore available as an attribute during run() ...
         self._fileStore = fileStore
         # ... but also pass it to run() as an argument for backwards compatibility.
-        returnValues = self._run(jobGraph, fileStore)
+        config = jobStore.config
+        if config.callCache is None or self.checkpoint or isinstance(self, ServiceJob):
+            returnValues = self._run(jobGraph, fileStore)
+        else:
+            returnValues = CallCache(config.callCache).run(self, jobGraph, fileStore,
+                                                           refresh=config.refreshCallCache)
         # Serialize the new jobs defined by the run method to the jobStore
         self._serialiseExistingJob(jobGraph, jobStore, returnValues)
 
@@ -1480,6 +1576,109 @@ class JobFunctionWrappingJob(FunctionWrappingJob):
         return rValue
 
 
+class MapJob(FunctionWrappingJob):
+    """
+    Job used to call a function on each of a list of items. In its `run` method the items are
+    split into chunks and a child job is added for each chunk, which calls the function on the
+    items of the chunk in turn. The return value of the job is the list of the function's return
+    values, in the order of the items. It is gathered by a follow-on of the job.
+
+    The arguments passed to the function along with the item are pickled into a file in the
+    job store once, instead of once for every chunk.
+    """
+    _isJobFunction = False
+
+    maxDefaultChunks = 1000
+    """
+    The maximum number of chunks the items are split into if no chunk size was specified
+    """
+
+    def __init__(self, userFunction, items, *args, **kwargs):
+        """
+        :param callable userFunction: The function to call on each item. It will be called with
+               the item, ``*args`` and ``**kwargs`` as arguments.
+        :param items: An iterable of the items to call the function on.
+
+        The keyword ``chunkSize`` is reserved for the maximum number of items per chunk. It
+        defaults to the number of items divided by :attr:`.maxDefaultChunks`, rounded up. The
+        keywords ``memory``, ``cores``, ``disk`` and ``preemptable`` are reserved for the
+        resource requirements of the jobs processing the chunks, as for
+        :class:`toil.job.FunctionWrappingJob`. This job only adds those jobs and requires few
+        resources. The keywords ``name`` and ``checkpoint`` apply to this job.
+        """
+        self._items = list(items)
+        self._chunkSize = kwargs.pop('chunkSize', None)
+        if self._chunkSize is None:
+            self._chunkSize = max(1, -(-len(self._items) // self.maxDefaultChunks))
+        elif self._chunkSize < 1:
+            raise ValueError('The chunk size must be positive, not %r' % self._chunkSize)
+        self._chunkRequirements = {requirement: kwargs.pop(requirement)
+                                   for requirement in ('memory', 'cores', 'disk', 'preemptable')
+                                   if requirement in kwargs}
+        kwargs.update(disk='1M', memory='32M', cores=0.1)
+        super().__init__(userFunction, *args, **kwargs)
+
+    def run(self, fileStore):
+        if not self._items:
+            return []
+        userFunction = self._getUserFunction()
+        args = pickle.dumps((self._args, self._kwargs), pickle.HIGHEST_PROTOCOL)
+        with fileStore.writeGlobalFileStream() as (fileHandle, argsFileStoreID):
+            fileHandle.write(args)
+        # As a FileID the arguments are hashed by their content for the call cache
+        argsFileStoreID = FileID(argsFileStoreID, len(args))
+        chunkSize = self._chunkSize
+        chunkJobs = [self.addChild(_MapChunkJob(userFunction, self._items[i:i + chunkSize],
+                                                argsFileStoreID, self._isJobFunction,
+                                                **self._chunkRequirements))
+                     for i in range(0, len(self._items), chunkSize)]
+        return self.addFollowOnJobFn(_gatherChunkResults, [job.rv() for job in chunkJobs],
+                                     argsFileStoreID, disk='1M', memory='32M', cores=0.1).rv()
+
+
+class JobMapJob(MapJob):
+    """
+    Job used to call a job function on each of a list of items. The job function is called with
+    the job processing the item's chunk as the first argument, otherwise this is the same as
+    :class:`toil.job.MapJob`.
+    """
+    _isJobFunction = True
+
+
+class _MapChunkJob(FunctionWrappingJob):
+    """
+    A job that calls a function on a chunk of the items of a :class:`toil.job.MapJob`.
+    """
+    def __init__(self, userFunction, items, argsFileStoreID, isJobFunction, **kwargs):
+        super().__init__(userFunction, **kwargs)
+        self._items = items
+        self._argsFileStoreID = argsFileStoreID
+        self._isJobFunction = isJobFunction
+
+    @property
+    def fileStore(self):
+        return self._fileStore
+
+    def run(self, fileStore):
+        userFunction = self._getUserFunction()
+        with fileStore.readGlobalFileStream(self._argsFileStoreID) as fileHandle:
+            args, kwargs = self._getUnpickler(self._loadUserModule(self.userFunctionModule),
+                                              fileHandle).load()
+        if self._isJobFunction:
+            return [userFunction(self, item, *args, **kwargs) for item in self._items]
+        else:
+            return [userFunction(item, *args, **kwargs) for item in self._items]
+
+
+def _gatherChunkResults(job, chunkResults, argsFileStoreID):
+    """
+    Concatenates the results of the chunks of a :class:`toil.job.MapJob` and deletes the file
+    holding the arguments shared by the chunks.
+    """
+    job.fileStore.deleteGlobalFile(argsFileStoreID)
+    return [result for results in chunkResults for result in results]
+
+
 class PromisedRequirementFunctionWrappingJob(FunctionWrappingJob):
     """
     Handles dynamic resource allocation using :class:`toil.job.Promise` instances.
@@ -1660,13 +1859,6 @@ class ServiceJob(Job):
             #of a file
             assert self.jobGraph.terminateJobStoreID != None
             while True:
-                # Check for the terminate signal
-                if not fileStore.jobStore.fileExists(self.jobGraph.terminateJobStoreID):
-                    logger.debug("Detected that the terminate jobStoreID has been removed so exiting")
-                    if not fileStore.jobStore.fileExists(self.jobGraph.errorJobStoreID):
-                        raise RuntimeError("Detected the error jobStoreID has been removed so exiting with an error")
-                    break
-
                 # Check the service's status and exit if failed or complete
                 try:
                     if not service.check():
@@ -1676,7 +1868,14 @@ class ServiceJob(Job):
                     logger.debug("Detected termination of the service")
                     raise
 
-                time.sleep(fileStore.jobStore.config.servicePollingInterval) #Avoid excessive polling
+                # Wait for the terminate signal until the service is due to be checked again
+                if fileStore.jobStore.waitForFileDeletion(
+                        self.jobGraph.terminateJobStoreID,
+                        timeout=fileStore.jobStore.config.servicePollingInterval):
+                    logger.debug("Detected that the terminate jobStoreID has been removed so exiting")
+                    if not fileStore.jobStore.fileExists(self.jobGraph.errorJobStoreID):
+                        raise RuntimeError("Detected the error jobStoreID has been removed so exiting with an error")
+                    break
 
             # Remove link to the jobGraph
             self.jobGraph = None
@@ -1727,6 +1926,24 @@ class Promise(object):
     """
     A set of IDs of files containing promised values when we know we won't need them anymore
     """
+
+    transferThreads = 16
+    """
+    The maximum number of files containing promised values that are written or read concurrently
+    """
+
+    _values = {}
+    """
+    Maps the IDs of files containing promised values that were read by the current process to
+    the pickled content of the file, or to the unpickled values once a promise referencing the
+    file was resolved
+    """
+
+    _promissorFiles = None
+    """
+    While promises are pickled as part of a promissee, maps each promissor to the file that holds
+    all values it promised to that promissee. See :meth:`._sharingFiles`.
+    """
     def __init__(self, job, path):
         """
         :param Job job: the job whose return value this promise references
@@ -1749,11 +1966,13 @@ class Promise(object):
         jobStoreLocator, jobStoreFileID = self.job.registerPromise(self.path)
         # Returning a class object here causes the pickling machinery to attempt to instantiate
         # the class. We will catch that with __new__ and return an the actual return value instead.
-        return self.__class__, (jobStoreLocator, jobStoreFileID)
+        return self.__class__, (jobStoreLocator, jobStoreFileID, self.path)
 
     @staticmethod
     def __new__(cls, *args):
-        assert len(args) == 2
+        # Promises pickled by older versions of Toil don't have a path, the file they reference
+        # holds just the promised value
+        assert len(args) in (2, 3)
         if isinstance(args[0], Job):
             # Regular instantiation when promise is created, before it is being pickled
             return super().__new__(cls)
@@ -1762,17 +1981,231 @@ class Promise(object):
             return cls._resolve(*args)
 
     @classmethod
-    def _resolve(cls, jobStoreLocator, jobStoreFileID):
+    @contextmanager
+    def _sharingFiles(cls):
+        """
+        A context manager in which all promises by the same promissor that are pickled share a
+        single file in the job store. Pickle only one promissee in it, to which it yields a dict
+        mapping each promissor to the ID of that file. Nested uses yield the same dict.
+        """
+        if cls._promissorFiles is not None:
+            yield cls._promissorFiles
+        else:
+            cls._promissorFiles = {}
+            try:
+                yield cls._promissorFiles
+            finally:
+                cls._promissorFiles = None
+
+    @classmethod
+    def _loadJobStore(cls, jobStoreLocator):
         # Initialize the cached job store if it was never initialized in the current process or
         # if it belongs to a different workflow that was run earlier in the current process.
         if cls._jobstore is None or cls._jobstore.config.jobStore != jobStoreLocator:
             cls._jobstore = Toil.resumeJobStore(jobStoreLocator)
+        return cls._jobstore
+
+    @classmethod
+    def _prefetch(cls, jobStoreLocator, jobStoreFileIDs):
+        """
+        Concurrently read the given files containing promised values, so that resolving the
+        promises referencing them doesn't have to.
+        """
+        jobStore = cls._loadJobStore(jobStoreLocator)
+        jobStoreFileIDs = [jobStoreFileID for jobStoreFileID in jobStoreFileIDs
+                           if jobStoreFileID not in cls._values]
+
+        def read(jobStoreFileID):
+            with jobStore.readFileStream(jobStoreFileID) as fileHandle:
+                return jobStoreFileID, fileHandle.read()
+
+        if jobStoreFileIDs:
+            # The contents are unpickled in this thread, when they are needed
+            cls._values.update(mapConcurrently(read, jobStoreFileIDs,
+                                               min(cls.transferThreads, len(jobStoreFileIDs))))
+
+    @classmethod
+    def _resolve(cls, jobStoreLocator, jobStoreFileID, path=None):
         cls.filesToDelete.add(jobStoreFileID)
-        with cls._jobstore.readFileStream(jobStoreFileID) as fileHandle:
+        values = cls._values.get(jobStoreFileID)
+        if values is None:
+            with cls._loadJobStore(jobStoreLocator).readFileStream(jobStoreFileID) as fileHandle:
+                values = fileHandle.read()
+        if isinstance(values, bytes):
             # If this doesn't work then the file containing the promise may not exist or be
             # corrupted
-            value = safeUnpickleFromStream(fileHandle)
-            return value
+            values = pickle.loads(values)
+            if path is None:
+                # A promise pickled by an older version of Toil has a file of its own, which
+                # holds just the promised value if it was fulfilled by an older version, too
+                if isinstance(values, _PromisedValues):
+                    value, = itervalues(values)
+                    return value
+                return values
+            cls._values[jobStoreFileID] = values
+        return values[path]
+
+
+class _PromisedValues(dict):
+    """
+    The promised values held by a file in the job store, by index path. A distinct type so that
+    such a file can be told apart from one that holds a single promised value that is a dict.
+    """
+
+
+class _SharedValues(object):
+    """
+    Stores large values that are referenced by several of the jobs being serialised together,
+    the arguments shared by the children of a job for example, in the job store once instead of
+    in the pickle of each of those jobs. The pickles reference the stored values by their
+    persistent IDs instead, which consist of the job store locator and the ID of the file holding
+    the value.
+
+    The values considered are those of the attributes of the jobs and, if such a value is a
+    list, tuple or dict, its items. Values that contain a promise are never shared, since a
+    promised value is resolved exactly once.
+    """
+    sizeThreshold = 16 * 1024
+    """
+    The minimum size in bytes of the pickle of a value for it to be stored on its own
+    """
+
+    cacheSize = 256 * 1024 * 1024
+    """
+    The maximum number of bytes of pickled values that are kept in memory after loading them, so
+    that the jobs run by the same process don't each have to read them from the job store
+    """
+
+    _cache = collections.OrderedDict()
+    """
+    Maps the IDs of the files holding the most recently loaded values to the pickled values, in
+    the order in which they were last used
+    """
+
+    _cachedBytes = 0
+
+    class _UnsharableValue(Exception):
+        pass
+
+    def __init__(self, jobStore, jobStoreID):
+        """
+        :param toil.jobStores.abstractJobStore.AbstractJobStore jobStore: the job store to store
+               the values in
+        :param str jobStoreID: the ID of the job the files holding the values belong to, they
+               are deleted along with it
+        """
+        self.jobStore = jobStore
+        self.jobStoreID = jobStoreID
+        # Maps the id() of each shared value to its persistent ID
+        self.persistentIDs = {}
+        # Keeps the shared values alive so that their id() isn't reused
+        self.values = []
+
+    def add(self, jobs):
+        """
+        Store the values referenced by more than one of the given jobs whose pickle is at least
+        :attr:`sizeThreshold` bytes large. Equal values are stored only once.
+        """
+        # Maps the id() of each candidate value to the value and the number of jobs referencing it
+        candidates = {}
+        for job in jobs:
+            referenced = {}
+            for value in self._getCandidates(job):
+                referenced[id(value)] = value
+            for key, value in iteritems(referenced):
+                candidates.setdefault(key, [value, 0])[1] += 1
+        fileIDsByDigest = {}
+        for key, (value, numJobs) in iteritems(candidates):
+            if numJobs < 2:
+                continue
+            try:
+                pickledValue = self._dumpValue(value)
+            except self._UnsharableValue:
+                continue
+            if len(pickledValue) < self.sizeThreshold:
+                continue
+            digest = hashlib.sha1(pickledValue).digest()
+            fileID = fileIDsByDigest.get(digest)
+            if fileID is None:
+                with self.jobStore.writeFileStream(self.jobStoreID) as (fileHandle, fileID):
+                    fileHandle.write(pickledValue)
+                fileIDsByDigest[digest] = fileID
+            self.persistentIDs[key] = (self.jobStore.config.jobStore, fileID)
+            self.values.append(value)
+
+    # The attributes that link a job to other jobs or to the job store, they aren't pickled
+    _ignoredAttributes = frozenset(('_children', '_followOns', '_services', '_directPredecessors',
+                                    '_promiseJobStore', '_fileStore'))
+
+    @classmethod
+    def _getCandidates(cls, job):
+        for name, value in iteritems(vars(job)):
+            if name in cls._ignoredAttributes:
+                continue
+            if isinstance(value, (list, tuple)):
+                items = value
+            elif isinstance(value, dict):
+                items = itervalues(value)
+            else:
+                items = ()
+            for item in items:
+                if not isinstance(item, (numbers.Number, type(None))):
+                    yield item
+            if not isinstance(value, (numbers.Number, type(None))):
+                yield value
+
+    def _dumpValue(self, value):
+        def persistent_id(obj):
+            if isinstance(obj, (Promise, Job)):
+                raise self._UnsharableValue()
+            return None
+
+        buf = BytesIO()
+        pickler = pickle.Pickler(buf, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+        pickler.dump(value)
+        return buf.getvalue()
+
+    def dumps(self, job):
+        """
+        Pickle the given job, referencing the shared values it holds instead of including them.
+
+        :rtype: bytes
+        """
+        persistentIDs = self.persistentIDs
+
+        def persistent_id(obj):
+            return persistentIDs.get(id(obj))
+
+        buf = BytesIO()
+        pickler = pickle.Pickler(buf, pickle.HIGHEST_PROTOCOL)
+        if persistentIDs:
+            pickler.persistent_id = persistent_id
+        pickler.dump(job)
+        return buf.getvalue()
+
+    @classmethod
+    def load(cls, persistentID, userModule):
+        """
+        Load the shared value with the given persistent ID.
+        """
+        jobStoreLocator, jobStoreFileID = persistentID
+        pickledValue = cls._cache.pop(jobStoreFileID, None)
+        if pickledValue is None:
+            jobStore = Promise._loadJobStore(jobStoreLocator)
+            with jobStore.readFileStream(jobStoreFileID) as fileHandle:
+                pickledValue = fileHandle.read()
+        else:
+            cls._cachedBytes -= len(pickledValue)
+        if len(pickledValue) <= cls.cacheSize:
+            # Insert it as the most recently used value and evict the least recently used ones
+            cls._cache[jobStoreFileID] = pickledValue
+            cls._cachedBytes += len(pickledValue)
+            while cls._cachedBytes > cls.cacheSize:
+                _, evicted = cls._cache.popitem(last=False)
+                cls._cachedBytes -= len(evicted)
+        # Every job gets its own copy of the value, they may modify it
+        return Job._getUnpickler(userModule, BytesIO(pickledValue)).load()
 
 
 class PromisedRequirement(object):
@@ -100,11 +100,19 @@ class JobGraph(JobNode):
         # this job
         self.chainedJobs = chainedJobs
 
-    def setupJobAfterFailure(self, config):
+    def setupJobAfterFailure(self, config, exitReason=None, limit=None):
         """
         Reduce the remainingRetryCount if greater than zero and set the memory
         to be at least as big as the default memory (in case of exhaustion of memory,
         which is common).
+
+        If the cause of the failure is known to be the exhaustion of memory or disk, the
+        exhausted requirement is multiplied by config.retryResourceFactor, see
+        :meth:`escalateRequirement`.
+
+        :param str exitReason: a :class:`toil.batchSystems.abstractBatchSystem.BatchJobExitReason`
+               or None if the cause of the failure is unknown
+        :param int limit: the value the exhausted requirement must not exceed
         """
         self.remainingRetryCount = max(0, self.remainingRetryCount - 1)
         logger.warn("Due to failure we are reducing the remaining retry count of job %s with ID %s to %s",
@@ -116,6 +124,24 @@ class JobGraph(JobNode):
             self._memory = config.defaultMemory
             logger.warn("We have increased the default memory of the failed job %s to %s bytes",
                         self, self.memory)
+        if exitReason is not None:
+            self.escalateRequirement(exitReason, config, limit=limit)
+
+    def escalateRequirement(self, requirement, config, limit=None):
+        """
+        Multiply the given requirement by config.retryResourceFactor.
+
+        :param str requirement: 'memory' or 'disk'
+        :param int limit: the value not to exceed, by default config.maxMemory or config.maxDisk
+        """
+        value = getattr(self, requirement)
+        if limit is None:
+            limit = getattr(config, 'max' + requirement.capitalize())
+        newValue = min(int(value * config.retryResourceFactor), limit)
+        if newValue > value:
+            setattr(self, '_' + requirement, newValue)
+            logger.warn("The failed job %s ran out of %s, increasing its requirement from %s to "
+                        "%s bytes", self, requirement, value, newValue)
 
     def restartCheckpoint(self, jobStore):
         """Restart a checkpoint after the total failure of jobs in its subtree.
@@ -145,18 +171,28 @@ class JobGraph(JobNode):
                 # Delete everything on the stack, as these represent successors to clean
                 # up as we restart the queue
                 def recursiveDelete(jobGraph2):
-                    # Recursive walk the stack to delete all remaining jobs
-                    for jobs in jobGraph2.stack + jobGraph2.services:
-                        for jobNode in jobs:
-                            if jobStore.exists(jobNode.jobStoreID):
-                                recursiveDelete(jobStore.load(jobNode.jobStoreID))
-                            else:
-                                logger.debug("Job %s has already been deleted", jobNode)
+                    # Recursive walk the stack to collect all remaining jobs
+                    jobNodes = [jobNode for jobs in jobGraph2.stack + jobGraph2.services
+                                for jobNode in jobs
+                                if jobNode.jobStoreID not in successorsSeen]
+                    successorsSeen.update(jobNode.jobStoreID for jobNode in jobNodes)
+                    existing = []
+                    for jobNode, exists in zip(jobNodes, jobStore.existsMany(
+                            [jobNode.jobStoreID for jobNode in jobNodes])):
+                        if exists:
+                            existing.append(jobNode.jobStoreID)
+                        else:
+                            logger.debug("Job %s has already been deleted", jobNode)
+                    for successorJobGraph in jobStore.loadMany(existing):
+                        recursiveDelete(successorJobGraph)
                     if jobGraph2 != self:
                         logger.debug("Checkpoint is deleting old successor job: %s", jobGraph2.jobStoreID)
-                        jobStore.delete(jobGraph2.jobStoreID)
                         successorsDeleted.append(jobGraph2.jobStoreID)
+                successorsSeen = set()
                 recursiveDelete(self)
+                # Successors are collected before their predecessors so that, were the deletion
+                # to be interrupted, the remaining jobs would still be reachable
+                jobStore.deleteMany(successorsDeleted)
 
                 self.stack = [ [], [] ] # Initialise the job to mimic the state of a job
                 # that has been previously serialised but which as yet has no successors
@@ -20,8 +20,11 @@ from builtins import map
 from builtins import object
 from builtins import super
 import shutil
+import hashlib
 
 import re
+import threading
+import time
 from abc import ABCMeta, abstractmethod
 from contextlib import contextmanager, closing
 from datetime import timedelta
@@ -37,6 +40,8 @@ from toil.lib.retry import retry_http
 from toil.common import safeUnpickleFromStream
 from toil.fileStore import FileID
 from toil.job import JobException
+from toil.jobStores.serialization import encodeJobGraph
+from toil.jobStores.utils import mapConcurrently
 from toil.lib.memoize import memoize
 from toil.lib.objects import abstractclassmethod
 from future.utils import with_metaclass
@@ -359,6 +364,90 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
         with self.readFileStream(jobStoreFileID) as readable:
             otherCls._writeToUrl(readable, url)
 
+    # The number of files importFiles() and exportFiles() transfer at once
+    importExportThreads = 16
+
+    def _copyForThread(self):
+        """
+        Return an instance of this job store for use by a thread other than the one that created
+        this instance. Job stores whose connections can't be shared between threads return a copy
+        of themselves with connections of its own, the others return themselves.
+
+        :rtype: AbstractJobStore
+        """
+        return self
+
+    def importFiles(self, srcUrls, numThreads=None):
+        """
+        Imports the files at the given URLs into the job store concurrently. Each file is imported
+        like :meth:`.importFile` would, by a server-side copy if the URL points into storage of
+        the same kind as this job store's and by a local copy if both are on the local file
+        system. A failure to import one file does not affect the others.
+
+        :param srcUrls: an iterable of URLs, see :meth:`.importFile` for the supported schemes.
+               Duplicates are imported once.
+
+        :param int numThreads: the number of files to import at once, defaults to
+               :attr:`importExportThreads`
+
+        :return: a dictionary mapping each URL to the ID of the imported file, or to the
+                 exception raised while importing it
+        :rtype: dict[str,FileID|Exception]
+        """
+        def importFile(store, srcUrl):
+            try:
+                return srcUrl, store.importFile(srcUrl)
+            except Exception as e:
+                logger.warning("Failed to import '%s': %s", srcUrl, e)
+                return srcUrl, e
+
+        return self._transferConcurrently(importFile, srcUrls, numThreads)
+
+    def exportFiles(self, pairs, numThreads=None):
+        """
+        Exports files to the destinations pointed at by the given URLs concurrently, like
+        :meth:`.exportFile` would. A failure to export one file does not affect the others.
+
+        :param pairs: an iterable of tuples of the ID of a file in the job store and the URL to
+               export it to, see :meth:`.importFile` for the supported schemes
+
+        :param int numThreads: the number of files to export at once, defaults to
+               :attr:`importExportThreads`
+
+        :return: a dictionary mapping each destination URL to None, or to the exception raised
+                 while exporting to it
+        :rtype: dict[str,None|Exception]
+        """
+        def exportFile(store, pair):
+            jobStoreFileID, dstUrl = pair
+            try:
+                store.exportFile(jobStoreFileID, dstUrl)
+            except Exception as e:
+                logger.warning("Failed to export file '%s' to '%s': %s", jobStoreFileID, dstUrl, e)
+                return dstUrl, e
+            else:
+                return dstUrl, None
+
+        return self._transferConcurrently(exportFile, pairs, numThreads)
+
+    def _transferConcurrently(self, transfer, items, numThreads):
+        # Preserve the order of the items, a listing for example might be sorted for a reason
+        seen = set()
+        items = [item for item in items if not (item in seen or seen.add(item))]
+        if numThreads is None:
+            numThreads = self.importExportThreads
+        numThreads = max(1, min(numThreads, len(items)))
+        local = threading.local()
+
+        def transferInThread(item):
+            try:
+                store = local.store
+            except AttributeError:
+                store = local.store = self._copyForThread()
+            return transfer(store, item)
+
+        return dict(mapConcurrently(transferInThread, items, numThreads))
+
     @abstractclassmethod
     def getSize(cls, url):
         """
@@ -459,7 +548,7 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
                 try:
                     return jobCache[jobId]
                 except KeyError:
-                    self.load(jobId)
+                    return self.load(jobId)
             else:
                 return self.load(jobId)
 
@@ -505,15 +594,17 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
 
         # Cleanup jobs that are not reachable from the root, and therefore orphaned
         jobsToDelete = [x for x in getJobs() if x.jobStoreID not in reachableFromRoot]
+        filesToDelete = []
         for jobGraph in jobsToDelete:
             # clean up any associated files before deletion
             for fileID in jobGraph.filesToDelete:
                 # Delete any files that should already be deleted
                 logger.warn("Deleting file '%s'. It is marked for deletion but has not yet been "
                             "removed.", fileID)
-                self.deleteFile(fileID)
-            # Delete the job
-            self.delete(jobGraph.jobStoreID)
+                filesToDelete.append(fileID)
+        self._deleteMarkedFiles(filesToDelete)
+        # Delete the jobs
+        self.deleteMany([jobGraph.jobStoreID for jobGraph in jobsToDelete])
 
         jobGraphsReachableFromRoot = {id: getJob(id) for id in reachableFromRoot}
 
@@ -533,6 +624,18 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
         for jobID in jobsDeletedByCheckpoints:
             del jobGraphsReachableFromRoot[jobID]
 
+        # Find out which successors and services of the remaining jobs still exist, all at once
+        successorIDs = list({jobNode.jobStoreID
+                             for jobGraph in jobGraphsReachableFromRoot.values()
+                             for jobs in jobGraph.stack + jobGraph.services
+                             for jobNode in jobs})
+        existingIDs = {jobStoreID for jobStoreID, exists
+                       in zip(successorIDs, self.existsMany(successorIDs)) if exists}
+
+        # The files to delete and jobs to update are collected so they can be handled in bulk
+        filesToDelete = []
+        jobsToUpdate = {}
+
         # Clean up jobs that are in reachable from the root
         for jobGraph in jobGraphsReachableFromRoot.values():
             # jobGraphs here are necessarily in reachable from root.
@@ -546,7 +649,7 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
                 for fileID in jobGraph.filesToDelete:
                     logger.critical("Removing file in job store: %s that was "
                                     "marked for deletion but not previously removed" % fileID)
-                    self.deleteFile(fileID)
+                    filesToDelete.append(fileID)
                 jobGraph.filesToDelete = []
                 changed[0] = True
 
@@ -557,7 +660,7 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
                 stackSizeFn = lambda: sum(map(len, jobGraph.stack))
                 startStackSize = stackSizeFn()
                 # Remove deleted jobs
-                jobGraph.stack = [[y for y in x if self.exists(y.jobStoreID)] for x in jobGraph.stack]
+                jobGraph.stack = [[y for y in x if y.jobStoreID in existingIDs] for x in jobGraph.stack]
                 # Remove empty stuff from the stack
                 jobGraph.stack = [x for x in jobGraph.stack if len(x) > 0]
                 # Check if anything got removed
@@ -576,7 +679,7 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
                 newFlag = self.getEmptyFileStoreID()
 
                 # Load the jobGraph for the service and initialise the link
-                serviceJobGraph = getJob(jobStoreID)
+                serviceJobGraph = jobGraphsReachableFromRoot.get(jobStoreID) or getJob(jobStoreID)
 
                 if flag == 1:
                     logger.debug("Recreating a start service flag for job: %s, flag: %s",
@@ -593,7 +696,7 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
                     serviceJobGraph.errorJobStoreID = newFlag
 
                 # Update the service job on disk
-                self.update(serviceJobGraph)
+                jobsToUpdate[jobStoreID] = serviceJobGraph
 
                 changed[0] = True
 
@@ -612,7 +715,7 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
             services = jobGraph.services
             jobGraph.services = []
             for serviceList in services:
-                existingServices = [service for service in serviceList if self.exists(service.jobStoreID)]
+                existingServices = [service for service in serviceList if service.jobStoreID in existingIDs]
                 if existingServices:
                     jobGraph.services.append(existingServices)
 
@@ -629,13 +732,18 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
             # This cleans the old log file which may
             # have been left if the jobGraph is being retried after a jobGraph failure.
             if jobGraph.logJobStoreFileID != None:
-                self.deleteFile(jobGraph.logJobStoreFileID)
+                filesToDelete.append(jobGraph.logJobStoreFileID)
                 jobGraph.logJobStoreFileID = None
                 changed[0] = True
 
             if changed[0]:  # Update, but only if a change has occurred
                 logger.critical("Repairing job: %s" % jobGraph.jobStoreID)
-                self.update(jobGraph)
+                jobsToUpdate[jobGraph.jobStoreID] = jobGraph
+
+        # Delete the files before updating the jobs that refer to them, so that the references
+        # outlive the files should the cleanup be interrupted
+        self._deleteMarkedFiles(filesToDelete)
+        self.updateMany(list(jobsToUpdate.values()))
 
         # Remove any crufty stats/logging files from the previous run
         logger.debug("Discarding old statistics and logs...")
@@ -651,6 +759,16 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
         # TODO: reloading of the rootJob may be redundant here
         return self.loadRootJob()
 
+    def _deleteMarkedFiles(self, jobStoreFileIDs):
+        """
+        Delete files that were marked for deletion by jobs, along with their peer cache indexes.
+        """
+        self.deleteFiles(jobStoreFileIDs)
+        if self.config.peerCache:
+            # FIXME Can't do this at the top because of loopy (circular) import errors
+            from toil.peerCache import PeerCache
+            PeerCache.deleteIndexes(self, jobStoreFileIDs)
+
     ##########################################
     # The following methods deal with creating/loading/updating/writing/checking for the
     # existence of jobs
@@ -755,6 +873,54 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
         """
         raise NotImplementedError()
 
+    ##########################################
+    # The following methods operate on several jobs at once. The default implementations loop
+    # over the methods above, job stores that can do better with fewer requests override them.
+    ##########################################
+
+    def loadMany(self, jobStoreIDs):
+        """
+        Loads the jobs referenced by the given IDs.
+
+        :param list[str] jobStoreIDs: the IDs of the jobs to load
+
+        :raise NoSuchJobException: if there is no job for any of the given IDs
+
+        :return: the jobs in the order of the given IDs
+        :rtype: list[toil.jobGraph.JobGraph]
+        """
+        return [self.load(jobStoreID) for jobStoreID in jobStoreIDs]
+
+    def updateMany(self, jobs):
+        """
+        Persists the given jobs in this store. Each job is updated atomically but the jobs may not
+        be updated all at once.
+
+        :param list[toil.jobGraph.JobGraph] jobs: the jobs to write to this job store
+        """
+        for job in jobs:
+            self.update(job)
+
+    def existsMany(self, jobStoreIDs):
+        """
+        Indicates for each of the given IDs whether the job with that ID exists in this store.
+
+        :param list[str] jobStoreIDs: the IDs of the jobs to check
+
+        :rtype: list[bool]
+        """
+        return [self.exists(jobStoreID) for jobStoreID in jobStoreIDs]
+
+    def deleteMany(self, jobStoreIDs):
+        """
+        Removes the given jobs and the files associated with them from this store, like
+        :meth:`delete`. Jobs that don't exist are ignored.
+
+        :param list[str] jobStoreIDs: the IDs of the jobs to delete from this job store
+        """
+        for jobStoreID in jobStoreIDs:
+            self.delete(jobStoreID)
+
     def jobs(self):
         """
         Best effort attempt to return iterator on all jobs in the store. The iterator may not
@@ -877,6 +1043,15 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
         """
         raise NotImplementedError()
 
+    def deleteFiles(self, jobStoreFileIDs):
+        """
+        Deletes the files with the given IDs from this job store, like :meth:`deleteFile`.
+
+        :param list[str] jobStoreFileIDs: IDs of the files to delete
+        """
+        for jobStoreFileID in jobStoreFileIDs:
+            self.deleteFile(jobStoreFileID)
+
     @abstractmethod
     def fileExists(self, jobStoreFileID):
         """
@@ -888,6 +1063,41 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
         """
         raise NotImplementedError()
 
+    def waitForFileDeletion(self, jobStoreFileID, timeout):
+        """
+        Block until the given file doesn't exist in this job store, or the timeout elapses. The
+        deletion of empty files is how the leader and services signal each other that a service
+        has started or should terminate.
+
+        Job stores that can be notified of the deletion of a file should override this method to
+        return as soon as the file is deleted. This implementation returns immediately if the
+        file doesn't exist, otherwise it sleeps for the timeout and checks again, so it doesn't
+        make more requests than the polling it replaces.
+
+        :param str jobStoreFileID: an ID referencing the file to wait for
+        :param float timeout: the maximum number of seconds to wait
+        :return: True if the file doesn't exist
+        :rtype: bool
+        """
+        if not self.fileExists(jobStoreFileID):
+            return True
+        time.sleep(timeout)
+        return not self.fileExists(jobStoreFileID)
+
+    def getFileContentHash(self, jobStoreFileID):
+        """
+        Returns the hash under which the content of the given file is deduplicated in this job
+        store. Files with equal hashes have equal content. Job stores that don't support the
+        deduplicateFiles option always return None.
+
+        :param str jobStoreFileID: an ID referencing the file
+
+        :return: the hex digest of the SHA-256 hash of the file's content, or None if the file
+                 is not deduplicated
+        :rtype: str|None
+        """
+        return None
+
     @abstractmethod
     def updateFile(self, jobStoreFileID, localFilePath):
         """
@@ -961,6 +1171,17 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
         """
         raise NotImplementedError()
 
+    @abstractmethod
+    def deleteSharedFile(self, sharedFileName):
+        """
+        Deletes the global file referenced by the given name. Deleting a file that doesn't exist
+        has no effect.
+
+        :param str sharedFileName: A file name matching AbstractJobStore.fileNameRegex, unique within
+               this job store
+        """
+        raise NotImplementedError()
+
     @abstractmethod
     def writeStatsAndLogging(self, statsAndLoggingString):
         """
@@ -1002,6 +1223,17 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
     def _defaultTryCount(self):
         return int(self.config.retryCount + 1)
 
+    def _encodeJobGraph(self, jobGraph):
+        """
+        Serialize the given job graph, in the compact encoding if the compactJobs option is set,
+        see :mod:`toil.jobStores.serialization`. Read job graphs with
+        :func:`toil.jobStores.serialization.decodeJobGraph`, which recognizes either encoding.
+
+        :rtype: bytes
+        """
+        # Configs pickled by older versions lack the option
+        return encodeJobGraph(jobGraph, compact=getattr(self.config, 'compactJobs', False))
+
     @classmethod
     def _validateSharedFileName(cls, sharedFileName):
         return bool(cls.sharedFileNameRegex.match(sharedFileName))
@@ -1011,6 +1243,31 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
         if not cls._validateSharedFileName(sharedFileName):
             raise ValueError("Not a valid shared file name: '%s'." % sharedFileName)
 
+    @staticmethod
+    def _hashFile(localFilePath, bufferSize=10485760):
+        """
+        :rtype: str
+        :return: the hex digest of the SHA-256 hash of the given file's content, see
+                 getFileContentHash()
+        """
+        with open(localFilePath, 'rb') as f:
+            return AbstractJobStore._hashStream(f, bufferSize)
+
+    @staticmethod
+    def _hashStream(readable, bufferSize=10485760):
+        """
+        :rtype: str
+        :return: the hex digest of the SHA-256 hash of the data read from the given file-like
+                 object, see getFileContentHash()
+        """
+        contentHash = hashlib.sha256()
+        while True:
+            buf = readable.read(bufferSize)
+            if not buf:
+                break
+            contentHash.update(buf)
+        return contentHash.hexdigest()
+
 
 class JobStoreSupport(with_metaclass(ABCMeta, AbstractJobStore)):
     @classmethod
@@ -18,19 +18,21 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import str
 from builtins import range
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager, closing
+from io import BytesIO
 import logging
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
 
+import os
 import re
+import shutil
 import uuid
 import base64
+import copy
 import hashlib
-import itertools
+import threading
 import urllib.parse
 import urllib.request, urllib.parse, urllib.error
 
@@ -44,6 +46,7 @@ from toil.lib.objects import InnerClass
 import boto.s3
 import boto.sdb
 from boto.exception import S3CreateError
+from boto.s3.multipart import MultiPartUpload
 from boto.exception import SDBResponseError, S3ResponseError
 
 from toil.fileStore import FileID
@@ -62,8 +65,10 @@ from toil.jobStores.aws.utils import (SDBHelper,
                                       bucket_location_to_region,
                                       region_to_bucket_location, copyKeyMultipart,
                                       uploadFromPath, chunkedFileUpload, fileSizeAndTime)
-from toil.jobStores.utils import WritablePipe, ReadablePipe
+from toil.jobStores.utils import ReadablePipe, SpooledWritablePipe
 from toil.jobGraph import JobGraph
+from toil.jobStores.serialization import decodeJobGraph
+from toil.lib.compression import CompressingWriter, openDecompressed
 import toil.lib.encryption as encryption
 
 log = logging.getLogger(__name__)
@@ -91,6 +96,9 @@ class AWSJobStore(AbstractJobStore):
     maxNameLen = 10
     nameSeparator = '--'
 
+    # The number of parts of a file that are uploaded or downloaded concurrently
+    transferThreads = 8
+
     def __init__(self, locator, partSize=50 << 20):
         """
         Create a new job store in AWS or load an existing one from there.
@@ -250,11 +258,10 @@ class AWSJobStore(AbstractJobStore):
         else:
             binary,_ = SDBHelper.attributesToBinary(item)
             assert binary is not None
-        job = pickle.loads(binary)
-        return job
+        return decodeJobGraph(binary)
 
     def _awsJobToItem(self, job):
-        binary = pickle.dumps(job, protocol=pickle.HIGHEST_PROTOCOL)
+        binary = self._encodeJobGraph(job)
         if len(binary) > SDBHelper.maxBinarySize(extraReservedChunks=1):
             #Store as an overlarge job in S3
             with self.writeFileStream() as (writable, fileID):
@@ -272,15 +279,49 @@ class AWSJobStore(AbstractJobStore):
     def batch(self):
         self._batchedJobGraphs = []
         yield
-        batches = [self._batchedJobGraphs[i:i + self.jobsPerBatchInsert] for i in range(0, len(self._batchedJobGraphs), self.jobsPerBatchInsert)]
+        self._putJobs(self._batchedJobGraphs)
+        self._batchedJobGraphs = None
+
+    def _putJobs(self, jobs):
+        batches = [jobs[i:i + self.jobsPerBatchInsert] for i in range(0, len(jobs), self.jobsPerBatchInsert)]
 
         for batch in batches:
             items = {jobGraph.jobStoreID:self._awsJobToItem(jobGraph) for jobGraph in batch}
             for attempt in retry_sdb():
                 with attempt:
                     assert self.jobsDomain.batch_put_attributes(items)
-        self._batchedJobGraphs = None
-            
+
+    # SimpleDB limits the number of comparisons in a select expression
+    itemsPerSelect = 20
+
+    def _selectItems(self, domain, names, attributes='*', key='itemName()'):
+        """
+        Select the items in the given domain whose key is one of the given values.
+
+        :param list[str] names: the values of the key to select items by
+        :param str attributes: the attributes to return, comma-separated
+        :param str key: the attribute to select items by, itemName() for the name of the item
+        :rtype: list[Item]
+        """
+        items = []
+        for i in range(0, len(names), self.itemsPerSelect):
+            values = ', '.join("'%s'" % name.replace("'", "''")
+                               for name in names[i:i + self.itemsPerSelect])
+            query = "select %s from `%s` where %s in (%s)" % (attributes, domain.name, key, values)
+            for attempt in retry_sdb():
+                with attempt:
+                    batch = list(domain.select(consistent_read=True, query=query))
+            items.extend(batch)
+        return items
+
+    def _deleteItems(self, domain, names):
+        n = self.itemsPerBatchDelete
+        for i in range(0, len(names), n):
+            itemsDict = {name: None for name in names[i:i + n]}
+            for attempt in retry_sdb():
+                with attempt:
+                    domain.batch_delete_attributes(itemsDict)
+
 
     def create(self, jobNode):
         jobStoreID = self._newJobID()
@@ -339,46 +380,63 @@ class AWSJobStore(AbstractJobStore):
     itemsPerBatchDelete = 25
 
     def delete(self, jobStoreID):
-        # remove job and replace with jobStoreId.
-        log.debug("Deleting job %s", jobStoreID)
+        self.deleteMany([jobStoreID])
 
-        #If the job is overlarge, delete its file from the filestore
-        item = None
-        for attempt in retry_sdb():
-            with attempt:
-                item = self.jobsDomain.get_attributes(bytes(jobStoreID), consistent_read=True)
-        self._checkItem(item)
-        if item["overlargeID"]:
-            log.debug("Deleting job from filestore")
-            self.deleteFile(item["overlargeID"])
-        for attempt in retry_sdb():
-            with attempt:
-                self.jobsDomain.delete_attributes(item_name=bytes(jobStoreID))
-        items = None
-        for attempt in retry_sdb():
-            with attempt:
-                items = list(self.filesDomain.select(
-                    consistent_read=True,
-                    query="select version from `%s` where ownerID='%s'" % (
-                        self.filesDomain.name, jobStoreID)))
-        assert items is not None
+    def loadMany(self, jobStoreIDs):
+        items = {item.name: item for item in self._selectItems(self.jobsDomain, jobStoreIDs)}
+        jobs = []
+        for jobStoreID in jobStoreIDs:
+            try:
+                item = items[jobStoreID]
+            except KeyError:
+                raise NoSuchJobException(jobStoreID)
+            jobs.append(self._awsJobFromItem(item))
+        return jobs
+
+    def updateMany(self, jobs):
+        log.debug("Updating %i jobs", len(jobs))
+        self._putJobs(jobs)
+
+    def existsMany(self, jobStoreIDs):
+        existing = {item.name for item in self._selectItems(self.jobsDomain, jobStoreIDs,
+                                                            attributes='itemName()')}
+        return [jobStoreID in existing for jobStoreID in jobStoreIDs]
+
+    def deleteMany(self, jobStoreIDs):
+        log.debug("Deleting %i job(s)", len(jobStoreIDs))
+        items = self._selectItems(self.jobsDomain, jobStoreIDs, attributes='overlargeID')
+        # If a job is overlarge, delete its file from the filestore
+        overlargeIDs = [str(item['overlargeID']) for item in items if item.get('overlargeID')]
+        if overlargeIDs:
+            log.debug("Deleting %d overlarge job(s) from filestore", len(overlargeIDs))
+            self.deleteFiles(overlargeIDs)
+        self._deleteItems(self.jobsDomain, [item.name for item in items])
+        items = self._selectItems(self.filesDomain, jobStoreIDs,
+                                  attributes='version, contentHash', key='ownerID')
         if items:
-            log.debug("Deleting %d file(s) associated with job %s", len(items), jobStoreID)
-            n = self.itemsPerBatchDelete
-            batches = [items[i:i + n] for i in range(0, len(items), n)]
-            for batch in batches:
-                itemsDict = {item.name: None for item in batch}
-                for attempt in retry_sdb():
-                    with attempt:
-                        self.filesDomain.batch_delete_attributes(itemsDict)
-            for item in items:
-                version = item.get('version')
-                for attempt in retry_s3():
-                    with attempt:
-                        if version:
-                            self.filesBucket.delete_key(key_name=bytes(item.name), version_id=version)
-                        else:
-                            self.filesBucket.delete_key(key_name=bytes(item.name))
+            log.debug("Deleting %d file(s) associated with jobs", len(items))
+            self._deleteFileItems(items)
+
+    def _deleteFileItems(self, items):
+        """
+        Delete the files represented by the given items from the files domain, along with their
+        content in S3, using batch requests.
+
+        :param list[Item] items: items with the version and contentHash attributes
+        """
+        self._deleteItems(self.filesDomain, [item.name for item in items])
+        keys = [(bytes(item.name), item['version']) if item.get('version') else bytes(item.name)
+                for item in items]
+        for attempt in retry_s3():
+            with attempt:
+                result = self.filesBucket.delete_keys(keys)
+        if result.errors:
+            raise RuntimeError('Failed to delete %s from S3.' % ', '.join(
+                '%s (%s)' % (error.key, error.message) for error in result.errors))
+        for item in items:
+            contentHash = item.get('contentHash')
+            if contentHash:
+                self._releaseBlob(str(contentHash))
 
     def getEmptyFileStoreID(self, jobStoreID=None):
         info = self.FileInfo.create(jobStoreID)
@@ -413,14 +471,18 @@ class AWSJobStore(AbstractJobStore):
 
     def _exportFile(self, otherCls, jobStoreFileID, url):
         if issubclass(otherCls, AWSJobStore):
-            dstKey = self._getKeyForUrl(url)
-            try:
-                info = self.FileInfo.loadOrFail(jobStoreFileID)
-                info.copyTo(dstKey)
-            finally:
-                dstKey.bucket.connection.close()
-        else:
-            super(AWSJobStore, self)._exportFile(otherCls, jobStoreFileID, url)
+            info = self.FileInfo.loadOrFail(jobStoreFileID)
+            if info.contentHash is not None:
+                info = info._blob()
+            # A server-side copy of compressed content would leave it compressed
+            if info.compression is None:
+                dstKey = self._getKeyForUrl(url)
+                try:
+                    info.copyTo(dstKey)
+                finally:
+                    dstKey.bucket.connection.close()
+                return
+        super(AWSJobStore, self)._exportFile(otherCls, jobStoreFileID, url)
 
     @classmethod
     def getSize(cls, url):
@@ -518,7 +580,7 @@ class AWSJobStore(AbstractJobStore):
 
     def writeFile(self, localFilePath, jobStoreID=None):
         info = self.FileInfo.create(jobStoreID)
-        info.upload(localFilePath)
+        self._upload(info, localFilePath)
         info.save()
         log.debug("Wrote %r of from %r", info, localFilePath)
         return info.fileID
@@ -526,7 +588,7 @@ class AWSJobStore(AbstractJobStore):
     @contextmanager
     def writeFileStream(self, jobStoreID=None):
         info = self.FileInfo.create(jobStoreID)
-        with info.uploadStream() as writable:
+        with self._uploadStream(info) as writable:
             yield writable, info.fileID
         info.save()
         log.debug("Wrote %r.", info)
@@ -544,18 +606,165 @@ class AWSJobStore(AbstractJobStore):
 
     def updateFile(self, jobStoreFileID, localFilePath):
         info = self.FileInfo.loadOrFail(jobStoreFileID)
-        info.upload(localFilePath)
+        self._upload(info, localFilePath)
         info.save()
         log.debug("Wrote %r from path %r.", info, localFilePath)
 
     @contextmanager
     def updateFileStream(self, jobStoreFileID):
         info = self.FileInfo.loadOrFail(jobStoreFileID)
-        with info.uploadStream() as writable:
+        with self._uploadStream(info) as writable:
             yield writable
         info.save()
         log.debug("Wrote %r from stream.", info)
 
+    def getFileContentHash(self, jobStoreFileID):
+        if not self.config.deduplicateFiles:
+            return None
+        info = self.FileInfo.load(jobStoreFileID)
+        return None if info is None else info.contentHash
+
+    # With deduplication enabled, the content of files that are too large to be inlined is
+    # stored once per distinct SHA-256 hash. Such a blob is represented by an item in the files
+    # domain, owned by blobOwnerID, that carries the number of files referencing it in its
+    # refCount attribute. Files referencing a blob record its hash instead of a version.
+
+    def _upload(self, info, localFilePath):
+        if (self.config.deduplicateFiles and
+                os.path.getsize(localFilePath) > info._maxInlinedSize()):
+            contentHash = self._hashFile(localFilePath)
+            # Only upload the content if there is no blob for it yet
+            self._acquireBlob(contentHash,
+                              lambda blob: blob.upload(localFilePath,
+                                                       codec=self.config.compressFiles))
+            info.referenceBlob(contentHash)
+        else:
+            info.upload(localFilePath, codec=self.config.compressFiles)
+
+    @contextmanager
+    def _uploadStream(self, info):
+        codec = self.config.compressFiles
+        if not self.config.deduplicateFiles:
+            with info.uploadStream(codec=codec) as writable:
+                yield writable
+            return
+        contentHash = hashlib.sha256()
+        with info.uploadStream(contentHash=contentHash, codec=codec) as writable:
+            yield writable
+        if info.version:
+            uploadedVersion = info.version
+            compression = info.compression
+            contentHash = contentHash.hexdigest()
+
+            def copy(blob):
+                # A server-side copy, the content doesn't have to be uploaded again
+                sseKey = info._getSSEKey() if info.encrypted else None
+                blob.version = copyKeyMultipart(srcBucketName=self.filesBucket.name,
+                                                srcKeyName=info.fileID,
+                                                srcKeyVersion=uploadedVersion,
+                                                dstBucketName=self.filesBucket.name,
+                                                dstKeyName=blob.fileID,
+                                                sseAlgorithm='AES256',
+                                                sseKey=sseKey,
+                                                copySourceSseAlgorithm='AES256',
+                                                copySourceSseKey=sseKey)
+                blob.compression = compression
+
+            self._acquireBlob(contentHash, copy)
+            info.referenceBlob(contentHash)
+            for attempt in retry_s3():
+                with attempt:
+                    self.filesBucket.delete_key(key_name=bytes(info.fileID),
+                                                version_id=uploadedVersion)
+
+    def _blobID(self, contentHash):
+        return str(uuid.uuid5(self.blobOwnerID, contentHash))
+
+    def _acquireBlob(self, contentHash, upload):
+        """
+        Add a reference to the blob for the given content hash, creating the blob if necessary.
+
+        :param str contentHash: the hex digest of the SHA-256 hash of the content
+
+        :param upload: a callable that is passed the AWSJobStore.FileInfo for a new blob and
+               stores the content in it. It is not invoked if the blob exists already.
+        """
+        blobID = self._blobID(contentHash)
+        while True:
+            for attempt in retry_sdb():
+                with attempt:
+                    item = self.filesDomain.get_attributes(item_name=bytes(blobID),
+                                                           attribute_name=['refCount'],
+                                                           consistent_read=True)
+            refCount = item.get('refCount')
+            blob = None
+            try:
+                if refCount is None:
+                    blob = self.FileInfo(blobID, str(self.blobOwnerID),
+                                         encrypted=self.sseKeyPath is not None)
+                    upload(blob)
+                    attributes, _ = blob.toItem()
+                    attributes['refCount'] = '1'
+                    expected = ['refCount', False]
+                else:
+                    attributes = {'refCount': str(int(refCount) + 1)}
+                    expected = ['refCount', refCount]
+                for attempt in retry_sdb():
+                    with attempt:
+                        assert self.filesDomain.put_attributes(item_name=bytes(blobID),
+                                                               attributes=attributes,
+                                                               expected_value=expected)
+                return
+            except SDBResponseError as e:
+                if e.error_code != 'ConditionalCheckFailed':
+                    raise
+                # The blob was created, referenced or deleted concurrently. Discard the
+                # content we uploaded, if any, and try again.
+                if blob is not None and blob.version:
+                    for attempt in retry_s3():
+                        with attempt:
+                            self.filesBucket.delete_key(key_name=bytes(blobID),
+                                                        version_id=blob.version)
+
+    def _releaseBlob(self, contentHash):
+        """
+        Remove a reference to the blob for the given content hash, deleting the blob if it was
+        the last one.
+        """
+        blobID = self._blobID(contentHash)
+        while True:
+            for attempt in retry_sdb():
+                with attempt:
+                    item = self.filesDomain.get_attributes(item_name=bytes(blobID),
+                                                           consistent_read=True)
+            refCount = item.get('refCount')
+            if refCount is None:
+                log.warn("Blob %s for content hash %s does not exist.", blobID, contentHash)
+                return
+            try:
+                if int(refCount) > 1:
+                    for attempt in retry_sdb():
+                        with attempt:
+                            assert self.filesDomain.put_attributes(
+                                item_name=bytes(blobID),
+                                attributes={'refCount': str(int(refCount) - 1)},
+                                expected_value=['refCount', refCount])
+                else:
+                    version = item.get('version')
+                    for attempt in retry_sdb():
+                        with attempt:
+                            self.filesDomain.delete_attributes(
+                                bytes(blobID), expected_values=['refCount', refCount])
+                    if version:
+                        for attempt in retry_s3():
+                            with attempt:
+                                self.filesBucket.delete_key(key_name=bytes(blobID),
+                                                            version_id=version)
+                return
+            except SDBResponseError as e:
+                if e.error_code != 'ConditionalCheckFailed':
+                    raise
+
     def fileExists(self, jobStoreFileID):
         return self.FileInfo.exists(jobStoreFileID)
 
@@ -580,6 +789,10 @@ class AWSJobStore(AbstractJobStore):
         with info.downloadStream() as readable:
             yield readable
 
+    def deleteSharedFile(self, sharedFileName):
+        assert self._validateSharedFileName(sharedFileName)
+        self.deleteFile(self._sharedFileID(sharedFileName))
+
     def deleteFile(self, jobStoreFileID):
         info = self.FileInfo.load(jobStoreFileID)
         if info is None:
@@ -587,6 +800,13 @@ class AWSJobStore(AbstractJobStore):
         else:
             info.delete()
 
+    def deleteFiles(self, jobStoreFileIDs):
+        # Unlike deleteFile(), this doesn't guard against concurrent updates of the files
+        items = self._selectItems(self.filesDomain, list(jobStoreFileIDs),
+                                  attributes='version, contentHash')
+        if items:
+            self._deleteFileItems(items)
+
     def writeStatsAndLogging(self, statsAndLoggingString):
         info = self.FileInfo.create(str(self.statsFileOwnerID))
         with info.uploadStream(multipart=False) as writeable:
@@ -624,12 +844,21 @@ class AWSJobStore(AbstractJobStore):
 
     def getPublicUrl(self, jobStoreFileID):
         info = self.FileInfo.loadOrFail(jobStoreFileID)
-        if info.content is not None:
+        if info.contentHash is not None:
+            info = info._blob()
+        if info.compression is not None:
+            # Whoever follows the URL expects the original content so upload it uncompressed
+            # as a new version of the object
+            source = self.FileInfo.loadOrFail(info.fileID)
+            with source.downloadStream() as readable:
+                with info.uploadStream(allowInlining=False) as writable:
+                    shutil.copyfileobj(readable, writable)
+        elif info.content is not None:
             with info.uploadStream(allowInlining=False) as f:
                 f.write(info.content)
         for attempt in retry_s3():
             with attempt:
-                key = self.filesBucket.get_key(key_name=bytes(jobStoreFileID), version_id=info.version)
+                key = self.filesBucket.get_key(key_name=bytes(info.fileID), version_id=info.version)
                 key.set_canned_acl('public-read')
                 url = key.generate_url(query_auth=False,
                                        expires_in=self.publicUrlExpiration.total_seconds())
@@ -671,6 +900,59 @@ class AWSJobStore(AbstractJobStore):
                              self.region)
         return s3
 
+    def _copyForThread(self):
+        # Boto's connections, and the domains and buckets bound to them, aren't thread-safe
+        store = copy.copy(self)
+        store.db = self._connectSimpleDB()
+        store.s3 = self._connectS3()
+        if self.jobsDomain is not None:
+            store.jobsDomain = store.db.get_domain(self.jobsDomain.name, validate=False)
+        if self.filesDomain is not None:
+            store.filesDomain = store.db.get_domain(self.filesDomain.name, validate=False)
+        if self.filesBucket is not None:
+            store.filesBucket = store.s3.get_bucket(self.filesBucket.name, validate=False)
+        return store
+
+    @contextmanager
+    def _transferPool(self):
+        """
+        A pool of threads for transferring the parts of a file concurrently.
+
+        :return: the pool and a function returning the files bucket bound to a connection of the
+                 calling thread's own, for use by the pool's threads
+        """
+        local = threading.local()
+
+        def filesBucket():
+            bucket = getattr(local, 'bucket', None)
+            if bucket is None:
+                bucket = local.bucket = self._connectS3().get_bucket(self.filesBucket.name,
+                                                                     validate=False)
+            return bucket
+
+        with ThreadPoolExecutor(max_workers=self.transferThreads) as pool:
+            yield pool, filesBucket
+
+    def _transferParts(self, pool, fn, parts):
+        """
+        Apply the given function to the given parts in the given pool. Like pool.map() but the
+        parts are consumed lazily, at most transferThreads of them ahead of the result being
+        yielded, which bounds the memory used by parts or results that hold content.
+
+        :return: an iterator over the results, in the order of the parts
+        """
+        pending = deque()
+        try:
+            for part in parts:
+                if len(pending) == self.transferThreads:
+                    yield pending.popleft().result()
+                pending.append(pool.submit(fn, part))
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
     def _bindBucket(self, bucket_name, create=False, block=True, versioning=False):
         """
         Return the Boto Bucket object representing the S3 bucket with the given name. If the
@@ -792,6 +1074,9 @@ class AWSJobStore(AbstractJobStore):
     # A dummy job ID under which all read stats files are stored
     readStatsFileOwnerID = uuid.UUID('e77fc3aa-d232-4255-ae04-f64ee8eb0bfa')
 
+    # A dummy job ID under which the blobs of deduplicated files are stored
+    blobOwnerID = uuid.UUID('5a4b1c6e-3f0d-4d1e-9b7a-2c8e6f1d0a93')
+
     def _sharedFileID(self, sharedFileName):
         return str(uuid.uuid5(self.sharedFileOwnerID, sharedFileName))
 
@@ -806,7 +1091,8 @@ class AWSJobStore(AbstractJobStore):
         """
 
         def __init__(self, fileID, ownerID, encrypted,
-                     version=None, content=None, numContentChunks=0):
+                     version=None, content=None, numContentChunks=0, contentHash=None,
+                     compression=None):
             """
             :type fileID: str
             :param fileID: the file's ID
@@ -828,6 +1114,14 @@ class AWSJobStore(AbstractJobStore):
             :type numContentChunks: int
             :param numContentChunks: the number of SDB domain attributes occupied by this files
             inlined content. Note that an inlined empty string still occupies one chunk.
+
+            :type contentHash: str|None
+            :param contentHash: the hash of the blob holding this file's content if the file is
+            deduplicated, in which case version is an empty string.
+
+            :type compression: str|None
+            :param compression: the codec this file's content is compressed with, if any, see
+            toil.lib.compression
             """
             super(AWSJobStore.FileInfo, self).__init__()
             self._fileID = fileID
@@ -837,6 +1131,9 @@ class AWSJobStore(AbstractJobStore):
             self._previousVersion = version
             self._content = content
             self._numContentChunks = numContentChunks
+            self._contentHash = contentHash
+            self._previousContentHash = contentHash
+            self._compression = compression
 
         @property
         def fileID(self):
@@ -857,6 +1154,8 @@ class AWSJobStore(AbstractJobStore):
             self._version = version
             if version:
                 self.content = None
+                self._contentHash = None
+            self._compression = None
 
         @property
         def previousVersion(self):
@@ -871,6 +1170,35 @@ class AWSJobStore(AbstractJobStore):
             self._content = content
             if content is not None:
                 self.version = ''
+                self._contentHash = None
+            self._compression = None
+
+        @property
+        def contentHash(self):
+            return self._contentHash
+
+        @property
+        def compression(self):
+            return self._compression
+
+        @compression.setter
+        def compression(self, compression):
+            # Must be set after the content it applies to
+            self._compression = compression
+
+        def referenceBlob(self, contentHash):
+            """
+            Make this file's content that of the blob with the given hash. The caller must have
+            acquired a reference to the blob for this file.
+            """
+            # The version of a newly uploaded but deduplicated object may be discarded
+            self._version = ''
+            self._content = None
+            self._contentHash = contentHash
+            self._compression = None
+
+        def _blob(self):
+            return self.outer.FileInfo.loadOrFail(self.outer._blobID(self.contentHash))
 
         @classmethod
         def create(cls, ownerID):
@@ -945,6 +1273,8 @@ class AWSJobStore(AbstractJobStore):
                 return None
             else:
                 version = strOrNone(item['version'])
+                contentHash = strOrNone(item.get('contentHash')) or None
+                compression = strOrNone(item.get('compression')) or None
                 encrypted = strict_bool(encrypted)
                 content, numContentChunks = cls.attributesToBinary(item)
                 if encrypted:
@@ -954,7 +1284,8 @@ class AWSJobStore(AbstractJobStore):
                     if content is not None:
                         content = encryption.decrypt(content, sseKeyPath)
                 self = cls(fileID=item.name, ownerID=ownerID, encrypted=encrypted, version=version,
-                           content=content, numContentChunks=numContentChunks)
+                           content=content, numContentChunks=numContentChunks,
+                           contentHash=contentHash, compression=compression)
                 return self
 
         def toItem(self):
@@ -976,12 +1307,15 @@ class AWSJobStore(AbstractJobStore):
             numChunks = attributes['numChunks']
             attributes.update(dict(ownerID=self.ownerID,
                                    encrypted=self.encrypted,
-                                   version=self.version or ''))
+                                   version=self.version or '',
+                                   contentHash=self.contentHash or '',
+                                   compression=self.compression or ''))
             return attributes, numChunks
 
         @classmethod
         def _reservedAttributes(cls):
-            return 3 + super(AWSJobStore.FileInfo, cls)._reservedAttributes()
+            # ownerID, encrypted, version, contentHash, compression and a blob's refCount
+            return 6 + super(AWSJobStore.FileInfo, cls)._reservedAttributes()
 
         @classmethod
         def maxInlinedSize(cls, encrypted):
@@ -1015,67 +1349,136 @@ class AWSJobStore(AbstractJobStore):
                             self.outer.filesDomain.delete_attributes(bytes(self.fileID),
                                                                      attributes=attributes)
                 self._numContentChunks = numNewContentChunks
+                if self._previousContentHash and self._previousContentHash != self.contentHash:
+                    self.outer._releaseBlob(self._previousContentHash)
+                self._previousContentHash = self._contentHash
             except SDBResponseError as e:
                 if e.error_code == 'ConditionalCheckFailed':
                     raise ConcurrentFileModificationException(self.fileID)
                 else:
                     raise
 
-        def upload(self, localFilePath):
+        def upload(self, localFilePath, codec=None):
+            """
+            :param str codec: the codec to compress the content with, see toil.lib.compression
+            """
+            if codec is not None:
+                with open(localFilePath, 'rb') as readable:
+                    with self.uploadStream(codec=codec) as writable:
+                        shutil.copyfileobj(readable, writable)
+                return
             file_size, file_time = fileSizeAndTime(localFilePath)
             if file_size <= self._maxInlinedSize():
                 with open(localFilePath) as f:
                     self.content = f.read()
-            else:
+            elif file_size <= self.outer.partSize:
                 headers = self._s3EncryptionHeaders()
                 self.version = uploadFromPath(localFilePath, partSize=self.outer.partSize,
                                               bucket=self.outer.filesBucket, fileID=bytes(self.fileID),
                                               headers=headers)
+            else:
+                def filePart(start):
+                    def openPart():
+                        f = open(localFilePath, 'rb')
+                        f.seek(start)
+                        return f, min(self.outer.partSize, file_size - start)
+                    return openPart
+
+                self.version = self._uploadParts(filePart(start) for start in
+                                                 range(0, file_size, self.outer.partSize))
+                # Make reasonably sure that the file wasn't touched during the upload
+                assert fileSizeAndTime(localFilePath) == (file_size, file_time)
+
+        def _uploadParts(self, parts):
+            """
+            Upload the content of this file to S3 in a multipart upload of the given parts,
+            several of them concurrently.
+
+            :param parts: the parts in order, each a function returning a file object positioned
+                   at the start of the part and the size of the part. The function is called by
+                   the thread uploading the part. The parts are consumed lazily, see
+                   AWSJobStore._transferParts().
+
+            :return: the version of the uploaded file
+            """
+            store = self.outer
+            headers = self._s3EncryptionHeaders()
+            for attempt in retry_s3():
+                with attempt:
+                    upload = store.filesBucket.initiate_multipart_upload(
+                        key_name=bytes(self.fileID),
+                        headers=headers)
+            try:
+                with store._transferPool() as (pool, filesBucket):
+                    def uploadPart(numberedPart):
+                        partNum, openPart = numberedPart
+                        partUpload = MultiPartUpload(filesBucket())
+                        partUpload.id, partUpload.key_name = upload.id, upload.key_name
+                        f, size = openPart()
+                        with closing(f):
+                            start = f.tell()
+                            for attempt in retry_s3():
+                                with attempt:
+                                    f.seek(start)
+                                    partUpload.upload_part_from_file(fp=f,
+                                                                     part_num=partNum,
+                                                                     size=size,
+                                                                     headers=headers)
+
+                    # part numbers are 1-based
+                    for _ in store._transferParts(pool, uploadPart, enumerate(parts, 1)):
+                        pass
+            except:
+                with panic(log=log):
+                    for attempt in retry_s3():
+                        with attempt:
+                            upload.cancel_upload()
+            else:
+                for attempt in retry_s3():
+                    with attempt:
+                        return upload.complete_upload().version_id
 
         @contextmanager
-        def uploadStream(self, multipart=True, allowInlining=True):
+        def uploadStream(self, multipart=True, allowInlining=True, contentHash=None, codec=None):
+            """
+            :param contentHash: an optional hashlib object that is updated with the content as
+                   it is written to the stream
+
+            :param str codec: the codec to compress the content with, see toil.lib.compression
+            """
             info = self
             store = self.outer
 
-            class MultiPartPipe(WritablePipe):
+            def read(readable, *args):
+                buf = readable.read(*args)
+                # With compression, the writer hashes the uncompressed content
+                if contentHash is not None and codec is None:
+                    contentHash.update(buf)
+                return buf
+
+            def bufferPart(buf):
+                return lambda: (BytesIO(buf), len(buf))
+
+            class MultiPartPipe(SpooledWritablePipe):
                 def readFrom(self, readable):
-                    buf = readable.read(store.partSize)
+                    buf = read(readable, store.partSize)
                     if allowInlining and len(buf) <= info._maxInlinedSize():
                         info.content = buf
                     else:
-                        headers = info._s3EncryptionHeaders()
-                        for attempt in retry_s3():
-                            with attempt:
-                                upload = store.filesBucket.initiate_multipart_upload(
-                                    key_name=bytes(info.fileID),
-                                    headers=headers)
-                        try:
-                            for part_num in itertools.count():
-                                # There must be at least one part, even if the file is empty.
-                                if len(buf) == 0 and part_num > 0:
-                                    break
-                                for attempt in retry_s3():
-                                    with attempt:
-                                        upload.upload_part_from_file(fp=StringIO(buf),
-                                                                     # part numbers are 1-based
-                                                                     part_num=part_num + 1,
-                                                                     headers=headers)
+                        def parts(buf):
+                            # There must be at least one part, even if the file is empty. The
+                            # parts are read from the pipe as the upload progresses.
+                            while True:
+                                yield bufferPart(buf)
+                                buf = read(readable, store.partSize)
                                 if len(buf) == 0:
                                     break
-                                buf = readable.read(info.outer.partSize)
-                        except:
-                            with panic(log=log):
-                                for attempt in retry_s3():
-                                    with attempt:
-                                        upload.cancel_upload()
-                        else:
-                            for attempt in retry_s3():
-                                with attempt:
-                                    info.version = upload.complete_upload().version_id
 
-            class SinglePartPipe(WritablePipe):
+                        info.version = info._uploadParts(parts(buf))
+
+            class SinglePartPipe(SpooledWritablePipe):
                 def readFrom(self, readable):
-                    buf = readable.read()
+                    buf = read(readable)
                     if allowInlining and len(buf) <= info._maxInlinedSize():
                         info.content = buf
                     else:
@@ -1089,7 +1492,13 @@ class AWSJobStore(AbstractJobStore):
                         info.version = key.version_id
 
             with MultiPartPipe() if multipart else SinglePartPipe() as writable:
-                yield writable
+                if codec is None:
+                    yield writable
+                else:
+                    with CompressingWriter(writable, codec, contentHash=contentHash) as writer:
+                        yield writer
+            if codec is not None:
+                self.compression = writer.codec
 
             assert bool(self.version) == (self.content is None)
 
@@ -1117,7 +1526,9 @@ class AWSJobStore(AbstractJobStore):
 
             :param Key dstKey: The key to copy this file's content to
             """
-            if self.content is not None:
+            if self.contentHash is not None:
+                self._blob().copyTo(dstKey)
+            elif self.content is not None:
                 for attempt in retry_s3():
                     with attempt:
                         dstKey.set_contents_from_string(self.content)
@@ -1141,41 +1552,115 @@ class AWSJobStore(AbstractJobStore):
                 assert False
 
         def download(self, localFilePath):
-            if self.content is not None:
+            if self.contentHash is not None:
+                self._blob().download(localFilePath)
+            elif self.compression is not None:
+                with self.downloadStream() as readable:
+                    with open(localFilePath, 'wb') as writable:
+                        shutil.copyfileobj(readable, writable)
+            elif self.content is not None:
                 with open(localFilePath, 'w') as f:
                     f.write(self.content)
             elif self.version:
-                headers = self._s3EncryptionHeaders()
-                key = self.outer.filesBucket.get_key(bytes(self.fileID), validate=False)
-                for attempt in retry_s3():
-                    with attempt:
-                        key.get_contents_to_filename(localFilePath,
-                                                     version_id=self.version,
-                                                     headers=headers)
+                store = self.outer
+                with open(localFilePath, 'wb') as f:
+                    size = self._downloadPart(store.filesBucket, f, 0)
+                if size > store.partSize:
+                    with store._transferPool() as (pool, filesBucket):
+                        # Each thread writes its parts through a file object of its own
+                        def downloadPart(start):
+                            with open(localFilePath, 'r+b') as f:
+                                f.seek(start)
+                                self._downloadPart(filesBucket(), f, start)
+
+                        parts = range(store.partSize, size, store.partSize)
+                        for _ in store._transferParts(pool, downloadPart, parts):
+                            pass
             else:
                 assert False
 
+        def _downloadPart(self, bucket, writable, start, size=None):
+            """
+            Download a byte range of this file's content from S3 to the given file object, at its
+            current position.
+
+            :param int start: the offset of the range
+            :param int size: the size of the range, by default it extends to the end of the part
+                   of the store's part size that the offset falls in
+
+            :return: the size of the entire content of this file
+            :rtype: int
+            """
+            partSize = self.outer.partSize
+            end = start + size if size is not None else (start // partSize + 1) * partSize
+            headers = dict(self._s3EncryptionHeaders(),
+                           Range='bytes=%i-%i' % (start, end - 1))
+            key = bucket.get_key(bytes(self.fileID), validate=False)
+            position = writable.tell()
+            for attempt in retry_s3():
+                with attempt:
+                    writable.seek(position)
+                    try:
+                        key.get_contents_to_file(writable,
+                                                 headers=headers,
+                                                 version_id=self.version)
+                    except S3ResponseError as e:
+                        if e.status == 416 and start == 0:
+                            # No range of an empty file is satisfiable
+                            return 0
+                        raise
+            # From the Content-Range of the response
+            return key.size
+
         @contextmanager
         def downloadStream(self):
+            if self.contentHash is not None:
+                with self._blob().downloadStream() as readable:
+                    yield readable
+                return
             info = self
+            store = self.outer
+
+            def decompressed(readable):
+                if info.compression is None:
+                    return readable
+                else:
+                    return openDecompressed(readable, info.compression)
+
+            if info.content is not None:
+                yield decompressed(BytesIO(info.content))
+                return
+            assert info.version
+            # As much of the content as SpooledWritablePipe collects in memory is downloaded in
+            # this thread. Only the rest of a larger file needs a pipe and a thread, to download
+            # it while the beginning is being read.
+            bufferSize = SpooledWritablePipe.bufferSize
+            first = BytesIO()
+            size = info._downloadPart(store.filesBucket, first, 0, size=bufferSize)
+            first.seek(0)
+            if size <= bufferSize:
+                yield decompressed(first)
+                return
 
             class DownloadPipe(ReadablePipe):
                 def writeTo(self, writable):
-                    if info.content is not None:
-                        writable.write(info.content)
-                    elif info.version:
-                        headers = info._s3EncryptionHeaders()
-                        key = info.outer.filesBucket.get_key(bytes(info.fileID), validate=False)
-                        for attempt in retry_s3():
-                            with attempt:
-                                key.get_contents_to_file(writable,
-                                                         headers=headers,
-                                                         version_id=info.version)
-                    else:
-                        assert False
+                    writable.write(first.getvalue())
+                    with store._transferPool() as (pool, filesBucket):
+                        def downloadPart(start):
+                            buf = BytesIO()
+                            info._downloadPart(filesBucket(), buf, start)
+                            return buf.getvalue()
+
+                        # The rest of the part the buffered content ends in and the remaining
+                        # parts are downloaded concurrently and written in order
+                        partSize = store.partSize
+                        parts = [bufferSize] + list(range((bufferSize // partSize + 1) * partSize,
+                                                          size, partSize))
+                        for buf in store._transferParts(pool, downloadPart, parts):
+                            writable.write(buf)
 
             with DownloadPipe() as readable:
-                yield readable
+                yield decompressed(readable)
 
         def delete(self):
             store = self.outer
@@ -1190,6 +1675,8 @@ class AWSJobStore(AbstractJobStore):
                         with attempt:
                             store.filesBucket.delete_key(key_name=bytes(self.fileID),
                                                          version_id=self.previousVersion)
+                if self._previousContentHash:
+                    store._releaseBlob(self._previousContentHash)
 
         def _getSSEKey(self):
             sseKeyPath = self.outer.sseKeyPath
@@ -1221,6 +1708,8 @@ class AWSJobStore(AbstractJobStore):
                  ('encrypted', r(self.encrypted)),
                  ('version', r(self.version)),
                  ('previousVersion', r(self.previousVersion)),
+                 ('contentHash', r(self.contentHash)),
+                 ('compression', r(self.compression)),
                  ('content', r(self.content)),
                  ('_numContentChunks', r(self._numContentChunks)))
             return "{}({})".format(type(self).__name__,
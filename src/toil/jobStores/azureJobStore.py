@@ -29,10 +29,6 @@ from collections import namedtuple
 from contextlib import contextmanager
 from datetime import datetime, timedelta
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
 
 # Python 3 compatibility imports
 from six.moves.http_client import HTTPException
@@ -42,6 +38,7 @@ from azure.common import AzureMissingResourceHttpError, AzureException
 from azure.storage.blob.blockblobservice import BlockBlobService
 from azure.storage.blob.models import BlobPermissions, BlobBlock
 from azure.cosmosdb.table import TableService, EntityProperty, Entity
+from azure.cosmosdb.table.tablebatch import TableBatch
 
 from toil.jobStores import azure_credential_file_path as credential_file_path
 
@@ -52,8 +49,9 @@ from toil.lib.memoize import strict_bool, memoize
 from toil.lib.exceptions import panic
 from toil.lib.retry import retry
 
-from toil.jobStores.utils import WritablePipe, ReadablePipe
+from toil.jobStores.utils import WritablePipe, ReadablePipe, mapConcurrently
 from toil.jobGraph import JobGraph
+from toil.jobStores.serialization import encodeJobGraph, decodeJobGraph
 from toil.jobStores.abstractJobStore import (AbstractJobStore,
                                              NoSuchJobException,
                                              ConcurrentFileModificationException,
@@ -226,9 +224,10 @@ class AzureJobStore(AbstractJobStore):
         # How many jobs have we done?
         total_processed = 0
 
-        for jobEntity in self.jobItems.query_entities():
-            # Process the items in the page
-            yield AzureJob.fromEntity(jobEntity)
+        # The entities hold the jobs, so there is nothing to load but the pages of the query
+        # are fetched while the jobs on earlier pages are decoded
+        for job in mapConcurrently(AzureJob.fromEntity, self.jobItems.query_entities(), 1):
+            yield job
             total_processed += 1
 
             if total_processed % 1000 == 0:
@@ -238,11 +237,21 @@ class AzureJobStore(AbstractJobStore):
 
         logger.debug("Processed %d total jobs" % total_processed)
 
+    @contextmanager
+    def batch(self):
+        self._batchedEntities = []
+        yield
+        self._commitBatches(self._batchedEntities, operation='insert')
+        self._batchedEntities = None
+
     def create(self, jobNode):
         jobStoreID = self._newJobID()
         job = AzureJob.fromJobNode(jobNode, jobStoreID, self._defaultTryCount())
-        entity = job.toEntity(chunkSize=self.jobChunkSize)
-        self.jobItems.insert_entity(entity=entity)
+        entity = job.toEntity(self._encodeJobGraph, chunkSize=self.jobChunkSize)
+        if getattr(self, '_batchedEntities', None) is not None:
+            self._batchedEntities.append(entity)
+        else:
+            self.jobItems.insert_entity(entity=entity)
         return job
 
     def exists(self, jobStoreID):
@@ -257,7 +266,8 @@ class AzureJobStore(AbstractJobStore):
         return AzureJob.fromEntity(jobEntity)
 
     def update(self, job):
-        self.jobItems.update_entity(entity=job.toEntity(chunkSize=self.jobChunkSize))
+        self.jobItems.update_entity(entity=job.toEntity(self._encodeJobGraph,
+                                                        chunkSize=self.jobChunkSize))
 
     def delete(self, jobStoreID):
         try:
@@ -265,11 +275,93 @@ class AzureJobStore(AbstractJobStore):
         except AzureMissingResourceHttpError:
             # Job deletion is idempotent, and this job has been deleted already
             return
+        self._deleteJobFiles(jobStoreID)
+
+    def _deleteJobFiles(self, jobStoreID):
         filterString = "PartitionKey eq '%s'" % jobStoreID
         for fileEntity in self.jobFileIDs.query_entities(filter=filterString):
             jobStoreFileID = fileEntity.RowKey
             self.deleteFile(jobStoreFileID)
 
+    # All jobs are stored in the same partition of the jobs table so they can be operated on in
+    # entity group transactions, which are limited to this many operations ...
+    entitiesPerBatch = 100
+    # ... and this many bytes of payload. The remainder of the limit of 4MiB is left for the
+    # overhead of the request.
+    bytesPerBatch = 3 << 20
+
+    # Query filters are limited in the number of comparisons they may contain
+    comparisonsPerFilter = 15
+
+    def _queryJobs(self, jobStoreIDs, select=None):
+        entities = []
+        n = self.comparisonsPerFilter
+        for i in range(0, len(jobStoreIDs), n):
+            filterString = ' or '.join("RowKey eq '%s'" % jobStoreID
+                                       for jobStoreID in jobStoreIDs[i:i + n])
+            entities.extend(self.jobItems.query_entities(filter=filterString, select=select))
+        return entities
+
+    def _commitBatches(self, entities, operation='update'):
+        """
+        Insert, update or delete the given entities of the jobs table in as few entity group
+        transactions as possible.
+
+        :param str operation: 'insert', 'update' or 'delete'
+        """
+        def size(entity):
+            return sum(len(value.value) for value in entity.values()
+                       if isinstance(value, EntityProperty))
+
+        batch, batchCount, batchSize = TableBatch(), 0, 0
+        for entity in entities:
+            entitySize = size(entity)
+            if batchCount == self.entitiesPerBatch or (
+                    batchCount and batchSize + entitySize > self.bytesPerBatch):
+                self.jobItems.commit_batch(batch=batch)
+                batch, batchCount, batchSize = TableBatch(), 0, 0
+            if operation == 'delete':
+                batch.delete_entity(entity['PartitionKey'], entity['RowKey'])
+            elif operation == 'insert':
+                batch.insert_entity(entity)
+            else:
+                batch.update_entity(entity)
+            batchCount += 1
+            batchSize += entitySize
+        if batchCount:
+            self.jobItems.commit_batch(batch=batch)
+
+    def loadMany(self, jobStoreIDs):
+        jobEntities = {entity.RowKey: entity for entity in self._queryJobs(jobStoreIDs)}
+        jobs = []
+        for jobStoreID in jobStoreIDs:
+            try:
+                jobEntity = jobEntities[jobStoreID]
+            except KeyError:
+                raise NoSuchJobException(jobStoreID)
+            jobs.append(AzureJob.fromEntity(jobEntity))
+        return jobs
+
+    def updateMany(self, jobs):
+        self._commitBatches([job.toEntity(self._encodeJobGraph, chunkSize=self.jobChunkSize)
+                             for job in jobs])
+
+    def existsMany(self, jobStoreIDs):
+        existing = {entity.RowKey for entity in self._queryJobs(jobStoreIDs, select='RowKey')}
+        return [jobStoreID in existing for jobStoreID in jobStoreIDs]
+
+    def deleteMany(self, jobStoreIDs):
+        # A transaction fails as a whole if any of its entities doesn't exist so only delete
+        # the jobs that do
+        jobStoreIDs = [jobStoreID for jobStoreID, exists
+                       in zip(jobStoreIDs, self.existsMany(jobStoreIDs)) if exists]
+        self._commitBatches([Entity(PartitionKey=AzureTable.defaultPartition,
+                                    RowKey=str(jobStoreID))
+                             for jobStoreID in jobStoreIDs],
+                            operation='delete')
+        for jobStoreID in jobStoreIDs:
+            self._deleteJobFiles(jobStoreID)
+
     def getEnv(self):
         return dict(AZURE_ACCOUNT_KEY=self.accountKey)
 
@@ -415,6 +507,13 @@ class AzureJobStore(AbstractJobStore):
         with self._downloadStream(sharedFileID, self.files) as fd:
             yield fd
 
+    def deleteSharedFile(self, sharedFileName):
+        assert self._validateSharedFileName(sharedFileName)
+        try:
+            self.files.delete_blob(blob_name=str(self._newFileID(sharedFileName)))
+        except AzureMissingResourceHttpError:
+            pass
+
     def writeStatsAndLogging(self, statsAndLoggingString):
         # TODO: would be a great use case for the append blobs, once implemented in the Azure SDK
         jobStoreFileID = self._newFileID()
@@ -558,9 +657,11 @@ class AzureJobStore(AbstractJobStore):
                 raise RuntimeError('Encryption requested but no key was provided')
 
         maxBlockSize = self._maxAzureBlockBytes
+        # Encrypted content is written in the streaming format, blobs written before it existed
+        # consist of blocks encrypted as a whole
+        metadata = dict(encrypted=str(encrypted))
         if encrypted:
-            # There is a small overhead for encrypted data.
-            maxBlockSize -= encryption.overhead
+            metadata['encryptionFormat'] = 'stream'
 
         store = self
 
@@ -575,8 +676,6 @@ class AzureJobStore(AbstractJobStore):
                             # We're safe to break here even if we never read anything, since
                             # putting an empty block list creates an empty blob.
                             break
-                        if encrypted:
-                            buf = encryption.encrypt(buf, store.keyPath)
                         blockID = store._newFileID()
                         container.put_block(blob_name=str(jobStoreFileID),
                                             block=buf,
@@ -600,7 +699,7 @@ class AzureJobStore(AbstractJobStore):
                     container.put_block_list(blob_name=str(jobStoreFileID),
                                              block_list=blocks,
                                              lease_id=leaseID,
-                                             metadata=dict(encrypted=str(encrypted)))
+                                             metadata=metadata)
                     # then release the lock.
                     container.release_blob_lease(blob_name=str(jobStoreFileID), lease_id=leaseID)
                 else:
@@ -608,10 +707,14 @@ class AzureJobStore(AbstractJobStore):
                     # was there.
                     container.put_block_list(blob_name=str(jobStoreFileID),
                                              block_list=blocks,
-                                             metadata=dict(encrypted=str(encrypted)))
+                                             metadata=metadata)
 
         with UploadPipe() as writable:
-            yield writable
+            if encrypted:
+                with encryption.EncryptingWriter(writable, self.keyPath) as encryptingWritable:
+                    yield encryptingWritable
+            else:
+                yield writable
 
     @contextmanager
     def _downloadStream(self, jobStoreFileID, container):
@@ -622,6 +725,7 @@ class AzureJobStore(AbstractJobStore):
         encrypted = strict_bool(blob.metadata['encrypted'])
         if encrypted and self.keyPath is None:
             raise AssertionError('Content is encrypted but no key was provided.')
+        streamed = encrypted and blob.metadata.get('encryptionFormat') == 'stream'
 
         outer_self = self
 
@@ -634,13 +738,16 @@ class AzureJobStore(AbstractJobStore):
                     buf = container.get_blob_to_bytes(blob_name=str(jobStoreFileID),
                                                       start_range=chunkStart,
                                                       end_range=chunkEnd).content
-                    if encrypted:
+                    if encrypted and not streamed:
                         buf = encryption.decrypt(buf, outer_self.keyPath)
                     writable.write(buf)
                     chunkStart = chunkEnd + 1
 
         with DownloadPipe() as readable:
-            yield readable
+            if streamed:
+                yield encryption.openDecrypted(readable, self.keyPath)
+            else:
+                yield readable
 
 
 class AzureTable(object):
@@ -745,17 +852,19 @@ class AzureJob(JobGraph):
             wholeJobString = chunkedJob[0][1].value
         else:
             wholeJobString = ''.join(item[1].value for item in chunkedJob)
-        return pickle.loads(bz2.decompress(wholeJobString))
+        return decodeJobGraph(bz2.decompress(wholeJobString), cls)
 
-    def toEntity(self, chunkSize=maxAzureTablePropertySize):
+    def toEntity(self, encode=encodeJobGraph, chunkSize=maxAzureTablePropertySize):
         """
+        :param encode: the function serializing the job, see
+               :meth:`toil.jobStores.abstractJobStore.AbstractJobStore._encodeJobGraph`
         :param chunkSize: the size of a chunk for splitting up the serialized job into chunks
         that each fit into a property value of the an Azure table entity
         :rtype: dict
         """
         assert chunkSize <= maxAzureTablePropertySize
         item = {}
-        serializedAndEncodedJob = bz2.compress(pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL))
+        serializedAndEncodedJob = bz2.compress(encode(self))
         jobChunks = [serializedAndEncodedJob[i:i + chunkSize]
                      for i in range(0, len(serializedAndEncodedJob), chunkSize)]
         for attributeOrder, chunk in enumerate(jobChunks):
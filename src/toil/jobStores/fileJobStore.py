@@ -18,34 +18,57 @@ from builtins import range
 
 # standard library
 from contextlib import contextmanager
+import fcntl
+from fcntl import flock, LOCK_EX, LOCK_SH
+from io import BytesIO
+import json
 import logging
 import random
 import shutil
 import os
 import re
+import sqlite3
 import tempfile
 import stat
+import struct
+import sys
 import errno
+import threading
 import time
 import traceback
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
+import uuid
 
 # toil and bd2k dependencies
 from toil.fileStore import FileID
 from toil.lib.bioio import absSymPath
+from toil.lib.compression import CompressingWriter, openCompressed
+from toil.lib import inotify
 from toil.jobStores.abstractJobStore import (AbstractJobStore,
                                              NoSuchJobException,
                                              NoSuchFileException,
                                              JobStoreExistsException,
                                              NoSuchJobStoreException)
 from toil.jobGraph import JobGraph
+from toil.jobStores.serialization import decodeJobGraph
 
 logger = logging.getLogger( __name__ )
 
 
+class ReferencedFileModifiedException(Exception):
+    """
+    Indicates that the original of a file imported by reference was modified or deleted after it
+    was imported.
+    """
+    def __init__(self, jobStoreFileID, path):
+        """
+        :param str jobStoreFileID: the ID of the file imported by reference
+        :param str path: the path of the original file
+        """
+        super(ReferencedFileModifiedException, self).__init__(
+            "The file '%s' was modified or deleted after it was imported as '%s'." % (
+                path, jobStoreFileID))
+
+
 class FileJobStore(AbstractJobStore):
     """
     A job store that uses a directory on a locally attached file system. To be compatible with
@@ -60,6 +83,22 @@ class FileJobStore(AbstractJobStore):
     # 10Mb RAM chunks when reading/writing files
     BUFFER_SIZE = 10485760 # 10Mb
 
+    # Name of the directory in self.tempFilesDir holding jobs and files in the indexed layout
+    shardsDirName = 'shards'
+
+    # Seconds to wait for other processes to release their lock on the index
+    indexTimeout = 600
+
+    # Number of jobs loaded per query from the index
+    indexPageSize = 500
+
+    # Stats and logging are appended by the workers to one of this many segment files in
+    # self.statsDir, as records prefixed by their size. The leader drains the segments instead of
+    # scanning the temporary directories for them, moving the records it read to an archive that
+    # only reading all stats and logging has to go through.
+    statsSegments = 16
+    _statsRecordHeader = struct.Struct('>Q')
+
     def __init__(self, path):
         """
         :param str path: Path to directory holding the job store
@@ -69,6 +108,17 @@ class FileJobStore(AbstractJobStore):
         logger.debug("Path to job store directory is '%s'.", self.jobStoreDir)
         # Directory where temporary files go
         self.tempFilesDir = os.path.join(self.jobStoreDir, 'tmp')
+        # Directory holding the content of deduplicated files, see _commitDeduplicated()
+        self.blobsDir = os.path.join(self.jobStoreDir, 'blobs')
+        # SQLite database holding the jobs of an indexed store, see _createIndex()
+        self.indexPath = os.path.join(self.jobStoreDir, 'jobs.db')
+        # Directory holding the stats and logging spool, see writeStatsAndLogging()
+        self.statsDir = os.path.join(self.jobStoreDir, 'stats')
+        # Stores created before the spool existed may still have stats files in the temporary
+        # directories, which are looked for once by the first read
+        self._legacyStatsRead = False
+        self._indexed = False
+        self._connections = threading.local()
         self.linkImports = None
 
     def initialize(self, config):
@@ -80,14 +130,24 @@ class FileJobStore(AbstractJobStore):
             else:
                 raise
         os.mkdir(self.tempFilesDir)
+        os.mkdir(self.statsDir)
+        self._legacyStatsRead = True
         self.linkImports = config.linkImports
         super(FileJobStore, self).initialize(config)
 
     def resume(self):
         if not os.path.isdir(self.jobStoreDir):
             raise NoSuchJobStoreException(self.jobStoreDir)
+        self._indexed = os.path.exists(self.indexPath)
         super(FileJobStore, self).resume()
 
+    def writeConfig(self):
+        # Called with the merged configuration on restart, too, so a store can be migrated by
+        # restarting its workflow with the fileJobStoreIndex option.
+        if self.config.fileJobStoreIndex and not self._indexed:
+            self._createIndex()
+        super(FileJobStore, self).writeConfig()
+
     def robust_rmtree(self, path, max_retries=7):
         """Robustly tries to delete paths.
 
@@ -121,15 +181,23 @@ class FileJobStore(AbstractJobStore):
     ##########################################
 
     def create(self, jobNode):
-        # The absolute path to the job directory.
-        absJobDir = tempfile.mkdtemp(prefix="job", dir=self._getTempSharedDir())
-        # Sub directory to put temporary files associated with the job in
-        os.mkdir(os.path.join(absJobDir, "g"))
+        if self._indexed:
+            # The job directory is only created once the job writes a file
+            key = uuid.uuid4().hex
+            jobStoreID = self._getRelativePath(os.path.join(self._getShardDir(key), 'job' + key))
+        else:
+            # The absolute path to the job directory.
+            absJobDir = tempfile.mkdtemp(prefix="job", dir=self._getTempSharedDir())
+            # Sub directory to put temporary files associated with the job in
+            os.mkdir(os.path.join(absJobDir, "g"))
+            jobStoreID = self._getRelativePath(absJobDir)
         # Make the job
-        job = JobGraph.fromJobNode(jobNode, jobStoreID=self._getRelativePath(absJobDir),
+        job = JobGraph.fromJobNode(jobNode, jobStoreID=jobStoreID,
                                    tryCount=self._defaultTryCount())
         if hasattr(self, "_batchedJobGraphs") and self._batchedJobGraphs is not None:
             self._batchedJobGraphs.append(job)
+        elif self._indexed:
+            self._insertJobs([job])
         else:
             self.update(job)
         return job
@@ -138,20 +206,31 @@ class FileJobStore(AbstractJobStore):
     def batch(self):
         self._batchedJobGraphs = []
         yield
-        for jobGraph in self._batchedJobGraphs:
-            self.update(jobGraph)
+        if self._indexed:
+            self._insertJobs(self._batchedJobGraphs)
+        else:
+            for jobGraph in self._batchedJobGraphs:
+                self.update(jobGraph)
         self._batchedJobGraphs = None
 
     def exists(self, jobStoreID):
+        if self._indexed:
+            cursor = self._getConnection().execute('SELECT 1 FROM jobs WHERE id = ?',
+                                                   (jobStoreID,))
+            return cursor.fetchone() is not None
         return os.path.exists(self._getJobFileName(jobStoreID))
 
     def getPublicUrl(self, jobStoreFileID):
         self._checkJobStoreFileID(jobStoreFileID)
         jobStorePath = self._getAbsPath(jobStoreFileID)
-        if os.path.exists(jobStorePath):
-            return 'file:' + jobStorePath
-        else:
+        if not os.path.exists(jobStorePath):
             raise NoSuchFileException(jobStoreFileID)
+        if self.config.compressFiles:
+            # Whoever follows the URL expects the original content
+            publicPath = jobStorePath + '.public'
+            self._copyOut(jobStorePath, publicPath)
+            return 'file:' + publicPath
+        return 'file:' + jobStorePath
 
     def getSharedPublicUrl(self, sharedFileName):
         jobStorePath = self.jobStoreDir + '/' + sharedFileName
@@ -161,11 +240,13 @@ class FileJobStore(AbstractJobStore):
             raise NoSuchFileException(sharedFileName)
 
     def load(self, jobStoreID):
+        if self._indexed:
+            return self.loadMany([jobStoreID])[0]
         self._checkJobStoreId(jobStoreID)
         # Load a valid version of the job
         jobFile = self._getJobFileName(jobStoreID)
         with open(jobFile, 'rb') as fileHandle:
-            job = pickle.load(fileHandle)
+            job = decodeJobGraph(fileHandle.read())
         # The following cleans up any issues resulting from the failure of the
         # job during writing by the batch system.
         if os.path.isfile(jobFile + ".new"):
@@ -175,22 +256,60 @@ class FileJobStore(AbstractJobStore):
         return job
 
     def update(self, job):
+        if self._indexed:
+            self.updateMany([job])
+            return
         # The job is serialised to a file suffixed by ".new"
         # The file is then moved to its correct path.
         # Atomicity guarantees use the fact the underlying file systems "move"
         # function is atomic.
         with open(self._getJobFileName(job.jobStoreID) + ".new", 'wb') as f:
-            pickle.dump(job, f)
+            f.write(self._encodeJobGraph(job))
         # This should be atomic for the file system
         os.rename(self._getJobFileName(job.jobStoreID) + ".new", self._getJobFileName(job.jobStoreID))
 
     def delete(self, jobStoreID):
+        if self._indexed:
+            self.deleteMany([jobStoreID])
         # The jobStoreID is the relative path to the directory containing the job,
         # removing this directory deletes the job.
-        if self.exists(jobStoreID):
-            self.robust_rmtree(self._getAbsPath(jobStoreID))
+        elif self.exists(jobStoreID):
+            self._deleteJobDir(jobStoreID)
+
+    def _deleteJobDir(self, jobStoreID):
+        """
+        Delete the directory holding the given job and the files associated with it.
+        """
+        # Remember the content of the job's deduplicated files so their blobs can be
+        # released once the files are gone
+        filesDir = os.path.join(self._getAbsPath(jobStoreID), 'g')
+        try:
+            fileNames = os.listdir(filesDir)
+        except OSError as e:
+            # Jobs in an indexed store may not have a directory
+            if e.errno == errno.ENOENT and self._indexed:
+                return
+            raise
+        digests = [self._readDigest(os.path.join(filesDir, fileName[:-len(self.digestSuffix)]))
+                   for fileName in fileNames
+                   if fileName.endswith(self.digestSuffix)]
+        self.robust_rmtree(self._getAbsPath(jobStoreID))
+        for digest in digests:
+            if digest is not None:
+                self._releaseBlob(digest)
 
     def jobs(self):
+        if self._indexed:
+            # Page through the jobs so as not to lock the index while the caller iterates
+            lastID = ''
+            while True:
+                rows = self._getConnection().execute(
+                    'SELECT id, job FROM jobs WHERE id > ? ORDER BY id LIMIT ?',
+                    (lastID, self.indexPageSize)).fetchall()
+                for lastID, job in rows:
+                    yield self._decodeJob(job)
+                if len(rows) < self.indexPageSize:
+                    return
         # Walk through list of temporary directories searching for jobs
         for tempDir in self._tempDirectories():
             for i in os.listdir(tempDir):
@@ -201,6 +320,64 @@ class FileJobStore(AbstractJobStore):
                         # An orphaned job may leave an empty or incomplete job file which we can safely ignore
                         pass
 
+    ##########################################
+    # The following methods operate on several jobs at once. In an indexed store, each call is a
+    # single transaction.
+    ##########################################
+
+    def _selectJobs(self, columns, jobStoreIDs):
+        """
+        :return: the rows with the given columns for those of the given jobs that exist
+        :rtype: list[tuple]
+        """
+        rows = []
+        connection = self._getConnection()
+        # SQLite limits the number of parameters per statement
+        for i in range(0, len(jobStoreIDs), self.indexPageSize):
+            page = jobStoreIDs[i:i + self.indexPageSize]
+            cursor = connection.execute('SELECT %s FROM jobs WHERE id IN (%s)'
+                                        % (columns, ','.join('?' * len(page))), page)
+            rows.extend(cursor.fetchall())
+        return rows
+
+    def loadMany(self, jobStoreIDs):
+        if not self._indexed:
+            return super(FileJobStore, self).loadMany(jobStoreIDs)
+        jobs = dict(self._selectJobs('id, job', jobStoreIDs))
+        try:
+            return [self._decodeJob(jobs[jobStoreID]) for jobStoreID in jobStoreIDs]
+        except KeyError as e:
+            raise NoSuchJobException(e.args[0])
+
+    def updateMany(self, jobs):
+        if not self._indexed:
+            super(FileJobStore, self).updateMany(jobs)
+            return
+        # Either all jobs are updated or, if any of them doesn't exist, none is
+        with self._transaction() as connection:
+            for job in jobs:
+                cursor = connection.execute('UPDATE jobs SET job = ? WHERE id = ?',
+                                            (self._encodeJob(job), job.jobStoreID))
+                if cursor.rowcount != 1:
+                    raise NoSuchJobException(job.jobStoreID)
+
+    def existsMany(self, jobStoreIDs):
+        if not self._indexed:
+            return super(FileJobStore, self).existsMany(jobStoreIDs)
+        existing = {row[0] for row in self._selectJobs('id', jobStoreIDs)}
+        return [jobStoreID in existing for jobStoreID in jobStoreIDs]
+
+    def deleteMany(self, jobStoreIDs):
+        if not self._indexed:
+            super(FileJobStore, self).deleteMany(jobStoreIDs)
+            return
+        # Once a job is gone from the index, its files may be cleaned up at leisure
+        with self._transaction() as connection:
+            connection.executemany('DELETE FROM jobs WHERE id = ?',
+                                   ((jobStoreID,) for jobStoreID in jobStoreIDs))
+        for jobStoreID in jobStoreIDs:
+            self._deleteJobDir(jobStoreID)
+
     ##########################################
     # Functions that deal with temporary files associated with jobs
     ##########################################
@@ -213,11 +390,98 @@ class FileJobStore(AbstractJobStore):
         else:
             shutil.copyfile(srcPath, destPath)
 
+    # With referenceImports enabled, imported local files aren't copied into the store. A file on
+    # the same device as the store is reflinked, i.e. cloned copy-on-write, which makes it
+    # independent of its original. Where that isn't supported, or for a file on another device,
+    # the file is symlinked. A file ID linked to its original is accompanied by a small file with
+    # the same name plus this suffix, recording the path, size and modification time of the
+    # original that readers validate the original against. The original is never hard-linked,
+    # neither into the store nor by readFile(), since the user's file would then be modified by
+    # writes to the link and its permissions by the caching file store.
+    referenceSuffix = '.ref'
+
+    # The ioctl cloning a file on Linux, see ioctl_ficlone(2)
+    _FICLONE = 0x40049409
+
+    def _importReference(self, url, absPath):
+        srcPath = os.path.realpath(self._extractPathFromUrl(url))
+        if os.stat(srcPath).st_dev == os.stat(os.path.dirname(absPath)).st_dev:
+            if self._reflink(srcPath, absPath):
+                return
+        os.symlink(srcPath, absPath)
+        st = os.stat(absPath)
+        with open(absPath + self.referenceSuffix, 'w') as f:
+            json.dump(dict(path=srcPath, size=st.st_size, mtime=st.st_mtime), f)
+
+    @classmethod
+    def _reflink(cls, srcPath, dstPath):
+        """
+        Clone the given file copy-on-write if the file system supports it.
+
+        :return: whether the file was cloned
+        :rtype: bool
+        """
+        if not sys.platform.startswith('linux'):
+            return False
+        with open(srcPath, 'rb') as src:
+            with open(dstPath, 'wb') as dst:
+                try:
+                    fcntl.ioctl(dst.fileno(), cls._FICLONE, src.fileno())
+                except (IOError, OSError) as e:
+                    logger.debug("Can't reflink '%s': %s", srcPath, e)
+                else:
+                    return True
+        os.remove(dstPath)
+        return False
+
+    def _checkReference(self, jobStoreFileID, absPath):
+        """
+        Make sure that the original of the given file is unchanged if it was imported by reference.
+
+        :raises ReferencedFileModifiedException: if the original was modified or deleted
+
+        :return: whether the file was imported by reference
+        :rtype: bool
+        """
+        try:
+            with open(absPath + self.referenceSuffix, 'r') as f:
+                reference = json.load(f)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            else:
+                raise
+        try:
+            st = os.stat(absPath)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            if st.st_size == reference['size'] and st.st_mtime == reference['mtime']:
+                return True
+        raise ReferencedFileModifiedException(jobStoreFileID, reference['path'])
+
+    def _dropReference(self, absPath):
+        """
+        Unlink the given file from its original if it was imported by reference, so that
+        writing to it doesn't modify the original.
+        """
+        try:
+            os.remove(absPath + self.referenceSuffix)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            os.remove(absPath)
+
     def _importFile(self, otherCls, url, sharedFileName=None):
         if issubclass(otherCls, FileJobStore):
             if sharedFileName is None:
                 absPath = self._getUniqueName(url.path)  # use this to get a valid path to write to in job store
-                self._copyOrLink(url, absPath)
+                if self.config.referenceImports:
+                    self._importReference(url, absPath)
+                else:
+                    self._copyOrLink(url, absPath)
                 return FileID(self._getRelativePath(absPath), os.stat(absPath).st_size)
             else:
                 self._requireValidSharedFileName(sharedFileName)
@@ -230,7 +494,9 @@ class FileJobStore(AbstractJobStore):
 
     def _exportFile(self, otherCls, jobStoreFileID, url):
         if issubclass(otherCls, FileJobStore):
-            shutil.copyfile(self._getAbsPath(jobStoreFileID), self._extractPathFromUrl(url))
+            absPath = self._getAbsPath(jobStoreFileID)
+            self._checkReference(jobStoreFileID, absPath)
+            self._copyOut(absPath, self._extractPathFromUrl(url))
         else:
             super(FileJobStore, self)._exportFile(otherCls, jobStoreFileID, url)
 
@@ -290,15 +556,26 @@ class FileJobStore(AbstractJobStore):
         else:
             sourceFunctionName = "x"
         absPath = self._getUniqueName(localFilePath, jobStoreID, sourceFunctionName)
-        shutil.copyfile(localFilePath, absPath)
+        if self.config.deduplicateFiles:
+            self._writeDeduplicated(localFilePath, absPath)
+        else:
+            self._copyIn(localFilePath, absPath)
         return self._getRelativePath(absPath)
 
     @contextmanager
     def writeFileStream(self, jobStoreID=None):
         fd, absPath = self._getTempFile(jobStoreID)
-        with open(absPath, 'wb') as f:
-            yield f, self._getRelativePath(absPath)
-        os.close(fd)  # Close the os level file descriptor
+        if self.config.deduplicateFiles:
+            # The content can only be hashed once it is complete so write it next to its final
+            # location first.
+            with self._openForWriting(absPath + '.new') as f:
+                yield f, self._getRelativePath(absPath)
+            os.close(fd)
+            self._commitDeduplicated(absPath + '.new', absPath)
+        else:
+            with self._openForWriting(absPath) as f:
+                yield f, self._getRelativePath(absPath)
+            os.close(fd)  # Close the os level file descriptor
 
     def getEmptyFileStoreID(self, jobStoreID=None):
         with self.writeFileStream(jobStoreID) as (fileHandle, jobStoreFileID):
@@ -306,16 +583,33 @@ class FileJobStore(AbstractJobStore):
 
     def updateFile(self, jobStoreFileID, localFilePath):
         self._checkJobStoreFileID(jobStoreFileID)
-        shutil.copyfile(localFilePath, self._getAbsPath(jobStoreFileID))
+        self._dropReference(self._getAbsPath(jobStoreFileID))
+        if self.config.deduplicateFiles:
+            self._writeDeduplicated(localFilePath, self._getAbsPath(jobStoreFileID))
+        else:
+            self._copyIn(localFilePath, self._getAbsPath(jobStoreFileID))
 
     def readFile(self, jobStoreFileID, localFilePath, symlink=False):
-        self._checkJobStoreFileID(jobStoreFileID)
         jobStoreFilePath = self._getAbsPath(jobStoreFileID)
+        referenced = self._checkReference(jobStoreFileID, jobStoreFilePath)
+        self._checkJobStoreFileID(jobStoreFileID)
         localDirPath = os.path.dirname(localFilePath)
+        if referenced:
+            # The original belongs to the user, the caller gets a copy of it
+            jobStoreFilePath = os.path.realpath(jobStoreFilePath)
+            if not self._reflink(jobStoreFilePath, localFilePath):
+                shutil.copyfile(jobStoreFilePath, localFilePath)
+        elif self.config.compressFiles:
+            # Stored files may be compressed so they can't be linked
+            self._copyOut(jobStoreFilePath, localFilePath)
         # If local file would end up on same file system as the one hosting this job store ...
-        if os.stat(jobStoreFilePath).st_dev == os.stat(localDirPath).st_dev:
-            # ... we can hard-link the file, ...
-            if symlink:
+        elif os.stat(jobStoreFilePath).st_dev == os.stat(localDirPath).st_dev:
+            # ... we can link the file, unless it is deduplicated. Handing out hard links to a
+            # blob would defeat its reference count and expose the content of other files to
+            # modification.
+            if self.config.deduplicateFiles and not symlink:
+                shutil.copyfile(jobStoreFilePath, localFilePath)
+            elif symlink:
                 try:
                     os.symlink(jobStoreFilePath, localFilePath)
                 except OSError as e:
@@ -344,9 +638,18 @@ class FileJobStore(AbstractJobStore):
             shutil.copyfile(jobStoreFilePath, localFilePath)
 
     def deleteFile(self, jobStoreFileID):
+        absPath = self._getAbsPath(jobStoreFileID)
+        # The original of a file imported by reference may be gone already
+        self._dropReference(absPath)
         if not self.fileExists(jobStoreFileID):
             return
-        os.remove(self._getAbsPath(jobStoreFileID))
+        digest = self._readDigest(absPath)
+        os.remove(absPath)
+        if self.config.compressFiles and os.path.exists(absPath + '.public'):
+            os.remove(absPath + '.public')
+        if digest is not None:
+            os.remove(absPath + self.digestSuffix)
+            self._releaseBlob(digest)
 
     def fileExists(self, jobStoreFileID):
         absPath = self._getAbsPath(jobStoreFileID)
@@ -358,21 +661,37 @@ class FileJobStore(AbstractJobStore):
             raise NoSuchFileException("Path %s is not a file in the jobStore" % jobStoreFileID)
         return True
 
+    def waitForFileDeletion(self, jobStoreFileID, timeout):
+        return inotify.waitForDeletion(self._getAbsPath(jobStoreFileID), timeout)
+
     @contextmanager
     def updateFileStream(self, jobStoreFileID):
         self._checkJobStoreFileID(jobStoreFileID)
         # File objects are context managers (CM) so we could simply return what open returns.
         # However, it is better to wrap it in another CM so as to prevent users from accessing
         # the file object directly, without a with statement.
-        with open(self._getAbsPath(jobStoreFileID), 'wb') as f:
-            yield f
+        absPath = self._getAbsPath(jobStoreFileID)
+        self._dropReference(absPath)
+        if self.config.deduplicateFiles:
+            # Other files may share the stored content so it must be replaced, not overwritten.
+            with self._openForWriting(absPath + '.new') as f:
+                yield f
+            self._commitDeduplicated(absPath + '.new', absPath)
+        else:
+            with self._openForWriting(absPath) as f:
+                yield f
 
     @contextmanager
     def readFileStream(self, jobStoreFileID):
+        absPath = self._getAbsPath(jobStoreFileID)
+        self._checkReference(jobStoreFileID, absPath)
         self._checkJobStoreFileID(jobStoreFileID)
-        with open(self._getAbsPath(jobStoreFileID), 'rb') as f:
+        with self._openForReading(absPath) as f:
             yield f
 
+    def getFileContentHash(self, jobStoreFileID):
+        return self._readDigest(self._getAbsPath(jobStoreFileID))
+
     ##########################################
     # The following methods deal with shared files, i.e. files not associated
     # with specific jobs.
@@ -400,16 +719,157 @@ class FileJobStore(AbstractJobStore):
             else:
                 raise
 
+    def deleteSharedFile(self, sharedFileName):
+        assert self._validateSharedFileName(sharedFileName)
+        try:
+            os.remove(self._getSharedFilePath(sharedFileName))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
     def writeStatsAndLogging(self, statsAndLoggingString):
-        # Temporary files are placed in the set of temporary files/directories
-        fd, tempStatsFile = tempfile.mkstemp(prefix="stats", suffix=".new", dir=self._getTempSharedDir())
-        writeFormat = 'w' if isinstance(statsAndLoggingString, str) else 'wb'
-        with open(tempStatsFile, writeFormat) as f:
-            f.write(statsAndLoggingString)
-        os.close(fd)
-        os.rename(tempStatsFile, tempStatsFile[:-4])  # This operation is atomic
+        if not isinstance(statsAndLoggingString, bytes):
+            statsAndLoggingString = statsAndLoggingString.encode('utf-8')
+        record = self._statsRecordHeader.pack(len(statsAndLoggingString)) + statsAndLoggingString
+        # Spread the writers over the segments to keep them from contending for the same lock
+        segment = os.path.join(self.statsDir, '%i.log' % random.randrange(self.statsSegments))
+        try:
+            fd = os.open(segment, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Job stores created before the spool existed
+            self._makeDirs(self.statsDir)
+            fd = os.open(segment, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            flock(fd, LOCK_EX)
+            # O_APPEND isn't atomic on all shared file systems, the lock is what serializes
+            # the writers
+            os.lseek(fd, 0, os.SEEK_END)
+            while record:
+                record = record[os.write(fd, record):]
+        finally:
+            os.close(fd)
 
     def readStatsAndLogging(self, callback, readAll=False):
+        numberOfFilesProcessed = 0
+        if readAll or not self._legacyStatsRead:
+            numberOfFilesProcessed += self._readLegacyStatsAndLogging(callback, readAll)
+            self._legacyStatsRead = True
+        paths = [os.path.join(self.statsDir, segment) for segment in self._statsSegmentNames()]
+        if readAll:
+            for path in [self._statsArchivePath()] + paths:
+                try:
+                    f = open(path, 'rb')
+                except IOError as e:
+                    if e.errno == errno.ENOENT:
+                        continue
+                    raise
+                with f:
+                    # Keep writers from appending while the segment is read so that no partial
+                    # records are seen, on shared file systems in particular
+                    flock(f, LOCK_SH)
+                    for record in self._readStatsRecords(f, path):
+                        callback(BytesIO(record))
+                        numberOfFilesProcessed += 1
+        else:
+            for path in paths:
+                # The callback runs after the segment is unlocked so that it doesn't hold up the
+                # writers. Only the records it returned from are removed from the segment so that
+                # the others are read again should it fail or the leader die.
+                end = 0
+                try:
+                    for record in self._readStatsSegment(path):
+                        callback(BytesIO(record))
+                        numberOfFilesProcessed += 1
+                        end += self._statsRecordHeader.size + len(record)
+                finally:
+                    if end:
+                        self._drainStatsSegment(path, end)
+        return numberOfFilesProcessed
+
+    ##########################################
+    # Private methods
+    ##########################################
+
+    def _statsSegmentNames(self):
+        try:
+            return [name for name in os.listdir(self.statsDir) if name.endswith('.log')]
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return []
+            raise
+
+    def _statsArchivePath(self):
+        return os.path.join(self.statsDir, 'archive')
+
+    def _readStatsSegment(self, path):
+        """
+        Read the complete records in the given segment of the stats spool.
+
+        :rtype: list[bytes]
+        """
+        try:
+            if os.path.getsize(path) == 0:
+                return []
+            f = open(path, 'rb')
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return []
+            raise
+        with f:
+            # Keep writers from appending while the segment is read so that no partial records
+            # are seen, on shared file systems in particular
+            flock(f, LOCK_SH)
+            return list(self._readStatsRecords(f, path))
+
+    def _drainStatsSegment(self, path, end):
+        """
+        Remove the records before the given offset from the given segment of the stats spool,
+        appending them to the archive, so that the segment only ever holds records that haven't
+        been read yet. Only the leader drains segments and writers only append to them, so the
+        records read by _readStatsSegment() are still where they were.
+
+        :param int end: the offset of the first record to keep
+        """
+        with open(path, 'r+b') as f:
+            flock(f, LOCK_EX)
+            data = f.read(end)
+            assert len(data) == end
+            # Keep the records written since the segment was read
+            tail = f.read()
+            with open(self._statsArchivePath(), 'ab') as archive:
+                flock(archive, LOCK_EX)
+                archive.write(data)
+            f.seek(0)
+            f.write(tail)
+            f.truncate()
+
+    def _readStatsRecords(self, f, path):
+        """
+        Yield the complete records in the given segment of the stats spool, starting at the
+        current position of the given file and leaving it positioned after the last one.
+        """
+        headerSize = self._statsRecordHeader.size
+        while True:
+            start = f.tell()
+            header = f.read(headerSize)
+            if len(header) == headerSize:
+                size, = self._statsRecordHeader.unpack(header)
+                record = f.read(size)
+                if len(record) == size:
+                    yield record
+                    continue
+            if header:
+                logger.warn('Ignoring incomplete record at offset %i of %s.', start, path)
+            f.seek(start)
+            return
+
+    def _readLegacyStatsAndLogging(self, callback, readAll):
+        """
+        Read the stats and logging files written to the temporary directories before the stats
+        spool existed.
+        """
         numberOfFilesProcessed = 0
         for tempDir in self._tempDirectories():
             for tempFile in os.listdir(tempDir):
@@ -425,9 +885,142 @@ class FileJobStore(AbstractJobStore):
                         os.rename(absTempFile, newAbsTempFile)
         return numberOfFilesProcessed
 
-    ##########################################
-    # Private methods
-    ##########################################
+    def _canLinkFiles(self):
+        """
+        :return: whether files in the store hold exactly the content of a single file ID and
+                 may therefore be hard-linked by readFile()
+        :rtype: bool
+        """
+        return not (self.config.deduplicateFiles or self.config.compressFiles)
+
+    # With compression enabled, files are stored as written by a CompressingWriter with
+    # header=True. Content that doesn't compress well is stored as is and reading files without
+    # a header, e.g. ones written before compression was enabled, works as usual.
+
+    @contextmanager
+    def _openForWriting(self, absPath):
+        with open(absPath, 'wb') as f:
+            if self.config.compressFiles:
+                with CompressingWriter(f, self.config.compressFiles, header=True) as writer:
+                    yield writer
+            else:
+                yield f
+
+    @contextmanager
+    def _openForReading(self, absPath):
+        with open(absPath, 'rb') as f:
+            yield openCompressed(f)
+
+    def _copyIn(self, localFilePath, absPath):
+        if self.config.compressFiles:
+            with open(localFilePath, 'rb') as readable:
+                with self._openForWriting(absPath) as writable:
+                    shutil.copyfileobj(readable, writable, length=self.BUFFER_SIZE)
+        else:
+            shutil.copyfile(localFilePath, absPath)
+
+    def _copyOut(self, absPath, localFilePath):
+        if self.config.compressFiles:
+            with self._openForReading(absPath) as readable:
+                with open(localFilePath, 'wb') as writable:
+                    shutil.copyfileobj(readable, writable, length=self.BUFFER_SIZE)
+        else:
+            shutil.copyfile(absPath, localFilePath)
+
+    # With deduplication enabled, every distinct content is stored once as a blob, i.e. a file
+    # named after the SHA-256 digest of the content in self.blobsDir. Each file ID holding that
+    # content is a hard link to the blob and is accompanied by a small file with the same name
+    # plus this suffix recording the digest. The link count of a blob therefore doubles as its
+    # reference count, which is why readFile() never hard-links deduplicated files.
+    digestSuffix = '.sha256'
+
+    def _getBlobPath(self, digest):
+        return os.path.join(self.blobsDir, digest[:2], digest)
+
+    def _readDigest(self, absPath):
+        """
+        :rtype: str|None
+        :return: the digest of the blob the given file in the store is linked to or None if the
+                 file isn't deduplicated
+        """
+        try:
+            with open(absPath + self.digestSuffix, 'r') as f:
+                return f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            else:
+                raise
+
+    def _writeDeduplicated(self, localFilePath, absPath):
+        """
+        Store the content of the given local file at the given path in the store. The content is
+        only copied if no blob with the same content exists.
+        """
+        digest = self._hashFile(localFilePath)
+        tempPath = absPath + '.new'
+        try:
+            os.link(self._getBlobPath(digest), tempPath)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._copyIn(localFilePath, tempPath)
+        self._commitDeduplicated(tempPath, absPath, digest)
+
+    def _commitDeduplicated(self, tempPath, absPath, digest=None):
+        """
+        Move the file at tempPath to absPath, making it the blob for its content if there is no
+        such blob yet, or replacing it with a link to the existing blob otherwise. Any blob
+        previously referenced by the file at absPath is released.
+
+        :param str digest: the digest of the file's uncompressed content, computed if omitted
+        """
+        if digest is None:
+            with self._openForReading(tempPath) as f:
+                digest = self._hashStream(f)
+        blobPath = self._getBlobPath(digest)
+        try:
+            os.makedirs(os.path.dirname(blobPath))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        while True:
+            try:
+                os.link(tempPath, blobPath)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            else:
+                break
+            try:
+                if os.path.samestat(os.stat(tempPath), os.stat(blobPath)):
+                    break
+                os.link(blobPath, tempPath + '.blob')
+            except OSError as e:
+                # The blob was released concurrently, try making this file the blob again
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                os.rename(tempPath + '.blob', tempPath)
+                break
+        previousDigest = self._readDigest(absPath)
+        with open(absPath + self.digestSuffix, 'w') as f:
+            f.write(digest)
+        os.rename(tempPath, absPath)
+        if previousDigest is not None and previousDigest != digest:
+            self._releaseBlob(previousDigest)
+
+    def _releaseBlob(self, digest):
+        """
+        Delete the blob with the given digest if no file in the store links to it anymore.
+        """
+        blobPath = self._getBlobPath(digest)
+        try:
+            if os.stat(blobPath).st_nlink == 1:
+                os.remove(blobPath)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
 
     def _getAbsPath(self, relativePath):
         """
@@ -491,12 +1084,15 @@ class FileJobStore(AbstractJobStore):
 
     def _tempDirectories(self):
         """
-        :rtype : an iterator to the temporary directories containing jobs/stats files
+        :rtype : an iterator to the temporary directories containing jobs and files
         in the hierarchy of directories in self.tempFilesDir
         """
         def _dirs(path, levels):
             if levels > 0:
                 for subPath in os.listdir(path):
+                    if levels == self.levels and subPath == self.shardsDirName:
+                        # Jobs and files in the indexed layout live here
+                        continue
                     for i in _dirs(os.path.join(path, subPath), levels-1):
                         yield i
             else:
@@ -537,8 +1133,104 @@ class FileJobStore(AbstractJobStore):
         if jobStoreID != None:
             # Make a temporary file within the job's directory
             self._checkJobStoreId(jobStoreID)
-            return tempfile.mkstemp(suffix=".tmp",
-                                dir=os.path.join(self._getAbsPath(jobStoreID), "g"))
+            filesDir = os.path.join(self._getAbsPath(jobStoreID), "g")
+            if self._indexed:
+                self._makeDirs(filesDir)
+            return tempfile.mkstemp(suffix=".tmp", dir=filesDir)
+        elif self._indexed:
+            shardDir = self._getShardDir(uuid.uuid4().hex)
+            self._makeDirs(shardDir)
+            return tempfile.mkstemp(prefix="tmp", suffix=".tmp", dir=shardDir)
         else:
             # Make a temporary file within the temporary file structure
             return tempfile.mkstemp(prefix="tmp", suffix=".tmp", dir=self._getTempSharedDir())
+
+    # In the indexed layout, jobs are stored in a SQLite database instead of one file per job.
+    # Enumerating, loading and updating jobs then takes a handful of queries instead of a walk
+    # over the file system and creating a job doesn't create any directories. The directories of
+    # jobs that write files, and files not associated with a job, are spread over a fixed
+    # hierarchy of directories below shardsDirName, named after a random hexadecimal key.
+
+    def _getShardDir(self, key):
+        """
+        :param str key: a hexadecimal string of at least four characters
+        :return: the absolute path to the directory for items with the given key
+        :rtype: str
+        """
+        return os.path.join(self.tempFilesDir, self.shardsDirName, key[:2], key[2:4])
+
+    @staticmethod
+    def _makeDirs(dirPath):
+        try:
+            os.makedirs(dirPath)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _getConnection(self):
+        """
+        :return: the current thread's connection to the index
+        :rtype: sqlite3.Connection
+        """
+        # SQLite connections can be used neither by other threads nor across a fork
+        connection = getattr(self._connections, 'connection', None)
+        if connection is None or self._connections.pid != os.getpid():
+            # Transactions are managed explicitly by _transaction()
+            connection = sqlite3.connect(self.indexPath, timeout=self.indexTimeout,
+                                         isolation_level=None)
+            self._connections.connection = connection
+            self._connections.pid = os.getpid()
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._getConnection()
+        # Take the write lock up front to avoid deadlocks between concurrent writers
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        else:
+            connection.execute('COMMIT')
+
+    def _encodeJob(self, job):
+        return sqlite3.Binary(self._encodeJobGraph(job))
+
+    @staticmethod
+    def _decodeJob(data):
+        return decodeJobGraph(bytes(data))
+
+    def _insertJobs(self, jobs):
+        with self._transaction() as connection:
+            connection.executemany('INSERT INTO jobs VALUES (?, ?)',
+                                   ((job.jobStoreID, self._encodeJob(job)) for job in jobs))
+
+    def _createIndex(self):
+        """
+        Create the index, moving any jobs stored in the per-job files of the original layout
+        into it. Files stay where they are so migrated jobs keep their IDs.
+        """
+        tempPath = self.indexPath + '.new'
+        if os.path.exists(tempPath):
+            # Left behind by an interrupted migration
+            os.remove(tempPath)
+        jobs = list(self.jobs())
+        connection = sqlite3.connect(tempPath, isolation_level=None)
+        try:
+            connection.execute('CREATE TABLE jobs (id TEXT PRIMARY KEY, job BLOB NOT NULL)')
+            connection.execute('BEGIN')
+            connection.executemany('INSERT INTO jobs VALUES (?, ?)',
+                                   ((job.jobStoreID, self._encodeJob(job)) for job in jobs))
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+        # The store switches layouts atomically. Should the old job files survive a crash after
+        # this, they are ignored.
+        os.rename(tempPath, self.indexPath)
+        self._indexed = True
+        for job in jobs:
+            os.remove(self._getJobFileName(job.jobStoreID))
+        if jobs:
+            logger.info('Migrated %i jobs into the index of the job store.', len(jobs))
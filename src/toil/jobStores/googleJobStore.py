@@ -20,15 +20,12 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import str
 from contextlib import contextmanager
+from io import BytesIO
 import uuid
 import logging
 import time
 import os
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
 
 from toil.lib.retry import retry
 from google.cloud import storage, exceptions
@@ -42,8 +39,9 @@ from toil.jobStores.abstractJobStore import (AbstractJobStore, NoSuchJobExceptio
                                              NoSuchFileException, NoSuchJobStoreException,
                                              JobStoreExistsException,
                                              ConcurrentFileModificationException)
-from toil.jobStores.utils import WritablePipe, ReadablePipe
+from toil.jobStores.utils import ReadablePipe, SpooledWritablePipe, mapConcurrently
 from toil.jobGraph import JobGraph
+from toil.jobStores.serialization import decodeJobGraph
 log = logging.getLogger(__name__)
 
 GOOGLE_STORAGE = 'gs'
@@ -91,6 +89,15 @@ def googleRetry(f):
 class GoogleJobStore(AbstractJobStore):
 
     nodeServiceAccountJson = '/root/service_account.json'
+
+    # The number of jobs that are loaded or written concurrently, each with a request of its own
+    # since batch requests can't carry the content of objects. Stays within the default size of
+    # the client's connection pool.
+    jobThreads = 8
+
+    # Likewise for the files imported or exported at once
+    importExportThreads = jobThreads
+
     def __init__(self, locator):
         super(GoogleJobStore, self).__init__()
 
@@ -171,9 +178,23 @@ class GoogleJobStore(AbstractJobStore):
         if hasattr(self, "_batchedJobGraphs") and self._batchedJobGraphs is not None:
             self._batchedJobGraphs.append(job)
         else:
-            self._writeString(jobStoreID, pickle.dumps(job, protocol=pickle.HIGHEST_PROTOCOL))  # UPDATE: bz2.compress(
+            self._writeString(jobStoreID, self._encodeJobGraph(job))  # UPDATE: bz2.compress(
         return job
 
+    @contextmanager
+    def batch(self):
+        self._batchedJobGraphs = []
+        yield
+        self._writeJobs(self._batchedJobGraphs, update=False)
+        self._batchedJobGraphs = None
+
+    def _writeJobs(self, jobs, update):
+        def writeJob(job):
+            self._writeString(job.jobStoreID, self._encodeJobGraph(job), update=update)
+
+        for _ in mapConcurrently(writeJob, jobs, self.jobThreads):
+            pass
+
     def _newJobID(self):
         return "job"+str(uuid.uuid4())
 
@@ -196,10 +217,10 @@ class GoogleJobStore(AbstractJobStore):
             jobString = self._readContents(jobStoreID)
         except NoSuchFileException:
             raise NoSuchJobException(jobStoreID)
-        return pickle.loads(jobString)  # UPDATE bz2.decompress(
+        return decodeJobGraph(jobString)  # UPDATE bz2.decompress(
 
     def update(self, job):
-        self._writeString(job.jobStoreID, pickle.dumps(job, protocol=pickle.HIGHEST_PROTOCOL), update=True)
+        self._writeString(job.jobStoreID, self._encodeJobGraph(job), update=True)
 
     @googleRetry
     def delete(self, jobStoreID):
@@ -210,11 +231,26 @@ class GoogleJobStore(AbstractJobStore):
             self._delete(blob.name)
 
     @googleRetry
+    def deleteMany(self, jobStoreIDs):
+        self._deleteBlobs(jobStoreIDs)
+        # best effort delete associated files
+        self._deleteBlobs([blob.name
+                           for jobStoreID in jobStoreIDs
+                           for blob in self.bucket.list_blobs(prefix=bytes(jobStoreID))])
+
     def jobs(self):
-        for blob in self.bucket.list_blobs(prefix=b'job'):
-            jobStoreID = blob.name
-            if len(jobStoreID) == 39:  # 'job' + uuid length
-                yield self.load(jobStoreID)
+        jobStoreIDs = (blob.name for blob in self.bucket.list_blobs(prefix=b'job')
+                       if len(blob.name) == 39)  # 'job' + uuid length
+        # Loads the jobs while the remaining pages of the listing are fetched
+        return mapConcurrently(self.load, jobStoreIDs, self.jobThreads)
+
+    def loadMany(self, jobStoreIDs):
+        jobs = dict(mapConcurrently(lambda jobStoreID: (jobStoreID, self.load(jobStoreID)),
+                                    jobStoreIDs, self.jobThreads))
+        return [jobs[jobStoreID] for jobStoreID in jobStoreIDs]
+
+    def updateMany(self, jobs):
+        self._writeJobs(jobs, update=True)
 
     def writeFile(self, localFilePath, jobStoreID=None):
         fileID = self._newID(isFile=True, jobStoreID=jobStoreID)
@@ -251,6 +287,9 @@ class GoogleJobStore(AbstractJobStore):
     def deleteFile(self, jobStoreFileID):
         self._delete(jobStoreFileID)
 
+    def deleteFiles(self, jobStoreFileIDs):
+        self._deleteBlobs(list(jobStoreFileIDs))
+
     @googleRetry
     def fileExists(self, jobStoreFileID):
         return self.bucket.blob(bytes(jobStoreFileID), encryption_key=self.sseKey).exists()
@@ -274,6 +313,9 @@ class GoogleJobStore(AbstractJobStore):
         with self._downloadStream(sharedFileName, encrypt=isProtected) as readable:
             yield readable
 
+    def deleteSharedFile(self, sharedFileName):
+        self._delete(sharedFileName)
+
     @classmethod
     @googleRetry
     def _getBlobFromURL(cls, url, exists=False):
@@ -393,6 +435,20 @@ class GoogleJobStore(AbstractJobStore):
         # remember, this is supposed to be idempotent, so we don't do anything
         # if the file doesn't exist
 
+    # The maximum number of calls in a batch request
+    callsPerBatch = 100
+
+    @googleRetry
+    def _deleteBlobs(self, names):
+        for i in range(0, len(names), self.callsPerBatch):
+            try:
+                with self.storageClient.batch():
+                    for name in names[i:i + self.callsPerBatch]:
+                        self.bucket.delete_blob(bytes(name))
+            except exceptions.NotFound:
+                # Deletion is idempotent, and the other calls in the batch were carried out
+                pass
+
     @googleRetry
     def _readContents(self, jobStoreID):
         """
@@ -426,7 +482,7 @@ class GoogleJobStore(AbstractJobStore):
     def _uploadStream(self, fileName, update=False, encrypt=True):
         """
         Yields a context manager that can be used to write to the bucket
-        with a stream. See :class:`~toil.jobStores.utils.WritablePipe` for an example.
+        with a stream. See :class:`~toil.jobStores.utils.SpooledWritablePipe` for an example.
 
         Will throw assertion error if the file shouldn't be updated
         and yet exists.
@@ -437,12 +493,12 @@ class GoogleJobStore(AbstractJobStore):
         :type update: bool
         :param encrypt: whether or not the file is encrypted
         :type encrypt: bool
-        :return: an instance of WritablePipe.
-        :rtype: :class:`~toil.jobStores.utils.writablePipe`
+        :return: an instance of SpooledWritablePipe.
+        :rtype: :class:`~toil.jobStores.utils.SpooledWritablePipe`
         """
         blob = self.bucket.blob(bytes(fileName), encryption_key=self.sseKey if encrypt else None)
 
-        class UploadPipe(WritablePipe):
+        class UploadPipe(SpooledWritablePipe):
             def readFrom(self, readable):
                 if not update:
                     assert not blob.exists()
@@ -462,12 +518,19 @@ class GoogleJobStore(AbstractJobStore):
         :type fileName: str
         :param encrypt: whether or not the file is encrypted
         :type encrypt: bool
-        :return: an instance of ReadablePipe.
+        :return: an instance of ReadablePipe, or of BytesIO for small files
         :rtype: :class:`~toil.jobStores.utils.ReadablePipe`
         """
         blob = self.bucket.get_blob(bytes(fileName), encryption_key=self.sseKey if encrypt else None)
         if blob is None:
             raise NoSuchFileException(fileName)
+        if blob.size <= SpooledWritablePipe.bufferSize:
+            # Small files are downloaded in this thread
+            readable = BytesIO()
+            blob.download_to_file(readable)
+            readable.seek(0)
+            yield readable
+            return
 
         class DownloadPipe(ReadablePipe):
             def writeTo(self, writable):
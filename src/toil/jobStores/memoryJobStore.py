@@ -0,0 +1,458 @@
+# Copyright (C) 2015-2018 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# python 2/3 compatibility
+from __future__ import absolute_import
+from builtins import object
+
+# standard library
+from collections import defaultdict
+from contextlib import contextmanager
+from io import BytesIO
+import atexit
+import errno
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+# toil and bd2k dependencies
+from toil.jobStores.abstractJobStore import (AbstractJobStore,
+                                             NoSuchJobException,
+                                             NoSuchFileException,
+                                             JobStoreExistsException,
+                                             NoSuchJobStoreException)
+from toil.jobGraph import JobGraph
+from toil.jobStores.serialization import decodeJobGraph
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryJobStore(AbstractJobStore):
+    """
+    A job store that keeps jobs and files in the memory of the current process. All instances of
+    this class with the same name share the same storage, which is lost when the process exits.
+    Workers must therefore run in the leader's process, i.e. with the single machine batch system
+    and the debugWorker option.
+
+    Files larger than the memJobStoreSpillSize option are kept in a temporary directory instead.
+    """
+
+    # Maps the name of each job store in this process to its storage
+    _stores = {}
+    _storesLock = threading.Lock()
+
+    # Bytes read at a time when copying files
+    bufferSize = 1 << 20
+
+    def __init__(self, name):
+        """
+        :param str name: the name of the job store, unique within the current process
+        """
+        super(MemoryJobStore, self).__init__()
+        if not name:
+            raise RuntimeError('The in-memory job store requires a name, e.g. mem:myWorkflow.')
+        self.name = name
+        self.locator = 'mem:' + name
+        self._storage = None
+
+    def initialize(self, config):
+        with self._storesLock:
+            if self.name in self._stores:
+                raise JobStoreExistsException(self.locator)
+            self._storage = self._stores[self.name] = _Storage()
+        super(MemoryJobStore, self).initialize(config)
+
+    def resume(self):
+        with self._storesLock:
+            try:
+                self._storage = self._stores[self.name]
+            except KeyError:
+                raise NoSuchJobStoreException(self.locator)
+        super(MemoryJobStore, self).resume()
+
+    def destroy(self):
+        with self._storesLock:
+            storage = self._stores.pop(self.name, None)
+        if storage is not None:
+            storage.removeSpillDir()
+
+    ##########################################
+    # The following methods deal with creating/loading/updating/writing/checking for the
+    # existence of jobs
+    ##########################################
+
+    def create(self, jobNode):
+        job = JobGraph.fromJobNode(jobNode, jobStoreID='job' + uuid.uuid4().hex,
+                                   tryCount=self._defaultTryCount())
+        self.update(job)
+        return job
+
+    def exists(self, jobStoreID):
+        return jobStoreID in self._storage.jobs
+
+    def load(self, jobStoreID):
+        # Jobs are stored serialized so that callers can't modify them without an update
+        try:
+            return decodeJobGraph(self._storage.jobs[jobStoreID])
+        except KeyError:
+            raise NoSuchJobException(jobStoreID)
+
+    def update(self, job):
+        self._storage.jobs[job.jobStoreID] = self._encodeJobGraph(job)
+
+    def delete(self, jobStoreID):
+        storage = self._storage
+        with storage.lock:
+            storage.jobs.pop(jobStoreID, None)
+            fileIDs = storage.jobFiles.pop(jobStoreID, ())
+        self.deleteFiles(list(fileIDs))
+
+    def jobs(self):
+        for data in list(self._storage.jobs.values()):
+            yield decodeJobGraph(data)
+
+    def getPublicUrl(self, jobStoreFileID):
+        return 'file:' + self._storage.spill(self._getFile(jobStoreFileID))
+
+    def getSharedPublicUrl(self, sharedFileName):
+        return 'file:' + self._storage.spill(self._getSharedFile(sharedFileName))
+
+    ##########################################
+    # Functions that deal with files associated with jobs
+    ##########################################
+
+    @classmethod
+    def _supportsUrl(cls, url, export=False):
+        # Files in memory can't be addressed from elsewhere, but importFile() and exportFile()
+        # work with the URLs supported by the other job stores.
+        return False
+
+    # Since _supportsUrl() rejects every URL, the following are only reached when called directly
+
+    @classmethod
+    def _unsupportedUrl(cls, url, export=False):
+        return RuntimeError("The in-memory job store doesn't support %sporting for URL '%s'" %
+                            ('ex' if export else 'im', url.geturl()))
+
+    @classmethod
+    def getSize(cls, url):
+        raise cls._unsupportedUrl(url)
+
+    @classmethod
+    def _readFromUrl(cls, url, writable):
+        raise cls._unsupportedUrl(url)
+
+    @classmethod
+    def _writeToUrl(cls, readable, url):
+        raise cls._unsupportedUrl(url, export=True)
+
+    def writeFile(self, localFilePath, jobStoreID=None):
+        with open(localFilePath, 'rb') as readable:
+            with self.writeFileStream(jobStoreID) as (writable, jobStoreFileID):
+                shutil.copyfileobj(readable, writable, self.bufferSize)
+        return jobStoreFileID
+
+    @contextmanager
+    def writeFileStream(self, jobStoreID=None):
+        storage = self._storage
+        jobStoreFileID = str(uuid.uuid4())
+        with storage.lock:
+            if jobStoreID is not None:
+                if jobStoreID not in storage.jobs:
+                    raise NoSuchJobException(jobStoreID)
+                storage.jobFiles[jobStoreID].add(jobStoreFileID)
+            # The file exists as soon as its ID is handed out
+            storage.files[jobStoreFileID] = _File(b'', jobStoreID)
+        with self._writing() as writer:
+            yield writer, jobStoreFileID
+        self._replaceFile(storage.files, jobStoreFileID, writer, jobStoreID)
+
+    def getEmptyFileStoreID(self, jobStoreID=None):
+        with self.writeFileStream(jobStoreID) as (writable, jobStoreFileID):
+            return jobStoreFileID
+
+    def readFile(self, jobStoreFileID, localFilePath, symlink=False):
+        f = self._getFile(jobStoreFileID)
+        if f.path is not None:
+            # Spilled files are never modified, only replaced, so they can be linked
+            try:
+                os.unlink(localFilePath)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            try:
+                os.link(f.path, localFilePath)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+        with f.open() as readable:
+            with open(localFilePath, 'wb') as writable:
+                shutil.copyfileobj(readable, writable, self.bufferSize)
+
+    @contextmanager
+    def readFileStream(self, jobStoreFileID):
+        with self._getFile(jobStoreFileID).open() as readable:
+            yield readable
+
+    def deleteFile(self, jobStoreFileID):
+        storage = self._storage
+        with storage.lock:
+            f = storage.files.pop(jobStoreFileID, None)
+            if f is None:
+                return
+            if f.ownerID is not None:
+                storage.jobFiles.get(f.ownerID, set()).discard(jobStoreFileID)
+            storage.fileDeleted.notify_all()
+        f.release()
+
+    def fileExists(self, jobStoreFileID):
+        return jobStoreFileID in self._storage.files
+
+    def waitForFileDeletion(self, jobStoreFileID, timeout):
+        storage = self._storage
+        deadline = time.time() + timeout
+        with storage.lock:
+            while jobStoreFileID in storage.files:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                storage.fileDeleted.wait(remaining)
+        return True
+
+    def updateFile(self, jobStoreFileID, localFilePath):
+        with open(localFilePath, 'rb') as readable:
+            with self.updateFileStream(jobStoreFileID) as writable:
+                shutil.copyfileobj(readable, writable, self.bufferSize)
+
+    @contextmanager
+    def updateFileStream(self, jobStoreFileID):
+        ownerID = self._getFile(jobStoreFileID).ownerID
+        with self._writing() as writer:
+            yield writer
+        self._replaceFile(self._storage.files, jobStoreFileID, writer, ownerID)
+
+    ##########################################
+    # The following methods deal with shared files, i.e. files not associated
+    # with specific jobs.
+    ##########################################
+
+    @contextmanager
+    def writeSharedFileStream(self, sharedFileName, isProtected=None):
+        # Nothing leaves the process so there is no need for encryption
+        self._requireValidSharedFileName(sharedFileName)
+        with self._writing() as writer:
+            yield writer
+        self._replaceFile(self._storage.sharedFiles, sharedFileName, writer)
+
+    @contextmanager
+    def readSharedFileStream(self, sharedFileName):
+        with self._getSharedFile(sharedFileName).open() as readable:
+            yield readable
+
+    def deleteSharedFile(self, sharedFileName):
+        self._requireValidSharedFileName(sharedFileName)
+        with self._storage.lock:
+            f = self._storage.sharedFiles.pop(sharedFileName, None)
+        if f is not None:
+            f.release()
+
+    def writeStatsAndLogging(self, statsAndLoggingString):
+        if not isinstance(statsAndLoggingString, bytes):
+            statsAndLoggingString = statsAndLoggingString.encode('utf-8')
+        with self._storage.lock:
+            self._storage.statsAndLogging.append([statsAndLoggingString, False])
+
+    def readStatsAndLogging(self, callback, readAll=False):
+        with self._storage.lock:
+            entries = [entry for entry in self._storage.statsAndLogging if readAll or not entry[1]]
+            for entry in entries:
+                entry[1] = True
+        for data, _ in entries:
+            callback(BytesIO(data))
+        return len(entries)
+
+    ##########################################
+    # Private methods
+    ##########################################
+
+    def _getFile(self, jobStoreFileID):
+        try:
+            return self._storage.files[jobStoreFileID]
+        except KeyError:
+            raise NoSuchFileException(jobStoreFileID)
+
+    def _getSharedFile(self, sharedFileName):
+        try:
+            return self._storage.sharedFiles[sharedFileName]
+        except KeyError:
+            raise NoSuchFileException(sharedFileName)
+
+    @contextmanager
+    def _writing(self):
+        """
+        A context manager yielding a writer for the content of a new version of a file.
+        """
+        writer = _SpillingWriter(self._storage, self.config.memJobStoreSpillSize)
+        try:
+            yield writer
+        except:
+            writer.discard()
+            raise
+
+    def _replaceFile(self, files, key, writer, ownerID=None):
+        """
+        Make the content written by the given writer the content of the file with the given key
+        in the given dictionary, releasing the file's previous content.
+        """
+        f = writer.commit(ownerID)
+        with self._storage.lock:
+            previous = files.get(key)
+            files[key] = f
+        if previous is not None:
+            previous.release()
+
+
+class _File(object):
+    """
+    The content of a file in a memory job store, either in memory or in a temporary file.
+    """
+
+    def __init__(self, content=None, ownerID=None, path=None):
+        """
+        :param bytes content: the content, or None if it is spilled to the given path
+        :param str ownerID: the ID of the job the file belongs to
+        """
+        self.content = content
+        self.ownerID = ownerID
+        self.path = path
+
+    def open(self):
+        # See _Storage.spill() for why the content is looked at first
+        content = self.content
+        if content is None:
+            return open(self.path, 'rb')
+        else:
+            return BytesIO(content)
+
+    def release(self):
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+class _SpillingWriter(object):
+    """
+    Collects the content of a file in memory until it exceeds the given number of bytes, at which
+    point it is moved to a temporary file.
+    """
+
+    def __init__(self, storage, spillSize):
+        self.storage = storage
+        self.spillSize = spillSize
+        self.buffer = BytesIO()
+        self.file = None
+
+    def write(self, data):
+        if self.file is None:
+            self.buffer.write(data)
+            if self.spillSize is not None and self.buffer.tell() > self.spillSize:
+                self.file = open(self.storage.newSpillPath(), 'wb')
+                self.file.write(self.buffer.getvalue())
+                self.buffer = None
+        else:
+            self.file.write(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def commit(self, ownerID):
+        """
+        :rtype: _File
+        """
+        if self.file is None:
+            return _File(self.buffer.getvalue(), ownerID)
+        else:
+            self.file.close()
+            return _File(None, ownerID, self.file.name)
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            os.remove(self.file.name)
+
+
+class _Storage(object):
+    """
+    The jobs and files of a memory job store.
+    """
+
+    def __init__(self):
+        # Guards compound updates, single dictionary operations are atomic
+        self.lock = threading.RLock()
+        # Notified whenever a file is deleted
+        self.fileDeleted = threading.Condition(self.lock)
+        # Maps job IDs to serialized job graphs
+        self.jobs = {}
+        # Maps the IDs of files and the names of shared files to _File instances
+        self.files = {}
+        self.sharedFiles = {}
+        # Maps job IDs to the IDs of the files that belong to the job
+        self.jobFiles = defaultdict(set)
+        # Pairs of a stats and logging string and whether it was read
+        self.statsAndLogging = []
+        self.spillDir = None
+
+    def newSpillPath(self):
+        with self.lock:
+            if self.spillDir is None:
+                self.spillDir = tempfile.mkdtemp(prefix='toil-mem-')
+                atexit.register(shutil.rmtree, self.spillDir, ignore_errors=True)
+        fd, path = tempfile.mkstemp(dir=self.spillDir)
+        os.close(fd)
+        return path
+
+    def spill(self, f):
+        """
+        Ensure that the content of the given file is held in a temporary file.
+
+        :param _File f: the file
+        :return: the path of the temporary file
+        :rtype: str
+        """
+        with self.lock:
+            if f.path is None:
+                path = self.newSpillPath()
+                with open(path, 'wb') as writable:
+                    writable.write(f.content)
+                # Readers may be looking at the file concurrently
+                f.path = path
+                f.content = None
+            return f.path
+
+    def removeSpillDir(self):
+        if self.spillDir is not None:
+            shutil.rmtree(self.spillDir, ignore_errors=True)
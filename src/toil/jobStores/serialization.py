@@ -0,0 +1,368 @@
+# Copyright (C) 2015-2018 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+The serialization of the job graphs persisted in the job stores.
+
+Job graphs are pickled by default. With the --compactJobs option, the job stores write them in
+a compact binary encoding whose records are 20-40% smaller, even after compression, but which is
+pure Python and therefore takes 3-4 times as long as cPickle to encode and decode, see
+:meth:`toil.test.jobStores.serializationTest.SerializationTest.testBenchmark`.
+
+A compact record starts with a magic number and a format version, followed by a table of the distinct
+strings in the record and finally the job graph itself. Every value is a one-byte tag followed by
+its payload. Integers and lengths are varints, strings are references into the string table and
+the attributes of job graphs and job nodes are written in the fixed order defined by the schema
+of the format version instead of by name. Records with values the schema does not cover, custom
+attributes or classes for example, are pickled instead. Pickled records, including those written
+before this encoding existed, are recognized and loaded transparently.
+"""
+
+from __future__ import absolute_import
+
+from itertools import repeat
+import logging
+import struct
+import sys
+
+from six import integer_types, text_type
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+log = logging.getLogger(__name__)
+
+# No pickle starts with this byte, it isn't a pickle opcode
+magic = b'\xffTJG'
+
+version = 1
+
+_none, _false, _true, _int, _float, _string, _list, _tuple, _set, _dict, _object = range(11)
+
+# Small non-negative integers and references to the first strings in the string table are
+# written as a single byte, their tag
+_smallInt = 0x10
+_maxSmallInt = 0x2f
+_smallString = 0x40
+_maxSmallString = 0xff
+
+# The kinds of strings in the string table. Native strings are bytes in Python 2 and text in
+# Python 3, they are kept apart from the other two so that every string is decoded to its
+# original type.
+_native, _text, _bytes = range(3)
+
+_packDouble = struct.Struct('<d')
+
+_py3 = sys.version_info >= (3, 0)
+
+# Maps each format version to the classes it encodes, indexed by their code in records of that
+# version, and the names of their attributes in the order they are written in
+_schemas = None
+
+
+def _getSchemas():
+    global _schemas
+    if _schemas is None:
+        from toil.job import JobNode, ServiceJobNode
+        from toil.jobGraph import JobGraph
+        jobNodeFields = ('jobStoreID', 'command', 'jobName', 'unitName', 'displayName',
+                         '_memory', '_cores', '_disk', '_preemptable', '_config',
+                         'predecessorNumber')
+        _schemas = {
+            1: [(JobNode, jobNodeFields),
+                (ServiceJobNode, jobNodeFields + ('startJobStoreID', 'terminateJobStoreID',
+                                                  'errorJobStoreID')),
+                (JobGraph, jobNodeFields + ('remainingRetryCount', 'filesToDelete',
+                                            'predecessorsFinished', 'stack', 'services',
+                                            'logJobStoreFileID', 'startJobStoreID',
+                                            'terminateJobStoreID', 'errorJobStoreID', 'checkpoint',
+                                            'checkpointFilesToDelete', 'chainedJobs'))]}
+    return _schemas
+
+
+class UnsupportedValueError(ValueError):
+    """
+    Raised when a job graph holds a value that can't be encoded in the current format version.
+    """
+
+
+def encodeJobGraph(jobGraph, compact=False):
+    """
+    Serialize the given job graph into a pickle or into a compact record.
+
+    :param toil.jobGraph.JobGraph jobGraph: the job graph, or an instance of a subclass of it
+           that has no attributes of its own
+
+    :param bool compact: whether to write a record in the current format version of the compact
+           encoding, trading speed for size. Job graphs holding values the format doesn't
+           support are pickled regardless.
+
+    :rtype: bytes
+    """
+    if compact:
+        try:
+            return _Encoder().encode(jobGraph)
+        except UnsupportedValueError as e:
+            log.debug('Pickling job %s: %s', jobGraph.jobStoreID, e)
+    return pickle.dumps(jobGraph, pickle.HIGHEST_PROTOCOL)
+
+
+def decodeJobGraph(data, cls=None):
+    """
+    Deserialize a job graph from a record written by :func:`encodeJobGraph`, or from a pickle.
+
+    :param bytes data: the record
+
+    :param type cls: the class to instantiate the job graph as, defaults to
+           :class:`toil.jobGraph.JobGraph`. Ignored for pickles, which record their class.
+
+    :rtype: toil.jobGraph.JobGraph
+    """
+    if data[:len(magic)] == magic:
+        return _decode(data, cls)
+    else:
+        return pickle.loads(data)
+
+
+
+
+class _Encoder(object):
+    def __init__(self):
+        self.classes = {cls: (code, fields)
+                        for code, (cls, fields) in enumerate(_getSchemas()[version])}
+        # Maps the kind and value of each string to its index in the string table
+        self.strings = {}
+        self.stringData = []
+        # The index and kind of every string in the table that is not a native string
+        self.otherStrings = []
+        self.body = bytearray()
+
+    def encode(self, jobGraph):
+        from toil.jobGraph import JobGraph
+        if not isinstance(jobGraph, JobGraph):
+            raise UnsupportedValueError('%r is not a job graph' % jobGraph)
+        # The decoder determines the class of the job graph itself
+        self._writeObject(jobGraph, *self.classes[JobGraph])
+        header = bytearray(magic)
+        _writeVarint(header, version)
+        _writeVarint(header, len(self.stringData))
+        # The strings are separated by NUL so that they can be split and decoded all at once
+        stringTable = b'\0'.join(self.stringData)
+        _writeVarint(header, len(stringTable))
+        header.extend(stringTable)
+        _writeVarint(header, len(self.otherStrings))
+        for index, kind in self.otherStrings:
+            _writeVarint(header, index)
+            header.append(kind)
+        return bytes(header + self.body)
+
+    def _writeString(self, kind, value):
+        key = kind, value
+        index = self.strings.get(key)
+        if index is None:
+            index = self.strings[key] = len(self.stringData)
+            if kind == _bytes or (kind == _native and not _py3):
+                data = value
+            else:
+                try:
+                    data = value.encode('utf-8')
+                except UnicodeEncodeError as e:
+                    raise UnsupportedValueError(str(e))
+                if kind == _text:
+                    self.otherStrings.append((index, kind))
+            if kind == _bytes:
+                self.otherStrings.append((index, kind))
+            if b'\0' in data:
+                raise UnsupportedValueError('%r contains NUL' % value)
+            self.stringData.append(data)
+        if index <= _maxSmallString - _smallString:
+            self.body.append(_smallString + index)
+        else:
+            self.body.append(_string)
+            _writeVarint(self.body, index)
+
+    def _writeObject(self, value, code, fields):
+        attributes = value.__dict__
+        if len(attributes) != len(fields):
+            raise UnsupportedValueError('%s has attributes %s, expected %s' % (
+                type(value).__name__, sorted(attributes), sorted(fields)))
+        self.body.append(_object)
+        _writeVarint(self.body, code)
+        write = self._write
+        try:
+            for field in fields:
+                write(attributes[field])
+        except KeyError as e:
+            raise UnsupportedValueError('%s has no attribute %s' % (type(value).__name__, e))
+
+    def _write(self, value):
+        body = self.body
+        valueType = type(value)
+        if valueType is str:
+            self._writeString(_native, value)
+        elif value is None:
+            body.append(_none)
+        elif valueType is list or valueType is tuple or valueType is set:
+            body.append(_list if valueType is list else _tuple if valueType is tuple else _set)
+            _writeVarint(body, len(value))
+            for item in value:
+                self._write(item)
+        elif valueType in self.classes:
+            self._writeObject(value, *self.classes[valueType])
+        elif isinstance(value, bool):
+            body.append(_true if value else _false)
+        elif isinstance(value, integer_types):
+            if 0 <= value <= _maxSmallInt - _smallInt:
+                body.append(_smallInt + value)
+                return
+            body.append(_int)
+            # Zigzag encoding keeps small negative numbers small
+            _writeVarint(body, value << 1 if value >= 0 else ((-value - 1) << 1) | 1)
+        elif isinstance(value, float):
+            body.append(_float)
+            body.extend(_packDouble.pack(value))
+        elif isinstance(value, str):
+            self._writeString(_native, value)
+        elif isinstance(value, text_type):
+            self._writeString(_text, value)
+        elif isinstance(value, bytes):
+            self._writeString(_bytes, value)
+        elif valueType is dict:
+            body.append(_dict)
+            _writeVarint(body, len(value))
+            for key, item in value.items():
+                self._write(key)
+                self._write(item)
+        else:
+            raise UnsupportedValueError('Values of %s are not supported' % valueType)
+
+
+def _writeVarint(out, n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _readVarint(data, pos):
+    n = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return n, pos
+        shift += 7
+
+
+def _decode(data, cls):
+    data = bytearray(data)
+    recordVersion, pos = _readVarint(data, len(magic))
+    try:
+        classes = _getSchemas()[recordVersion]
+    except KeyError:
+        raise ValueError('Job record has format version %i, this version of Toil only supports '
+                         'versions up to %i.' % (recordVersion, version))
+    numStrings, pos = _readVarint(data, pos)
+    tableSize, pos = _readVarint(data, pos)
+    stringTable = bytes(data[pos:pos + tableSize])
+    pos += tableSize
+    if numStrings == 0:
+        strings = []
+    elif _py3:
+        # Surrogate escapes restore any strings that are bytes
+        strings = stringTable.decode('utf-8', 'surrogateescape').split('\0')
+    else:
+        strings = stringTable.split(b'\0')
+    numOtherStrings, pos = _readVarint(data, pos)
+    for _ in repeat(None, numOtherStrings):
+        index, pos = _readVarint(data, pos)
+        kind = data[pos]
+        pos += 1
+        if kind == _bytes and _py3:
+            strings[index] = strings[index].encode('utf-8', 'surrogateescape')
+        elif kind == _text and not _py3:
+            strings[index] = strings[index].decode('utf-8')
+
+    # Reading the body through an iterator is considerably faster than keeping track of the
+    # position in it
+    body = iter(data[pos:])
+    nextByte = body.__next__ if _py3 else body.next
+
+    def readVarint():
+        b = nextByte()
+        if not b & 0x80:
+            return b
+        n = b & 0x7f
+        shift = 7
+        while True:
+            b = nextByte()
+            n |= (b & 0x7f) << shift
+            if not b & 0x80:
+                return n
+            shift += 7
+
+    def readObject(cls, fields):
+        obj = cls.__new__(cls)
+        obj.__dict__ = dict(zip(fields, [read() for _ in fields]))
+        return obj
+
+    def read():
+        tag = nextByte()
+        if tag >= _smallString:
+            return strings[tag - _smallString]
+        elif tag == _none:
+            return None
+        elif tag >= _smallInt:
+            if tag > _maxSmallInt:
+                raise ValueError('Malformed job record, unknown tag %i' % tag)
+            return tag - _smallInt
+        elif tag == _string:
+            return strings[readVarint()]
+        elif tag == _list:
+            return [read() for _ in repeat(None, readVarint())]
+        elif tag == _object:
+            return readObject(*classes[readVarint()])
+        elif tag == _int:
+            n = readVarint()
+            return -(n >> 1) - 1 if n & 1 else n >> 1
+        elif tag == _true:
+            return True
+        elif tag == _false:
+            return False
+        elif tag == _set:
+            return {read() for _ in repeat(None, readVarint())}
+        elif tag == _tuple:
+            return tuple([read() for _ in repeat(None, readVarint())])
+        elif tag == _dict:
+            items = {}
+            for _ in repeat(None, readVarint()):
+                key = read()
+                items[key] = read()
+            return items
+        elif tag == _float:
+            return _packDouble.unpack(bytes(bytearray(nextByte() for _ in repeat(None, 8))))[0]
+        else:
+            raise ValueError('Malformed job record, unknown tag %i' % tag)
+
+    if nextByte() != _object:
+        raise ValueError('Malformed job record')
+    _, fields = classes[readVarint()]
+    if cls is None:
+        from toil.jobGraph import JobGraph
+        cls = JobGraph
+    return readObject(cls, fields)
@@ -1,11 +1,19 @@
 from builtins import object
+from builtins import range
 import codecs
+import io
+from io import BytesIO
 import logging
 import os
 import errno
+import sys
+import threading
 from abc import ABCMeta
 from abc import abstractmethod
 
+from six import reraise
+from six.moves.queue import Queue, Full
+
 from toil.lib.threading import ExceptionalThread
 from future.utils import with_metaclass
 
@@ -84,22 +92,31 @@ class WritablePipe(with_metaclass(ABCMeta, object)):
         raise NotImplementedError()
 
     def _reader(self):
-        with os.fdopen(self.readable_fh, 'rb') as readable:
-            # FIXME: another race here, causing a redundant attempt to close in the main thread
-            self.readable_fh = None  # signal to parent thread that we've taken over
+        # The readable end is closed as soon as the reader is done so that writes to a pipe that
+        # nobody reads from anymore fail instead of blocking
+        with self.readable as readable:
             self.readFrom(readable)
 
     def __init__(self):
         super(WritablePipe, self).__init__()
-        self.readable_fh = None
+        self.readable = None
         self.writable = None
         self.thread = None
 
     def __enter__(self):
-        self.readable_fh, writable_fh = os.pipe()
+        readable_fh, writable_fh = os.pipe()
+        # Both ends are wrapped before the thread starts. From then on, the thread owns the
+        # readable end and is the only one to close it.
+        self.readable = os.fdopen(readable_fh, 'rb')
         self.writable = os.fdopen(writable_fh, 'wb')
         self.thread = ExceptionalThread(target=self._reader)
-        self.thread.start()
+        try:
+            self.thread.start()
+        except:
+            self.thread = None
+            self.readable.close()
+            self.writable.close()
+            raise
         return self.writable
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -115,14 +132,6 @@ class WritablePipe(with_metaclass(ABCMeta, object)):
                 # Only raise the child exception if there wasn't
                 # already an exception in the main thread
                 raise
-        finally:
-            # The responsibility for closing the readable end is generally that of the reader
-            # thread. To cover the small window before the reader takes over we also close it here.
-            readable_fh = self.readable_fh
-            if readable_fh is not None:
-                # FIXME: This is still racy. The reader thread could close it now, and someone
-                # else may immediately open a new file, reusing the file handle.
-                os.close(readable_fh)
 
 
 class ReadablePipe(with_metaclass(ABCMeta, object)):
@@ -199,7 +208,7 @@ class ReadablePipe(with_metaclass(ABCMeta, object)):
 
     def _writer(self):
         try:
-            with os.fdopen(self.writable_fh, 'wb') as writable:
+            with self.writable as writable:
                 self.writeTo(writable)
         except IOError as e:
             # The other side of the pipe may have been closed by the
@@ -209,15 +218,23 @@ class ReadablePipe(with_metaclass(ABCMeta, object)):
 
     def __init__(self):
         super(ReadablePipe, self).__init__()
-        self.writable_fh = None
+        self.writable = None
         self.readable = None
         self.thread = None
 
     def __enter__(self):
-        readable_fh, self.writable_fh = os.pipe()
+        readable_fh, writable_fh = os.pipe()
+        # As in WritablePipe, the thread owns the writable end once it is started
         self.readable = os.fdopen(readable_fh, 'rb')
+        self.writable = os.fdopen(writable_fh, 'wb')
         self.thread = ExceptionalThread(target=self._writer)
-        self.thread.start()
+        try:
+            self.thread.start()
+        except:
+            self.thread = None
+            self.readable.close()
+            self.writable.close()
+            raise
         return self.readable
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -234,3 +251,199 @@ class ReadablePipe(with_metaclass(ABCMeta, object)):
                 # Only raise the child exception if there wasn't
                 # already an exception in the main thread
                 raise
+
+
+class SpooledWritablePipe(WritablePipe):
+    """
+    A :class:`WritablePipe` that only resorts to a pipe and a thread for content larger than
+    :attr:`bufferSize`. Until more than that was written, the content is collected in memory,
+    in the calling thread. If the stream is closed before, :meth:`readFrom` is invoked in the
+    calling thread with an in-memory file object holding the content. Otherwise the pipe and the
+    thread are created on demand, and the content collected so far is written to the pipe.
+
+    >>> class MyPipe(SpooledWritablePipe):
+    ...     bufferSize = 8
+    ...     def readFrom(self, readable):
+    ...         how = 'in memory' if isinstance(readable, BytesIO) else 'piped'
+    ...         print(how + ': ' + readable.read().decode('utf-8'))
+    >>> with MyPipe() as writable:
+    ...     _ = writable.write('Hello'.encode('utf-8'))
+    in memory: Hello
+    >>> with MyPipe() as writable:
+    ...     _ = writable.write('Hello, '.encode('utf-8'))
+    ...     _ = writable.write('world!'.encode('utf-8'))
+    piped: Hello, world!
+
+    Unlike with a WritablePipe, :meth:`readFrom` isn't invoked for content collected in memory
+    if the body of the with statement raises an exception:
+
+    >>> with MyPipe() as writable:
+    ...     raise RuntimeError('Hello, world!')
+    Traceback (most recent call last):
+    ...
+    RuntimeError: Hello, world!
+
+    The writable end is a raw binary stream, so it can be wrapped in a buffered or text stream.
+    Closing it prevents further writes, the content is still completed upon exit from the context
+    manager:
+
+    >>> import io
+    >>> with MyPipe() as writable:
+    ...     with io.TextIOWrapper(writable, encoding='utf-8') as text:
+    ...         _ = text.write(u'Hello, world!')
+    piped: Hello, world!
+    >>> writable.closed
+    True
+    """
+
+    # The amount of content that is collected in memory before resorting to a pipe
+    bufferSize = 1 << 20
+
+    class _Writer(io.RawIOBase):
+        def __init__(self, pipe):
+            super(SpooledWritablePipe._Writer, self).__init__()
+            self.pipe = pipe
+            self.buffer = BytesIO()
+            # The writable end of the pipe once it was started
+            self.target = None
+
+        def writable(self):
+            return True
+
+        def _startPipe(self):
+            self.target = super(SpooledWritablePipe, self.pipe).__enter__()
+            self.target.write(self.buffer.getvalue())
+            self.buffer = None
+
+        def write(self, data):
+            if self.closed:
+                raise ValueError('I/O operation on closed file')
+            if isinstance(data, memoryview):
+                data = data.tobytes()
+            if self.target is None:
+                self.buffer.write(data)
+                if self.buffer.tell() > self.pipe.bufferSize:
+                    self._startPipe()
+            else:
+                self.target.write(data)
+            return len(data)
+
+        def flush(self):
+            super(SpooledWritablePipe._Writer, self).flush()
+            if self.target is not None:
+                self.target.flush()
+
+        def fileno(self):
+            # Whoever asks for the file descriptor is going to write to it directly
+            if self.target is None:
+                self._startPipe()
+            return self.target.fileno()
+
+        def close(self):
+            # Like the pipe, the content is only completed upon exit from the context manager.
+            # Closing the pipe early merely lets the reader see the end of the content sooner.
+            if not self.closed:
+                super(SpooledWritablePipe._Writer, self).close()
+                if self.target is not None:
+                    self.target.close()
+
+    def __init__(self):
+        super(SpooledWritablePipe, self).__init__()
+        self._writer = None
+
+    def __enter__(self):
+        self._writer = self._Writer(self)
+        return self._writer
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        writer, self._writer = self._writer, None
+        if writer.target is not None:
+            return super(SpooledWritablePipe, self).__exit__(exc_type, exc_val, exc_tb)
+        elif exc_type is None:
+            writer.buffer.seek(0)
+            self.readFrom(writer.buffer)
+
+
+def mapConcurrently(function, items, numThreads):
+    """
+    Apply the given function to the given items in the given number of threads and yield the
+    results in the order in which they become available. The items are consumed in a thread of
+    their own, at most twice as many of them ahead of the results as there are threads, so that
+    producing the items, e.g. by iterating over a paged listing, overlaps with applying the
+    function to them.
+
+    >>> sorted(mapConcurrently(lambda x: x * x, range(10), 4))
+    [0, 1, 4, 9, 16, 25, 36, 49, 64, 81]
+
+    Exceptions raised by the function or while producing the items are reraised by the iterator,
+    after which the remaining items are discarded:
+
+    >>> list(mapConcurrently(lambda x: 1 // x, [0], 4))
+    Traceback (most recent call last):
+    ...
+    ZeroDivisionError: integer division or modulo by zero
+    """
+    pending = Queue()
+    results = Queue()
+    # Holds an entry for every item that was consumed but whose result wasn't yielded yet
+    slots = Queue(maxsize=2 * numThreads)
+    stop = threading.Event()
+    done = object()
+    # The results are tuples of whether they belong to an item, and thus hold a slot, whether
+    # they succeeded and the return value of the function or the exception info
+
+    def feed():
+        try:
+            for item in items:
+                while True:
+                    if stop.is_set():
+                        return
+                    try:
+                        slots.put(None, timeout=1)
+                    except Full:
+                        pass
+                    else:
+                        break
+                pending.put(item)
+        except BaseException:
+            results.put((False, False, sys.exc_info()))
+        finally:
+            # The workers keep draining the queue after being stopped so these don't block
+            for _ in range(numThreads):
+                pending.put(done)
+
+    def work():
+        try:
+            while True:
+                item = pending.get()
+                if item is done:
+                    break
+                if not stop.is_set():
+                    try:
+                        results.put((True, True, function(item)))
+                    except BaseException:
+                        results.put((True, False, sys.exc_info()))
+        finally:
+            results.put(done)
+
+    threads = [threading.Thread(target=feed)]
+    threads.extend(threading.Thread(target=work) for _ in range(numThreads))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        remaining = numThreads
+        while remaining:
+            result = results.get()
+            if result is done:
+                remaining -= 1
+            else:
+                fromItem, succeeded, value = result
+                if fromItem:
+                    slots.get_nowait()
+                if succeeded:
+                    yield value
+                else:
+                    reraise(*value)
+    finally:
+        stop.set()
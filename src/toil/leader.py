@@ -24,8 +24,11 @@ from builtins import str
 from builtins import object
 from builtins import super
 import logging
+import sys
 import time
 
+from six import iteritems
+
 try:
     import cPickle as pickle
 except ImportError:
@@ -38,6 +41,7 @@ try:
 except ImportError:
     # CWL extra not installed
     CWL_INTERNAL_JOBS = ()
+from toil.batchSystems.abstractBatchSystem import BatchJobExitReason
 from toil.jobStores.abstractJobStore import NoSuchJobException
 from toil.provisioners.clusterScaler import ScalerThread
 from toil.serviceManager import ServiceManager
@@ -137,6 +141,10 @@ class Leader(object):
         # Map of batch system IDs to IssuedJob tuples
         self.jobBatchSystemIDToIssuedJob = {}
 
+        # Maps the names of jobs to the memory and disk requirements that jobs of that name were
+        # retried with after running out of memory or disk, see _learnRequirements
+        self.learnedRequirements = {}
+
         # Number of preempetable jobs currently being run by batch system
         self.preemptableJobsIssued = 0
 
@@ -229,7 +237,9 @@ class Leader(object):
 
 
         # Filter the failed jobs
-        self.toilState.totalFailedJobs = [j for j in self.toilState.totalFailedJobs if self.jobStore.exists(j.jobStoreID)]
+        failedJobs = list(self.toilState.totalFailedJobs)
+        self.toilState.totalFailedJobs = [j for j, exists in zip(failedJobs, self.jobStore.existsMany(
+            [j.jobStoreID for j in failedJobs])) if exists]
 
         logger.info("Finished toil run %s" %
                      ("successfully." if not self.toilState.totalFailedJobs \
@@ -589,6 +599,10 @@ class Leader(object):
                                     jobNode.jobName,
                                     self.jobStoreLocator,
                                     jobNode.jobStoreID))
+        # Start from what earlier jobs of the same name turned out to need
+        for requirement, value in iteritems(self.learnedRequirements.get(jobNode.jobName, {})):
+            if getattr(jobNode, requirement) < value:
+                setattr(jobNode, '_' + requirement, value)
         # jobBatchSystemID is an int that is an incremented counter for each job
         jobBatchSystemID = self.batchSystem.issueBatchJob(jobNode)
         self.jobBatchSystemIDToIssuedJob[jobBatchSystemID] = jobNode
@@ -794,8 +808,20 @@ class Leader(object):
                 # reduce the retry count here.
                 if jobGraph.logJobStoreFileID is None:
                     logger.warn("No log file is present, despite job failing: %s", jobNode)
-                jobGraph.setupJobAfterFailure(self.config)
+                exitReason = BatchJobExitReason.fromExitStatus(resultStatus)
+                limit = None
+                if exitReason is not None and self.config.retryResourceFactor > 1:
+                    # The job was issued with a requirement learned from other jobs, if larger
+                    value = max(getattr(jobGraph, exitReason), getattr(jobNode, exitReason))
+                    setattr(jobGraph, '_' + exitReason, value)
+                    limit = self._getRequirementLimit(exitReason)
+                jobGraph.setupJobAfterFailure(self.config, exitReason=exitReason, limit=limit)
+                self._learnRequirements(jobNode, jobGraph)
                 self.jobStore.update(jobGraph)
+            elif jobGraph.logJobStoreFileID is not None:
+                # The worker captured the failure of the job
+                if self._learnRequirements(jobNode, jobGraph):
+                    self.jobStore.update(jobGraph)
             elif jobStoreID in self.toilState.hasFailedSuccessors:
                 # If the job has completed okay, we can remove it from the list of jobs with failed successors
                 self.toilState.hasFailedSuccessors.remove(jobStoreID)
@@ -806,6 +832,51 @@ class Leader(object):
         else:  #The jobGraph is done
             self.processRemovedJob(jobNode, resultStatus)
 
+    def _getRequirementLimit(self, requirement):
+        """
+        :param str requirement: 'memory' or 'disk'
+        :return: the largest value of the given requirement that a job can be issued with, that
+                 of the largest node shape if the cluster is autoscaled
+        :rtype: int
+        """
+        name = 'max' + requirement.capitalize()
+        limit = min(getattr(self.config, name), getattr(self.batchSystem, name, sys.maxsize))
+        if self.provisioner is not None and self.provisioner.nodeShapes:
+            limit = min(limit, max(getattr(nodeShape, requirement)
+                                   for nodeShape in self.provisioner.nodeShapes))
+        return limit
+
+    def _learnRequirements(self, jobNode, jobGraph):
+        """
+        Record any increase of the memory or disk requirement of a failed job, so that jobs of
+        the same name are issued with at least the increased requirement. An increase made by
+        the worker is capped to the largest value the job can be issued with.
+
+        :param toil.job.JobNode jobNode: the job as it was issued
+        :param toil.jobGraph.JobGraph jobGraph: the failed job, set up for its retry
+        :return: True if a requirement of jobGraph was capped
+        :rtype: bool
+        """
+        capped = False
+        if self.config.retryResourceFactor <= 1:
+            return capped
+        for requirement in (BatchJobExitReason.MEMLIMIT, BatchJobExitReason.DISKLIMIT):
+            value = getattr(jobGraph, requirement)
+            if value <= getattr(jobNode, requirement):
+                continue
+            limit = self._getRequirementLimit(requirement)
+            if value > limit:
+                value = max(limit, getattr(jobNode, requirement))
+                setattr(jobGraph, '_' + requirement, value)
+                capped = True
+            # After chaining, the job that failed may not be the one that was issued
+            learned = self.learnedRequirements.setdefault(jobGraph.jobName, {})
+            if value > learned.get(requirement, 0):
+                learned[requirement] = value
+                logger.info("Jobs named %s will be issued with at least %s of %s.",
+                            jobGraph.jobName, bytes2human(value), requirement)
+        return capped
+
     @staticmethod
     def getSuccessors(jobGraph, alreadySeenSuccessors, jobStore):
         """
@@ -816,6 +887,7 @@ class Leader(object):
         successors = set()
         def successorRecursion(jobGraph):
             # For lists of successors
+            newSuccessors = []
             for successorList in jobGraph.stack:
 
                 # For each successor in list of successors
@@ -827,11 +899,15 @@ class Leader(object):
                         # Add to set of successors
                         successors.add(successorJobNode.jobStoreID)
                         alreadySeenSuccessors.add(successorJobNode.jobStoreID)
-
-                        # Recurse if job exists
-                        # (job may not exist if already completed)
-                        if jobStore.exists(successorJobNode.jobStoreID):
-                            successorRecursion(jobStore.load(successorJobNode.jobStoreID))
+                        newSuccessors.append(successorJobNode.jobStoreID)
+
+            # Recurse if job exists
+            # (job may not exist if already completed)
+            existingSuccessors = [successor for successor, exists
+                                  in zip(newSuccessors, jobStore.existsMany(newSuccessors))
+                                  if exists]
+            for successorJobGraph in jobStore.loadMany(existingSuccessors):
+                successorRecursion(successorJobGraph)
 
         successorRecursion(jobGraph) # Recurse from jobGraph
 
@@ -0,0 +1,344 @@
+# Copyright (C) 2015-2018 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Streaming compression of job store files. zlib is always available, zstd and lz4 are available
+if the zstandard and lz4 packages are installed, respectively.
+
+>>> from io import BytesIO
+>>> stored = BytesIO()
+>>> with CompressingWriter(stored, 'zlib', header=True) as writable:
+...     _ = writable.write(b'chr1\\t100\\t.\\tA\\tT\\n' * 1000)
+>>> writable.codec
+'zlib'
+>>> len(stored.getvalue()) < 1000
+True
+>>> _ = stored.seek(0)
+>>> readable = openCompressed(stored)
+>>> readable.read() == b'chr1\\t100\\t.\\tA\\tT\\n' * 1000
+True
+
+Content that is already compressed is passed through unchanged:
+
+>>> import gzip
+>>> compressed = BytesIO()
+>>> with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
+...     _ = f.write(b'data')
+>>> stored = BytesIO()
+>>> with CompressingWriter(stored, 'zlib', header=True) as writable:
+...     _ = writable.write(compressed.getvalue())
+>>> writable.codec is None
+True
+>>> stored.getvalue() == compressed.getvalue()
+True
+"""
+
+from __future__ import absolute_import
+
+from builtins import object
+import io
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+# Each codec has a compressor() returning an object with compress() and flush() methods, and a
+# decompress() generator yielding the decompressed content of a file-like object in chunks of
+# at most the given size, so that highly compressed content doesn't have to fit into memory.
+
+class _ZlibCodec(object):
+    @staticmethod
+    def compressor():
+        return zlib.compressobj(6)
+
+    @staticmethod
+    def decompress(readable, size):
+        decompressor = zlib.decompressobj()
+        while True:
+            data = readable.read(size)
+            if not data:
+                break
+            while data:
+                chunk = decompressor.decompress(data, size)
+                # The input that didn't fit into the chunk
+                data = decompressor.unconsumed_tail
+                if chunk:
+                    yield chunk
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+
+
+class _ZstdCodec(object):
+    @staticmethod
+    def compressor():
+        return zstandard.ZstdCompressor().compressobj()
+
+    @staticmethod
+    def decompress(readable, size):
+        return zstandard.ZstdDecompressor().read_to_iter(readable, read_size=size,
+                                                         write_size=size)
+
+
+class _Lz4Codec(object):
+    class _Compressor(object):
+        def __init__(self):
+            self.compressor = lz4.frame.LZ4FrameCompressor()
+            self.started = False
+
+        def compress(self, data):
+            if self.started:
+                return self.compressor.compress(data)
+            self.started = True
+            return self.compressor.begin() + self.compressor.compress(data)
+
+        def flush(self):
+            return (b'' if self.started else self.compressor.begin()) + self.compressor.flush()
+
+    @classmethod
+    def compressor(cls):
+        return cls._Compressor()
+
+    @staticmethod
+    def decompress(readable, size):
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+        while not decompressor.eof:
+            if decompressor.needs_input:
+                data = readable.read(size)
+                if not data:
+                    break
+            else:
+                # Output of the input fed so far didn't fit into the last chunk
+                data = b''
+            chunk = decompressor.decompress(data, max_length=size)
+            if chunk:
+                yield chunk
+
+
+codecs = {'zlib': _ZlibCodec}
+if zstandard is not None:
+    codecs['zstd'] = _ZstdCodec
+if lz4 is not None:
+    codecs['lz4'] = _Lz4Codec
+
+# Leading bytes of common compressed formats: gzip (including BGZF as used by BAM, BCF and
+# tabix-indexed files), bzip2, xz, zstd, lz4, zip, 7z, CRAM, PNG and JPEG
+compressedMagics = (b'\x1f\x8b', b'BZh', b'\xfd7zXZ\x00', b'\x28\xb5\x2f\xfd',
+                    b'\x04\x22\x4d\x18', b'PK\x03\x04', b'7z\xbc\xaf\x27\x1c', b'CRAM',
+                    b'\x89PNG', b'\xff\xd8\xff')
+
+sniffSize = max(len(magic) for magic in compressedMagics)
+
+# Precedes the name of the codec in streams written with header=True
+headerMagic = b'\x89TOILZ\r\n'
+
+
+def isCompressed(head):
+    """
+    Guess whether content is already compressed from its leading bytes.
+
+    >>> isCompressed(b'\\x1f\\x8b\\x08\\x04')
+    True
+    >>> isCompressed(b'@read1\\nACGT')
+    False
+
+    :param bytes head: at least the first sniffSize bytes of the content, or all of it if shorter
+    :rtype: bool
+    """
+    return any(head.startswith(magic) for magic in compressedMagics)
+
+
+class CompressingWriter(object):
+    """
+    A file-like object that compresses the data written to it and writes the result to another
+    file-like object. Unless sniffing is disabled, data that looks like it has been compressed
+    already is written unchanged. The underlying file object is not closed by close().
+    """
+
+    def __init__(self, writable, codec, header=False, sniff=True, contentHash=None):
+        """
+        :param writable: the file-like object to write to
+
+        :param str codec: the name of the codec to compress with, one of the keys of `codecs`
+
+        :param bool header: whether to precede compressed data with a header naming the codec
+               so that openCompressed() can detect it
+
+        :param bool sniff: whether to check if the data is compressed already
+
+        :param contentHash: an optional hashlib object to update with the uncompressed data
+        """
+        self.writable = writable
+        self.header = header
+        self.contentHash = contentHash
+        self._codec = codec
+        self._compressor = None
+        self._head = b'' if sniff else None
+        self.closed = False
+        if not sniff:
+            self._start(compress=True)
+
+    @property
+    def codec(self):
+        """
+        The codec the data is compressed with, or None if it is written unchanged. Only final
+        once the writer is closed.
+        """
+        return self._codec if self._compressor is not None else None
+
+    def _start(self, compress):
+        self._head = None
+        if compress:
+            self._compressor = codecs[self._codec].compressor()
+            if self.header:
+                self.writable.write(headerMagic + self._codec.encode('ascii') + b'\n')
+
+    def _write(self, data):
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        if data:
+            self.writable.write(data)
+
+    def write(self, data):
+        if self.contentHash is not None:
+            self.contentHash.update(data)
+        if self._head is not None:
+            self._head += data
+            if len(self._head) < sniffSize:
+                return
+            data = self._head
+            self._start(compress=not isCompressed(data))
+        self._write(data)
+
+    def flush(self):
+        # Flushing the compressor would hurt the compression ratio
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        if self._head is not None:
+            head = self._head
+            self._start(compress=not isCompressed(head))
+            self._write(head)
+        if self._compressor is not None:
+            self.writable.write(self._compressor.flush())
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class DecompressingReader(io.RawIOBase):
+    """
+    A raw binary stream that reads compressed data from another file-like object and returns it
+    decompressed. Use openDecompressed() to get a buffered stream with readline() and iteration.
+    """
+    bufferSize = 1 << 20
+    """
+    The maximum number of bytes read from the file-like object and of decompressed bytes held in
+    memory at a time
+    """
+
+    def __init__(self, readable, codec):
+        super(DecompressingReader, self).__init__()
+        self.source = readable
+        self._chunks = codecs[codec].decompress(readable, self.bufferSize)
+        # Decompressed data not yet returned starts at _offset in _buffer
+        self._buffer = b''
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        # Decompress the next chunk into the buffer once it has been consumed, return False at
+        # the end
+        while self._offset >= len(self._buffer):
+            if self._chunks is None:
+                return False
+            self._buffer = next(self._chunks, None)
+            self._offset = 0
+            if self._buffer is None:
+                self._chunks = None
+                self._buffer = b''
+        return True
+
+    def readinto(self, b):
+        if not self._fill():
+            return 0
+        size = min(len(b), len(self._buffer) - self._offset)
+        b[:size] = self._buffer[self._offset:self._offset + size]
+        self._offset += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.source.close()
+        super(DecompressingReader, self).close()
+
+
+def openDecompressed(readable, codec):
+    """
+    Return a buffered binary stream that reads the content of a file-like object compressed with
+    the given codec, decompressed. Closing it closes the file-like object.
+
+    >>> from io import BytesIO
+    >>> stored = BytesIO()
+    >>> with CompressingWriter(stored, 'zlib', sniff=False) as writable:
+    ...     _ = writable.write(b'a\\nb\\n')
+    >>> _ = stored.seek(0)
+    >>> [line for line in openDecompressed(stored, 'zlib')] == [b'a\\n', b'b\\n']
+    True
+    """
+    return io.BufferedReader(DecompressingReader(readable, codec))
+
+
+def readHeader(readable):
+    """
+    Read the header written by a CompressingWriter from a seekable file-like object.
+
+    :return: the name of the codec, or None if there is no header, in which case the file
+             position is restored
+    :rtype: str|None
+    """
+    start = readable.tell()
+    if readable.read(len(headerMagic)) == headerMagic:
+        codec = readable.readline().rstrip(b'\n').decode('ascii')
+        if codec not in codecs:
+            raise RuntimeError("Content is compressed with the unavailable codec '%s'." % codec)
+        return codec
+    readable.seek(start)
+    return None
+
+
+def openCompressed(readable):
+    """
+    Return a file-like object that reads the uncompressed content of a seekable file-like object
+    written by a CompressingWriter with header=True. If the content isn't compressed, the file
+    object itself is returned.
+    """
+    codec = readHeader(readable)
+    return readable if codec is None else openDecompressed(readable, codec)
@@ -0,0 +1,497 @@
+# Copyright (C) 2015-2018 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+In-process measurement of the disk space used by a directory tree, without forking du.
+"""
+
+from __future__ import absolute_import
+
+from builtins import range
+from builtins import object
+import ctypes
+import errno
+import logging
+import os
+import select
+import stat
+import sys
+import threading
+import time
+
+from six.moves.queue import Queue
+
+from future.utils import raise_
+
+from toil.lib import inotify
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+log = logging.getLogger(__name__)
+
+# st_blocks is in units of 512 bytes, regardless of the file system's block size
+blockSize = 512
+
+
+def _listDir(dirPath):
+    """
+    :return: a list of tuples (path, stat, isDir) for the entries of the given directory, not
+             following symlinks. Entries that disappear while the directory is listed are
+             omitted.
+    """
+    entries = []
+    try:
+        names = scandir(dirPath) if scandir is not None else os.listdir(dirPath)
+    except OSError as e:
+        # The directory may have been deleted since it was listed in its parent
+        if e.errno == errno.ENOENT:
+            return entries
+        raise
+    if scandir is not None:
+        for entry in names:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                entries.append((entry.path, st, stat.S_ISDIR(st.st_mode)))
+    else:
+        for name in names:
+            path = os.path.join(dirPath, name)
+            try:
+                st = os.lstat(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                entries.append((path, st, stat.S_ISDIR(st.st_mode)))
+    return entries
+
+
+class _Usage(object):
+    """
+    Disk usage accumulated by one thread of getDirSize(). Only entries with more than one hard
+    link are remembered, all others can't be encountered twice.
+    """
+    def __init__(self):
+        self.total = 0
+        self.linked = {}
+
+    def add(self, st):
+        size = st.st_blocks * blockSize
+        if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+            self.linked[(st.st_dev, st.st_ino)] = size
+        else:
+            self.total += size
+
+    def scan(self, dirPath):
+        """
+        Add the entries of the given directory and return its subdirectories.
+        """
+        subDirs = []
+        for path, st, isDir in _listDir(dirPath):
+            self.add(st)
+            if isDir:
+                subDirs.append(path)
+        return subDirs
+
+
+def getDirSize(dirPath, threads=8):
+    """
+    Return the number of bytes allocated on disk to the given directory, its subdirectories and
+    all files in them, like `du -s` would. Files with several hard links in the tree are counted
+    once. Subdirectories are scanned by the given number of threads.
+
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> with open(os.path.join(d, 'a'), 'wb') as f:
+    ...     _ = f.write(os.urandom(1 << 16))
+    >>> size = getDirSize(d)
+    >>> os.link(os.path.join(d, 'a'), os.path.join(d, 'b'))
+    >>> getDirSize(d) == size
+    True
+    >>> os.mkdir(os.path.join(d, 'c'))
+    >>> _ = shutil.copy(os.path.join(d, 'a'), os.path.join(d, 'c'))
+    >>> getDirSize(d) - size >= 1 << 16
+    True
+    >>> getDirSize(d) == getDirSize(d, threads=1)
+    True
+    >>> shutil.rmtree(d)
+
+    :param str dirPath: the path to a directory or a file
+    :param int threads: the maximum number of threads scanning directories concurrently
+    :rtype: int
+    """
+    root = os.lstat(dirPath)
+    usage = _Usage()
+    usage.add(root)
+    if not stat.S_ISDIR(root.st_mode):
+        return usage.total + sum(usage.linked.values())
+    # The vast majority of jobs leave few files behind, so don't bother starting threads unless
+    # there are subdirectories.
+    subDirs = usage.scan(dirPath)
+    usages = [usage]
+    if threads == 1:
+        while subDirs:
+            subDirs.extend(usage.scan(subDirs.pop()))
+    elif subDirs:
+        pending = Queue()
+        for subDir in subDirs:
+            pending.put(subDir)
+        errors = []
+
+        def scan(usage):
+            while True:
+                subDir = pending.get()
+                try:
+                    if subDir is None:
+                        return
+                    for path in usage.scan(subDir):
+                        pending.put(path)
+                except:
+                    # Keep going so that the queue is drained, the first error is raised below
+                    errors.append(sys.exc_info())
+                finally:
+                    pending.task_done()
+
+        workers = []
+        for _ in range(threads):
+            usage = _Usage()
+            usages.append(usage)
+            worker = threading.Thread(target=scan, args=(usage,))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        pending.join()
+        for _ in workers:
+            pending.put(None)
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise_(*errors[0])
+    linked = {}
+    for usage in usages:
+        linked.update(usage.linked)
+    return sum(usage.total for usage in usages) + sum(linked.values())
+
+
+class DiskUsageTracker(object):
+    """
+    Keeps track of the disk space used by the files in a directory tree as they are created,
+    modified and deleted, making it cheap to check the usage frequently. Files are either
+    recorded explicitly by whoever writes them or, on Linux, picked up by an inotify watch on
+    the tree. Without a working watch, getUsage() falls back to scanning the tree.
+
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> with DiskUsageTracker(d, watch=False) as tracker:
+    ...     with open(os.path.join(d, 'a'), 'wb') as f:
+    ...         _ = f.write(os.urandom(1 << 16))
+    ...     tracker.record(os.path.join(d, 'a'))
+    ...     tracker.trackedUsage >= (1 << 16)
+    ...     tracker.forget(os.path.join(d, 'a'))
+    ...     tracker.trackedUsage
+    True
+    0
+    >>> shutil.rmtree(d)
+    """
+
+    def __init__(self, dirPath, watch=True):
+        """
+        :param str dirPath: the directory to track
+        :param bool watch: whether to watch the directory for changes if the platform supports it
+        """
+        self.dirPath = dirPath
+        self._lock = threading.Lock()
+        # Maps the path of every tracked file to the (st_dev, st_ino) tuple of its inode
+        self._paths = {}
+        # Maps each of those tuples to a list holding the size of the inode and the number of
+        # tracked paths referring to it
+        self._inodes = {}
+        self._total = 0
+        self._watcher = None
+        if watch and _InotifyWatcher.supported():
+            try:
+                self._watcher = _InotifyWatcher(self)
+            except OSError as e:
+                log.debug("Can't watch %s for changes: %s", dirPath, e)
+            else:
+                self._watcher.start()
+
+    @property
+    def watching(self):
+        """
+        Whether all changes to the tree are being tracked.
+        """
+        return self._watcher is not None and self._watcher.healthy
+
+    @property
+    def trackedUsage(self):
+        """
+        The number of bytes used by the files tracked so far.
+        """
+        with self._lock:
+            return self._total
+
+    def getUsage(self):
+        """
+        :return: the number of bytes used by the directory tree, scanning it unless it is being
+                 watched
+        :rtype: int
+        """
+        if self.watching:
+            return self.trackedUsage
+        else:
+            return getDirSize(self.dirPath)
+
+    def record(self, path):
+        """
+        Record the current size of the file at the given path.
+        """
+        try:
+            st = os.lstat(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.forget(path)
+            return
+        if stat.S_ISDIR(st.st_mode):
+            return
+        key, size = (st.st_dev, st.st_ino), st.st_blocks * blockSize
+        with self._lock:
+            self._forget(path)
+            self._paths[path] = key
+            inode = self._inodes.get(key)
+            if inode is None:
+                self._inodes[key] = [size, 1]
+                self._total += size
+            else:
+                self._total += size - inode[0]
+                inode[0] = size
+                inode[1] += 1
+
+    def forget(self, path):
+        """
+        Stop tracking the file at the given path, e.g. because it was deleted.
+        """
+        with self._lock:
+            self._forget(path)
+
+    def forgetTree(self, dirPath):
+        """
+        Stop tracking all files below the given directory.
+        """
+        prefix = os.path.join(dirPath, '')
+        with self._lock:
+            for path in [path for path in self._paths if path.startswith(prefix)]:
+                self._forget(path)
+
+    def _forget(self, path):
+        key = self._paths.pop(path, None)
+        if key is not None:
+            inode = self._inodes[key]
+            inode[1] -= 1
+            if inode[1] == 0:
+                del self._inodes[key]
+                self._total -= inode[0]
+
+    def stop(self):
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class _InotifyWatcher(threading.Thread):
+    """
+    Feeds changes to the files below the directory of a DiskUsageTracker into the tracker,
+    using Linux's inotify API. Becomes unhealthy if events were lost, e.g. because the kernel's
+    event queue overflowed or the limit on the number of watches was reached.
+    """
+    IN_MODIFY = inotify.IN_MODIFY
+    IN_CLOSE_WRITE = inotify.IN_CLOSE_WRITE
+    IN_MOVED_FROM = inotify.IN_MOVED_FROM
+    IN_MOVED_TO = inotify.IN_MOVED_TO
+    IN_CREATE = inotify.IN_CREATE
+    IN_DELETE = inotify.IN_DELETE
+    IN_Q_OVERFLOW = inotify.IN_Q_OVERFLOW
+    IN_IGNORED = inotify.IN_IGNORED
+    IN_ONLYDIR = inotify.IN_ONLYDIR
+    IN_ISDIR = inotify.IN_ISDIR
+    IN_NONBLOCK = inotify.IN_NONBLOCK
+    IN_CLOEXEC = inotify.IN_CLOEXEC
+
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    # Files being written to are re-measured at most this often, in seconds
+    modifyInterval = 1.0
+
+    _eventHeader = inotify.eventHeader
+
+    _libc = inotify.libc
+
+    @classmethod
+    def supported(cls):
+        return cls._libc is not None
+
+    def __init__(self, tracker):
+        super(_InotifyWatcher, self).__init__()
+        self.daemon = True
+        self.tracker = tracker
+        self.healthy = True
+        # Maps the paths of files being written to the time they were last measured
+        self._modified = {}
+        # Paths of files modified since they were last measured
+        self._dirty = set()
+        self._dirs = {}
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self._stopRead, self._stopWrite = os.pipe()
+        try:
+            self._addTree(tracker.dirPath)
+        except:
+            self._close()
+            raise
+        if not self.healthy:
+            self._close()
+            raise OSError(errno.ENOSPC, 'Too many directories to watch.')
+
+    def _addTree(self, dirPath):
+        """
+        Watch the given directory and all directories below it, and record the files in them,
+        which may have been created before the watch was in place.
+        """
+        pending = [dirPath]
+        while pending and self.healthy:
+            dirPath = pending.pop()
+            path = dirPath.encode(sys.getfilesystemencoding()) if not isinstance(dirPath,
+                                                                               bytes) else dirPath
+            wd = self._libc.inotify_add_watch(self._fd, path, self.mask | self.IN_ONLYDIR)
+            if wd < 0:
+                e = ctypes.get_errno()
+                if e in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                log.debug("Can't watch %s: %s", dirPath, os.strerror(e))
+                self.healthy = False
+                return
+            self._dirs[wd] = dirPath
+            try:
+                entries = _listDir(dirPath)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                for entryPath, st, isDir in entries:
+                    if isDir:
+                        pending.append(entryPath)
+                    else:
+                        self.tracker.record(entryPath)
+
+    def _removeTree(self, dirPath):
+        prefix = os.path.join(dirPath, '')
+        for wd, path in list(self._dirs.items()):
+            if path == dirPath or path.startswith(prefix):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._dirs[wd]
+        self.tracker.forgetTree(dirPath)
+
+    def run(self):
+        try:
+            while self.healthy:
+                timeout = self.modifyInterval if self._dirty else None
+                readable, _, _ = select.select([self._fd, self._stopRead], [], [], timeout)
+                if self._stopRead in readable:
+                    break
+                if self._fd in readable:
+                    try:
+                        events = os.read(self._fd, 1 << 16)
+                    except OSError as e:
+                        if e.errno != errno.EAGAIN:
+                            raise
+                    else:
+                        self._handleEvents(events)
+                for path in list(self._dirty):
+                    self._measure(path)
+        except:
+            self.healthy = False
+            log.exception('Stopped watching %s.', self.tracker.dirPath)
+
+    def _handleEvents(self, events):
+        offset = 0
+        while offset < len(events):
+            wd, mask, cookie, length = self._eventHeader.unpack_from(events, offset)
+            offset += self._eventHeader.size
+            name = events[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                self.healthy = False
+                return
+            dirPath = self._dirs.get(wd)
+            if dirPath is None:
+                continue
+            if mask & self.IN_IGNORED:
+                del self._dirs[wd]
+                continue
+            if not isinstance(name, str):
+                name = name.decode(sys.getfilesystemencoding())
+            path = os.path.join(dirPath, name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self._addTree(path)
+                elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                    self._removeTree(path)
+            elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                self._modified.pop(path, None)
+                self._dirty.discard(path)
+                self.tracker.forget(path)
+            elif mask & self.IN_MODIFY:
+                self._dirty.add(path)
+                self._measure(path)
+            else:
+                self._modified.pop(path, None)
+                self._dirty.discard(path)
+                self.tracker.record(path)
+
+    def _measure(self, path):
+        """
+        Record the size of a file that is being written to, unless it was measured recently.
+        """
+        now = time.time()
+        if now - self._modified.get(path, 0) >= self.modifyInterval:
+            self._modified[path] = now
+            self._dirty.discard(path)
+            self.tracker.record(path)
+
+    def stop(self):
+        os.write(self._stopWrite, b'x')
+        self.join()
+        self._close()
+
+    def _close(self):
+        for fd in self._fd, self._stopRead, self._stopWrite:
+            os.close(fd)
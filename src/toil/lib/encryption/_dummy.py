@@ -26,6 +26,23 @@ def decrypt(ciphertext, keyPath):
     _bail()
 
 
+class EncryptingWriter(object):
+    # noinspection PyUnusedLocal
+    def __init__(self, writable, keyPath, chunkSize=None):
+        _bail()
+
+
+class DecryptingReader(object):
+    # noinspection PyUnusedLocal
+    def __init__(self, readable, keyPath):
+        _bail()
+
+
+# noinspection PyUnusedLocal
+def openDecrypted(readable, keyPath):
+    _bail()
+
+
 def _bail():
     raise NotImplementedError("Encryption support is not installed. Consider re-installing toil "
                               "with the 'encryption' extra along with any other extras you might "
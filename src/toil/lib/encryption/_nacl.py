@@ -12,17 +12,52 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from builtins import object
 from builtins import str
+import io
+import struct
+
 import nacl
+import nacl.utils
+from nacl.exceptions import CryptoError
 from nacl.secret import SecretBox
 
+from toil.lib.memoize import memoize
+
 
 # 16-byte MAC plus a nonce is added to every message.
 overhead = 16 + SecretBox.NONCE_SIZE
 
+# Content encrypted by an EncryptingWriter starts with this, followed by the stream header. No
+# message encrypted by encrypt() is likely to, those start with a random nonce.
+streamMagic = b'\x89TOILE\r\n'
+
+# The plaintext size of the chunks of a stream and the random prefix of their nonces
+_streamHeader = struct.Struct('>I15s')
+
+# The nonce of a chunk is the stream's prefix, followed by the index of the chunk and a byte
+# telling whether it is the final chunk, so chunks can't be reordered, dropped or appended
+_chunkSuffix = struct.Struct('>QB')
+
+
+@memoize
+def _secretBox(keyPath):
+    """
+    Load the key in the given file, once per process.
+
+    :rtype: SecretBox
+    """
+    with open(keyPath, 'rb') as f:
+        key = f.read()
+    if len(key) != SecretBox.KEY_SIZE:
+        raise ValueError("Key is %d bytes, but must be exactly %d bytes" % (len(key),
+                                                                            SecretBox.KEY_SIZE))
+    return SecretBox(key)
+
 def encrypt(message, keyPath):
     """
-    Encrypts a message given a path to a local file containing a key.
+    Encrypts a message given a path to a local file containing a key. The key is loaded once per
+    process.
 
     :param message: The message to be encrypted.
     :param keyPath: A path to a file containing a 256-bit key (and nothing else).
@@ -39,12 +74,7 @@ def encrypt(message, keyPath):
     >>> len(encrypt(message, k)) == overhead + len(message)
     True
     """
-    with open(keyPath, 'rb') as f:
-        key = f.read()
-    if len(key) != SecretBox.KEY_SIZE:
-        raise ValueError("Key is %d bytes, but must be exactly %d bytes" % (len(key),
-                                                                            SecretBox.KEY_SIZE))
-    sb = SecretBox(key)
+    sb = _secretBox(keyPath)
     # We generate the nonce using secure random bits. For long enough
     # nonce size, the chance of a random nonce collision becomes
     # *much* smaller than the chance of a subtle coding error causing
@@ -81,11 +111,206 @@ def decrypt(ciphertext, keyPath):
     >>> decrypt(encrypt("testMessage".encode('utf-8'), k), k).decode('utf-8') # doctest: +ALLOW_UNICODE
     u'testMessage'
     """
-    with open(keyPath, 'rb') as f:
-        key = f.read()
-    if len(key) != SecretBox.KEY_SIZE:
-        raise ValueError("Key is %d bytes, but must be exactly %d bytes" % (len(key),
-                                                                            SecretBox.KEY_SIZE))
-    sb = SecretBox(key)
+    sb = _secretBox(keyPath)
     # The nonce is kept with the message.
     return sb.decrypt(ciphertext)
+
+
+def _chunkNonce(prefix, index, final):
+    return prefix + _chunkSuffix.pack(index, final)
+
+
+def _readFully(readable, size):
+    data = b''
+    while len(data) < size:
+        buf = readable.read(size - len(data))
+        if not buf:
+            break
+        data += buf
+    return data
+
+
+class EncryptingWriter(object):
+    """
+    A file-like object that encrypts the data written to it and writes the result to another
+    file-like object, in chunks of a fixed size so that only a chunk is held in memory at a time.
+    Each chunk is authenticated on its own, with a nonce derived from its index and whether it is
+    the final chunk, so the content can't be truncated or rearranged without the
+    :class:`DecryptingReader` noticing. The underlying file object is not closed by close().
+
+    >>> import tempfile
+    >>> from io import BytesIO
+    >>> k = tempfile.mktemp()
+    >>> with open(k, 'wb') as f:
+    ...     _ = f.write(nacl.utils.random(SecretBox.KEY_SIZE))
+    >>> stored = BytesIO()
+    >>> with EncryptingWriter(stored, k, chunkSize=4) as writable:
+    ...     _ = writable.write(b'0123456789')
+    >>> len(stored.getvalue()) == len(streamMagic) + _streamHeader.size + 10 + 3 * 16
+    True
+    >>> DecryptingReader(BytesIO(stored.getvalue()), k).read() == b'0123456789'
+    True
+
+    Content that was cut short, even at the end of a chunk, fails to decrypt:
+
+    >>> truncated = stored.getvalue()[:-(2 + 16)]
+    >>> DecryptingReader(BytesIO(truncated), k).read() # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ...
+    CryptoError: Decryption failed. Ciphertext failed verification
+    """
+    # 64KiB, large enough for the MACs to be negligible
+    chunkSize = 1 << 16
+
+    def __init__(self, writable, keyPath, chunkSize=None):
+        """
+        :param writable: the file-like object to write to
+
+        :param str keyPath: A path to a file containing a 256-bit key (and nothing else).
+
+        :param int chunkSize: the number of bytes of plaintext per chunk
+        """
+        self.writable = writable
+        if chunkSize is not None:
+            self.chunkSize = chunkSize
+        self._box = _secretBox(keyPath)
+        self._prefix = nacl.utils.random(_streamHeader.size - 4)
+        self._index = 0
+        # The last chunk is held back until more data arrives since it may be the final one
+        self._buffer = b''
+        self.closed = False
+        writable.write(streamMagic + _streamHeader.pack(self.chunkSize, self._prefix))
+
+    def _writeChunk(self, plaintext, final):
+        nonce = _chunkNonce(self._prefix, self._index, final)
+        self.writable.write(self._box.encrypt(bytes(plaintext), nonce).ciphertext)
+        self._index += 1
+
+    def write(self, data):
+        chunkSize = self.chunkSize
+        start = 0
+        if self._buffer:
+            start = chunkSize - len(self._buffer)
+            if len(data) <= start:
+                self._buffer += data
+                return
+            self._writeChunk(self._buffer + data[:start], final=False)
+        while len(data) - start > chunkSize:
+            self._writeChunk(data[start:start + chunkSize], final=False)
+            start += chunkSize
+        self._buffer = bytes(data[start:])
+
+    def flush(self):
+        # The held back chunk can't be written before it is known whether it is the final one
+        pass
+
+    def close(self):
+        if not self.closed:
+            self._writeChunk(self._buffer, final=True)
+            self._buffer = b''
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Leave the content without its final chunk so that it can't be mistaken for
+            # complete content
+            self.closed = True
+
+
+class DecryptingReader(io.RawIOBase):
+    """
+    A raw binary stream that reads content encrypted by an :class:`EncryptingWriter` from another
+    file-like object and returns it decrypted, a chunk at a time. Content encrypted as a whole by
+    :func:`encrypt` is decrypted, too, but that is read into memory at once. Use
+    :func:`openDecrypted` to get a buffered stream with readline() and iteration.
+
+    >>> import tempfile
+    >>> from io import BytesIO
+    >>> k = tempfile.mktemp()
+    >>> with open(k, 'wb') as f:
+    ...     _ = f.write(nacl.utils.random(SecretBox.KEY_SIZE))
+    >>> DecryptingReader(BytesIO(encrypt(b'testMessage', k)), k).read() == b'testMessage'
+    True
+    """
+
+    def __init__(self, readable, keyPath):
+        """
+        :param readable: the file-like object to read from
+
+        :param str keyPath: A path to a file containing a 256-bit key (and nothing else).
+        """
+        super(DecryptingReader, self).__init__()
+        self.source = readable
+        self._box = _secretBox(keyPath)
+        # Decrypted data not yet returned starts at _offset in _buffer
+        self._buffer = b''
+        self._offset = 0
+        self._index = 0
+        head = _readFully(readable, len(streamMagic))
+        if head == streamMagic:
+            header = _readFully(readable, _streamHeader.size)
+            if len(header) < _streamHeader.size:
+                raise CryptoError('Encrypted content is truncated')
+            self._chunkSize, self._prefix = _streamHeader.unpack(header)
+            self._next = _readFully(readable, self._chunkSize + SecretBox.MACBYTES)
+            self._eof = False
+        else:
+            self._buffer = bytes(self._box.decrypt(head + readable.read()))
+            self._eof = True
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        # Decrypt the next chunk into the buffer once it has been consumed, return False at the end
+        while self._offset >= len(self._buffer):
+            if self._eof:
+                return False
+            chunk = self._next
+            # Only once the next chunk is read does it become clear whether this is the last one
+            self._next = _readFully(self.source, self._chunkSize + SecretBox.MACBYTES)
+            final = not self._next
+            nonce = _chunkNonce(self._prefix, self._index, final)
+            self._buffer = bytes(self._box.decrypt(chunk, nonce))
+            self._offset = 0
+            self._index += 1
+            self._eof = final
+        return True
+
+    def readinto(self, b):
+        if not self._fill():
+            return 0
+        size = min(len(b), len(self._buffer) - self._offset)
+        b[:size] = self._buffer[self._offset:self._offset + size]
+        self._offset += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.source.close()
+        super(DecryptingReader, self).close()
+
+
+def openDecrypted(readable, keyPath):
+    """
+    Return a buffered binary stream that reads the content of a file-like object encrypted by an
+    :class:`EncryptingWriter` or :func:`encrypt`, decrypted. Closing it closes the file-like object.
+
+    >>> import tempfile
+    >>> from io import BytesIO
+    >>> k = tempfile.mktemp()
+    >>> with open(k, 'wb') as f:
+    ...     _ = f.write(nacl.utils.random(SecretBox.KEY_SIZE))
+    >>> stored = BytesIO()
+    >>> with EncryptingWriter(stored, k, chunkSize=3) as writable:
+    ...     _ = writable.write(b'a\\nbc\\nd\\n')
+    >>> _ = stored.seek(0)
+    >>> [line for line in openDecrypted(stored, k)] == [b'a\\n', b'bc\\n', b'd\\n']
+    True
+    """
+    return io.BufferedReader(DecryptingReader(readable, keyPath))
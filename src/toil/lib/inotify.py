@@ -0,0 +1,137 @@
+# Copyright (C) 2015-2018 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Access to Linux's inotify API through ctypes.
+"""
+
+from __future__ import absolute_import
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+log = logging.getLogger(__name__)
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x80000
+
+eventHeader = struct.Struct('iIII')
+
+
+def _loadLibc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch, libc.inotify_rm_watch
+    except (OSError, AttributeError):
+        return None
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+libc = _loadLibc()
+"""
+The C library with the inotify functions, or None if inotify is not available
+"""
+
+
+def _encode(path):
+    return path.encode(sys.getfilesystemencoding()) if not isinstance(path, bytes) else path
+
+
+def _pollForDeletion(path, timeout):
+    # Without notifications the file is checked before and after sleeping for the timeout
+    if not os.path.exists(path):
+        return True
+    time.sleep(timeout)
+    return not os.path.exists(path)
+
+
+def waitForDeletion(path, timeout):
+    """
+    Block until the file at the given path doesn't exist, or the timeout elapses. Where inotify
+    is available, the deletion of the file is noticed as soon as it happens. Note that inotify
+    doesn't see changes made by other hosts to network file systems, so the file is checked
+    again once the timeout has elapsed.
+
+    :param str path: the path of the file
+    :param float timeout: the maximum number of seconds to wait
+    :return: True if the file doesn't exist
+    :rtype: bool
+    """
+    if libc is None:
+        return _pollForDeletion(path, timeout)
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        e = ctypes.get_errno()
+        log.debug("Can't use inotify: %s", os.strerror(e))
+        return _pollForDeletion(path, timeout)
+    try:
+        dirPath, name = os.path.split(path)
+        name = _encode(name)
+        if libc.inotify_add_watch(fd, _encode(dirPath),
+                                  IN_DELETE | IN_MOVED_FROM | IN_DELETE_SELF | IN_ONLYDIR) < 0:
+            e = ctypes.get_errno()
+            if e in (errno.ENOENT, errno.ENOTDIR):
+                return True
+            log.debug("Can't watch %s: %s", dirPath, os.strerror(e))
+            return _pollForDeletion(path, timeout)
+        # The file may have been deleted before the watch was in place
+        if not os.path.exists(path):
+            return True
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if not readable:
+                break
+            try:
+                events = os.read(fd, 1 << 16)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                continue
+            offset = 0
+            while offset < len(events):
+                _, mask, _, length = eventHeader.unpack_from(events, offset)
+                offset += eventHeader.size
+                if ((mask & (IN_DELETE_SELF | IN_Q_OVERFLOW)
+                     or events[offset:offset + length].rstrip(b'\0') == name)
+                        and not os.path.exists(path)):
+                    return True
+                offset += length
+        return not os.path.exists(path)
+    finally:
+        os.close(fd)
@@ -0,0 +1,370 @@
+# Copyright (C) 2015-2018 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Lets the caching file stores on different nodes fetch files from each other's caches instead of
+from the job store. Each node runs a small HTTP server that serves the files in its cache
+directory. Which nodes hold a copy of which file is recorded in a shared file per job store
+file, along with the SHA-256 hash of the file's content that downloads from peers are validated
+against. The index is only a hint: peers that have evicted a file or are unreachable are skipped
+and removed from it, and the job store remains the source of truth.
+
+The servers listen on the nodes' private addresses only and serve requests that present the
+workflow's token, a random secret the leader keeps in a protected shared file of the job store.
+"""
+
+from __future__ import absolute_import
+
+from builtins import object
+from builtins import range
+from contextlib import closing
+from fcntl import flock, LOCK_EX
+import binascii
+import errno
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import socket
+import sys
+import threading
+import time
+
+import requests
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+
+from toil import subprocess
+
+log = logging.getLogger(__name__)
+
+# The names of files in a cache directory that may be served, i.e. URL-safe base64, excluding
+# hidden files such as partial downloads and the cache's own bookkeeping files
+_servableFileName = re.compile(r'^[A-Za-z0-9=-][A-Za-z0-9_=-]*$')
+
+
+def _isPrivateIP(ip):
+    octets = [int(octet) for octet in ip.split('.')]
+    return (octets[0] == 10 or
+            octets[0] == 172 and 16 <= octets[1] < 32 or
+            octets[0] == 192 and octets[1] == 168)
+
+
+def getPrivateIP():
+    """
+    Get the address this machine uses to contact the machines in the private networks reserved
+    by RFC 1918, i.e. the address of the interface facing the other nodes of a cluster.
+
+    :return: the private address, or None if this machine has none
+    :rtype: str|None
+    """
+    # Connecting a UDP socket sends no packets but selects the interface a packet to the given
+    # address would be routed through
+    for address in ('10.255.255.255', '172.31.255.255', '192.168.255.255'):
+        try:
+            with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as sock:
+                sock.connect((address, 1))
+                ip = sock.getsockname()[0]
+        except socket.error:
+            continue
+        if _isPrivateIP(ip):
+            return ip
+    return None
+
+
+class PeerCache(object):
+    """
+    The view of one node's cache onto the caches of its peers.
+    """
+    # Seconds to wait for a peer to respond
+    timeout = 10
+
+    # The index is updated without locking so concurrent updates may clobber each other. Updates
+    # are verified and retried this many times, after a random delay of up to this many seconds.
+    attempts = 5
+    backoff = 0.5
+
+    # The name of the shared file holding the token peers must present
+    tokenFileName = 'peerCacheToken'
+
+    def __init__(self, jobStore, cacheDir, host):
+        """
+        :param toil.jobStores.abstractJobStore.AbstractJobStore jobStore: the job store holding
+               the index and the token, see :meth:`createToken`
+
+        :param str cacheDir: the node's cache directory, served to peers
+
+        :param str host: the private address peers can reach this node at
+        """
+        self.jobStore = jobStore
+        self.cacheDir = cacheDir
+        with jobStore.readSharedFileStream(self.tokenFileName) as f:
+            self.token = f.read().decode('utf-8')
+        self.url = PeerCacheServer.ensureRunning(cacheDir, host, self.token)
+
+    @classmethod
+    def createToken(cls, jobStore):
+        """
+        Create the token the peers of a workflow authenticate with, unless the given job store
+        has one already. Must be called by the leader before any worker uses the peer cache.
+        """
+        from toil.jobStores.abstractJobStore import NoSuchFileException
+        try:
+            with jobStore.readSharedFileStream(cls.tokenFileName):
+                return
+        except NoSuchFileException:
+            pass
+        with jobStore.writeSharedFileStream(cls.tokenFileName, isProtected=True) as f:
+            f.write(binascii.hexlify(os.urandom(32)))
+
+    @staticmethod
+    def _indexFileName(jobStoreFileID):
+        return 'peerCache-' + hashlib.sha1(jobStoreFileID.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def deleteIndexes(cls, jobStore, jobStoreFileIDs):
+        """
+        Delete the indexes of the given files, which have been or are about to be deleted.
+
+        :param list[str] jobStoreFileIDs: the IDs of the files
+        """
+        for jobStoreFileID in jobStoreFileIDs:
+            jobStore.deleteSharedFile(cls._indexFileName(jobStoreFileID))
+
+    def _loadIndex(self, jobStoreFileID):
+        """
+        :return: a dictionary with the SHA-256 hex digest of the file's content under 'sha256' and
+                 the URLs of the peers holding it under 'peers', or None if no peer holds it
+        :rtype: dict|None
+        """
+        from toil.jobStores.abstractJobStore import NoSuchFileException
+        for attempt in range(self.attempts):
+            try:
+                with self.jobStore.readSharedFileStream(self._indexFileName(jobStoreFileID)) as f:
+                    return json.loads(f.read().decode('utf-8'))
+            except NoSuchFileException:
+                return None
+            except ValueError:
+                # Torn by a concurrent update
+                time.sleep(random.random() * self.backoff)
+        log.debug('Ignoring unreadable peer cache index for file %s.', jobStoreFileID)
+        return None
+
+    def _saveIndex(self, jobStoreFileID, index):
+        with self.jobStore.writeSharedFileStream(self._indexFileName(jobStoreFileID)) as f:
+            f.write(json.dumps(index).encode('utf-8'))
+
+    def download(self, jobStoreFileID, cachedFilePath, localFilePath):
+        """
+        Try to download a file from the cache of a peer.
+
+        :param str cachedFilePath: the path of the file in a cache directory
+        :param str localFilePath: the path to download the file to
+        :return: True if the file was downloaded and its content is valid, False otherwise
+        :rtype: bool
+        """
+        index = self._loadIndex(jobStoreFileID)
+        if index is None:
+            return False
+        peers = [url for url in index['peers'] if url != self.url]
+        random.shuffle(peers)
+        for url in peers:
+            try:
+                if self._fetch(url + os.path.basename(cachedFilePath), localFilePath,
+                               index['sha256']):
+                    log.debug('Downloaded file %s from peer %s.', jobStoreFileID, url)
+                    return True
+            except (requests.exceptions.RequestException, IOError) as e:
+                log.debug('Failed to download file %s from peer %s: %s', jobStoreFileID, url, e)
+            self._removePeer(jobStoreFileID, url)
+        return False
+
+    def _fetch(self, url, localFilePath, digest):
+        response = requests.get(url, stream=True, timeout=self.timeout,
+                                headers={'Authorization': 'Bearer ' + self.token})
+        try:
+            if response.status_code != 200:
+                log.debug('Peer responded to %s with status %i.', url, response.status_code)
+                return False
+            contentHash = hashlib.sha256()
+            with open(localFilePath, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1 << 20):
+                    contentHash.update(chunk)
+                    f.write(chunk)
+        finally:
+            response.close()
+        if contentHash.hexdigest() != digest:
+            log.warn('Content of %s does not match its checksum, discarding it.', url)
+            os.remove(localFilePath)
+            return False
+        return True
+
+    def advertise(self, jobStoreFileID, cachedFilePath, contentHash=None):
+        """
+        Record in the index that this node's cache holds the given file.
+
+        :param str contentHash: the SHA-256 hex digest of the file's content, computed if omitted
+        """
+        if contentHash is None:
+            from toil.jobStores.abstractJobStore import AbstractJobStore
+            contentHash = AbstractJobStore._hashFile(cachedFilePath)
+        for attempt in range(self.attempts):
+            index = self._loadIndex(jobStoreFileID) or dict(peers=[])
+            if self.url in index['peers']:
+                return
+            if index.get('sha256', contentHash) != contentHash:
+                log.warn('Cached copy of file %s differs from the copies of its peers, not '
+                         'sharing it.', jobStoreFileID)
+                return
+            index['sha256'] = contentHash
+            index['peers'].append(self.url)
+            self._saveIndex(jobStoreFileID, index)
+            time.sleep(random.random() * self.backoff)
+        log.debug('Failed to advertise file %s in the peer cache index.', jobStoreFileID)
+
+    def _removePeer(self, jobStoreFileID, url):
+        index = self._loadIndex(jobStoreFileID)
+        if index is not None and url in index['peers']:
+            index['peers'].remove(url)
+            self._saveIndex(jobStoreFileID, index)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if not hmac.compare_digest(str(self.headers.get('Authorization', '')),
+                                   str('Bearer ' + self.server.token)):
+            self.send_error(403)
+            return
+        name = self.path.lstrip('/')
+        if not _servableFileName.match(name):
+            self.send_error(404)
+            return
+        try:
+            f = open(os.path.join(self.server.cacheDir, name), 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.send_error(404)
+            return
+        with f:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, 1 << 20)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+class PeerCacheServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves the files in a cache directory to peers. Runs in a process of its own, one per
+    cache directory, which exits once the cache directory is removed.
+    """
+    daemon_threads = True
+
+    # Holds the URL and PID of the server for a cache directory
+    stateFileName = '.peerCacheServer'
+
+    # Seconds between checks whether the cache directory still exists
+    pollInterval = 5
+
+    def __init__(self, cacheDir, host, token):
+        HTTPServer.__init__(self, (host, 0), _RequestHandler)
+        self.cacheDir = cacheDir
+        self.token = token
+        self.url = 'http://%s:%i/' % (host, self.server_address[1])
+
+    @classmethod
+    def ensureRunning(cls, cacheDir, host, token):
+        """
+        Start the server for the given cache directory unless it is running already.
+
+        :param str token: the token requests must present, passed to the server through its
+               standard input so other users of the node can't see it
+
+        :return: the URL of the server
+        :rtype: str
+        """
+        stateFile = os.path.join(cacheDir, cls.stateFileName)
+        with open(stateFile + '.lock', 'w') as lockFile:
+            flock(lockFile, LOCK_EX)
+            url = cls._runningServer(stateFile)
+            if url is None:
+                with open(os.devnull, 'r+') as devnull:
+                    process = subprocess.Popen([sys.executable, '-m', 'toil.peerCache',
+                                                cacheDir, host],
+                                               stdin=subprocess.PIPE, stdout=devnull,
+                                               stderr=devnull, close_fds=True,
+                                               preexec_fn=os.setsid)
+                process.stdin.write(token.encode('utf-8'))
+                process.stdin.close()
+                deadline = time.time() + 30
+                while url is None:
+                    if process.poll() is not None:
+                        raise RuntimeError('The peer cache server for %s failed to start.'
+                                           % cacheDir)
+                    if time.time() > deadline:
+                        process.kill()
+                        raise RuntimeError('The peer cache server for %s did not start in '
+                                           'time.' % cacheDir)
+                    time.sleep(0.1)
+                    url = cls._runningServer(stateFile)
+                log.debug('Started peer cache server at %s.', url)
+            return url
+
+    @staticmethod
+    def _runningServer(stateFile):
+        try:
+            with open(stateFile) as f:
+                url, pid = f.read().split()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            os.kill(int(pid), 0)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                return None
+            raise
+        return url
+
+    def run(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        stateFile = os.path.join(self.cacheDir, self.stateFileName)
+        with open(stateFile + '.tmp', 'w') as f:
+            f.write('%s %i' % (self.url, os.getpid()))
+        os.rename(stateFile + '.tmp', stateFile)
+        while os.path.isdir(self.cacheDir):
+            time.sleep(self.pollInterval)
+        self.shutdown()
+
+
+def main():
+    logging.basicConfig()
+    cacheDir, host = sys.argv[1:]
+    token = sys.stdin.read().strip()
+    PeerCacheServer(cacheDir, host, token).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -25,7 +25,7 @@ import logging
 import os
 import sys
 import time
-from collections import defaultdict
+from collections import Counter, defaultdict
 
 from toil.lib.retry import retry
 from toil.lib.threading import ExceptionalThread
@@ -34,6 +34,7 @@ from itertools import islice
 
 from toil.batchSystems.abstractBatchSystem import AbstractScalableBatchSystem, NodeInfo
 from toil.provisioners.abstractProvisioner import Shape
+from toil.provisioners.runtimeModel import RuntimeModel
 from toil.job import ServiceJobNode
 from toil.common import defaultTargetTime
 
@@ -71,22 +72,34 @@ class BinPackedFit(object):
         self.nodeReservations = {nodeShape:[] for nodeShape in nodeShapes}
 
     def binPack(self, jobShapes):
-        """Pack a list of jobShapes into the fewest nodes reasonable. Can be run multiple times."""
+        """
+        Pack jobShapes into the fewest nodes reasonable. Can be run multiple times.
+
+        :param jobShapes: a list of job shapes, or a dict mapping each job shape to the number of
+                          jobs of that shape
+        """
+        if not isinstance(jobShapes, dict):
+            jobShapes = Counter(jobShapes)
         logger.debug('Running bin packing for node shapes %s and %s job(s).',
-                     self.nodeShapes, len(jobShapes))
+                     self.nodeShapes, sum(jobShapes.values()))
         # Sort in descending order from largest to smallest. The FFD like-strategy will pack the
-        # jobs in order from longest to shortest.
-        jobShapes.sort()
-        jobShapes.reverse()
-        assert len(jobShapes) == 0 or jobShapes[0] >= jobShapes[-1]
-        for jS in jobShapes:
-            self.addJobShape(jS)
+        # jobs in order from longest to shortest. Identical jobs are packed together.
+        for jS in sorted(jobShapes, reverse=True):
+            self.addJobShape(jS, jobShapes[jS])
 
-    def addJobShape(self, jobShape):
+    def addJobShape(self, jobShape, count=1):
         """
         Function adds the job to the first node reservation in which it will fit (this is the
         bin-packing aspect).
+
+        The result of adding several identical jobs at once is the same as adding them one after
+        the other, but takes time in the order of the number of distinct node reservations
+        rather than the number of jobs.
+
+        :param int count: the number of jobs of this shape to add
         """
+        if count <= 0:
+            return
         chosenNodeShape = None
         for nodeShape in self.nodeShapes:
             if NodeReservation(nodeShape).fits(jobShape):
@@ -95,34 +108,74 @@ class BinPackedFit(object):
                 break
 
         if chosenNodeShape is None:
-            logger.warning("Couldn't fit job with requirements %r into any nodes in the nodeTypes "
-                           "list." % jobShape)
+            logger.warning("Couldn't fit %i job(s) with requirements %r into any nodes in the "
+                           "nodeTypes list." % (count, jobShape))
             return
 
         # grab current list of job objects appended to this nodeType
         nodeReservations = self.nodeReservations[chosenNodeShape]
-        for nodeReservation in nodeReservations:
-            if nodeReservation.attemptToAddJob(jobShape, chosenNodeShape, self.targetTime):
-                # We succeeded adding the job to this node reservation. Now we're done.
-                return
-
-        reservation = NodeReservation(chosenNodeShape)
-        currentTimeAllocated = chosenNodeShape.wallTime
-        adjustEndingReservationForJob(reservation, jobShape, 0)
-        self.nodeReservations[chosenNodeShape].append(reservation)
-
-        # Extend the reservation if necessary to cover the job's entire runtime.
-        while currentTimeAllocated < jobShape.wallTime:
-            extendThisReservation = NodeReservation(reservation.shape)
-            currentTimeAllocated += chosenNodeShape.wallTime
-            reservation.nReservation = extendThisReservation
-            reservation = extendThisReservation
+        i = 0
+        while count > 0 and i < len(nodeReservations):
+            nodeReservation = nodeReservations[i]
+            if nodeReservation.count == 1:
+                count -= nodeReservation.fill(jobShape, chosenNodeShape, self.targetTime, count)
+                i += 1
+                continue
+            # The reservation stands for several identical nodes. Each of them takes as many jobs
+            # as the first one before the jobs spill over to the next.
+            first = nodeReservation.copy()
+            first.count = 1
+            added = first.fill(jobShape, chosenNodeShape, self.targetTime, count)
+            if added == 0:
+                i += 1
+                continue
+            if added == count:
+                filled = [first]
+                count = 0
+            else:
+                # The first node is full, so all nodes are filled with the same number of jobs
+                first.count = min(nodeReservation.count, count // added)
+                count -= first.count * added
+                filled = [first]
+                if count > 0 and first.count < nodeReservation.count:
+                    last = nodeReservation.copy()
+                    last.count = 1
+                    count -= last.fill(jobShape, chosenNodeShape, self.targetTime, count)
+                    assert count == 0
+                    filled.append(last)
+            nodeReservation.count -= sum(reservation.count for reservation in filled)
+            if nodeReservation.count > 0:
+                filled.append(nodeReservation)
+            nodeReservations[i:i + 1] = filled
+            i += len(filled)
+
+        while count > 0:
+            reservation = NodeReservation(chosenNodeShape)
+            currentTimeAllocated = chosenNodeShape.wallTime
+            adjustEndingReservationForJob(reservation, jobShape, 0)
+            self.nodeReservations[chosenNodeShape].append(reservation)
+
+            # Extend the reservation if necessary to cover the job's entire runtime.
+            lastReservation = reservation
+            while currentTimeAllocated < jobShape.wallTime:
+                extendThisReservation = NodeReservation(lastReservation.shape)
+                currentTimeAllocated += chosenNodeShape.wallTime
+                lastReservation.nReservation = extendThisReservation
+                lastReservation = extendThisReservation
+
+            added = 1 + reservation.fill(jobShape, chosenNodeShape, self.targetTime, count - 1)
+            count -= added
+            if count > 0:
+                # The new node is full and every further new node would be filled the same way
+                reservation.count += count // added
+                count %= added
 
     def getRequiredNodes(self):
         """
         Returns a dict from node shape to number of nodes required to run the packed jobs.
         """
-        return {nodeShape:len(self.nodeReservations[nodeShape]) for nodeShape in self.nodeShapes}
+        return {nodeShape:sum(reservation.count for reservation in self.nodeReservations[nodeShape])
+                for nodeShape in self.nodeShapes}
 
 class NodeReservation(object):
     """
@@ -131,12 +184,18 @@ class NodeReservation(object):
     represent the resources available in a reservation, we represent a
     reservation as a linked list of NodeReservations, each giving the
     resources free within a single timeslice.
+
+    A reservation may stand for several nodes with identical timeslices, so that
+    large numbers of identical jobs can be packed without representing each node.
     """
     def __init__(self, shape):
         # The wall-time of this slice and resources available in this timeslice
         self.shape = shape
         # The next portion of the reservation (None if this is the end)
         self.nReservation = None
+        # The number of identical nodes this reservation stands for (only used for the first
+        # slice of a reservation)
+        self.count = 1
 
     def __str__(self):
         return "-------------------\n" \
@@ -175,6 +234,37 @@ class NodeReservation(object):
                jobShape.disk <= self.shape.disk and \
                (jobShape.preemptable or not self.shape.preemptable)
 
+    def capacity(self, jobShape, maximum):
+        """
+        Get the number of jobs of the given shape, up to maximum, whose resource requirements
+        will fit within this allocation at the same time.
+        """
+        number = maximum
+        for required, available in ((jobShape.memory, self.shape.memory),
+                                    (jobShape.cores, self.shape.cores),
+                                    (jobShape.disk, self.shape.disk)):
+            if required > 0:
+                fitting = int(available // required)
+                # Guard against rounding in the division of fractional requirements
+                while fitting > 0 and fitting * required > available:
+                    fitting -= 1
+                while (fitting + 1) * required <= available and fitting < number:
+                    fitting += 1
+                number = min(number, fitting)
+        return number
+
+    def copy(self):
+        """Get a copy of this reservation and the reservations after it."""
+        reservation = NodeReservation(self.shape)
+        reservation.count = self.count
+        lastReservation = reservation
+        curRes = self.nReservation
+        while curRes is not None:
+            lastReservation.nReservation = NodeReservation(curRes.shape)
+            lastReservation = lastReservation.nReservation
+            curRes = curRes.nReservation
+        return reservation
+
     def shapes(self):
         """Get all time-slice shapes, in order, from this reservation on."""
         shapes = []
@@ -194,12 +284,15 @@ class NodeReservation(object):
                            self.shape.disk - jobShape.disk,
                            self.shape.preemptable)
 
-    def attemptToAddJob(self, jobShape, nodeShape, targetTime):
+    def attemptToAddJob(self, jobShape, nodeShape, targetTime, count=1):
         """
         Attempt to pack a job into this reservation timeslice and/or the reservations after it.
 
         jobShape is the Shape of the job requirements, nodeShape is the Shape of the node this
         is a reservation for, and targetTime is the maximum time to wait before starting this job.
+
+        Up to count identical jobs are packed into the first timeslices that fit the job, as many
+        as fit into them side by side. Returns the number of jobs packed.
         """
         # starting slice of time that we can fit in so far
         startingReservation = self
@@ -217,6 +310,21 @@ class NodeReservation(object):
                 availableTime += endingReservation.shape.wallTime
                 # does the job time fit in the reservation's remaining time?
                 if availableTime >= jobShape.wallTime:
+                    # Adding one job after the other would put all jobs that still fit into
+                    # these slices there, so add them at once.
+                    number = count
+                    curRes = startingReservation
+                    while number > 1:
+                        number = curRes.capacity(jobShape, number)
+                        if curRes == endingReservation:
+                            break
+                        curRes = curRes.nReservation
+                    if number > 1:
+                        jobShape = Shape(jobShape.wallTime,
+                                         jobShape.memory * number,
+                                         jobShape.cores * number,
+                                         jobShape.disk * number,
+                                         jobShape.preemptable)
                     timeSlice = 0
                     while startingReservation != endingReservation:
                         # removes resources only (NO time) from startingReservation
@@ -226,8 +334,8 @@ class NodeReservation(object):
                         startingReservation = startingReservation.nReservation
                     assert jobShape.wallTime - timeSlice <= startingReservation.shape.wallTime
                     adjustEndingReservationForJob(endingReservation, jobShape, timeSlice)
-                    # Packed the job.
-                    return True
+                    # Packed the jobs.
+                    return number
 
                 # If the job would fit, but is longer than the total node allocation
                 # extend the node allocation
@@ -249,7 +357,20 @@ class NodeReservation(object):
                 # add to reservation
                 break
         # Couldn't pack the job.
-        return False
+        return 0
+
+    def fill(self, jobShape, nodeShape, targetTime, count):
+        """
+        Pack up to count identical jobs into this reservation, stopping at the first job that
+        doesn't fit. Returns the number of jobs packed.
+        """
+        added = 0
+        while added < count:
+            number = self.attemptToAddJob(jobShape, nodeShape, targetTime, count - added)
+            if number == 0:
+                break
+            added += number
+        return added
 
 def adjustEndingReservationForJob(reservation, jobShape, wallTime):
     """
@@ -301,12 +422,9 @@ class ClusterScaler(object):
         self.config = config
         self.static = {}
 
-        # Dictionary of job names to their average runtime, used to estimate wall time of queued
-        # jobs for bin-packing
-        self.jobNameToAvgRuntime = {}
-        self.jobNameToNumCompleted = {}
-        self.totalAvgRuntime = 0.0
-        self.totalJobsCompleted = 0
+        # The runtimes of completed jobs, used to estimate wall time of queued jobs for
+        # bin-packing
+        self.runtimeModel = RuntimeModel(config.runtimeModel)
 
         self.targetTime = config.targetTime
         if self.targetTime <= 0:
@@ -399,7 +517,16 @@ class ClusterScaler(object):
             # If we get here, something has gone wrong.
             raise RuntimeError("Could not round {}".format(number))
 
-    def getAverageRuntime(self, jobName, service=False):
+    def getEstimatedRuntime(self, jobName, service=False, cores=None, memory=None):
+        """
+        Estimate the runtime of a job from the runtimes of completed jobs, see the
+        --runtimeEstimate option.
+
+        :param str jobName: the name of the job
+        :param bool service: whether the job is a service job
+        :param cores: the number of cores the job requires, or None if unknown
+        :param memory: the memory the job requires in bytes, or None if unknown
+        """
         if service:
             # We short-circuit service jobs and assume that they will
             # take a very long time, because if they are assumed to
@@ -409,17 +536,14 @@ class ClusterScaler(object):
             # and a deadlock, because often multiple services need to
             # be running at once for any actual work to get done.
             return self.targetTime * 24 + 3600
-        if jobName in self.jobNameToAvgRuntime:
-            #Have seen jobs of this type before, so estimate
-            #the runtime based on average of previous jobs of this type
-            return self.jobNameToAvgRuntime[jobName]
-        elif self.totalAvgRuntime > 0:
-            #Haven't seen this job yet, so estimate its runtime as
-            #the average runtime of all completed jobs
-            return self.totalAvgRuntime
-        else:
+        # Based on previous jobs of this type, if any have completed in this or earlier runs,
+        # otherwise on all completed jobs
+        runtime = self.runtimeModel.getRuntime(jobName, estimate=self.config.runtimeEstimate,
+                                               cores=cores, memory=memory)
+        if runtime is None:
             #Have no information whatsoever
             return 1.0
+        return runtime
 
     def addCompletedJob(self, job, wallTime):
         """
@@ -428,20 +552,7 @@ class ClusterScaler(object):
         :param toil.job.JobNode job: The memory, core and disk requirements of the completed job
         :param int wallTime: The wall-time taken to complete the job in seconds.
         """
-
-        #Adjust average runtimes to include this job.
-        if job.jobName in self.jobNameToAvgRuntime:
-            prevAvg = self.jobNameToAvgRuntime[job.jobName]
-            prevNum = self.jobNameToNumCompleted[job.jobName]
-            self.jobNameToAvgRuntime[job.jobName] = float(prevAvg*prevNum + wallTime)/(prevNum + 1)
-            self.jobNameToNumCompleted[job.jobName] += 1
-        else:
-            self.jobNameToAvgRuntime[job.jobName] = wallTime
-            self.jobNameToNumCompleted[job.jobName] = 1
-
-        self.totalJobsCompleted += 1
-        self.totalAvgRuntime = float(self.totalAvgRuntime * (self.totalJobsCompleted - 1) + \
-                                     wallTime)/self.totalJobsCompleted
+        self.runtimeModel.addRuntime(job.jobName, wallTime, cores=job.cores, memory=job.memory)
 
     def setStaticNodes(self, nodes, preemptable):
         """
@@ -481,6 +592,9 @@ class ClusterScaler(object):
         """
         Given the resource requirements of queued jobs and the current size of the cluster, returns
         a dict mapping from nodeShape to the number of nodes we want in the cluster right now.
+
+        :param queuedJobShapes: a list of the shapes of the queued jobs, or a dict mapping each
+                                shape to the number of queued jobs of that shape
         """
         nodesToRunQueuedJobs = binPacking(jobShapes=queuedJobShapes,
                                           nodeShapes=self.nodeShapes,
@@ -866,14 +980,23 @@ class ScalerThread(ExceptionalThread):
             with throttle(self.scaler.config.scaleInterval):
                 try:
                     queuedJobs = self.scaler.leader.getJobs()
-                    queuedJobShapes = [
-                        Shape(wallTime=self.scaler.getAverageRuntime(
-                            jobName=job.jobName,
-                            service=isinstance(job, ServiceJobNode)),
-                            memory=job.memory,
-                            cores=job.cores,
-                            disk=job.disk,
-                            preemptable=job.preemptable) for job in queuedJobs]
+                    # Count the queued jobs by their requirements so the bin packing only has to
+                    # deal with each distinct job shape once
+                    queuedJobCounts = Counter((job.jobName, isinstance(job, ServiceJobNode),
+                                               job.memory, job.cores, job.disk, job.preemptable)
+                                              for job in queuedJobs)
+                    queuedJobShapes = Counter()
+                    for (jobName, service, memory, cores, disk,
+                         preemptable), count in queuedJobCounts.items():
+                        queuedJobShapes[Shape(wallTime=self.scaler.getEstimatedRuntime(
+                            jobName=jobName,
+                            service=service,
+                            cores=cores,
+                            memory=memory),
+                            memory=memory,
+                            cores=cores,
+                            disk=disk,
+                            preemptable=preemptable)] += count
                     currentNodeCounts = {}
                     for nodeShape in self.scaler.nodeShapes:
                         nodeType = self.scaler.nodeShapeToType[nodeShape]
@@ -885,9 +1008,11 @@ class ScalerThread(ExceptionalThread):
                     self.scaler.updateClusterSize(estimatedNodeCounts)
                     if self.stats:
                         self.stats.checkStats()
+                    self.scaler.runtimeModel.save()
                 except:
                     logger.exception("Exception encountered in scaler thread. Making a best-effort "
                                      "attempt to keep going, but things may go wrong from now on.")
+        self.scaler.runtimeModel.save()
         self.scaler.shutDown()
 
 class ClusterStats(object):
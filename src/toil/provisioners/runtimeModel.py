@@ -0,0 +1,250 @@
+# Copyright (C) 2015-2018 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A model of the runtimes of jobs that can be shared by the runs of workflows, see the
+--runtimeModel option.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import errno
+import fcntl
+import json
+import logging
+import math
+import os
+import tempfile
+from builtins import object
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+class RuntimeDistribution(object):
+    """
+    The distribution of the runtimes of a kind of job, summarized by their mean, an exponentially
+    weighted moving average and a histogram with logarithmically growing buckets from which
+    quantiles can be estimated.
+    """
+    bucketsPerDoubling = 8
+    """
+    The number of histogram buckets each doubling of the runtime is divided into, which bounds
+    the relative error of estimated quantiles to about 4.5%
+    """
+
+    minRuntime = 0.001
+    """
+    Shorter runtimes are counted as this many seconds in the histogram
+    """
+
+    ewmaWeight = 0.1
+    """
+    The weight of the most recent runtime in the exponentially weighted moving average
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.ewma = None
+        self.min = None
+        self.max = None
+        # Maps the index of a histogram bucket to the number of runtimes in it
+        self.histogram = {}
+
+    def add(self, runtime):
+        """
+        :param float runtime: a runtime in seconds
+        """
+        runtime = float(runtime)
+        self.count += 1
+        self.total += runtime
+        if self.ewma is None:
+            self.ewma = runtime
+        else:
+            self.ewma += self.ewmaWeight * (runtime - self.ewma)
+        self.min = runtime if self.min is None else min(self.min, runtime)
+        self.max = runtime if self.max is None else max(self.max, runtime)
+        bucket = self._bucket(runtime)
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    def mean(self):
+        return self.total / self.count
+
+    def quantile(self, q):
+        """
+        Estimate the runtime that the given fraction of runtimes doesn't exceed.
+
+        :param float q: a number between 0 (exclusive) and 1 (inclusive)
+        """
+        if q >= 1:
+            return self.max
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.histogram):
+            seen += self.histogram[bucket]
+            if seen >= rank:
+                break
+        # The middle of the bucket on a logarithmic scale
+        runtime = self.minRuntime * 2 ** ((bucket + 0.5) / self.bucketsPerDoubling)
+        return min(max(runtime, self.min), self.max)
+
+    def _bucket(self, runtime):
+        return int(math.floor(math.log(max(runtime, self.minRuntime) / self.minRuntime, 2)
+                              * self.bucketsPerDoubling))
+
+    def toDict(self):
+        return dict(count=self.count, total=self.total, ewma=self.ewma, min=self.min,
+                    max=self.max,
+                    histogram={str(bucket): n for bucket, n in self.histogram.items()})
+
+    @classmethod
+    def fromDict(cls, d):
+        distribution = cls()
+        distribution.count = d['count']
+        distribution.total = d['total']
+        distribution.ewma = d['ewma']
+        distribution.min = d['min']
+        distribution.max = d['max']
+        distribution.histogram = {int(bucket): n for bucket, n in d['histogram'].items()}
+        return distribution
+
+
+class RuntimeModel(object):
+    """
+    The distributions of the runtimes of completed jobs by job name, by job name and resource
+    requirements and over all jobs.
+
+    If the model has a path, it starts with the runtimes recorded in the file at that path by
+    earlier runs, and :meth:`save` adds the runtimes recorded since to the file. Runs of several
+    workflows can share the file concurrently.
+    """
+    version = 1
+    """
+    The format of the file
+    """
+
+    def __init__(self, path=None):
+        """
+        :param str path: the path of the file the model is kept in, or None to not keep it
+        """
+        self.path = path
+        self.distributions = {}
+        # The runtimes recorded since the model was last saved
+        self._unsaved = []
+        self._lock = Lock()
+        if path is not None:
+            with self._lock:
+                self.distributions = self._load()
+            logger.debug('Loaded runtimes of %i kinds of jobs from %s.',
+                         len(self.distributions), path)
+
+    @staticmethod
+    def _keys(jobName, cores, memory):
+        keys = ['', jobName]
+        if cores is not None and memory is not None:
+            keys.append('%s:cores=%s:memory=%s' % (jobName, cores, memory))
+        return keys
+
+    def addRuntime(self, jobName, runtime, cores=None, memory=None):
+        """
+        Record the runtime of a completed job.
+
+        :param str jobName: the name of the job
+        :param float runtime: the wall-clock time the job took in seconds
+        :param cores: the number of cores the job was given, or None if unknown
+        :param memory: the memory the job was given in bytes, or None if unknown
+        """
+        with self._lock:
+            for key in self._keys(jobName, cores, memory):
+                self._add(self.distributions, key, runtime)
+            if self.path is not None:
+                self._unsaved.append((jobName, runtime, cores, memory))
+
+    @staticmethod
+    def _add(distributions, key, runtime):
+        try:
+            distribution = distributions[key]
+        except KeyError:
+            distribution = distributions[key] = RuntimeDistribution()
+        distribution.add(runtime)
+
+    def getRuntime(self, jobName, estimate='mean', cores=None, memory=None):
+        """
+        Estimate the runtime of a job from the runtimes of earlier jobs with the same name and,
+        if known, the same resource requirements. Falls back to the runtimes of jobs with the
+        same name, then to those of all jobs.
+
+        :param str jobName: the name of the job
+        :param estimate: 'mean' or 'ewma' for the mean or the exponentially weighted moving average
+               of the runtimes, or a number between 0 and 1 for that quantile of the runtimes
+        :return: the estimated runtime in seconds, or None if no job has completed yet
+        :rtype: float|None
+        """
+        with self._lock:
+            for key in reversed(self._keys(jobName, cores, memory)):
+                distribution = self.distributions.get(key)
+                if distribution is not None:
+                    if estimate == 'mean':
+                        return distribution.mean()
+                    elif estimate == 'ewma':
+                        return distribution.ewma
+                    else:
+                        return distribution.quantile(estimate)
+        return None
+
+    def save(self):
+        """
+        Add the runtimes recorded since the model was loaded or last saved to the model's file,
+        and update the model with the runtimes other runs have added to the file.
+        """
+        if self.path is None:
+            return
+        with self._lock:
+            if not self._unsaved:
+                return
+            with open(self.path + '.lock', 'w') as lockFile:
+                fcntl.flock(lockFile, fcntl.LOCK_EX)
+                distributions = self._load()
+                for jobName, runtime, cores, memory in self._unsaved:
+                    for key in self._keys(jobName, cores, memory):
+                        self._add(distributions, key, runtime)
+                fd, tempPath = tempfile.mkstemp(prefix='tmp-', dir=os.path.dirname(self.path))
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump(dict(version=self.version,
+                                       jobs={key: distribution.toDict()
+                                             for key, distribution in distributions.items()}), f)
+                    os.rename(tempPath, self.path)
+                except:
+                    os.unlink(tempPath)
+                    raise
+            logger.debug('Saved %i runtimes to %s.', len(self._unsaved), self.path)
+            self.distributions = distributions
+            self._unsaved = []
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return {}
+            raise
+        if data['version'] != self.version:
+            logger.warning('Ignoring the runtimes in %s, which is in an unsupported format.',
+                           self.path)
+            return {}
+        return {key: RuntimeDistribution.fromDict(d) for key, d in data['jobs'].items()}
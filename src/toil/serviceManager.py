@@ -53,6 +53,14 @@ class ServiceManager( object ):
         self.jobsIssuedToServiceManager = 0 # The number of jobs the service manager
         # is scheduling
 
+        # The start and terminate flags of services that are known to have been deleted. Only
+        # services delete their start flag and only the leader deletes terminate flags, so
+        # remembering them saves checking the job store each time the leader asks about them.
+        self._startedServices = set()
+        self._terminatedServices = set()
+        # The terminate flags that are known to exist, unless they are in _terminatedServices
+        self._activeServices = set()
+
         # Start a thread that starts the services of jobGraphs in the
         # jobsWithServicesToStart input queue and puts the jobGraphs whose services
         # are running on the jobGraphssWithServicesThatHaveStarted output queue
@@ -60,7 +68,7 @@ class ServiceManager( object ):
                                      args=(self._jobGraphsWithServicesToStart,
                                            self._jobGraphsWithServicesThatHaveStarted,
                                            self._serviceJobGraphsToStart, self._terminate,
-                                           self.jobStore))
+                                           self.jobStore, self._startedServices))
         
     def start(self): 
         """
@@ -125,20 +133,34 @@ class ServiceManager( object ):
             if error:
                 self.jobStore.deleteFile(serviceJob.errorJobStoreID)
             self.jobStore.deleteFile(serviceJob.terminateJobStoreID)
+            self._terminatedServices.add(serviceJob.terminateJobStoreID)
             
     def isActive(self, serviceJobNode):
         """
         Returns true if the service job has not been told to terminate.
         :rtype: boolean
         """
-        return self.jobStore.fileExists(serviceJobNode.terminateJobStoreID)
+        flag = serviceJobNode.terminateJobStoreID
+        if flag in self._terminatedServices:
+            return False
+        if flag not in self._activeServices:
+            if not self.jobStore.fileExists(flag):
+                self._terminatedServices.add(flag)
+                return False
+            self._activeServices.add(flag)
+        return True
 
     def isRunning(self, serviceJobNode):
         """
         Returns true if the service job has started and is active
         :rtype: boolean
         """
-        return (not self.jobStore.fileExists(serviceJobNode.startJobStoreID)) and self.isActive(serviceJobNode)
+        flag = serviceJobNode.startJobStoreID
+        if flag not in self._startedServices:
+            if self.jobStore.fileExists(flag):
+                return False
+            self._startedServices.add(flag)
+        return self.isActive(serviceJobNode)
 
     def check(self):
         """
@@ -166,7 +188,7 @@ class ServiceManager( object ):
     def _startServices(jobGraphsWithServicesToStart,
                        jobGraphsWithServicesThatHaveStarted,
                        serviceJobsToStart,
-                       terminate, jobStore):
+                       terminate, jobStore, startedServices):
         """
         Thread used to schedule services.
         """
@@ -195,14 +217,14 @@ class ServiceManager( object ):
 
                 # Wait until all the services of the batch are running
                 for serviceJob in serviceJobList:
-                    while jobStore.fileExists(serviceJob.startJobStoreID):
-                        # Sleep to avoid thrashing
-                        time.sleep(1.0)
-
+                    while not jobStore.waitForFileDeletion(serviceJob.startJobStoreID,
+                                                           timeout=1.0):
                         # Check if the thread should quit
                         if terminate.is_set():
                             logger.debug('Received signal to quit starting services.')
                             break
+                    else:
+                        startedServices.add(serviceJob.startJobStoreID)
 
             # Add the jobGraph to the output queue of jobs whose services have been started
             jobGraphsWithServicesThatHaveStarted.put(jobGraph)
@@ -19,16 +19,297 @@ from builtins import object
 import gzip
 import json
 import logging
+import math
 import os
+import shutil
+import sqlite3
+import tempfile
 import time
 from threading import Thread, Event
 
+from toil.jobStores.abstractJobStore import NoSuchFileException
 from toil.lib.expando import Expando
 from toil.lib.bioio import getTotalCpuTime
 
 logger = logging.getLogger( __name__ )
 
 
+class StatsTable(object):
+    """
+    The stats of the workers and jobs of a workflow, one row per worker and per job in a SQLite
+    database in a temporary file, so that the stats of any number of jobs can be summarized
+    without holding them in memory. The leader adds the stats to a table as it aggregates them
+    and stores it in the job store when it is done, so that toil stats doesn't have to go
+    through all stats again.
+    """
+    categories = ('time', 'clock', 'wait', 'memory')
+
+    # The percentiles reported in addition to the median
+    percentiles = (90, 99)
+
+    # Rows are inserted in batches of this size
+    batchSize = 10000
+
+    # The name of the shared file in the job store holding the table of a workflow
+    sharedFileName = 'statsTable'
+
+    # Tables of a different version are ignored
+    version = 1
+
+    # The number of call cache hits and misses of the jobs
+    _callCacheAggregates = 'total(call_cache_hit = 1), total(call_cache_hit = 0)'
+
+    def __init__(self, since=None, jobNames=None, fileHandle=None):
+        """
+        :param float since: if given, only the stats of workers and jobs that started at or after
+               this time, in seconds since the epoch, are summarized. Stats recorded by versions
+               of Toil that don't record the start time are left out.
+
+        :param jobNames: if given, only the stats of jobs with one of these names, and of the
+               workers that ran them, are summarized
+
+        :param fileHandle: a file-like object to read a table saved by save() from
+        """
+        self.since = since
+        self.jobNames = None if jobNames is None else set(jobNames)
+        self._tempDir = tempfile.mkdtemp(prefix='toil-stats-')
+        path = os.path.join(self._tempDir, 'stats.db')
+        if fileHandle is not None:
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(fileHandle, f)
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        # The database is copied into the job store once complete, there is no point in making
+        # it durable
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA synchronous = OFF')
+        if fileHandle is None:
+            self.connection.execute('PRAGMA user_version = %i' % self.version)
+            self.connection.execute('CREATE TABLE workers (id INTEGER PRIMARY KEY, start REAL, '
+                                    'jobs INTEGER, time REAL, clock REAL, wait REAL, '
+                                    'memory REAL)')
+            # Whether the job's return value was taken from the call cache, NULL if the cache
+            # wasn't consulted
+            self.connection.execute('CREATE TABLE jobs (worker INTEGER, class_name TEXT, '
+                                    'start REAL, time REAL, clock REAL, wait REAL, memory REAL, '
+                                    'call_cache_hit INTEGER)')
+            self.connection.execute('CREATE TABLE totals (time REAL, clock REAL)')
+            self.connection.execute('INSERT INTO totals VALUES (NULL, NULL)')
+        elif self.connection.execute('PRAGMA user_version').fetchone()[0] != self.version:
+            self.close()
+            raise ValueError('Stats table is not of version %i' % self.version)
+        self.totalTime, self.totalClock = self.connection.execute(
+            'SELECT time, clock FROM totals').fetchone()
+        self._workers = []
+        self._jobs = []
+        self._numWorkers = self.connection.execute(
+            'SELECT coalesce(max(id) + 1, 0) FROM workers').fetchone()[0]
+
+    @classmethod
+    def load(cls, jobStore, since=None, jobNames=None, remove=False):
+        """
+        Load the table stored in the given job store by save().
+
+        :param bool remove: whether to remove the table from the job store, so that it isn't
+               mistaken for the complete stats of the workflow while more are added to it
+
+        :return: the table, or None if there is none
+        :rtype: StatsTable|None
+        """
+        try:
+            with jobStore.readSharedFileStream(cls.sharedFileName) as fileHandle:
+                table = cls(since=since, jobNames=jobNames, fileHandle=fileHandle)
+        except NoSuchFileException:
+            return None
+        except ValueError as e:
+            logger.warn('Ignoring the stored stats table: %s', e)
+            table = None
+        if remove:
+            jobStore.deleteSharedFile(cls.sharedFileName)
+        return table
+
+    def save(self, jobStore):
+        """
+        Store the table in the given job store, where load() finds it.
+        """
+        self._flush()
+        self.connection.execute('UPDATE totals SET time = ?, clock = ?',
+                                (self.totalTime, self.totalClock))
+        with open(os.path.join(self._tempDir, 'stats.db'), 'rb') as f:
+            with jobStore.writeSharedFileStream(self.sharedFileName) as fileHandle:
+                shutil.copyfileobj(f, fileHandle)
+
+    def add(self, fileHandle):
+        """
+        Add the stats in the given stats and logging file, as written by a worker or the leader.
+        """
+        try:
+            stats = json.load(fileHandle)
+        except ValueError:
+            logger.critical("File %s contains corrupted json. Skipping file." % fileHandle)
+            return
+        self.addStats(stats)
+
+    def addStats(self, stats):
+        """
+        Add the given stats, as decoded from a stats and logging file.
+
+        :param dict stats: the decoded file
+        """
+        if 'total_time' in stats:
+            self.totalTime = (self.totalTime or 0.0) + float(stats['total_time'])
+            self.totalClock = (self.totalClock or 0.0) + float(stats['total_clock'])
+        worker = stats.get('workers', {})
+        if 'time' not in worker:
+            # Only logging to report
+            return
+        workerID = self._numWorkers
+        numJobs = 0
+        for job in stats.get('jobs', ()):
+            callCacheHit = job.get('call_cache_hit')
+            self._jobs.append((workerID, job['class_name'], self._start(job)) + self._row(job) +
+                              (None if callCacheHit is None else int(callCacheHit),))
+            numJobs += 1
+        self._workers.append((workerID, self._start(worker), numJobs) + self._row(worker))
+        self._numWorkers += 1
+        if len(self._jobs) >= self.batchSize or len(self._workers) >= self.batchSize:
+            self._flush()
+
+    @staticmethod
+    def _start(item):
+        start = item.get('start')
+        return None if start is None else float(start)
+
+    @staticmethod
+    def _row(item):
+        def nonnegative(name):
+            value = float(item[name])
+            if value < 0:
+                raise RuntimeError("Negative value %s reported for %s" % (value, name))
+            return value
+        time, clock, memory = nonnegative('time'), nonnegative('clock'), nonnegative('memory')
+        return time, clock, time - clock, memory
+
+    def _flush(self):
+        self.connection.execute('BEGIN')
+        self.connection.executemany('INSERT INTO workers VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    self._workers)
+        self.connection.executemany('INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                    self._jobs)
+        self.connection.execute('COMMIT')
+        self._workers = []
+        self._jobs = []
+
+    def _select(self):
+        """
+        :return: the names of the tables holding the workers and the jobs to summarize, copies
+                 of the rows that pass the filters if there are any
+        :rtype: (str, str)
+        """
+        if self.since is None and self.jobNames is None:
+            return 'workers', 'jobs'
+        workerCondition, jobCondition, params = '1', '1', []
+        if self.since is not None:
+            workerCondition = 'workers.start >= ?'
+            jobCondition = 'workers.start >= ? AND jobs.start >= ?'
+            params = [self.since]
+        if self.jobNames is not None:
+            jobCondition += ' AND class_name IN (%s)' % ', '.join('?' * len(self.jobNames))
+        self.connection.execute('DROP TABLE IF EXISTS temp.selected_jobs')
+        self.connection.execute('CREATE TEMP TABLE selected_jobs AS SELECT jobs.* FROM jobs '
+                                'JOIN workers ON jobs.worker = workers.id WHERE %s'
+                                % jobCondition, params * 2 + sorted(self.jobNames or ()))
+        self.connection.execute('DROP TABLE IF EXISTS temp.selected_workers')
+        self.connection.execute('CREATE TEMP TABLE selected_workers AS '
+                                'SELECT workers.id, workers.start, '
+                                'count(selected_jobs.worker) AS jobs, workers.time, '
+                                'workers.clock, workers.wait, workers.memory FROM workers '
+                                'LEFT JOIN selected_jobs ON selected_jobs.worker = workers.id '
+                                'WHERE %s GROUP BY workers.id %s'
+                                % (workerCondition,
+                                   # Only the workers that ran the named jobs
+                                   '' if self.jobNames is None else
+                                   'HAVING count(selected_jobs.worker) > 0'),
+                                params)
+        return 'selected_workers', 'selected_jobs'
+
+    def summarize(self):
+        """
+        :return: the summaries of the workers, of the jobs, and of the jobs of each name, each in
+                 an Expando with the number of items and the minimum, median, percentiles,
+                 average, maximum and total of each category
+        :rtype: (Expando, Expando, dict)
+        """
+        self._flush()
+        workersTable, jobsTable = self._select()
+        for category in self.categories:
+            # Lets the medians and percentiles be read off an index instead of sorting the rows
+            self.connection.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)'
+                                    % (workersTable, category, workersTable, category))
+            self.connection.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (class_name, %s)'
+                                    % (jobsTable, category, jobsTable, category))
+        worker = self._summarize(workersTable, 'worker')
+        jobs = self._summarize(jobsTable, 'jobs')
+        counts = self.connection.execute('SELECT count(*), avg(jobs), min(jobs), max(jobs) '
+                                         'FROM %s' % workersTable).fetchone()
+        if counts[0] == 0:
+            counts = (0, 0.0, 0, 0)
+        jobs.median_number_per_worker = self._median(workersTable, 'jobs', counts[0]) or 0
+        jobs.average_number_per_worker = float(counts[1])
+        jobs.min_number_per_worker = counts[2]
+        jobs.max_number_per_worker = counts[3]
+        jobs.call_cache_hits, jobs.call_cache_misses = self.connection.execute(
+            'SELECT %s FROM %s' % (self._callCacheAggregates, jobsTable)).fetchone()
+        aggregates = ', '.join('total(%s), avg(%s), min(%s), max(%s)' % ((category,) * 4)
+                               for category in self.categories)
+        jobTypes = {}
+        for row in self.connection.execute('SELECT class_name, count(*), %s, %s FROM %s '
+                                           'GROUP BY class_name'
+                                           % (aggregates, self._callCacheAggregates,
+                                              jobsTable)).fetchall():
+            name = row[0]
+            jobTypes[name] = self._element(name, row[1], row[2:-2], jobsTable,
+                                           'class_name = ?', (name,))
+            jobTypes[name].call_cache_hits, jobTypes[name].call_cache_misses = row[-2:]
+        return worker, jobs, jobTypes
+
+    def _summarize(self, table, name):
+        aggregates = ', '.join('total(%s), avg(%s), min(%s), max(%s)' % ((category,) * 4)
+                               for category in self.categories)
+        row = self.connection.execute('SELECT count(*), %s FROM %s'
+                                      % (aggregates, table)).fetchone()
+        return self._element(name, row[0], row[1:], table)
+
+    def _element(self, name, count, aggregates, table, condition='1', params=()):
+        element = Expando(total_number=float(count), name=name)
+        for i, category in enumerate(self.categories):
+            total, average, minimum, maximum = aggregates[4 * i:4 * i + 4]
+            element['total_' + category] = float(total or 0)
+            element['average_' + category] = float(average or 0)
+            element['min_' + category] = float(minimum or 0)
+            element['max_' + category] = float(maximum or 0)
+            element['median_' + category] = float(
+                self._median(table, category, count, condition, params) or 0)
+            for percentile in self.percentiles:
+                # The nearest-rank percentile
+                rank = max(int(math.ceil(percentile / 100.0 * count)) - 1, 0)
+                element['p%i_%s' % (percentile, category)] = float(
+                    self._nth(table, category, rank, condition, params) or 0)
+        return element
+
+    def _median(self, table, column, count, condition='1', params=()):
+        return self._nth(table, column, count // 2, condition, params)
+
+    def _nth(self, table, column, n, condition='1', params=()):
+        row = self.connection.execute('SELECT %s FROM %s WHERE %s ORDER BY %s LIMIT 1 OFFSET ?'
+                                      % (column, table, condition, column),
+                                      params + (n,)).fetchone()
+        return None if row is None else row[0]
+
+    def close(self):
+        self.connection.close()
+        shutil.rmtree(self._tempDir)
+
+
 class StatsAndLogging( object ):
     """
     Class manages a thread that aggregates statistics and logging information on a toil run.
@@ -107,6 +388,14 @@ class StatsAndLogging( object ):
         #  Overall timing
         startTime = time.time()
         startClock = getTotalCpuTime()
+        # The table of a previous attempt is only carried on with if that leader saved it, i.e.
+        # if it added all stats it aggregated
+        if config.restart:
+            statsTable = StatsTable.load(jobStore, remove=True)
+        elif config.stats:
+            statsTable = StatsTable()
+        else:
+            statsTable = None
 
         def callback(fileHandle):
             stats = json.load(fileHandle, object_hook=Expando)
@@ -131,19 +420,29 @@ class StatsAndLogging( object ):
                 cls.logWithFormatting(jobNames[0], messages,
                                       message='Received Toil worker log. Disable debug level logging to hide this output')
                 cls.writeLogFiles(jobNames, messages, config=config)
+            # The totals of previous leaders were added by them before they saved the table
+            if statsTable is not None and 'total_time' not in stats:
+                statsTable.addStats(stats)
+
+        try:
+            while True:
+                # This is a indirect way of getting a message to the thread to exit
+                if stop.is_set():
+                    jobStore.readStatsAndLogging(callback)
+                    break
+                if jobStore.readStatsAndLogging(callback) == 0:
+                    time.sleep(0.5)  # Avoid cycling too fast
 
-        while True:
-            # This is a indirect way of getting a message to the thread to exit
-            if stop.is_set():
-                jobStore.readStatsAndLogging(callback)
-                break
-            if jobStore.readStatsAndLogging(callback) == 0:
-                time.sleep(0.5)  # Avoid cycling too fast
-
-        # Finish the stats file
-        text = json.dumps(dict(total_time=str(time.time() - startTime),
-                               total_clock=str(getTotalCpuTime() - startClock)), ensure_ascii=True)
-        jobStore.writeStatsAndLogging(text)
+            # Finish the stats file
+            totals = dict(total_time=str(time.time() - startTime),
+                          total_clock=str(getTotalCpuTime() - startClock))
+            jobStore.writeStatsAndLogging(json.dumps(totals, ensure_ascii=True))
+            if statsTable is not None:
+                statsTable.addStats(totals)
+                statsTable.save(jobStore)
+        finally:
+            if statsTable is not None:
+                statsTable.close()
 
     def check(self):
         """
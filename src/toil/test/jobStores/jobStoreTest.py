@@ -27,6 +27,7 @@ from past.utils import old_div
 from builtins import object
 import socketserver
 import pytest
+import errno
 import hashlib
 import logging
 import threading
@@ -37,13 +38,16 @@ import time
 import uuid
 from stubserver import FTPStubServer
 from abc import abstractmethod, ABCMeta
+from functools import partial
 from itertools import chain, islice, count
+from io import BytesIO
 from threading import Thread
 from unittest import skip
 
 # Python 3 compatibility imports
 from six.moves.queue import Queue
 from six.moves import SimpleHTTPServer, StringIO
+from six.moves import cPickle as pickle
 from six import iteritems
 import six.moves.urllib.parse as urlparse
 from six.moves.urllib.request import urlopen, Request
@@ -57,10 +61,17 @@ from mock import patch
 from toil.common import Config, Toil
 from toil.fileStore import FileID
 from toil.job import Job, JobNode
-from toil.jobStores.abstractJobStore import (NoSuchJobException,
+from toil.jobStores.abstractJobStore import (AbstractJobStore,
+                                             NoSuchJobException,
                                              NoSuchFileException)
 from toil.jobStores.googleJobStore import googleRetry
-from toil.jobStores.fileJobStore import FileJobStore
+from toil.jobStores.fileJobStore import FileJobStore, ReferencedFileModifiedException
+from toil.jobStores.memoryJobStore import MemoryJobStore
+from toil.jobStores import serialization
+from toil.jobStores.utils import SpooledWritablePipe, WritablePipe
+from toil.lib import inotify
+from toil.lib.compression import (CompressingWriter, DecompressingReader, codecs,
+                                  headerMagic)
 from toil.test import (ToilTest,
                        needs_aws,
                        needs_azure,
@@ -277,6 +288,11 @@ class AbstractJobStoreTest(object):
             self.assertUrl(master.getSharedPublicUrl('nonEncrypted'))
             self.assertRaises(NoSuchFileException, master.getSharedPublicUrl, 'missing')
 
+            # Deleting a shared file is idempotent
+            worker.deleteSharedFile('nonEncrypted')
+            self.assertRaises(NoSuchFileException, master.getSharedPublicUrl, 'nonEncrypted')
+            master.deleteSharedFile('nonEncrypted')
+
             # Test per-job files: Create empty file on master, ...
             #
             # First recreate job
@@ -386,6 +402,49 @@ class AbstractJobStoreTest(object):
             for jobGraph in jobGraphs:
                 self.assertTrue(master.exists(jobGraph.jobStoreID))
 
+        def testCompactJobs(self):
+            master = self.master
+            pickled = master.create(self.arbitraryJob)
+            master.config.compactJobs = True
+            with patch('toil.jobStores.abstractJobStore.encodeJobGraph',
+                       wraps=serialization.encodeJobGraph) as encode:
+                compact = master.create(self.arbitraryJob)
+                compact.remainingRetryCount = 0
+                master.update(compact)
+                pickled.remainingRetryCount = 0
+                master.updateMany([pickled])
+            self.assertEqual([call[1] for call in encode.call_args_list], [dict(compact=True)] * 3)
+            # Jobs stored in either encoding are loaded alike
+            master.config.compactJobs = False
+            self.assertEquals(master.loadMany([pickled.jobStoreID, compact.jobStoreID]),
+                              [pickled, compact])
+            self.assertEquals({job.remainingRetryCount
+                               for job in (master.load(pickled.jobStoreID),
+                                           master.load(compact.jobStoreID))}, {0})
+
+        def testBulkOperations(self):
+            master = self.master
+            jobs = [master.create(self.arbitraryJob) for _ in range(30)]
+            jobStoreIDs = [job.jobStoreID for job in jobs]
+            fileIDs = [master.getEmptyFileStoreID(jobStoreID) for jobStoreID in jobStoreIDs[:2]]
+            self.assertEquals(master.loadMany(jobStoreIDs), jobs)
+            for job in jobs:
+                job.remainingRetryCount = 0
+            master.updateMany(jobs)
+            self.assertEquals({job.remainingRetryCount for job in master.loadMany(jobStoreIDs)},
+                              {0})
+            # Deleting jobs deletes their files, too
+            master.deleteMany(jobStoreIDs[:3])
+            self.assertEquals(master.existsMany(jobStoreIDs[:4]), [False, False, False, True])
+            self.assertFalse(any(map(master.fileExists, fileIDs)))
+            self.assertRaises(NoSuchJobException, master.loadMany, jobStoreIDs[2:4])
+            # Deletion is idempotent
+            master.deleteMany(jobStoreIDs[:4])
+            self.assertFalse(master.exists(jobStoreIDs[3]))
+            fileIDs = [master.getEmptyFileStoreID() for _ in range(30)]
+            master.deleteFiles(fileIDs[:29] + [str(uuid.uuid4())])
+            self.assertEquals(list(map(master.fileExists, fileIDs)), [False] * 29 + [True])
+
         def _prepareTestFile(self, store, size=None):
             """
             Generates a URL that can be used to point at a test file in the storage mechanism
@@ -486,6 +545,35 @@ class AbstractJobStoreTest(object):
                                  partSize=cls.mpTestPartSize,
                                  partSizePlusOne=cls.mpTestPartSize + 1))
 
+            def testImportExportFiles(self, otherCls):
+                """
+                :param AbstractJobStoreTest.Test self: the current test case
+
+                :param AbstractJobStoreTest.Test otherCls: the test case class for the job store
+                       to import from or export to
+                """
+                self.master.partSize = cls.mpTestPartSize
+                other = otherCls('test')
+                store = other._externalStore()
+
+                srcMd5s = dict(other._prepareTestFile(store, size) for size in (0, 1, 1000, 42))
+                srcUrls = list(srcMd5s)
+                imported = self.master.importFiles(srcUrls + srcUrls[:1], numThreads=3)
+                self.assertEqual(set(imported), set(srcUrls))
+                for srcUrl, jobStoreFileID in iteritems(imported):
+                    self.assertTrue(isinstance(jobStoreFileID, FileID))
+                    with self.master.readFileStream(jobStoreFileID) as f:
+                        self.assertEqual(hashlib.md5(f.read()).hexdigest(), srcMd5s[srcUrl])
+                pairs = [(imported[srcUrl], other._prepareTestFile(store)) for srcUrl in srcUrls]
+                self.assertEqual(self.master.exportFiles(pairs),
+                                 {dstUrl: None for _, dstUrl in pairs})
+                for (jobStoreFileID, dstUrl), srcUrl in zip(pairs, srcUrls):
+                    self.assertEqual(other._hashTestFile(dstUrl), srcMd5s[srcUrl])
+
+            make_tests(testImportExportFiles,
+                       cls,
+                       otherCls=activeTestClassesByName)
+
             def testImportSharedFile(self, otherCls):
                 """
                 :param AbstractJobStoreTest.Test self: the current test case
@@ -638,6 +726,13 @@ class AbstractJobStoreTest(object):
                         checksum.update(buf)
                 after = checksum.hexdigest()
                 self.assertEquals(before, after)
+
+                # Download to file
+                #
+                path = os.path.join(self._createTempDir(), 'download')
+                self.master.readFile(fileId, path)
+                with open(path, 'rb') as f:
+                    self.assertEquals(before, hashlib.md5(f.read()).hexdigest())
             self.master.delete(job.jobStoreID)
 
         def testZeroLengthFiles(self):
@@ -651,6 +746,82 @@ class AbstractJobStoreTest(object):
                 self.assertEquals(f.read(), "")
             self.master.delete(job.jobStoreID)
 
+        def testDeduplicatedFiles(self):
+            """Files with equal content must remain independent when they are deduplicated."""
+            self.master.config.deduplicateFiles = True
+            job = self.master.create(self.arbitraryJob)
+            content, otherContent = os.urandom(1024 * 1024), os.urandom(1024 * 1024)
+            dirPath = self._createTempDir()
+            filePath = os.path.join(dirPath, 'content')
+            with open(filePath, 'wb') as f:
+                f.write(content)
+            fileIDs = [self.master.writeFile(filePath, job.jobStoreID),
+                       self.master.writeFile(filePath)]
+            with self.master.writeFileStream(job.jobStoreID) as (f, fileID):
+                f.write(content)
+            fileIDs.append(fileID)
+            contentHashes = set(map(self.master.getFileContentHash, fileIDs))
+            self.assertEquals(len(contentHashes), 1)
+            # Updating a file must not affect the files it shares content with
+            with self.master.updateFileStream(fileIDs[0]) as f:
+                f.write(otherContent)
+            with self.master.readFileStream(fileIDs[0]) as f:
+                self.assertEquals(f.read(), otherContent)
+            for fileID in fileIDs[1:]:
+                with self.master.readFileStream(fileID) as f:
+                    self.assertEquals(f.read(), content)
+            # Neither must deleting it
+            self.master.deleteFile(fileIDs[2])
+            self.master.delete(job.jobStoreID)
+            self.assertFalse(self.master.fileExists(fileIDs[0]))
+            self.assertFalse(self.master.fileExists(fileIDs[2]))
+            readPath = os.path.join(dirPath, 'read')
+            self.master.updateFile(fileIDs[1], filePath)
+            self.master.readFile(fileIDs[1], readPath)
+            with open(readPath, 'rb') as f:
+                self.assertEquals(f.read(), content)
+            self.master.deleteFile(fileIDs[1])
+
+        def testCompressedFiles(self):
+            """Compression must be transparent to readers of files."""
+            self.master.config.compressFiles = 'zlib'
+            job = self.master.create(self.arbitraryJob)
+            content = b''.join(b'read%i\tchr1\t%i\t60\tACGTACGT\n' % (i, i * 10)
+                               for i in range(100000))
+            dirPath = self._createTempDir()
+            filePath = os.path.join(dirPath, 'content')
+            with open(filePath, 'wb') as f:
+                f.write(content)
+            fileID = self.master.writeFile(filePath, job.jobStoreID)
+            with self.master.writeFileStream(job.jobStoreID) as (f, streamedFileID):
+                f.write(content)
+            for fileID in fileID, streamedFileID:
+                with self.master.readFileStream(fileID) as f:
+                    self.assertEquals(f.read(), content)
+                readPath = os.path.join(dirPath, 'read')
+                self.master.readFile(fileID, readPath)
+                with open(readPath, 'rb') as f:
+                    self.assertEquals(f.read(), content)
+                # The stream can be read line by line and in small pieces like a file
+                with self.master.readFileStream(fileID) as f:
+                    self.assertEquals(next(iter(f)), b'read0\tchr1\t0\t60\tACGTACGT\n')
+                    self.assertEquals(f.readline(), b'read1\tchr1\t10\t60\tACGTACGT\n')
+                    self.assertEquals(b''.join(iter(lambda: f.read(7), b'')),
+                                      content[content.index(b'read2\t'):])
+            value = {'key': list(range(1000))}
+            with self.master.writeFileStream(job.jobStoreID) as (f, pickledFileID):
+                pickle.dump(value, f, 2)
+            with self.master.readFileStream(pickledFileID) as f:
+                self.assertEquals(pickle.load(f), value)
+            # Content that is compressed already is stored as is, small content is fine too
+            gzipped = b'\x1f\x8b' + os.urandom(1024)
+            for newContent in gzipped, b'', b'x':
+                with self.master.updateFileStream(fileID) as f:
+                    f.write(newContent)
+                with self.master.readFileStream(fileID) as f:
+                    self.assertEquals(f.read(), newContent)
+            self.master.delete(job.jobStoreID)
+
         def testGrowingAndShrinkingJob(self):
             """Make sure jobs update correctly if they grow/shrink."""
             # Make some very large data, large enough to trigger
@@ -778,6 +949,47 @@ class AbstractJobStoreTest(object):
                 self.assertEquals(f.read(1), "a")
             # If it times out here, there's a deadlock
 
+        @slow
+        def testSmallFileStreamBenchmark(self):
+            """
+            Log the throughput of writing and reading small files through streams, and the cost
+            of passing the same content through a pipe and a thread in comparison to collecting
+            it in memory.
+            """
+            numFiles = 200
+            content = os.urandom(1024)
+            job = self.master.create(self.arbitraryJob)
+            start = time.time()
+            fileIDs = []
+            for _ in range(numFiles):
+                with self.master.writeFileStream(job.jobStoreID) as (f, fileID):
+                    f.write(content)
+                fileIDs.append(fileID)
+            writeTime = time.time() - start
+            start = time.time()
+            for fileID in fileIDs:
+                with self.master.readFileStream(fileID) as f:
+                    self.assertEqual(f.read(), content)
+            readTime = time.time() - start
+            logger.info('%s: wrote %i files of %i bytes through streams at %.0f files/s, read '
+                        'them at %.0f files/s.', type(self.master).__name__, numFiles,
+                        len(content), old_div(numFiles, writeTime), old_div(numFiles, readTime))
+
+            class Pipe(WritablePipe):
+                def readFrom(self, readable):
+                    readable.read()
+
+            class SpooledPipe(SpooledWritablePipe, Pipe):
+                pass
+
+            for cls in (Pipe, SpooledPipe):
+                start = time.time()
+                for _ in range(numFiles * 10):
+                    with cls() as f:
+                        f.write(content)
+                logger.info('%s: %.0f streams/s.', cls.__name__,
+                            old_div(numFiles * 10, time.time() - start))
+
         @abstractmethod
         def _corruptJobStore(self):
             """
@@ -814,6 +1026,40 @@ class AbstractJobStoreTest(object):
             finally:
                 os.unlink(path)
 
+        # Whether waitForFileDeletion returns as soon as the file is deleted
+        _notifiesFileDeletion = False
+
+        def testWaitForFileDeletion(self):
+            fileID = self.master.getEmptyFileStoreID()
+            self.assertFalse(self.master.waitForFileDeletion(fileID, timeout=0.1))
+            timeout = 10
+            deleter = threading.Timer(0.1, self.master.deleteFile, args=(fileID,))
+            deleter.start()
+            try:
+                start = time.time()
+                self.assertTrue(self.master.waitForFileDeletion(fileID, timeout=timeout))
+                if self._notifiesFileDeletion:
+                    self.assertLess(time.time() - start, timeout / 2)
+            finally:
+                deleter.join()
+            self.assertTrue(self.master.waitForFileDeletion(fileID, timeout=0.1))
+
+        def testWaitForDeletedFile(self):
+            # Waiting for a file that is already gone takes no time, with any implementation,
+            # including the default one of job stores that aren't notified of deletions
+            fileID = self.master.getEmptyFileStoreID()
+            self.master.deleteFile(fileID)
+            defaultWait = partial(AbstractJobStore.waitForFileDeletion, self.master)
+            for wait in (self.master.waitForFileDeletion, defaultWait):
+                start = time.time()
+                self.assertTrue(wait(fileID, timeout=10))
+                self.assertLess(time.time() - start, 5)
+            # Otherwise the default implementation waits for the timeout
+            fileID = self.master.getEmptyFileStoreID()
+            start = time.time()
+            self.assertFalse(defaultWait(fileID, timeout=0.5))
+            self.assertGreaterEqual(time.time() - start, 0.5)
+
         def _largeLogEntrySize(self):
             """
             Sub-classes may want to override these in order to maximize test coverage
@@ -884,7 +1130,98 @@ class AbstractEncryptedJobStoreTest(object):
                 self.fail("Read encryption content with encryption off.")
 
 
+@needs_encryption
+class EncryptedStreamTest(ToilTest):
+    """
+    Tests the encryption of file streams the job stores use, independently of any job store
+    """
+    chunkSize = 16
+
+    def setUp(self):
+        super(EncryptedStreamTest, self).setUp()
+        self.keyPath = os.path.join(self._createTempDir(), 'keyFile')
+        with open(self.keyPath, 'wb') as f:
+            f.write(os.urandom(32))
+
+    def _encrypt(self, data):
+        from toil.lib.encryption import EncryptingWriter
+        stored = BytesIO()
+        with EncryptingWriter(stored, self.keyPath, chunkSize=self.chunkSize) as writable:
+            # Written in pieces that don't line up with the chunks
+            for start in range(0, len(data), 7):
+                writable.write(data[start:start + 7])
+        return stored.getvalue()
+
+    def _decrypt(self, stored):
+        from toil.lib.encryption import openDecrypted
+        with openDecrypted(BytesIO(stored), self.keyPath) as readable:
+            return readable.read()
+
+    def _chunks(self, stored):
+        from toil.lib.encryption._nacl import streamMagic, _streamHeader
+        from nacl.secret import SecretBox
+        start = len(streamMagic) + _streamHeader.size
+        size = self.chunkSize + SecretBox.MACBYTES
+        return stored[:start], [stored[i:i + size] for i in range(start, len(stored), size)]
+
+    def testRoundTrip(self):
+        n = self.chunkSize
+        for size in (0, 1, n - 1, n, n + 1, 5 * n, 5 * n + 3):
+            data = os.urandom(size)
+            self.assertEqual(self._decrypt(self._encrypt(data)), data)
+
+    def testLines(self):
+        from toil.lib.encryption import openDecrypted
+        lines = [b'x' * i + b'\n' for i in range(20)]
+        stored = self._encrypt(b''.join(lines))
+        self.assertEqual(list(openDecrypted(BytesIO(stored), self.keyPath)), lines)
+        with openDecrypted(BytesIO(stored), self.keyPath) as readable:
+            self.assertEqual(readable.readline(), lines[0])
+            self.assertEqual(readable.read(5), b''.join(lines[1:])[:5])
+        obj = {'a': list(range(100))}
+        stored = self._encrypt(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(pickle.load(openDecrypted(BytesIO(stored), self.keyPath)), obj)
+
+    def testTruncation(self):
+        from nacl.exceptions import CryptoError
+        stored = self._encrypt(os.urandom(3 * self.chunkSize + 5))
+        header, chunks = self._chunks(stored)
+        self.assertEqual(len(chunks), 4)
+        # Cut short at every chunk boundary, within a chunk and within the header
+        truncated = [header + b''.join(chunks[:i]) for i in range(len(chunks))]
+        truncated += [stored[:-1], header[:-1]]
+        for content in truncated:
+            with self.assertRaises(CryptoError):
+                self._decrypt(content)
+
+    def testReordering(self):
+        from nacl.exceptions import CryptoError
+        stored = self._encrypt(os.urandom(4 * self.chunkSize))
+        header, chunks = self._chunks(stored)
+        swapped = [chunks[1], chunks[0]] + chunks[2:]
+        with self.assertRaises(CryptoError):
+            self._decrypt(header + b''.join(swapped))
+        # The final chunk can't be replaced with one that isn't, nor can chunks be appended
+        with self.assertRaises(CryptoError):
+            self._decrypt(header + b''.join(chunks[:-1] + [chunks[0]]))
+        with self.assertRaises(CryptoError):
+            self._decrypt(stored + chunks[1])
+
+    def testLegacyFormat(self):
+        from toil.lib.encryption import encrypt
+        data = os.urandom(5 * self.chunkSize)
+        self.assertEqual(self._decrypt(encrypt(data, self.keyPath)), data)
+        # Content encrypted as a whole that was tampered with fails to decrypt, too
+        from nacl.exceptions import CryptoError
+        stored = bytearray(encrypt(data, self.keyPath))
+        stored[-1] ^= 1
+        with self.assertRaises(CryptoError):
+            self._decrypt(bytes(stored))
+
+
 class FileJobStoreTest(AbstractJobStoreTest.Test):
+    _notifiesFileDeletion = inotify.libc is not None
+
     def _createJobStore(self):
         return FileJobStore(self.namePrefix)
 
@@ -892,6 +1229,29 @@ class FileJobStoreTest(AbstractJobStoreTest.Test):
         assert isinstance(self.master, FileJobStore)  # type hint
         shutil.rmtree(self.master.jobStoreDir)
 
+    def testWaitWithoutInotify(self):
+        fileID = self.master.getEmptyFileStoreID()
+        with patch.object(inotify, 'libc', None):
+            start = time.time()
+            self.assertFalse(self.master.waitForFileDeletion(fileID, timeout=0.5))
+            self.assertGreaterEqual(time.time() - start, 0.5)
+            self.master.deleteFile(fileID)
+            start = time.time()
+            self.assertTrue(self.master.waitForFileDeletion(fileID, timeout=10))
+            self.assertLess(time.time() - start, 5)
+
+    def _jobRecord(self, jobStoreID):
+        with open(self.master._getJobFileName(jobStoreID), 'rb') as f:
+            return f.read()
+
+    def testCompactJobRecords(self):
+        pickled = self.master.create(self.arbitraryJob).jobStoreID
+        self.master.config.compactJobs = True
+        compact = self.master.create(self.arbitraryJob).jobStoreID
+        self.assertFalse(self._jobRecord(pickled).startswith(serialization.magic))
+        self.assertTrue(self._jobRecord(compact).startswith(serialization.magic))
+        self.assertLess(len(self._jobRecord(compact)), len(self._jobRecord(pickled)))
+
     def _prepareTestFile(self, dirPath, size=None):
         fileName = 'testfile_%s' % uuid.uuid4()
         localFilePath = dirPath + fileName
@@ -916,6 +1276,263 @@ class FileJobStoreTest(AbstractJobStoreTest.Test):
     def _cleanUpExternalStore(self, dirPath):
         shutil.rmtree(dirPath)
 
+    def testImportExportFilesErrors(self):
+        dirPath = self._createTempDir()
+        srcUrl, srcMd5 = self._prepareTestFile(dirPath, 100)
+        missingUrl = self._prepareTestFile(dirPath)
+        imported = self.master.importFiles([missingUrl, srcUrl])
+        self.assertTrue(isinstance(imported[missingUrl], Exception))
+        with self.master.readFileStream(imported[srcUrl]) as f:
+            self.assertEqual(hashlib.md5(f.read()).hexdigest(), srcMd5)
+        dstUrl = self._prepareTestFile(dirPath)
+        exported = self.master.exportFiles([('nonexistent', self._prepareTestFile(dirPath)),
+                                            (imported[srcUrl], dstUrl)])
+        self.assertEqual(len(exported), 2)
+        self.assertIsNone(exported[dstUrl])
+        self.assertEqual(self._hashTestFile(dstUrl), srcMd5)
+        self.assertEqual(sum(isinstance(e, Exception) for e in exported.values()), 1)
+
+    def testReferenceImports(self):
+        self.master.config.referenceImports = True
+        dirPath = self._createTempDir() + '/'
+
+        def md5(fileID):
+            with self.master.readFileStream(fileID) as f:
+                return hashlib.md5(f.read()).hexdigest()
+
+        # Reflinks depend on the file system
+        noReflink = patch.object(FileJobStore, '_reflink', return_value=False)
+        for patches in ((), (noReflink,)):
+            srcUrl, srcMd5 = self._prepareTestFile(dirPath, 1000)
+            srcPath = srcUrl[len('file://'):]
+            for p in patches:
+                p.start()
+            try:
+                fileID = self.master.importFile(srcUrl)
+            finally:
+                for p in patches:
+                    p.stop()
+            self.assertEqual(fileID.size, 1000)
+            self.assertEqual(md5(fileID), srcMd5)
+            # The original is never hard-linked, not even when reading asks for a link
+            self.assertNotEqual(os.lstat(self.master._getAbsPath(fileID)).st_ino,
+                                os.stat(srcPath).st_ino)
+            localPath = os.path.join(self._createTempDir(), 'local')
+            for symlink in (False, True):
+                with patch.object(FileJobStore, '_reflink', return_value=False):
+                    self.master.readFile(fileID, localPath, symlink=symlink)
+                self.assertFalse(os.path.islink(localPath))
+                self.assertFalse(os.path.samefile(localPath, srcPath))
+                with open(localPath, 'rb') as f:
+                    self.assertEqual(hashlib.md5(f.read()).hexdigest(), srcMd5)
+                os.remove(localPath)
+            self.assertEqual(os.stat(srcPath).st_nlink, 1)
+            # Only a reflink isn't referenced
+            referenced = os.path.exists(self.master._getAbsPath(fileID) + '.ref')
+            if patches:
+                self.assertTrue(referenced)
+            with open(srcPath, 'ab') as f:
+                f.write(b'modified')
+            if referenced:
+                self.assertRaises(ReferencedFileModifiedException, md5, fileID)
+                self.assertRaises(ReferencedFileModifiedException,
+                                  self.master.readFile, fileID, localPath)
+                # Updating the file unlinks it from the original
+                updateUrl, updateMd5 = self._prepareTestFile(dirPath, 10)
+                self.master.updateFile(fileID, updateUrl[len('file://'):])
+                self.assertEqual(md5(fileID), updateMd5)
+                with open(srcPath, 'rb') as f:
+                    self.assertTrue(f.read().endswith(b'modified'))
+            else:
+                # A reflink is independent of the original
+                self.assertEqual(md5(fileID), srcMd5)
+            self.master.deleteFile(fileID)
+            self.assertTrue(os.path.exists(srcPath))
+        # A symlinked original that is gone
+        srcUrl, srcMd5 = self._prepareTestFile(dirPath, 10)
+        with noReflink:
+            fileID = self.master.importFile(srcUrl)
+        os.remove(srcUrl[len('file://'):])
+        self.assertRaises(ReferencedFileModifiedException, md5, fileID)
+        self.master.deleteFile(fileID)
+        self.assertFalse(os.path.lexists(self.master._getAbsPath(fileID)))
+
+    def testDeduplicatedFilesShareStorage(self):
+        self.master.config.deduplicateFiles = True
+        job = self.master.create(self.arbitraryJob)
+        filePath = os.path.join(self._createTempDir(), 'content')
+        with open(filePath, 'wb') as f:
+            f.write(os.urandom(1024))
+        fileIDs = [self.master.writeFile(filePath, job.jobStoreID) for _ in range(3)]
+        paths = [self.master._getAbsPath(fileID) for fileID in fileIDs]
+        blobPath = self.master._getBlobPath(self.master.getFileContentHash(fileIDs[0]))
+        for path in paths:
+            self.assertTrue(os.path.samefile(path, blobPath))
+        self.assertEquals(os.stat(blobPath).st_nlink, 4)
+        self.master.deleteFile(fileIDs[0])
+        self.assertEquals(os.stat(blobPath).st_nlink, 3)
+        # Deleting the job releases the blob along with the remaining files
+        self.master.delete(job.jobStoreID)
+        self.assertFalse(os.path.exists(blobPath))
+
+    def testStatsSpool(self):
+        stats = []
+
+        def callback(f):
+            stats.append(f.read())
+
+        worker = self._createJobStore()
+        worker.resume()
+        writers = [Thread(target=worker.writeStatsAndLogging, args=(str(i),))
+                   for i in range(100)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        self.assertEqual(100, self.master.readStatsAndLogging(callback))
+        self.assertEqual(sorted(str(i).encode('utf-8') for i in range(100)), sorted(stats))
+        # The records read are moved out of the segments
+        segments = [os.path.join(self.master.statsDir, segment)
+                    for segment in self.master._statsSegmentNames()]
+        self.assertEqual([0] * len(segments), list(map(os.path.getsize, segments)))
+        # A record still being written is read once it is complete
+        record = self.master._statsRecordHeader.pack(3) + b'abc'
+        with open(segments[0], 'ab') as f:
+            f.write(record[:-1])
+        self.assertEqual(0, self.master.readStatsAndLogging(callback))
+        self.assertEqual(len(record) - 1, os.path.getsize(segments[0]))
+        with open(segments[0], 'ab') as f:
+            f.write(record[-1:])
+        # Other instances carry on from where the previous one left off
+        resumed = self._createJobStore()
+        resumed.resume()
+        del stats[:]
+        self.assertEqual(1, resumed.readStatsAndLogging(callback))
+        self.assertEqual([b'abc'], stats)
+        self.assertEqual(0, resumed.readStatsAndLogging(callback))
+        # The records read remain available to readers of all stats and logging
+        self.assertEqual(101, self.master.readStatsAndLogging(callback, readAll=True))
+        # Stats files written to the temporary directories by older versions are read, too
+        with open(os.path.join(self.master._getTempSharedDir(), 'stats123'), 'wb') as f:
+            f.write(b'legacy')
+        resumed = self._createJobStore()
+        resumed.resume()
+        del stats[:]
+        self.assertEqual(1, resumed.readStatsAndLogging(callback))
+        self.assertEqual([b'legacy'], stats)
+        self.assertEqual(0, resumed.readStatsAndLogging(callback))
+
+    def testStatsSurviveFailingCallback(self):
+        """
+        Records whose callback didn't return must be read again instead of being lost.
+        """
+        self.master.statsSegments = 1
+        for i in range(3):
+            self.master.writeStatsAndLogging(str(i))
+        stats = []
+
+        def failingCallback(f):
+            record = f.read()
+            if record == b'1':
+                raise RuntimeError('Failed to process %s' % record)
+            stats.append(record)
+
+        self.assertRaises(RuntimeError, self.master.readStatsAndLogging, failingCallback)
+        self.assertEqual([b'0'], stats)
+        self.master.writeStatsAndLogging('3')
+        del stats[:]
+        self.assertEqual(3, self.master.readStatsAndLogging(lambda f: stats.append(f.read())))
+        self.assertEqual([b'1', b'2', b'3'], stats)
+        self.assertEqual(0, self.master.readStatsAndLogging(lambda f: stats.append(f.read())))
+        # Every record ends up in the archive exactly once
+        del stats[:]
+        self.master.readStatsAndLogging(lambda f: stats.append(f.read()), readAll=True)
+        self.assertEqual([b'0', b'1', b'2', b'3'], stats)
+
+    def testCompressedFilesAreSmaller(self):
+        self.master.config.compressFiles = 'zlib'
+        filePath = os.path.join(self._createTempDir(), 'content')
+        with open(filePath, 'wb') as f:
+            f.write(b'ACGT' * 10000)
+        fileID = self.master.writeFile(filePath)
+        with open(self.master._getAbsPath(fileID), 'rb') as f:
+            stored = f.read()
+        self.assertTrue(stored.startswith(headerMagic))
+        self.assertTrue(len(stored) < 1000)
+        # Files stored before compression was enabled remain readable
+        self.master.config.compressFiles = None
+        uncompressedID = self.master.writeFile(filePath)
+        self.master.config.compressFiles = 'zlib'
+        with self.master.readFileStream(uncompressedID) as f:
+            self.assertEquals(f.read(), b'ACGT' * 10000)
+
+    def testDecompressionIsBounded(self):
+        """
+        Highly compressed content must be decompressed a bounded chunk at a time, not in whole.
+        """
+        size = 16 * 1024 * 1024
+        for codec in sorted(codecs):
+            stored = BytesIO()
+            with CompressingWriter(stored, codec) as writable:
+                for _ in range(16):
+                    writable.write(b'\0' * (size // 16))
+            stored.seek(0)
+            with patch.object(DecompressingReader, 'bufferSize', 4096):
+                reader = DecompressingReader(stored, codec)
+                read = 0
+                buf = bytearray(1 << 20)
+                while True:
+                    n = reader.readinto(buf)
+                    self.assertTrue(len(reader._buffer) <= 4096)
+                    if not n:
+                        break
+                    self.assertEqual(buf[:n].count(b'\0'), n)
+                    read += n
+            self.assertEqual(read, size)
+
+    @slow
+    def testCompressionBenchmark(self):
+        """
+        Log how long it takes to store tabular text with each available codec, both in this job
+        store and when sending it over a link with limited bandwidth, standing in for S3.
+        """
+        filePath = os.path.join(self._createTempDir(), 'content')
+        with open(filePath, 'wb') as f:
+            for i in range(500000):
+                f.write(b'chr%i\t%i\t.\t%s\t%s\t60\tPASS\n' % (i % 22 + 1, i * 37,
+                                                                  b'ACGT'[i % 4:i % 4 + 1],
+                                                                  b'TGCA'[i % 4:i % 4 + 1]))
+        size = os.path.getsize(filePath)
+        bandwidth = 50 * 1000 * 1000  # bytes per second
+
+        class ThrottledWriter(object):
+            def __init__(self):
+                self.size = 0
+
+            def write(self, data):
+                self.size += len(data)
+                time.sleep(old_div(len(data), float(bandwidth)))
+
+        for codec in [None] + sorted(codecs):
+            self.master.config.compressFiles = codec
+            start = time.time()
+            fileID = self.master.writeFile(filePath)
+            storeTime = time.time() - start
+            storedSize = os.path.getsize(self.master._getAbsPath(fileID))
+            writer = ThrottledWriter()
+            start = time.time()
+            with open(filePath, 'rb') as readable:
+                if codec is None:
+                    shutil.copyfileobj(readable, writer)
+                else:
+                    with CompressingWriter(writer, codec) as compressingWriter:
+                        shutil.copyfileobj(readable, compressingWriter)
+            uploadTime = time.time() - start
+            logger.info("Codec %s: stored %i of %i bytes in %f s, throttled upload of %i bytes "
+                        "took %f s.", codec, storedSize, size, storeTime, writer.size, uploadTime)
+            if codec is not None:
+                self.assertTrue(storedSize < size)
+
     def testPreserveFileName(self):
         "Check that the fileID ends with the given file name."
         fh, path = tempfile.mkstemp()
@@ -928,6 +1545,188 @@ class FileJobStoreTest(AbstractJobStoreTest.Test):
             os.unlink(path)
 
 
+class IndexedFileJobStoreTest(FileJobStoreTest):
+    def _createConfig(self):
+        config = super(IndexedFileJobStoreTest, self)._createConfig()
+        config.fileJobStoreIndex = True
+        return config
+
+    def _jobRecord(self, jobStoreID):
+        cursor = self.master._getConnection().execute('SELECT job FROM jobs WHERE id = ?',
+                                                      (jobStoreID,))
+        return bytes(cursor.fetchone()[0])
+
+    def testJobsWithoutFilesHaveNoDirectory(self):
+        job = self.master.create(self.arbitraryJob)
+        self.assertTrue(self.master._indexed)
+        self.assertFalse(os.path.exists(self.master._getAbsPath(job.jobStoreID)))
+        fileID = self.master.getEmptyFileStoreID(job.jobStoreID)
+        self.assertTrue(self.master.fileExists(fileID))
+        self.master.delete(job.jobStoreID)
+        self.assertFalse(self.master.exists(job.jobStoreID))
+        self.assertFalse(self.master.fileExists(fileID))
+
+    def testTransactions(self):
+        # More jobs than fit into a single query
+        with self.master.batch():
+            jobs = [self.master.create(self.arbitraryJob) for _ in range(1200)]
+        jobStoreIDs = [job.jobStoreID for job in jobs]
+        self.assertEquals([job.jobStoreID for job in self.master.loadMany(jobStoreIDs)],
+                          jobStoreIDs)
+        self.assertEquals(self.master.existsMany(jobStoreIDs), [True] * len(jobs))
+        for job in jobs:
+            job.remainingRetryCount = 0
+        self.master.updateMany(jobs)
+        self.master.deleteMany(jobStoreIDs[:2])
+        # Updates are all or nothing
+        for job in jobs:
+            job.remainingRetryCount = 1
+        self.assertRaises(NoSuchJobException, self.master.updateMany, jobs[1:])
+        self.assertEquals({job.remainingRetryCount for job in self.master.jobs()}, {0})
+        self.assertEquals(len(list(self.master.jobs())), len(jobs) - 2)
+
+    def testMigrationToIndex(self):
+        jobStore = FileJobStore(os.path.join(self._createTempDir(), 'jobStore'))
+        jobStore.initialize(Config())
+        jobs = [jobStore.create(self.arbitraryJob) for _ in range(3)]
+        fileID = jobStore.getEmptyFileStoreID(jobs[0].jobStoreID)
+        self.assertFalse(jobStore._indexed)
+        # Restarting with the option migrates the store
+        jobStore.config.fileJobStoreIndex = True
+        jobStore.writeConfig()
+        self.assertTrue(jobStore._indexed)
+        self.assertFalse(os.path.exists(jobStore._getJobFileName(jobs[0].jobStoreID)))
+        other = FileJobStore(jobStore.jobStoreDir)
+        other.resume()
+        self.assertTrue(other._indexed)
+        self.assertEquals(sorted(job.jobStoreID for job in other.jobs()),
+                          sorted(job.jobStoreID for job in jobs))
+        self.assertTrue(other.fileExists(fileID))
+        other.delete(jobs[0].jobStoreID)
+        self.assertFalse(other.fileExists(fileID))
+        # New jobs are created in the indexed layout next to the migrated ones
+        job = other.create(self.arbitraryJob)
+        self.assertTrue(job.jobStoreID.startswith(FileJobStore.shardsDirName))
+        self.assertEquals(len(list(other.jobs())), 3)
+
+    @slow
+    def testIndexBenchmark(self):
+        """
+        Log how long it takes to create, enumerate and delete many jobs with and without the
+        index.
+        """
+        for indexed in (False, True):
+            jobStore = FileJobStore(os.path.join(self._createTempDir(), 'jobStore'))
+            config = Config()
+            config.fileJobStoreIndex = indexed
+            jobStore.initialize(config)
+            start = time.time()
+            with jobStore.batch():
+                jobStoreIDs = [jobStore.create(self.arbitraryJob).jobStoreID
+                               for _ in range(10000)]
+            createTime = time.time() - start
+            start = time.time()
+            self.assertEquals(len(list(jobStore.jobs())), len(jobStoreIDs))
+            jobsTime = time.time() - start
+            start = time.time()
+            jobStore.deleteMany(jobStoreIDs)
+            deleteTime = time.time() - start
+            logger.info('Indexed: %s, creating %i jobs took %f s, enumerating them took %f s, '
+                        'deleting them took %f s.', indexed, len(jobStoreIDs), createTime,
+                        jobsTime, deleteTime)
+            jobStore.destroy()
+
+
+def _countDown(job, n):
+    with job.fileStore.writeGlobalFileStream() as (writable, fileID):
+        writable.write(str(n).encode('utf-8'))
+    total = job.addChildJobFn(_countDown, n - 1).rv() if n else 0
+    return job.addFollowOnJobFn(_addFile, fileID, total).rv()
+
+
+def _addFile(job, fileID, total):
+    with job.fileStore.readGlobalFileStream(fileID) as readable:
+        return int(readable.read()) + total
+
+
+class MemoryJobStoreTest(AbstractJobStoreTest.Test):
+    _notifiesFileDeletion = True
+
+    def _createJobStore(self):
+        return MemoryJobStore(self.namePrefix)
+
+    def _corruptJobStore(self):
+        assert isinstance(self.master, MemoryJobStore)  # type hint
+        self.master._storage.jobs.clear()
+
+    # Nothing outside the process can address the files in the store, which is why the
+    # import/export tests only use the URLs of the other job stores
+
+    def _prepareTestFile(self, store, size=None):
+        raise NotImplementedError()
+
+    def _hashTestFile(self, url):
+        raise NotImplementedError()
+
+    def _createExternalStore(self):
+        raise NotImplementedError()
+
+    def _cleanUpExternalStore(self, store):
+        raise NotImplementedError()
+
+    def testUnsupportedUrls(self):
+        url = urlparse.urlparse('mem://foo')
+        self.assertFalse(MemoryJobStore._supportsUrl(url))
+        self.assertRaises(RuntimeError, MemoryJobStore.getSize, url)
+        self.assertRaises(RuntimeError, MemoryJobStore._readFromUrl, url, BytesIO())
+        self.assertRaises(RuntimeError, MemoryJobStore._writeToUrl, BytesIO(b'foo'), url)
+        self.assertRaises(RuntimeError, self.master.importFile, 'mem://foo')
+
+    def testSpilling(self):
+        self.master.config.memJobStoreSpillSize = 1024
+        job = self.master.create(self.arbitraryJob)
+        small, large = os.urandom(1024), os.urandom(1025)
+        with self.master.writeFileStream(job.jobStoreID) as (writable, smallID):
+            writable.write(small)
+        with self.master.writeFileStream(job.jobStoreID) as (writable, largeID):
+            writable.write(large[:1000])
+            writable.write(large[1000:])
+        self.assertIsNone(self.master._getFile(smallID).path)
+        largePath = self.master._getFile(largeID).path
+        self.assertTrue(os.path.exists(largePath))
+        localPath = os.path.join(self._createTempDir(), 'large')
+        self.master.readFile(largeID, localPath)
+        with open(localPath, 'rb') as f:
+            self.assertEqual(f.read(), large)
+        # Files that shrink below the threshold are moved back into memory
+        with self.master.updateFileStream(largeID) as writable:
+            writable.write(small)
+        self.assertFalse(os.path.exists(largePath))
+        with self.master.readFileStream(largeID) as readable:
+            self.assertEqual(readable.read(), small)
+        # Public URLs refer to a copy in the spill directory
+        url = self.master.getPublicUrl(smallID)
+        with open(url[len('file:'):], 'rb') as f:
+            self.assertEqual(f.read(), small)
+        with self.master.readFileStream(smallID) as readable:
+            self.assertEqual(readable.read(), small)
+        spillDir = self.master._storage.spillDir
+        self.master.delete(job.jobStoreID)
+        self.assertEqual(os.listdir(spillDir), [])
+        self.master.destroy()
+        self.assertFalse(os.path.exists(spillDir))
+
+    def testWorkflow(self):
+        options = Job.Runner.getDefaultOptions('mem:' + self.namePrefix + '-workflow')
+        options.batchSystem = 'singleMachine'
+        self.assertRaises(RuntimeError, Job.Runner.startToil, Job.wrapJobFn(_countDown, 0),
+                          options)
+        options.debugWorker = True
+        self.assertEqual(Job.Runner.startToil(Job.wrapJobFn(_countDown, 4), options), 10)
+        # The store was destroyed along with the workflow
+        self.assertNotIn(self.namePrefix + '-workflow', MemoryJobStore._stores)
+
+
 @needs_google
 class GoogleJobStoreTest(AbstractJobStoreTest.Test):
     projectID = os.getenv('TOIL_GOOGLE_PROJECTID')
@@ -942,6 +1741,37 @@ class GoogleJobStoreTest(AbstractJobStoreTest.Test):
         # fully deleting it.
         pass
 
+    def testConcurrentImportExport(self):
+        # The threads share the client, more of them than its connection pool holds would make
+        # it discard connections
+        self.assertLessEqual(self.master.importExportThreads, self.master.jobThreads)
+        bucket = self._externalStore()
+        srcMd5s = dict(self._prepareTestFile(bucket, 1000)
+                       for _ in range(2 * self.master.importExportThreads))
+        imported = self.master.importFiles(list(srcMd5s))
+        pairs = [(imported[srcUrl], self._prepareTestFile(bucket)) for srcUrl in srcMd5s]
+        self.assertEqual(self.master.exportFiles(pairs), {dstUrl: None for _, dstUrl in pairs})
+        for (jobStoreFileID, dstUrl), srcUrl in zip(pairs, srcMd5s):
+            with self.master.readFileStream(jobStoreFileID) as f:
+                self.assertEqual(hashlib.md5(f.read()).hexdigest(), srcMd5s[srcUrl])
+            self.assertEqual(self._hashTestFile(dstUrl), srcMd5s[srcUrl])
+
+    def testConcurrentBulkOperations(self):
+        # Enough jobs to keep all threads busy
+        jobs = [self.master.create(self.arbitraryJob) for _ in range(self.master.jobThreads * 4)]
+        jobStoreIDs = [job.jobStoreID for job in jobs]
+        # The jobs are loaded in any order but returned in the order asked for
+        self.assertEquals([job.jobStoreID for job in self.master.loadMany(jobStoreIDs)],
+                          jobStoreIDs)
+        for job in jobs:
+            job.remainingRetryCount = 0
+        self.master.updateMany(jobs)
+        self.assertEquals({job.remainingRetryCount for job in self.master.loadMany(jobStoreIDs)},
+                          {0})
+        # A missing job fails the whole load
+        self.master.delete(jobStoreIDs[-1])
+        self.assertRaises(NoSuchJobException, self.master.loadMany, jobStoreIDs)
+
     def _prepareTestFile(self, bucket, size=None):
         from toil.jobStores.googleJobStore import GoogleJobStore
         fileName = 'testfile_%s' % uuid.uuid4()
@@ -991,6 +1821,52 @@ class AWSJobStoreTest(AbstractJobStoreTest.Test):
         assert isinstance(self.master, AWSJobStore)  # type hinting
         self.master.filesBucket.delete()
 
+    def testDownloadRanges(self):
+        from toil.jobStores.aws.jobStore import AWSJobStore
+        bufferSize = SpooledWritablePipe.bufferSize
+        partSize = self.master.partSize
+        downloadPart = AWSJobStore.FileInfo._downloadPart
+        # Only content beyond what is buffered in memory is downloaded in another thread, in the
+        # rest of the part the buffered content ends in and in the remaining parts
+        expectedDownloads = {bufferSize - 1: 1, bufferSize: 1, bufferSize + 1: 2,
+                             partSize: 2, partSize + 1: 3, 2 * partSize + 1: 4}
+        for size, downloads in iteritems(expectedDownloads):
+            content = os.urandom(size)
+            with self.master.writeFileStream() as (f, fileID):
+                f.write(content)
+            with patch.object(AWSJobStore.FileInfo, '_downloadPart', autospec=True,
+                              side_effect=downloadPart) as mockDownloadPart:
+                with self.master.readFileStream(fileID) as f:
+                    self.assertEqual(f.read(), content)
+            self.assertEqual(mockDownloadPart.call_count, downloads)
+            self.assertEqual(mockDownloadPart.call_args_list[0][1], dict(size=bufferSize))
+
+    def testConcurrentImportExport(self):
+        # Boto's connections aren't thread-safe, each thread must transfer with its own
+        copies = []
+        copyForThread = self.master._copyForThread
+
+        def recordCopy():
+            store = copyForThread()
+            copies.append(store)
+            return store
+
+        bucket = self._externalStore()
+        srcMd5s = dict(self._prepareTestFile(bucket, 1000) for _ in range(8))
+        with patch.object(self.master, '_copyForThread', side_effect=recordCopy):
+            imported = self.master.importFiles(list(srcMd5s), numThreads=4)
+            pairs = [(imported[srcUrl], self._prepareTestFile(bucket)) for srcUrl in srcMd5s]
+            self.assertEqual(self.master.exportFiles(pairs, numThreads=4),
+                             {dstUrl: None for _, dstUrl in pairs})
+        self.assertTrue(1 <= len(copies) <= 8)
+        stores = copies + [self.master]
+        for attribute in ('db', 's3', 'jobsDomain', 'filesDomain', 'filesBucket'):
+            self.assertEqual(len({id(getattr(store, attribute)) for store in stores}), len(stores))
+        for (jobStoreFileID, dstUrl), srcUrl in zip(pairs, srcMd5s):
+            with self.master.readFileStream(jobStoreFileID) as f:
+                self.assertEqual(hashlib.md5(f.read()).hexdigest(), srcMd5s[srcUrl])
+            self.assertEqual(self._hashTestFile(dstUrl), srcMd5s[srcUrl])
+
     def testSDBDomainsDeletedOnFailedJobstoreBucketCreation(self):
         """
         This test ensures that SDB domains bound to a jobstore are deleted if the jobstore bucket
@@ -1170,6 +2046,27 @@ class AzureJobStoreTest(AbstractJobStoreTest.Test):
         self.assertIsNot(job1, job2)
         self.assertEqual(job2.command, command)
 
+    def testBatchInsert(self):
+        # Small limits so that the jobs are split into batches by both their number and their size
+        self.master.entitiesPerBatch = 10
+        self.master.bytesPerBatch = 256 * 1024
+        jobNode = self.arbitraryJob
+        with patch.object(self.master.jobItems, 'commit_batch',
+                          wraps=self.master.jobItems.commit_batch) as commitBatch:
+            with self.master.batch():
+                jobs = [self.master.create(self.arbitraryJob) for _ in range(25)]
+                # Random commands don't compress, each of these fills a batch by itself
+                for _ in range(3):
+                    jobNode.command = os.urandom(200 * 1024)
+                    jobs.append(self.master.create(jobNode))
+                # Nothing is inserted before the batch is done
+                self.assertFalse(self.master.exists(jobs[0].jobStoreID))
+            self.assertEqual(commitBatch.call_count, 5)
+        jobStoreIDs = [job.jobStoreID for job in jobs]
+        self.assertEqual(self.master.existsMany(jobStoreIDs), [True] * len(jobs))
+        self.assertEqual([job.command for job in self.master.loadMany(jobStoreIDs)],
+                         [job.command for job in jobs])
+
     def testJobStoreExists(self):
         from toil.jobStores.azureJobStore import AzureJobStore
         assert isinstance(self.master, AzureJobStore)  # mostly for type hinting
@@ -1243,7 +2140,38 @@ class EncryptedAWSJobStoreTest(AWSJobStoreTest, AbstractEncryptedJobStoreTest.Te
 @needs_encryption
 @slow
 class EncryptedAzureJobStoreTest(AzureJobStoreTest, AbstractEncryptedJobStoreTest.Test):
-    pass
+    def testStreamedEncryption(self):
+        from toil.lib.encryption import EncryptingWriter
+        # Lines straddling the chunks the content is encrypted in
+        lines = [b'x' * (i * 20) + b'\n' for i in range(200)]
+        with self.master.writeFileStream() as (f, fileID):
+            for line in lines:
+                f.write(line)
+        self.assertGreater(sum(map(len, lines)), 3 * EncryptingWriter.chunkSize)
+        metadata = self.master.files.get_blob_metadata(blob_name=str(fileID))
+        self.assertEqual(metadata['encryptionFormat'], 'stream')
+        with self.master.readFileStream(fileID) as f:
+            self.assertEqual(list(f), lines)
+
+    def testLegacyEncryption(self):
+        from toil.lib.encryption import encrypt, overhead
+        from azure.storage.blob.models import BlobBlock
+        # Blobs written before encryption was streamed consist of blocks encrypted as a whole
+        blocks = [os.urandom(1000) for _ in range(3)]
+        fileID = str(uuid.uuid4())
+        blockIDs = []
+        for block in blocks:
+            blockID = str(uuid.uuid4())
+            self.master.files.put_block(blob_name=fileID,
+                                        block=encrypt(block, self.master.keyPath),
+                                        block_id=blockID)
+            blockIDs.append(BlobBlock(blockID))
+        self.master.files.put_block_list(blob_name=fileID, block_list=blockIDs,
+                                         metadata=dict(encrypted='True'))
+        # Read a block at a time
+        self.master._maxAzureBlockBytes = 1000 + overhead
+        with self.master.readFileStream(fileID) as f:
+            self.assertEqual(f.read(), b''.join(blocks))
 
 @needs_google
 @needs_encryption
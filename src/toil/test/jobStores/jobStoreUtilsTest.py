@@ -0,0 +1,156 @@
+# Copyright (C) 2015-2018 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from builtins import next
+from builtins import range
+from io import BytesIO
+from itertools import count
+import io
+import pickle
+import threading
+import time
+
+from toil.jobStores.utils import SpooledWritablePipe, mapConcurrently
+from toil.test import ToilTest
+
+
+class MapConcurrentlyTest(ToilTest):
+    def _assertNoThreadsLeft(self, numThreads):
+        # The producer only checks for abandonment every second
+        deadline = time.time() + 10
+        while threading.active_count() > numThreads:
+            self.assertLess(time.time(), deadline, 'Threads are still running')
+            time.sleep(0.1)
+
+    def testOrder(self):
+        def slowlyIdentity(x):
+            time.sleep((10 - x) * 0.01)
+            return x
+
+        # The results are yielded as they become available ...
+        results = list(mapConcurrently(slowlyIdentity, range(10), 10))
+        self.assertEqual(sorted(results), list(range(10)))
+        self.assertNotEqual(results, list(range(10)))
+        # ... so with a single thread they are in the order of the items
+        self.assertEqual(list(mapConcurrently(slowlyIdentity, range(10), 1)), list(range(10)))
+
+    def testFunctionException(self):
+        numThreads = threading.active_count()
+
+        def function(x):
+            if x == 5:
+                raise KeyError(x)
+            return x
+
+        results = mapConcurrently(function, range(100), 4)
+        with self.assertRaises(KeyError) as cm:
+            list(results)
+        self.assertEqual(cm.exception.args, (5,))
+        self._assertNoThreadsLeft(numThreads)
+
+    def testProducerException(self):
+        numThreads = threading.active_count()
+        consumed = threading.Event()
+
+        def items():
+            for i in range(3):
+                yield i
+            # Fail only once the results of the items produced so far were consumed
+            self.assertTrue(consumed.wait(10))
+            raise ValueError('producer failed')
+
+        results = []
+        with self.assertRaises(ValueError):
+            for result in mapConcurrently(lambda x: x, items(), 4):
+                results.append(result)
+                if len(results) == 3:
+                    consumed.set()
+        self.assertEqual(sorted(results), [0, 1, 2])
+        self._assertNoThreadsLeft(numThreads)
+
+    def testImmediateProducerException(self):
+        numThreads = threading.active_count()
+
+        def items():
+            raise ValueError('producer failed')
+            # noinspection PyUnreachableCode
+            yield
+
+        with self.assertRaises(ValueError):
+            list(mapConcurrently(lambda x: x, items(), 4))
+        self._assertNoThreadsLeft(numThreads)
+
+    def testAbandonment(self):
+        numThreads = threading.active_count()
+        calls = count()
+        lock = threading.Lock()
+
+        def function(x):
+            with lock:
+                next(calls)
+            return x
+
+        # An endless stream of items, the iterator is closed after the first result
+        results = mapConcurrently(function, count(), 4)
+        next(results)
+        results.close()
+        self._assertNoThreadsLeft(numThreads)
+        # Only the first item and the ones in flight when the results were abandoned were processed
+        with lock:
+            self.assertLessEqual(next(calls), 2 * 4 + 1)
+
+
+class SpooledWritablePipeTest(ToilTest):
+    class Pipe(SpooledWritablePipe):
+        bufferSize = 16
+
+        def readFrom(self, readable):
+            self.piped = not isinstance(readable, BytesIO)
+            self.content = readable.read()
+
+    def testStreams(self):
+        for size in (0, 15, 16, 17, 100):
+            data = b'x' * size
+            # Raw, buffered and text streams can all be layered on the writable end
+            pipe = self.Pipe()
+            with pipe as writable:
+                writable.writelines([data[:5], data[5:]])
+            self.assertEqual(pipe.content, data)
+            self.assertEqual(pipe.piped, size > self.Pipe.bufferSize)
+            pipe = self.Pipe()
+            with pipe as writable:
+                with io.BufferedWriter(writable, buffer_size=8) as buffered:
+                    pickle.dump(data, buffered, protocol=pickle.HIGHEST_PROTOCOL)
+            self.assertEqual(pickle.loads(pipe.content), data)
+            pipe = self.Pipe()
+            with pipe as writable:
+                with io.TextIOWrapper(writable, encoding='utf-8') as text:
+                    text.write(data.decode('ascii'))
+            self.assertEqual(pipe.content, data)
+
+    def testClose(self):
+        for size in (1, 100):
+            pipe = self.Pipe()
+            with pipe as writable:
+                self.assertTrue(writable.writable())
+                self.assertFalse(writable.readable())
+                writable.write(b'x' * size)
+                writable.close()
+                self.assertTrue(writable.closed)
+                self.assertRaises(ValueError, writable.write, b'x')
+                # Closing twice is harmless
+                writable.close()
+            # The content written before the close is complete
+            self.assertEqual(pipe.content, b'x' * size)
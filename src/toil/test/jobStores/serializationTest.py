@@ -0,0 +1,165 @@
+# Copyright (C) 2015-2018 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from builtins import range
+import bz2
+import logging
+import time
+import uuid
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from toil.common import Config
+from toil.job import JobNode, ServiceJobNode
+from toil.jobGraph import JobGraph
+from toil.jobStores import serialization
+from toil.jobStores.serialization import encodeJobGraph, decodeJobGraph
+from toil.test import ToilTest, slow
+
+logger = logging.getLogger(__name__)
+
+
+def _makeID():
+    return 'job' + uuid.uuid4().hex
+
+
+def _makeCommand():
+    return '_toil file-%s/stream /home/user/workflow toil_workflow False' % uuid.uuid4().hex
+
+
+def _makeJobGraph(numChildren=10, numServices=2):
+    """
+    Create a job graph like the leader persists for a job with the given number of children
+    and a follow-on, after it ran once.
+    """
+    requirements = dict(memory=2 * 1024 ** 3, cores=1, disk=3 * 1024 ** 3, preemptable=False)
+    jobGraph = JobGraph(command=_makeCommand(), unitName='sample-%i' % numChildren,
+                        jobName='toil_workflow.AlignSample', jobStoreID=_makeID(),
+                        remainingRetryCount=1, predecessorNumber=1, **requirements)
+    jobGraph.stack = [[JobNode(requirements=requirements, jobName='toil_workflow.MergeSample',
+                               unitName=None, jobStoreID=_makeID(), command=_makeCommand(),
+                               predecessorNumber=numChildren)],
+                      [JobNode(requirements=dict(requirements, cores=0.5),
+                               jobName='toil_workflow.AlignChunk', unitName='chunk-%i' % i,
+                               displayName='AlignChunk', jobStoreID=_makeID(),
+                               command=_makeCommand())
+                       for i in range(numChildren)]]
+    jobGraph.services = [[ServiceJobNode(jobStoreID=_makeID(), memory=1024 ** 3, cores=1,
+                                         disk=1024 ** 3, preemptable=True,
+                                         startJobStoreID=_makeID(),
+                                         terminateJobStoreID=_makeID(),
+                                         errorJobStoreID=_makeID(), unitName=None,
+                                         jobName='toil_workflow.DatabaseService',
+                                         command=_makeCommand(), predecessorNumber=1)
+                          for _ in range(numServices)]]
+    jobGraph.filesToDelete = [_makeID() for _ in range(3)]
+    jobGraph.predecessorsFinished = {_makeID()}
+    jobGraph.checkpoint = _makeCommand()
+    jobGraph.checkpointFilesToDelete = []
+    jobGraph.chainedJobs = [u'toil_workflow.AlignSample', u'toil_workflow.Prepare \u2713']
+    return jobGraph
+
+
+class SerializationTest(ToilTest):
+    def _assertRoundTrip(self, jobGraph, cls=JobGraph):
+        decoded = decodeJobGraph(encodeJobGraph(jobGraph, compact=True), cls)
+        self.assertIs(type(decoded), type(jobGraph))
+        # JobGraph.__eq__ only compares some of the attributes
+        self.assertEqual(vars(decoded), vars(jobGraph))
+        for attribute, value in vars(jobGraph).items():
+            self.assertIs(type(vars(decoded)[attribute]), type(value))
+        return decoded
+
+    def testRoundTrip(self):
+        jobGraph = _makeJobGraph()
+        # Job graphs are pickled unless the compact encoding is asked for
+        self.assertEqual(vars(decodeJobGraph(encodeJobGraph(jobGraph))), vars(jobGraph))
+        self.assertFalse(encodeJobGraph(jobGraph).startswith(serialization.magic))
+        self.assertTrue(encodeJobGraph(jobGraph, compact=True).startswith(serialization.magic))
+        self._assertRoundTrip(jobGraph)
+        # The job graph of the root job, before it ran
+        self._assertRoundTrip(JobGraph(command=_makeCommand(), memory=None, cores=None,
+                                       disk=None, preemptable=None, unitName=None,
+                                       jobName='toil_workflow.Root', jobStoreID=_makeID(),
+                                       remainingRetryCount=0, predecessorNumber=0))
+
+    def testValues(self):
+        jobGraph = _makeJobGraph(numChildren=1, numServices=0)
+        for value in (-1, -(1 << 70), 1 << 70, 0, 0.25, -1e300, True, False, None, u'',
+                      u'\xe9t\xe9', b'\x00\xff', (1, u'a'), [], {u'a': [1, (2,)]}, {3}):
+            jobGraph.checkpoint = value
+            decoded = self._assertRoundTrip(jobGraph)
+            self.assertIs(type(decoded.checkpoint), type(value))
+
+    def testSubclass(self):
+        class CustomJobGraph(JobGraph):
+            pass
+
+        jobGraph = _makeJobGraph()
+        jobGraph.__class__ = CustomJobGraph
+        self._assertRoundTrip(jobGraph, cls=CustomJobGraph)
+
+    def testPickleFallback(self):
+        jobGraph = _makeJobGraph()
+        # Values and attributes the schema doesn't cover
+        jobGraph.stack[1][0]._config = Config()
+        record = encodeJobGraph(jobGraph, compact=True)
+        self.assertFalse(record.startswith(serialization.magic))
+        self.assertEqual(decodeJobGraph(record).stack, jobGraph.stack)
+        jobGraph = _makeJobGraph()
+        jobGraph.extra = 1
+        record = encodeJobGraph(jobGraph, compact=True)
+        self.assertFalse(record.startswith(serialization.magic))
+        self.assertEqual(decodeJobGraph(record).extra, 1)
+        # Records written before the encoding existed
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            jobGraph = _makeJobGraph()
+            self.assertEqual(vars(decodeJobGraph(pickle.dumps(jobGraph, protocol))),
+                             vars(jobGraph))
+
+    def testUnknownVersion(self):
+        record = bytearray(encodeJobGraph(_makeJobGraph(), compact=True))
+        record[len(serialization.magic)] = serialization.version + 1
+        self.assertRaises(ValueError, decodeJobGraph, bytes(record))
+
+    @slow
+    def testBenchmark(self):
+        """
+        Log the time it takes to encode and decode job graphs in the compact encoding and the
+        size of the records, in comparison to pickling them.
+        """
+        for numChildren, numServices in ((0, 0), (10, 0), (100, 2)):
+            jobGraphs = [_makeJobGraph(numChildren, numServices) for _ in range(1000)]
+            for name, dumps, loads in (
+                    ('pickle', lambda job: pickle.dumps(job, pickle.HIGHEST_PROTOCOL),
+                     pickle.loads),
+                    ('compact', lambda job: encodeJobGraph(job, compact=True),
+                     decodeJobGraph)):
+                start = time.time()
+                records = [dumps(jobGraph) for jobGraph in jobGraphs]
+                encodeTime = time.time() - start
+                start = time.time()
+                for record in records:
+                    loads(record)
+                decodeTime = time.time() - start
+                logger.info('%s with %i children and %i services: %.1f us to encode, %.1f us to '
+                            'decode, %i bytes per job, %i bytes compressed.',
+                            name, numChildren, numServices,
+                            encodeTime / len(records) * 1e6, decodeTime / len(records) * 1e6,
+                            sum(map(len, records)) // len(records),
+                            sum(len(bz2.compress(record)) for record in records) // len(records))
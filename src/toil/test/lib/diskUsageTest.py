@@ -0,0 +1,149 @@
+# Copyright (C) 2015-2018 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from builtins import range
+import logging
+import os
+import shutil
+import time
+from unittest import skipIf
+
+from toil import subprocess
+from toil.lib.diskUsage import getDirSize, DiskUsageTracker, _InotifyWatcher
+from toil.test import ToilTest, slow
+
+logger = logging.getLogger(__name__)
+
+
+class DiskUsageTest(ToilTest):
+    def setUp(self):
+        super(DiskUsageTest, self).setUp()
+        self.testDir = self._createTempDir()
+
+    def _createTree(self, dirPath, width=4, depth=3, fileSize=1 << 14):
+        for i in range(width):
+            with open(os.path.join(dirPath, 'file%i' % i), 'wb') as f:
+                f.write(os.urandom(fileSize))
+        os.link(os.path.join(dirPath, 'file0'), os.path.join(dirPath, 'link'))
+        os.symlink('file0', os.path.join(dirPath, 'symlink'))
+        if depth > 0:
+            for i in range(width):
+                subDir = os.path.join(dirPath, 'dir%i' % i)
+                os.mkdir(subDir)
+                self._createTree(subDir, width, depth - 1, fileSize)
+
+    def testGetDirSizeMatchesDu(self):
+        self._createTree(self.testDir)
+        # Hard links across directories must be counted once, too
+        os.link(os.path.join(self.testDir, 'dir0', 'file1'), os.path.join(self.testDir, 'crossLink'))
+        du = int(subprocess.check_output(['du', '-s', self.testDir],
+                                         env=dict(os.environ, BLOCKSIZE='512')).split()[0]) * 512
+        self.assertEqual(getDirSize(self.testDir), du)
+        self.assertEqual(getDirSize(self.testDir, threads=1), du)
+        filePath = os.path.join(self.testDir, 'file0')
+        self.assertEqual(getDirSize(filePath), os.stat(filePath).st_blocks * 512)
+
+    def testTrackerWithoutWatch(self):
+        with DiskUsageTracker(self.testDir, watch=False) as tracker:
+            self.assertFalse(tracker.watching)
+            self._createTree(self.testDir, depth=0)
+            # Unwatched trees are scanned
+            self.assertEqual(tracker.getUsage(), getDirSize(self.testDir))
+            filePath = os.path.join(self.testDir, 'file0')
+            tracker.record(filePath)
+            tracker.record(os.path.join(self.testDir, 'link'))
+            self.assertEqual(tracker.trackedUsage, os.stat(filePath).st_blocks * 512)
+            # Recording a file that no longer exists forgets it
+            os.remove(filePath)
+            tracker.record(filePath)
+            self.assertEqual(tracker.trackedUsage,
+                             os.stat(os.path.join(self.testDir, 'link')).st_blocks * 512)
+            tracker.forget(os.path.join(self.testDir, 'link'))
+            self.assertEqual(tracker.trackedUsage, 0)
+
+    @skipIf(not _InotifyWatcher.supported(), 'Requires inotify')
+    def testTrackerWithWatch(self):
+        with DiskUsageTracker(self.testDir) as tracker:
+            self.assertTrue(tracker.watching)
+            self._createTree(self.testDir, depth=2)
+            self._awaitUsage(tracker)
+            shutil.rmtree(os.path.join(self.testDir, 'dir1'))
+            os.rename(os.path.join(self.testDir, 'dir2'), os.path.join(self.testDir, 'dir0', 'moved'))
+            os.remove(os.path.join(self.testDir, 'file2'))
+            self._awaitUsage(tracker)
+            # Files in directories moved in from elsewhere must be picked up
+            outside = self._createTempDir()
+            self._createTree(outside, depth=1)
+            os.rename(outside, os.path.join(self.testDir, 'movedIn'))
+            self._awaitUsage(tracker)
+            # A file that is being written to is measured before it is closed
+            with open(os.path.join(self.testDir, 'growing'), 'wb') as f:
+                f.write(os.urandom(1 << 20))
+                f.flush()
+                time.sleep(_InotifyWatcher.modifyInterval)
+                f.write(os.urandom(1 << 20))
+                f.flush()
+                self._awaitUsage(tracker)
+
+    def _awaitUsage(self, tracker, timeout=10):
+        """
+        Wait for the usage reported by the given tracker to reflect the current state of its
+        directory, ignoring the size of the directories themselves, which aren't tracked.
+        """
+        expected = getDirSize(self.testDir) - self._getDirsSize(self.testDir)
+        deadline = time.time() + timeout
+        while tracker.getUsage() != expected:
+            self.assertTrue(time.time() < deadline,
+                            'Tracked usage %i differs from actual usage %i.' % (
+                                tracker.getUsage(), expected))
+            time.sleep(0.1)
+        self.assertTrue(tracker.watching)
+
+    @staticmethod
+    def _getDirsSize(dirPath):
+        size = 0
+        for root, dirs, files in os.walk(dirPath):
+            size += os.lstat(root).st_blocks * 512
+        return size
+
+    @slow
+    def testGetDirSizeBenchmark(self):
+        """
+        Log how long getDirSize() and du take for a directory as left behind by a typical job
+        and for one with many small files.
+        """
+        def timeIt(fn, repeat):
+            start = time.time()
+            for _ in range(repeat):
+                fn()
+            return (time.time() - start) / repeat
+
+        def du():
+            subprocess.check_output(['du', '-s', self.testDir])
+
+        def scan():
+            getDirSize(self.testDir)
+
+        for i in range(10):
+            open(os.path.join(self.testDir, 'file%i' % i), 'w').close()
+        logger.info('Small directory: du took %f s, getDirSize() took %f s.',
+                    timeIt(du, 100), timeIt(scan, 100))
+        for i in range(10):
+            subDir = os.path.join(self.testDir, 'dir%i' % i)
+            os.mkdir(subDir)
+            for j in range(5000):
+                open(os.path.join(subDir, 'file%i' % j), 'w').close()
+        logger.info('Large directory: du took %f s, getDirSize() took %f s.',
+                    timeIt(du, 3), timeIt(scan, 3))
@@ -18,6 +18,7 @@ from builtins import map
 from builtins import object
 from builtins import range
 from past.utils import old_div
+import os
 import time
 import datetime
 from contextlib import contextmanager
@@ -263,6 +264,58 @@ class BinPackingTest(ToilTest):
         self.bpf.addJobShape(largerThanR3)
         # If we got here we didn't crash.
 
+    def testPackingIdenticalJobsAtOnce(self):
+        """
+        Test that packing identical jobs at once gives the same node reservations as packing
+        them one after the other.
+        """
+        random.seed(42)
+        for targetTime in (0, 600, 3600):
+            jobShapes = [Shape(wallTime=random.choice([1, 300, 3600, 5000]),
+                               memory=random.choice([0, h2b('1G'), h2b('30G')]),
+                               cores=random.choice([0, 0.5, 1, 16]),
+                               disk=random.choice([0, h2b('1G'), h2b('10G')]),
+                               preemptable=random.choice([True, False])) for _ in range(6)]
+            jobShapes = [random.choice(jobShapes) for _ in range(2000)]
+            jobShapes.sort(reverse=True)
+            nodeShapes = [c4_8xlarge_preemptable, t2_micro, r3_8xlarge]
+            oneByOne = BinPackedFit(nodeShapes, targetTime)
+            for jobShape in jobShapes:
+                oneByOne.addJobShape(jobShape)
+            atOnce = BinPackedFit(nodeShapes, targetTime)
+            atOnce.binPack(jobShapes)
+            self.assertEqual(oneByOne.getRequiredNodes(), atOnce.getRequiredNodes())
+            for nodeShape in nodeShapes:
+                self.assertEqual([x.shapes() for x in oneByOne.nodeReservations[nodeShape]
+                                  for _ in range(x.count)],
+                                 [x.shapes() for x in atOnce.nodeReservations[nodeShape]
+                                  for _ in range(x.count)])
+
+    def testPackingMillionJobs(self):
+        """
+        Benchmark packing a million queued jobs, which must take considerably less time than
+        the default interval between scaling decisions.
+        """
+        jobShapes = {Shape(wallTime=300, memory=h2b('1G'), cores=1, disk=h2b('1G'),
+                           preemptable=False): 500000,
+                     Shape(wallTime=5000, memory=h2b('30G'), cores=16, disk=h2b('10G'),
+                           preemptable=False): 100000,
+                     Shape(wallTime=60, memory=h2b('2G'), cores=2, disk=h2b('2G'),
+                           preemptable=True): 300000,
+                     Shape(wallTime=1, memory=0, cores=0.5, disk=0,
+                           preemptable=True): 100000}
+        bpf = BinPackedFit([c4_8xlarge_preemptable, t2_micro, r3_8xlarge], targetTime=3600)
+        start = time.time()
+        bpf.binPack([jobShape for jobShape, count in iteritems(jobShapes)
+                     for _ in range(count)])
+        duration = time.time() - start
+        logger.info('Packed a million jobs in %f seconds: %s', duration, bpf.getRequiredNodes())
+        self.assertLess(duration, Config().scaleInterval / 2)
+        # Twelve of the short jobs run one after the other on each t2.micro
+        self.assertEqual(bpf.getRequiredNodes()[t2_micro], 500000 // 12 + 1)
+        # Two of the long jobs run side by side on each r3.8xlarge
+        self.assertEqual(bpf.getRequiredNodes()[r3_8xlarge], 100000 // 2)
+
 class ClusterScalerTest(ToilTest):
     def setUp(self):
         super(ClusterScalerTest, self).setUp()
@@ -458,6 +511,26 @@ class ClusterScalerTest(ToilTest):
             scaler.smoothEstimate(c4_8xlarge_preemptable, 100)
         self.assertEqual(scaler.smoothEstimate(c4_8xlarge_preemptable, 100), 100)
 
+    def testRuntimeModel(self):
+        """
+        Test that the runtimes of jobs are estimated from the runtimes recorded by earlier runs.
+        """
+        self.config.runtimeModel = os.path.join(self._createTempDir(), 'runtimes.json')
+        self.config.runtimeEstimate = 0.9
+        scaler = ClusterScaler(self.provisioner, self.leader, self.config)
+        self.assertEqual(scaler.getEstimatedRuntime('job'), 1.0)
+        for wallTime in range(1, 11):
+            scaler.addCompletedJob(JobNode(command=None, jobStoreID=None, jobName='job',
+                                           unitName=None, requirements=dict(memory=h2b('1G'),
+                                                                            cores=1, disk=0,
+                                                                            preemptable=False)),
+                                   wallTime)
+        scaler.runtimeModel.save()
+        # The next run starts with the runtimes recorded by this one
+        scaler = ClusterScaler(self.provisioner, self.leader, self.config)
+        self.assertAlmostEqual(scaler.getEstimatedRuntime('job'), 9, delta=0.5)
+        self.assertAlmostEqual(scaler.getEstimatedRuntime('otherJob'), 9, delta=0.5)
+
 
 class ScalerThreadTest(ToilTest):
     def _testClusterScaling(self, config, numJobs, numPreemptableJobs, jobShape):
@@ -0,0 +1,72 @@
+# Copyright (C) 2015-2018 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from builtins import range
+import os
+
+from toil.provisioners.runtimeModel import RuntimeDistribution, RuntimeModel
+from toil.test import ToilTest
+
+
+class RuntimeModelTest(ToilTest):
+    def testDistribution(self):
+        distribution = RuntimeDistribution()
+        for runtime in range(1, 101):
+            distribution.add(runtime)
+        self.assertEqual(distribution.mean(), 50.5)
+        self.assertEqual(distribution.min, 1)
+        self.assertEqual(distribution.max, 100)
+        for q in (0.1, 0.5, 0.9):
+            self.assertAlmostEqual(distribution.quantile(q), q * 100, delta=q * 100 * 0.05)
+        self.assertEqual(distribution.quantile(1.0), 100)
+        # The moving average favors the most recent runtimes
+        self.assertGreater(distribution.ewma, 90)
+        self.assertEqual(RuntimeDistribution.fromDict(distribution.toDict()).toDict(),
+                         distribution.toDict())
+
+    def testEstimates(self):
+        model = RuntimeModel()
+        self.assertIsNone(model.getRuntime('a'))
+        model.addRuntime('a', 10, cores=1, memory=100)
+        model.addRuntime('a', 30, cores=2, memory=100)
+        model.addRuntime('b', 100)
+        self.assertEqual(model.getRuntime('a'), 20)
+        self.assertEqual(model.getRuntime('a', estimate=1.0), 30)
+        # Jobs with the same requirements are preferred
+        self.assertEqual(model.getRuntime('a', cores=2, memory=100), 30)
+        self.assertEqual(model.getRuntime('a', cores=4, memory=100), 20)
+        # Without jobs of the same name all jobs are used
+        self.assertEqual(model.getRuntime('c'), 140 / 3.0)
+        self.assertEqual(model.getRuntime('b', estimate='ewma'), 100)
+
+    def testPersistence(self):
+        path = os.path.join(self._createTempDir(), 'runtimes.json')
+        first = RuntimeModel(path)
+        second = RuntimeModel(path)
+        first.addRuntime('a', 10)
+        second.addRuntime('a', 20)
+        second.addRuntime('b', 5)
+        first.save()
+        second.save()
+        # The file has the runtimes recorded by both models
+        self.assertEqual(second.getRuntime('a'), 15)
+        model = RuntimeModel(path)
+        self.assertEqual(model.getRuntime('a'), 15)
+        self.assertEqual(model.getRuntime('b'), 5)
+        # Saving again doesn't record runtimes twice
+        second.save()
+        model.addRuntime('b', 7)
+        model.save()
+        self.assertEqual(RuntimeModel(path).getRuntime('b'), 6)
@@ -0,0 +1,142 @@
+# Copyright (C) 2015-2018 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from builtins import range
+import os
+from mock import Mock
+
+from toil.callCache import CallCache, _UncacheableValue
+from toil.common import Config, Toil
+from toil.job import Job
+from toil.test import ToilTest
+from toil.utils.toilStats import getStats, processData
+
+
+class CallCacheTest(ToilTest):
+    def setUp(self):
+        super(CallCacheTest, self).setUp()
+        tempDir = self._createTempDir()
+        self.cachePath = os.path.join(tempDir, 'cache')
+        self.inputPath = os.path.join(tempDir, 'input')
+        self.outputPath = os.path.join(tempDir, 'output')
+        # Every run of the cacheable job appends a line to this file
+        self.runsPath = os.path.join(tempDir, 'runs')
+        open(self.runsPath, 'w').close()
+
+    def _run(self, factor, refresh=False):
+        options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+        options.logLevel = 'INFO'
+        options.callCache = self.cachePath
+        options.refreshCallCache = refresh
+        options.stats = True
+        with Toil(options) as toil:
+            inputID = toil.importFile('file://' + self.inputPath)
+            returnedFactor, outputID = toil.start(Job.wrapJobFn(parent, inputID, factor,
+                                                                self.runsPath))
+            self.assertEqual(returnedFactor, factor)
+            toil.exportFile(outputID, 'file://' + self.outputPath)
+            stats = processData(toil.config, getStats(toil._jobStore))
+        with open(self.outputPath) as f:
+            self.assertEqual(f.read(), self._input * factor)
+        with open(self.runsPath) as f:
+            numRuns = len(f.readlines())
+        return numRuns, stats.jobs.call_cache_hits
+
+    def _writeInput(self, value):
+        self._input = value
+        with open(self.inputPath, 'w') as f:
+            f.write(value)
+
+    def test(self):
+        self._writeInput('a')
+        self.assertEqual(self._run(2), (1, 0))
+        # The parent adds a child, so only the child's return value is cached
+        self.assertEqual(self._run(2), (1, 1))
+        # Different arguments
+        self.assertEqual(self._run(3), (2, 0))
+        # Different content of the input file
+        self._writeInput('b')
+        self.assertEqual(self._run(3), (3, 0))
+        self.assertEqual(self._run(3), (3, 1))
+        self.assertEqual(self._run(3, refresh=True), (4, 0))
+        self.assertEqual(self._run(3), (4, 1))
+
+    def testMap(self):
+        # The chunks of a map share a file holding the arguments, whose ID differs between runs.
+        # The chunks and the job gathering their results are cached.
+        for hits in (0, 3):
+            options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+            options.logLevel = 'INFO'
+            options.callCache = self.cachePath
+            options.stats = True
+            with Toil(options) as toil:
+                self.assertEqual(toil.start(Job.wrapJobFn(mapParent, self.runsPath)), [0, 2, 4, 6])
+                stats = processData(toil.config, getStats(toil._jobStore))
+            self.assertEqual(stats.jobs.call_cache_hits, hits)
+        with open(self.runsPath) as f:
+            self.assertEqual(len(f.readlines()), 4)
+
+    def testKey(self):
+        cache = CallCache(self.cachePath)
+        config = Config()
+        fileStore = Mock(jobStore=Mock(config=config))
+
+        def key(*args):
+            return cache._getKey(Job.wrapFn(double, *args), fileStore)
+
+        # 8 and 16 collide in a small hash table, so the order of iteration is that of insertion
+        self.assertNotEqual(list({8, 16}), list({16, 8}))
+        self.assertEqual(key({8, 16}), key({16, 8}))
+        self.assertEqual(key(frozenset([8, 16])), key(frozenset([16, 8])))
+        self.assertEqual(key({8: 'a', 16: {8, 16}}), key({16: {16, 8}, 8: 'a'}))
+        self.assertNotEqual(key({8, 16}), key(frozenset([8, 16])))
+        self.assertNotEqual(key({8: 'a'}), key({8: 'b'}))
+        # Options other than those concerning resources, for example, are part of the key
+        original = key(1)
+        config.defaultMemory *= 2
+        config.workflowID = 'another workflow'
+        self.assertEqual(key(1), original)
+        config.environment = dict(config.environment, FOO='bar')
+        self.assertNotEqual(key(1), original)
+        # Cyclic attributes have no key
+        cyclic = {}
+        cyclic['self'] = cyclic
+        self.assertRaises(_UncacheableValue, key, cyclic)
+
+
+def parent(job, inputID, factor, runsPath):
+    return job.addChildJobFn(repeat, inputID, factor, runsPath).rv()
+
+
+def repeat(job, inputID, factor, runsPath):
+    with open(runsPath, 'a') as f:
+        f.write('run\n')
+    with open(job.fileStore.readGlobalFile(inputID)) as f:
+        value = f.read()
+    outputPath = job.fileStore.getLocalTempFile()
+    with open(outputPath, 'w') as f:
+        f.write(value * factor)
+    return factor, job.fileStore.writeGlobalFile(outputPath)
+
+
+def mapParent(job, runsPath):
+    return job.addChildMap(double, range(4), runsPath, chunkSize=2).rv()
+
+
+def double(item, runsPath=None):
+    if runsPath is not None:
+        with open(runsPath, 'a') as f:
+            f.write('run\n')
+    return item * 2
@@ -25,13 +25,15 @@ from uuid import uuid4
 
 from toil.job import Job
 from toil.fileStore import IllegalDeletionCacheError, CachingFileStore
-from toil.test import ToilTest, needs_aws, needs_azure, needs_google, slow
+from toil.test import ToilTest, needs_aws, needs_azure, needs_google, slow, integrative
 from toil.leader import FailedJobsException
 from toil.jobStores.abstractJobStore import NoSuchFileException
 from toil.fileStore import CacheUnbalancedError
 
 import collections
+import hashlib
 import inspect
+import logging
 import os
 import random
 import signal
@@ -444,6 +446,76 @@ class hidden(object):
 
             return job.fileStore.writeGlobalFile(testFile.name), testFile
 
+        def testReadGlobalFileMapped(self):
+            """
+            Write a file to the job store and read it back as a memory map in a successor job, along
+            with an empty file.
+            """
+            A = Job.wrapJobFn(self._writeRandomFileFn, fileMB=1)
+            B = Job.wrapJobFn(self._readFileMappedFn, fsID=A.rv())
+            A.addChild(B)
+            Job.Runner.startToil(A, self.options)
+
+        @staticmethod
+        def _writeRandomFileFn(job, fileMB):
+            """
+            Write a local file of random bytes, one MB at a time, to the job store.
+
+            :param int fileMB: Size of the created file in MB
+            :return: the file store ID of the file
+            """
+            with open(job.fileStore.getLocalTempFile(), 'wb') as testFile:
+                for _ in range(fileMB):
+                    testFile.write(os.urandom(1024 * 1024))
+            return job.fileStore.writeGlobalFile(testFile.name)
+
+        @staticmethod
+        def _readFileMappedFn(job, fsID):
+            """
+            Read a global file both as a stream and as a memory map and compare the two.
+            """
+            with job.fileStore.readGlobalFileStream(fsID) as fH:
+                expected = fH.read()
+            with job.fileStore.readGlobalFileMapped(fsID) as mapped:
+                assert len(mapped) == len(expected)
+                assert mapped[:] == expected
+            emptyFile = job.fileStore.getLocalTempFile()
+            emptyFsID = job.fileStore.writeGlobalFile(emptyFile)
+            with job.fileStore.readGlobalFileMapped(emptyFsID) as mapped:
+                assert len(mapped) == 0
+
+        @integrative
+        def testReadGlobalFileMappedBenchmark(self):
+            """
+            Compare the wall time of consuming a 5 GB global file through readGlobalFileStream with
+            that of consuming it through readGlobalFileMapped. The timings are logged.
+            """
+            A = Job.wrapJobFn(self._writeRandomFileFn, fileMB=5 * 1024, disk='12G')
+            B = Job.wrapJobFn(self._readFileMappedBenchmarkFn, fsID=A.rv(), disk='12G')
+            A.addChild(B)
+            Job.Runner.startToil(A, self.options)
+
+        @staticmethod
+        def _readFileMappedBenchmarkFn(job, fsID, chunkSize=1024 * 1024):
+            start = time.time()
+            streamed = hashlib.md5()
+            with job.fileStore.readGlobalFileStream(fsID) as fH:
+                while True:
+                    chunk = fH.read(chunkSize)
+                    if not chunk:
+                        break
+                    streamed.update(chunk)
+            streamTime = time.time() - start
+            start = time.time()
+            with job.fileStore.readGlobalFileMapped(fsID) as mapped:
+                # The digest is computed straight from the mapped pages
+                mappedDigest = hashlib.md5(mapped).hexdigest()
+            mappedTime = time.time() - start
+            assert streamed.hexdigest() == mappedDigest
+            job.fileStore.logToMaster('Consumed %s bytes in %.2fs as a stream and in %.2fs as a '
+                                      'memory map.' % (fsID.size, streamTime, mappedTime),
+                                      level=logging.INFO)
+
     class AbstractNonCachingFileStoreTest(with_metaclass(ABCMeta, AbstractFileStoreTest)):
         """
         Abstract tests for the the various functions in :class:toil.fileStore.NonCachingFileStore.
@@ -960,6 +1032,51 @@ class hidden(object):
             # the file
             time.sleep(3)
 
+        def testReadGlobalFileMappedPinsCachedCopy(self):
+            """
+            Read a cached file as a memory map and ensure that the cached copy is in use, and hence
+            not evictable, while it is mapped.
+            """
+            A = Job.wrapJobFn(self._writeRandomFileFn, fileMB=1)
+            B = Job.wrapJobFn(self._readFileMappedPinnedFn, fsID=A.rv())
+            A.addChild(B)
+            Job.Runner.startToil(A, self.options)
+
+        @staticmethod
+        def _readFileMappedPinnedFn(job, fsID):
+            with job.fileStore.readGlobalFileMapped(fsID) as mapped:
+                assert len(mapped) == fsID.size
+                cachedFile = job.fileStore.encodedFileID(fsID)
+                assert os.stat(cachedFile).st_nlink > job.fileStore.nlinkThreshold
+
+        def testReadDeduplicatedFilesShareCachedCopy(self):
+            """
+            Read two files with the same content from a deduplicating job store and ensure that
+            the second read is served from the cached copy of the first file.
+            """
+            self.options.deduplicateFiles = True
+            A = Job.wrapJobFn(self._writeDuplicateFilesFn)
+            B = Job.wrapJobFn(self._readDuplicateFilesFn, fsIDs=A.rv())
+            A.addChild(B)
+            Job.Runner.startToil(A, self.options)
+
+        @staticmethod
+        def _writeDuplicateFilesFn(job):
+            localFilePath = job.fileStore.getLocalTempFile()
+            with open(localFilePath, 'wb') as f:
+                f.write(os.urandom(1024 * 1024))
+            # Bypass the file store so that neither file ends up in the cache
+            return [job.fileStore.jobStore.writeFile(localFilePath) for _ in range(2)]
+
+        @staticmethod
+        def _readDuplicateFilesFn(job, fsIDs):
+            first, second = fsIDs
+            assert job.fileStore.jobStore.getFileContentHash(first) is not None
+            job.fileStore.readGlobalFile(first)
+            secondPath = job.fileStore.readGlobalFile(second)
+            assert not job.fileStore._fileIsCached(second)
+            assert os.path.samefile(secondPath, job.fileStore.encodedFileID(first))
+
         @staticmethod
         def _writeExportGlobalFile(job):
             fileName = os.path.join(job.fileStore.getLocalTempDir(), 'testfile')
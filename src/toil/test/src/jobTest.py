@@ -25,11 +25,16 @@ import random
 
 # Python 3 compatibility imports
 from six.moves import xrange
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from mock import patch
 
 from toil.common import Toil
 from toil.leader import FailedJobsException
 from toil.lib.bioio import getTempFile
-from toil.job import Job, JobGraphDeadlockException, JobFunctionWrappingJob
+from toil.job import Job, JobGraphDeadlockException, JobFunctionWrappingJob, _SharedValues
 from toil.test import ToilTest, slow
 
 logger = logging.getLogger(__name__)
@@ -448,6 +453,44 @@ class JobTest(ToilTest):
                 print("ADJACENCY LIST", adjacencyList)
             self.assertTrue(self.isAcyclic(adjacencyList))
 
+    def testMap(self):
+        """
+        Tests that the functions of map jobs are called on each item, in chunks, and that their
+        results are gathered in the order of the items.
+        """
+        options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+        options.logLevel = 'INFO'
+        root = Job.wrapJobFn(mapParent)
+        self.assertEqual(Job.Runner.startToil(root, options),
+                         ([i * 3 for i in range(250)], [(5, i, 'x') for i in range(20)], []))
+
+    def testSharedArguments(self):
+        """
+        Tests that large arguments shared by sibling jobs are stored once instead of in the
+        pickle of each sibling.
+        """
+        options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+        options.logLevel = 'INFO'
+        root = Job.wrapFn(multiply, [0, 1, 2], 1)
+        sharedValue = {'samples': ['sample-%i' % i for i in range(5000)]}
+        rootValue = root.rv()
+        for _ in range(5):
+            # The promise is shared as well but must be resolved by each child on its own
+            root.addChildFn(checkSharedArguments, sharedValue, rootValue)
+        pickleSizes = []
+        dumps = _SharedValues.dumps
+
+        def dumpsJob(sharedValues, job):
+            pickledJob = dumps(sharedValues, job)
+            pickleSizes.append(len(pickledJob))
+            return pickledJob
+
+        # The root job and its children are serialized by the leader, in this process
+        with patch.object(_SharedValues, 'dumps', dumpsJob):
+            Job.Runner.startToil(root, options)
+        self.assertEqual(len(pickleSizes), 6)
+        self.assertTrue(max(pickleSizes) < len(pickle.dumps(sharedValue, pickle.HIGHEST_PROTOCOL)))
+
     @staticmethod
     def getRandomEdge(nodeNumber):
         assert nodeNumber > 1
@@ -647,6 +690,27 @@ def fn2Test(pStrings, s, outputFile):
     return s
 
 
+def mapParent(job):
+    tripled = job.addChildMap(multiply, range(250), 3, chunkSize=100)
+    chunks = job.addChildJobMap(chunkItem, range(20), suffix='x', chunkSize=5, memory='100M')
+    empty = job.addChildMap(multiply, [], 3)
+    return tripled.rv(), chunks.rv(), empty.rv()
+
+
+def multiply(i, factor):
+    return i * factor
+
+
+def chunkItem(job, i, suffix):
+    assert job.memory == 100 * 1024 * 1024
+    return len(job._items), i, suffix
+
+
+def checkSharedArguments(sharedValue, rootValue):
+    assert sharedValue == {'samples': ['sample-%i' % i for i in range(5000)]}
+    assert rootValue == [0, 1, 2]
+
+
 def trivialParent(job):
     strandedJob = JobFunctionWrappingJob(child)
     failingJob = JobFunctionWrappingJob(errorChild)
@@ -0,0 +1,138 @@
+# Copyright (C) 2015-2018 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from builtins import range
+import base64
+import multiprocessing
+import os
+
+import requests
+
+from toil.common import Config, Toil
+from toil.jobStores.abstractJobStore import NoSuchFileException
+from toil.jobStores.fileJobStore import FileJobStore
+from toil.peerCache import PeerCache, getPrivateIP, _isPrivateIP
+from toil.test import ToilTest
+
+
+def _cachedFileName(jobStoreFileID):
+    return base64.urlsafe_b64encode(jobStoreFileID.encode('utf-8')).decode('utf-8')
+
+
+def _simulateNode(locator, cacheDir, jobStoreFileID, results):
+    """
+    Download the given file into the given cache directory from a peer and share it in turn,
+    like a worker on a separate node would.
+    """
+    jobStore = Toil.resumeJobStore(locator)
+    peerCache = PeerCache(jobStore, cacheDir, '127.0.0.1')
+    cachedFilePath = os.path.join(cacheDir, _cachedFileName(jobStoreFileID))
+    downloadPath = os.path.join(cacheDir, '.' + _cachedFileName(jobStoreFileID))
+    downloaded = peerCache.download(jobStoreFileID, cachedFilePath, downloadPath)
+    if downloaded:
+        os.rename(downloadPath, cachedFilePath)
+        peerCache.advertise(jobStoreFileID, cachedFilePath)
+    results.put(downloaded)
+
+
+class PeerCacheTest(ToilTest):
+    def setUp(self):
+        super(PeerCacheTest, self).setUp()
+        self.locator = os.path.join(self._createTempDir(), 'jobStore')
+        self.jobStore = FileJobStore(self.locator)
+        self.jobStore.initialize(Config())
+        PeerCache.createToken(self.jobStore)
+        self.content = os.urandom(1024 * 1024)
+        filePath = os.path.join(self._createTempDir(), 'content')
+        with open(filePath, 'wb') as f:
+            f.write(self.content)
+        self.fileID = self.jobStore.writeFile(filePath)
+        # The first node reads the file from the job store and shares it
+        self.cacheDir = self._createTempDir()
+        self.peerCache = PeerCache(self.jobStore, self.cacheDir, '127.0.0.1')
+        self.cachedFilePath = os.path.join(self.cacheDir, _cachedFileName(self.fileID))
+        self.jobStore.readFile(self.fileID, self.cachedFilePath)
+        self.peerCache.advertise(self.fileID, self.cachedFilePath)
+
+    def _simulateNodes(self, numNodes):
+        results = multiprocessing.Queue()
+        cacheDirs = [self._createTempDir() for _ in range(numNodes)]
+        nodes = [multiprocessing.Process(target=_simulateNode,
+                                         args=(self.locator, cacheDir, self.fileID, results))
+                 for cacheDir in cacheDirs]
+        for node in nodes:
+            node.start()
+        for node in nodes:
+            node.join()
+            self.assertEqual(node.exitcode, 0)
+        return [results.get() for _ in nodes], cacheDirs
+
+    def testDownloadFromPeers(self):
+        # Peers must not need the job store's copy
+        self.jobStore.deleteFile(self.fileID)
+        results, cacheDirs = self._simulateNodes(3)
+        self.assertEqual(results, [True] * 3)
+        for cacheDir in cacheDirs:
+            with open(os.path.join(cacheDir, _cachedFileName(self.fileID)), 'rb') as f:
+                self.assertEqual(f.read(), self.content)
+        index = self.peerCache._loadIndex(self.fileID)
+        self.assertEqual(len(set(index['peers'])), 4)
+        # A node serves its cache to everyone, so each node runs one server only
+        self.assertEqual(PeerCache(self.jobStore, self.cacheDir, '127.0.0.1').url,
+                         self.peerCache.url)
+
+    def testCorruptCopiesAreRejected(self):
+        with open(self.cachedFilePath, 'wb') as f:
+            f.write(os.urandom(1024))
+        results, _ = self._simulateNodes(1)
+        self.assertEqual(results, [False])
+        # The peer with the corrupt copy is no longer advertised
+        self.assertEqual(self.peerCache._loadIndex(self.fileID)['peers'], [])
+
+    def testEvictedCopiesAreSkipped(self):
+        os.remove(self.cachedFilePath)
+        results, _ = self._simulateNodes(1)
+        self.assertEqual(results, [False])
+
+    def testRequestsRequireToken(self):
+        url = self.peerCache.url + _cachedFileName(self.fileID)
+        self.assertEqual(requests.get(url).status_code, 403)
+        self.assertEqual(requests.get(url, headers={'Authorization': 'Bearer wrong'}).status_code,
+                         403)
+        response = requests.get(url, headers={'Authorization': 'Bearer ' + self.peerCache.token})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, self.content)
+        # The token is created once per workflow
+        PeerCache.createToken(self.jobStore)
+        self.assertEqual(PeerCache(self.jobStore, self.cacheDir, '127.0.0.1').token,
+                         self.peerCache.token)
+
+    def testDeleteIndexes(self):
+        indexFileName = PeerCache._indexFileName(self.fileID)
+        with self.jobStore.readSharedFileStream(indexFileName):
+            pass
+        PeerCache.deleteIndexes(self.jobStore, [self.fileID])
+        self.assertIsNone(self.peerCache._loadIndex(self.fileID))
+        with self.assertRaises(NoSuchFileException):
+            with self.jobStore.readSharedFileStream(indexFileName):
+                pass
+
+    def testPrivateIP(self):
+        for ip in ('10.0.0.1', '172.16.5.4', '172.31.255.1', '192.168.1.1'):
+            self.assertTrue(_isPrivateIP(ip))
+        for ip in ('8.8.8.8', '172.32.0.1', '192.169.0.1', '127.0.0.1'):
+            self.assertFalse(_isPrivateIP(ip))
+        ip = getPrivateIP()
+        self.assertTrue(ip is None or _isPrivateIP(ip))
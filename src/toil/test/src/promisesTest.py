@@ -13,7 +13,12 @@
 # limitations under the License.
 from __future__ import absolute_import
 from builtins import range
-from toil.job import Job
+import pickle
+import uuid
+from mock import patch
+from toil.common import Config
+from toil.job import Job, Promise
+from toil.jobStores.memoryJobStore import MemoryJobStore
 from toil.test import ToilTest
 
 
@@ -85,3 +90,70 @@ def d(job):
 
 def e():
     return {'a': 'b', 42: 43, 'c': [1, 2, 3]}
+
+
+class SharedPromiseFilesTest(ToilTest):
+    """
+    Test that all values a job promises to another job are stored in a single file.
+    """
+
+    def test(self):
+        options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+        options.logLevel = 'INFO'
+        root = Job.wrapFn(f)
+        root.addChildFn(g, [root.rv(i) for i in range(100)], root.rv())
+        root.addChildFn(g, [root.rv(i) for i in range(10)], root.rv())
+        fileIDs = []
+        registerPromise = Job.registerPromise
+
+        def register(job, path):
+            jobStoreLocator, jobStoreFileID = registerPromise(job, path)
+            fileIDs.append(jobStoreFileID)
+            return jobStoreLocator, jobStoreFileID
+
+        # The root job and its children are serialized by the leader, in this process, which also
+        # registers a promise for the return value of the workflow
+        with patch.object(Job, 'registerPromise', register):
+            Job.Runner.startToil(root, options)
+        self.assertEqual(len(fileIDs), 113)
+        self.assertEqual(len(set(fileIDs)), 3)
+
+
+def f():
+    return list(range(100))
+
+
+def g(values, allValues):
+    assert values == allValues[:len(values)]
+
+
+class LegacyPromiseTest(ToilTest):
+    """
+    Test that promises pickled by older versions of Toil, which reference a file of their own
+    instead of a path into a file shared with other promises, can still be resolved.
+    """
+
+    def test(self):
+        jobStore = MemoryJobStore(str(uuid.uuid4()))
+        config = Config()
+        config.jobStore = jobStore.locator
+        jobStore.initialize(config)
+        try:
+            job = Job.wrapFn(e)
+            job.prepareForPromiseRegistration(jobStore)
+            # Without sharing files, registering a promise allocates a file for it alone, as
+            # older versions of Toil did
+            locator, wholeFileID = job.registerPromise(())
+            _, indexedFileID = job.registerPromise(('c', 2))
+            job._fulfillPromises(e(), jobStore)
+            # A file written by an older version of Toil holds just the promised value
+            with jobStore.writeFileStream() as (f, legacyFileID):
+                pickle.dump(e(), f, pickle.HIGHEST_PROTOCOL)
+            with patch.object(Promise, '_loadJobStore', return_value=jobStore):
+                # Promises pickled by older versions are instantiated without a path
+                self.assertEqual(Promise(locator, wholeFileID), e())
+                self.assertEqual(Promise(locator, indexedFileID), 3)
+                self.assertEqual(Promise(locator, legacyFileID), e())
+        finally:
+            Promise.filesToDelete.clear()
+            jobStore.destroy()
@@ -0,0 +1,106 @@
+# Copyright (C) 2015-2018 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+import os
+import signal
+from collections import defaultdict
+
+from mock import patch
+
+from toil.batchSystems.abstractBatchSystem import BatchJobExitReason
+from toil.batchSystems.singleMachine import SingleMachineBatchSystem
+from toil.common import Config
+from toil.job import Job
+from toil.jobGraph import JobGraph
+from toil.test import ToilTest
+
+
+class ResourceEscalationTest(ToilTest):
+    """
+    Tests the retrying of jobs that ran out of memory or disk with larger requirements.
+    """
+    def testExitReason(self):
+        self.assertEqual(BatchJobExitReason.fromExitStatus(137), BatchJobExitReason.MEMLIMIT)
+        self.assertEqual(BatchJobExitReason.fromExitStatus(-9), BatchJobExitReason.MEMLIMIT)
+        self.assertIsNone(BatchJobExitReason.fromExitStatus(1))
+
+    def testSetupJobAfterFailure(self):
+        config = Config()
+        config.defaultMemory = 1
+        config.maxDisk = 300
+        jobGraph = JobGraph(command=None, memory=100, cores=1, disk=100, unitName=None,
+                            jobName='test', preemptable=False, jobStoreID='test',
+                            remainingRetryCount=3, predecessorNumber=1)
+        jobGraph.setupJobAfterFailure(config)
+        self.assertEqual((jobGraph.memory, jobGraph.disk), (100, 100))
+        jobGraph.setupJobAfterFailure(config, exitReason=BatchJobExitReason.MEMLIMIT, limit=150)
+        self.assertEqual((jobGraph.memory, jobGraph.disk), (150, 100))
+        jobGraph.setupJobAfterFailure(config, exitReason=BatchJobExitReason.DISKLIMIT)
+        jobGraph.setupJobAfterFailure(config, exitReason=BatchJobExitReason.DISKLIMIT)
+        self.assertEqual((jobGraph.memory, jobGraph.disk), (150, 300))
+        self.assertEqual(jobGraph.remainingRetryCount, 0)
+        config.retryResourceFactor = 1
+        jobGraph.setupJobAfterFailure(config, exitReason=BatchJobExitReason.MEMLIMIT)
+        self.assertEqual(jobGraph.memory, 150)
+
+    def testEscalation(self):
+        options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+        options.retryCount = 1
+        options.defaultMemory = '100M'
+        options.defaultDisk = '1M'
+        # Each job must fail in a worker of its own
+        options.disableChaining = True
+        attemptsPath = os.path.join(self._createTempDir(), 'attempts')
+        root = Job.wrapJobFn(exceedMemory, attemptsPath, memory='100M')
+        # The second job of the same name starts with the memory the first was retried with
+        root.addFollowOnJobFn(exceedMemory, attemptsPath, memory='100M')
+        root.addChildJobFn(exceedDisk, attemptsPath)
+
+        issued = defaultdict(list)
+        issueBatchJob = SingleMachineBatchSystem.issueBatchJob
+
+        def recordIssue(batchSystem, jobNode):
+            issued[jobNode.jobName].append((jobNode.memory, jobNode.disk))
+            return issueBatchJob(batchSystem, jobNode)
+
+        with patch.object(SingleMachineBatchSystem, 'issueBatchJob', autospec=True,
+                          side_effect=recordIssue):
+            Job.Runner.startToil(root, options)
+        mb = 1024 * 1024
+        # The root is retried, the follow-on is issued and finally the root is issued again once
+        # its successors are done
+        self.assertEqual(issued['exceedMemory'], [(100 * mb, mb)] + [(200 * mb, mb)] * 3)
+        self.assertEqual(issued['exceedDisk'], [(100 * mb, mb), (100 * mb, 2 * mb)])
+
+
+def _isFirstAttempt(attemptsPath, name):
+    with open(attemptsPath, 'a+') as f:
+        f.seek(0)
+        first = name not in f.read().split()
+        f.write(name + '\n')
+    return first
+
+
+def exceedMemory(job, attemptsPath):
+    if _isFirstAttempt(attemptsPath, 'exceedMemory'):
+        # This is how the kernel deals with a process running out of memory
+        os.kill(os.getpid(), signal.SIGKILL)
+
+
+def exceedDisk(job, attemptsPath):
+    if _isFirstAttempt(attemptsPath, 'exceedDisk'):
+        with open(job.fileStore.getLocalTempFile(), 'wb') as f:
+            f.write(b'\0' * 2 * job.disk)
+        raise RuntimeError('Out of disk')
@@ -14,7 +14,10 @@
 
 from __future__ import absolute_import
 
+from argparse import Namespace
 from builtins import str
+from io import BytesIO
+import json
 import os
 import sys
 import uuid
@@ -32,8 +35,10 @@ from toil.job import Job
 from toil.lib.bioio import getTempFile, system
 from toil.test import ToilTest, needs_aws, needs_rsync3, integrative, slow
 from toil.test.sort.sortTest import makeFileToSort
-from toil.utils.toilStats import getStats, processData
+from toil.utils.toilStats import getStats, processData, refineData, reportPrettyData
 from toil.common import Toil, Config
+from toil.jobStores.fileJobStore import FileJobStore
+from toil.statsAndLogging import StatsTable
 from toil.provisioners import clusterFactory
 
 
@@ -307,6 +312,102 @@ class UtilsTest(ToilTest):
         collatedStats = processData(jobStore.config, stats)
         self.assertTrue(len(collatedStats.job_types) == 2,
                         "Some jobs are not represented in the stats")
+        # The leader stored the stats it aggregated, the same as all stats in the job store
+        stats = StatsTable()
+        jobStore.readStatsAndLogging(stats.add, readAll=True)
+        self.assertIsNotNone(StatsTable.load(jobStore))
+        self.assertEqual(processData(jobStore.config, stats), collatedStats)
+
+    def testStatsTable(self):
+        def record(start, *jobs):
+            return BytesIO(json.dumps(dict(
+                workers=dict(start=str(start), time='10', clock='4', memory='100',
+                             logsToMaster=[]),
+                jobs=[dict(start=str(start), class_name=name, time=str(t), clock='1',
+                           memory='100') for name, t in jobs])).encode('utf-8'))
+
+        def collate(**kwargs):
+            stats = StatsTable(**kwargs)
+            stats.add(record(100, ('A', 1), ('A', 2), ('B', 4)))
+            stats.add(record(200, ('A', 3)))
+            stats.add(BytesIO(json.dumps(dict(total_time='20', total_clock='8')).encode('utf-8')))
+            return processData(Config(), stats)
+
+        collated = collate()
+        self.assertEqual(collated.total_run_time, 20.0)
+        self.assertEqual(collated.worker.total_number, 2)
+        self.assertEqual(collated.worker.total_wait, 12.0)
+        self.assertEqual(collated.jobs.total_number, 4)
+        self.assertEqual(collated.jobs.max_number_per_worker, 3)
+        self.assertEqual(sorted(collated.job_types), ['A', 'B'])
+        jobType = collated.job_types['A']
+        self.assertEqual((jobType.total_number, jobType.min_time, jobType.median_time,
+                          jobType.average_time, jobType.max_time, jobType.total_time),
+                         (3, 1.0, 2.0, 2.0, 3.0, 6.0))
+        self.assertEqual((jobType.p90_time, jobType.p99_time), (3.0, 3.0))
+        self.assertEqual(collated.jobs.p90_time, 4.0)
+        self.assertEqual(jobType.total_wait, 3.0)
+        collated = collate(since=150)
+        self.assertEqual(collated.worker.total_number, 1)
+        self.assertEqual(list(collated.job_types), ['A'])
+        collated = collate(jobNames=['B'])
+        self.assertEqual(collated.worker.total_number, 1)
+        self.assertEqual(collated.jobs.total_number, 1)
+        self.assertEqual(collated.job_types['B'].median_time, 4.0)
+        self.assertEqual((collated.jobs.call_cache_hits, collated.jobs.call_cache_misses),
+                         (0, 0))
+        # Jobs run with the call cache record whether their return value was cached
+        stats = StatsTable()
+        stats.add(BytesIO(json.dumps(dict(
+            workers=dict(time='10', clock='4', memory='100'),
+            jobs=[dict(class_name='A', time='1', clock='1', memory='100', call_cache_hit=hit)
+                  for hit in (True, True, False)])).encode('utf-8')))
+        collated = processData(Config(), stats)
+        self.assertEqual((collated.jobs.call_cache_hits, collated.jobs.call_cache_misses),
+                         (2, 1))
+        self.assertEqual(collated.job_types['A'].call_cache_hits, 2)
+        options = Namespace(categories=['time'], sortCategory='time', sortField='med',
+                            sortReverse=False, pretty=True)
+        report = reportPrettyData(*refineData(collated, options) + (options,))
+        self.assertIn('Call Cache', report)
+
+    def testStoredStatsTable(self):
+        def record(start, name):
+            return dict(workers=dict(start=str(start), time='10', clock='4', memory='100'),
+                        jobs=[dict(start=str(start), class_name=name, time='1', clock='1',
+                                   memory='100')])
+
+        jobStore = FileJobStore(self._getTestJobStorePath())
+        jobStore.initialize(Config())
+        self.assertIsNone(StatsTable.load(jobStore))
+        stats = StatsTable()
+        stats.addStats(record(100, 'A'))
+        stats.addStats(dict(total_time='20', total_clock='8'))
+        stats.save(jobStore)
+        stats.close()
+        # A restarted leader carries on with the table, which is gone from the job store until
+        # it is saved again
+        stats = StatsTable.load(jobStore, remove=True)
+        self.assertIsNone(StatsTable.load(jobStore))
+        stats.addStats(record(200, 'B'))
+        stats.addStats(dict(total_time='10', total_clock='2'))
+        stats.save(jobStore)
+        stats.close()
+        collated = processData(Config(), StatsTable.load(jobStore))
+        self.assertEqual(collated.total_run_time, 30.0)
+        self.assertEqual(collated.worker.total_number, 2)
+        self.assertEqual(sorted(collated.job_types), ['A', 'B'])
+        collated = processData(Config(), StatsTable.load(jobStore, since=150))
+        self.assertEqual(collated.worker.total_number, 1)
+        self.assertEqual(list(collated.job_types), ['B'])
+        # A table of another version is ignored
+        StatsTable.version += 1
+        try:
+            self.assertIsNone(StatsTable.load(jobStore))
+        finally:
+            StatsTable.version -= 1
+        jobStore.destroy()
+
 
 def printUnicodeCharacter():
     # We want to get a unicode character to stdout but we can't print it directly because of
@@ -19,20 +19,30 @@ Reports statistical data about a given Toil workflow.
 from __future__ import absolute_import, print_function
 from __future__ import division
 from builtins import str
-from builtins import range
 from past.utils import old_div
 from builtins import object
-from functools import partial
+from datetime import datetime
 import logging
 import json
+import time
 from toil.lib.bioio import getBasicOptionParser
 from toil.lib.bioio import parseBasicOptions
 from toil.common import Toil, jobStoreLocatorHelp, Config
+from toil.statsAndLogging import StatsTable
 from toil.version import version
 from toil.lib.expando import Expando
 
 logger = logging.getLogger( __name__ )
 
+# The names of the fields of each category in the summaries computed by StatsTable
+longforms = {"med": "median",
+             "ave": "average",
+             "min": "min",
+             "total": "total",
+             "max": "max",
+             "p90": "p90",
+             "p99": "p99"}
+
 
 class ColumnWidths(object):
     """
@@ -40,8 +50,8 @@ class ColumnWidths(object):
     """
     def __init__(self):
         self.categories = ["time", "clock", "wait", "memory"]
-        self.fields_count = ["count", "min", "med", "ave", "max", "total"]
-        self.fields = ["min", "med", "ave", "max", "total"]
+        self.fields_count = ["count", "min", "med", "p90", "p99", "ave", "max", "total"]
+        self.fields = ["min", "med", "p90", "p99", "ave", "max", "total"]
         self.data = {}
         for category in self.categories:
             for field in self.fields_count:
@@ -82,11 +92,18 @@ def initializeOptions(parser):
                             "default=%(default)s"))
     parser.add_argument("--sortField", default="med",
                       help=("how to sort Job list. may be from [min, "
-                            "med, ave, max, total]. "
+                            "med, p90, p99, ave, max, total]. "
                             "default=%(default)s"))
     parser.add_argument("--sortReverse", "--reverseSort", default=False,
                       action="store_true",
                       help="reverse sort order.")
+    parser.add_argument("--since", default=None,
+                      help=("only report on the jobs that started at or after the given time, "
+                            "either in seconds since the epoch or as local time in the form "
+                            "YYYY-MM-DD[THH:MM[:SS]]."))
+    parser.add_argument("--jobName", dest="jobNames", action="append", default=None,
+                      help=("only report on the jobs with the given name. May be given more "
+                            "than once."))
     parser.add_argument("--version", action='version', version=version)
 
 def checkOptions(options, parser):
@@ -111,11 +128,32 @@ def checkOptions(options, parser):
             parser.error("Unknown --sortCategory %s. Must be from %s"
                          % (options.sortCategory,
                             str(defaultCategories + extraSort)))
-    sortFields = ["min", "med", "ave", "max", "total"]
+    sortFields = ["min", "med", "p90", "p99", "ave", "max", "total"]
     if options.sortField is not None:
         if (options.sortField not in sortFields):
             parser.error("Unknown --sortField %s. Must be from %s"
                          % (options.sortField, str(sortFields)))
+    if options.since is not None:
+        try:
+            options.since = parseTime(options.since)
+        except ValueError:
+            parser.error("Unknown --since %s. Must be seconds since the epoch or of the form "
+                         "YYYY-MM-DD[THH:MM[:SS]]" % options.since)
+
+def parseTime(s):
+    """ Return the given time, in seconds since the epoch or local time in ISO 8601 format, as
+    seconds since the epoch.
+    """
+    try:
+        return float(s)
+    except ValueError:
+        pass
+    for format in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            return time.mktime(datetime.strptime(s.replace(" ", "T"), format).timetuple())
+        except ValueError:
+            pass
+    raise ValueError(s)
 
 def printJson(elem):
     """ Return a JSON formatted string
@@ -251,58 +289,24 @@ def sprintTag(key, tag, options, columnWidths=None):
                   tag.average_number_per_worker, tag.max_number_per_worker]:
             worker_str += reportNumber(t, options, field=7)
         out_str += worker_str + "\n"
-    if "time" in options.categories:
-        header += "| %*s " % (columnWidths.title("time"),
-                              decorateTitle("Time", options))
-        sub_header += decorateSubHeader("Time", columnWidths, options)
-        tag_str += " | "
-        for t, width in [
-            (tag.min_time, columnWidths.getWidth("time", "min")),
-            (tag.median_time, columnWidths.getWidth("time", "med")),
-            (tag.average_time, columnWidths.getWidth("time", "ave")),
-            (tag.max_time, columnWidths.getWidth("time", "max")),
-            (tag.total_time, columnWidths.getWidth("time", "total")),
-            ]:
-            tag_str += reportTime(t, options, field=width)
-    if "clock" in options.categories:
-        header += "| %*s " % (columnWidths.title("clock"),
-                              decorateTitle("Clock", options))
-        sub_header += decorateSubHeader("Clock", columnWidths, options)
-        tag_str += " | "
-        for t, width in [
-            (tag.min_clock, columnWidths.getWidth("clock", "min")),
-            (tag.median_clock, columnWidths.getWidth("clock", "med")),
-            (tag.average_clock, columnWidths.getWidth("clock", "ave")),
-            (tag.max_clock, columnWidths.getWidth("clock", "max")),
-            (tag.total_clock, columnWidths.getWidth("clock", "total")),
-            ]:
-            tag_str += reportTime(t, options, field=width)
-    if "wait" in options.categories:
-        header += "| %*s " % (columnWidths.title("wait"),
-                              decorateTitle("Wait", options))
-        sub_header += decorateSubHeader("Wait", columnWidths, options)
-        tag_str += " | "
-        for t, width in [
-            (tag.min_wait, columnWidths.getWidth("wait", "min")),
-            (tag.median_wait, columnWidths.getWidth("wait", "med")),
-            (tag.average_wait, columnWidths.getWidth("wait", "ave")),
-            (tag.max_wait, columnWidths.getWidth("wait", "max")),
-            (tag.total_wait, columnWidths.getWidth("wait", "total")),
-            ]:
-            tag_str += reportTime(t, options, field=width)
-    if "memory" in options.categories:
-        header += "| %*s " % (columnWidths.title("memory"),
-                              decorateTitle("Memory", options))
-        sub_header += decorateSubHeader("Memory", columnWidths, options)
-        tag_str += " | "
-        for t, width in [
-            (tag.min_memory, columnWidths.getWidth("memory", "min")),
-            (tag.median_memory, columnWidths.getWidth("memory", "med")),
-            (tag.average_memory, columnWidths.getWidth("memory", "ave")),
-            (tag.max_memory, columnWidths.getWidth("memory", "max")),
-            (tag.total_memory, columnWidths.getWidth("memory", "total")),
-            ]:
-            tag_str += reportMemory(t, options, field=width, isBytes=True)
+        if tag.call_cache_hits or tag.call_cache_misses:
+            out_str += " %-12s | %7s%7s\n" % ("Call Cache", "hits", "misses")
+            out_str += "%s| %s%s\n" % (" " * 14,
+                                        reportNumber(tag.call_cache_hits, options, field=7),
+                                        reportNumber(tag.call_cache_misses, options, field=7))
+    for category in ["time", "clock", "wait", "memory"]:
+        if category in options.categories:
+            header += "| %*s " % (columnWidths.title(category),
+                                  decorateTitle(category.capitalize(), options))
+            sub_header += decorateSubHeader(category, columnWidths, options)
+            tag_str += " | "
+            for field in columnWidths.fields:
+                t = getattr(tag, "%s_%s" % (longforms[field], category))
+                width = columnWidths.getWidth(category, field)
+                if category == "memory":
+                    tag_str += reportMemory(t, options, field=width, isBytes=True)
+                else:
+                    tag_str += reportTime(t, options, field=width)
     out_str += header + "\n"
     out_str += sub_header + "\n"
     out_str += tag_str + "\n"
@@ -320,27 +324,15 @@ def decorateSubHeader(title, columnWidths, options):
     """ Add a marker to the correct field if the TITLE is sorted on.
     """
     title = title.lower()
-    if title != options.sortCategory:
-        s = "| %*s%*s%*s%*s%*s " % (
-            columnWidths.getWidth(title, "min"), "min",
-            columnWidths.getWidth(title, "med"), "med",
-            columnWidths.getWidth(title, "ave"), "ave",
-            columnWidths.getWidth(title, "max"), "max",
-            columnWidths.getWidth(title, "total"), "total")
-        return s
-    else:
-        s = "| "
-        for field, width in [("min", columnWidths.getWidth(title, "min")),
-                             ("med", columnWidths.getWidth(title, "med")),
-                             ("ave", columnWidths.getWidth(title, "ave")),
-                             ("max", columnWidths.getWidth(title, "max")),
-                             ("total", columnWidths.getWidth(title, "total"))]:
-            if options.sortField == field:
-                s += "%*s*" % (width - 1, field)
-            else:
-                s += "%*s" % (width, field)
-        s += " "
-        return s
+    s = "| "
+    for field in columnWidths.fields:
+        width = columnWidths.getWidth(title, field)
+        if title == options.sortCategory and options.sortField == field:
+            s += "%*s*" % (width - 1, field)
+        else:
+            s += "%*s" % (width, field)
+    s += " "
+    return s
 
 def get(tree, name):
     """ Return a float value attribute NAME from TREE.
@@ -358,11 +350,6 @@ def get(tree, name):
 def sortJobs(jobTypes, options):
     """ Return a jobTypes all sorted.
     """
-    longforms = {"med": "median",
-                 "ave": "average",
-                 "min": "min",
-                 "total": "total",
-                 "max": "max",}
     sortField = longforms[options.sortField]
     if (options.sortCategory == "time" or
         options.sortCategory == "clock" or
@@ -420,14 +407,9 @@ def computeColumnWidths(job_types, worker, job, options):
 def updateColumnWidths(tag, cw, options):
     """ Update the column width attributes for this tag's fields.
     """
-    longforms = {"med": "median",
-                 "ave": "average",
-                 "min": "min",
-                 "total": "total",
-                 "max": "max",}
     for category in ["time", "clock", "wait", "memory"]:
         if category in options.categories:
-            for field in ["min", "med", "ave", "max", "total"]:
+            for field in cw.fields:
                 t = getattr(tag, "%s_%s" % (longforms[field], category))
                 if category in ["time", "clock", "wait"]:
                     s = reportTime(t, options,
@@ -439,140 +421,42 @@ def updateColumnWidths(tag, cw, options):
                     # this string is larger than max, width must be increased
                     cw.setWidth(category, field, len(s) + 1)
 
-def buildElement(element, items, itemName):
-    """ Create an element for output.
-    """
-    def assertNonnegative(i,name):
-        if i < 0:
-            raise RuntimeError("Negative value %s reported for %s" %(i,name) )
-        else:
-            return float(i)
-
-    itemTimes = []
-    itemClocks = []
-    itemMemory = []
-    for item in items:
-        itemTimes.append(assertNonnegative(float(item["time"]), "time"))
-        itemClocks.append(assertNonnegative(float(item["clock"]), "clock"))
-        itemMemory.append(assertNonnegative(float(item["memory"]), "memory"))
-    assert len(itemClocks) == len(itemTimes) == len(itemMemory)
-
-    itemWaits=[]
-    for index in range(0,len(itemTimes)):
-        itemWaits.append(itemTimes[index] - itemClocks[index])
-
-    itemWaits.sort()
-    itemTimes.sort()
-    itemClocks.sort()
-    itemMemory.sort()
-
-    if len(itemTimes) == 0:
-        itemTimes.append(0)
-        itemClocks.append(0)
-        itemWaits.append(0)
-        itemMemory.append(0)
-
-    element[itemName]=Expando(
-        total_number=float(len(items)),
-        total_time=float(sum(itemTimes)),
-        median_time=float(itemTimes[old_div(len(itemTimes),2)]),
-        average_time=float(old_div(sum(itemTimes),len(itemTimes))),
-        min_time=float(min(itemTimes)),
-        max_time=float(max(itemTimes)),
-        total_clock=float(sum(itemClocks)),
-        median_clock=float(itemClocks[old_div(len(itemClocks),2)]),
-        average_clock=float(old_div(sum(itemClocks),len(itemClocks))),
-        min_clock=float(min(itemClocks)),
-        max_clock=float(max(itemClocks)),
-        total_wait=float(sum(itemWaits)),
-        median_wait=float(itemWaits[old_div(len(itemWaits),2)]),
-        average_wait=float(old_div(sum(itemWaits),len(itemWaits))),
-        min_wait=float(min(itemWaits)),
-        max_wait=float(max(itemWaits)),
-        total_memory=float(sum(itemMemory)),
-        median_memory=float(itemMemory[old_div(len(itemMemory),2)]),
-        average_memory=float(old_div(sum(itemMemory),len(itemMemory))),
-        min_memory=float(min(itemMemory)),
-        max_memory=float(max(itemMemory)),
-        name=itemName
-    )
-    return element[itemName]
-
-def createSummary(element, containingItems, containingItemName, getFn):
-    itemCounts = [len(getFn(containingItem)) for
-                  containingItem in containingItems]
-    itemCounts.sort()
-    if len(itemCounts) == 0:
-        itemCounts.append(0)
-    element["median_number_per_%s" % containingItemName] = itemCounts[old_div(len(itemCounts), 2)]
-    element["average_number_per_%s" % containingItemName] = old_div(float(sum(itemCounts)), len(itemCounts))
-    element["min_number_per_%s" % containingItemName] = min(itemCounts)
-    element["max_number_per_%s" % containingItemName] = max(itemCounts)
-
-
-def getStats(jobStore):
-    """ Collect and return the stats and config data.
+def getStats(jobStore, since=None, jobNames=None):
+    """ Collect and return the stats data, from the table stored by the leader if there is one.
+    Otherwise, e.g. while the workflow is running, it is built from all stats in the job store.
+
+    :param float since: see :class:`StatsTable`
+    :param jobNames: see :class:`StatsTable`
+    :rtype: StatsTable
     """
-    def aggregateStats(fileHandle,aggregateObject):
+    stats = StatsTable.load(jobStore, since=since, jobNames=jobNames)
+    if stats is None:
+        stats = StatsTable(since=since, jobNames=jobNames)
         try:
-            stats = json.load(fileHandle, object_hook=Expando)
-            for key in list(stats.keys()):
-                if key in aggregateObject:
-                    aggregateObject[key].append(stats[key])
-                else:
-                    aggregateObject[key]=[stats[key]]
-        except ValueError:
-            logger.critical("File %s contains corrupted json. Skipping file." % fileHandle)
-            pass  # The file is corrupted.
-
-    aggregateObject = Expando()
-    callBack = partial(aggregateStats, aggregateObject=aggregateObject)
-    jobStore.readStatsAndLogging(callBack, readAll=True)
-    return aggregateObject
+            jobStore.readStatsAndLogging(stats.add, readAll=True)
+        except:
+            stats.close()
+            raise
+    return stats
 
 
 def processData(config, stats):
-    ##########################################
-    # Collate the stats and report
-    ##########################################
-    if stats.get("total_time", None) is None:  # Hack to allow unfinished toils.
-        stats.total_time = {"total_time": "0.0", "total_clock": "0.0"}
-    else:
-        stats.total_time = sum([float(number) for number in stats.total_time])
-        stats.total_clock = sum([float(number) for number in stats.total_clock])
-
-    collatedStatsTag = Expando(total_run_time=stats.total_time,
-                               total_clock=stats.total_clock,
-                               batch_system=config.batchSystem,
-                               default_memory=str(config.defaultMemory),
-                               default_cores=str(config.defaultCores),
-                               max_cores=str(config.maxCores)
-                               )
-
-    # Add worker info
-    worker = [_f for _f in stats.workers if _f]
-    jobs = [_f for _f in stats.jobs if _f]
-    jobs = [item for sublist in jobs for item in sublist]
-
-    def fn4(job):
-        try:
-            return list(jobs)
-        except TypeError:
-            return []
-
-    buildElement(collatedStatsTag, worker, "worker")
-    createSummary(buildElement(collatedStatsTag, jobs, "jobs"),
-                  stats.workers, "worker", fn4)
-    # Get info for each job
-    jobNames = set()
-    for job in jobs:
-        jobNames.add(job.class_name)
-    jobTypesTag = Expando()
-    collatedStatsTag.job_types = jobTypesTag
-    for jobName in jobNames:
-        jobTypes = [ job for job in jobs if job.class_name == jobName ]
-        buildElement(jobTypesTag, jobTypes, jobName)
-    collatedStatsTag.name = "collatedStatsTag"
+    """ Collate the stats returned by getStats(), which are closed afterwards.
+    """
+    try:
+        worker, jobs, jobTypes = stats.summarize()
+        collatedStatsTag = Expando(total_run_time=stats.totalTime or 0.0,  # Unfinished toils
+                                   total_clock=stats.totalClock or 0.0,
+                                   batch_system=config.batchSystem,
+                                   default_memory=str(config.defaultMemory),
+                                   default_cores=str(config.defaultCores),
+                                   max_cores=str(config.maxCores),
+                                   worker=worker,
+                                   jobs=jobs,
+                                   job_types=Expando(jobTypes),
+                                   name="collatedStatsTag")
+    finally:
+        stats.close()
     return collatedStatsTag
 
 def reportData(tree, options):
@@ -599,6 +483,6 @@ def main():
     config = Config()
     config.setOptions(options)
     jobStore = Toil.resumeJobStore(config.jobStore)
-    stats = getStats(jobStore)
+    stats = getStats(jobStore, since=options.since, jobNames=options.jobNames)
     collatedStatsTag = processData(jobStore.config, stats)
     reportData(collatedStatsTag, options)
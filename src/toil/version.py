@@ -0,0 +1,13 @@
+dockerShortTag = '3.17.0a1-cfcfe26-dirty'
+baseVersion = '3.17.0a1'
+dockerTag = '3.17.0a1-cfcfe268ce98d4d0a169e72d96b438850a4f267e-dirty'
+dockerName = 'toil'
+buildNumber = None
+cgcloudVersion = '1.6.0a1.dev393'
+version = '3.17.0a1-cfcfe268ce98d4d0a169e72d96b438850a4f267e-dirty'
+dirty = True
+shortVersion = '3.17.0a1-cfcfe26-dirty'
+currentCommit = 'cfcfe268ce98d4d0a169e72d96b438850a4f267e'
+dockerMinimalTag = '3.17.0a1'
+distVersion = '3.17.0a1'
+dockerRegistry = 'quay.io/ucsc_cgl'
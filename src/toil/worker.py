@@ -16,8 +16,6 @@ from __future__ import absolute_import, print_function
 from future import standard_library
 standard_library.install_aliases()
 from builtins import str
-from builtins import map
-from builtins import filter
 import os
 import sys
 import copy
@@ -38,6 +36,7 @@ except ImportError:
     import pickle
 
 from toil.lib.expando import MagicExpando
+from toil.batchSystems.abstractBatchSystem import BatchJobExitReason
 from toil.common import Toil, safeUnpickleFromStream
 from toil.fileStore import FileStore
 from toil import logProcessContext
@@ -217,6 +216,7 @@ def workerScript(jobStore, config, jobName, jobStoreID, redirectOutputToLogFile=
     statsDict.jobs = []
     statsDict.workers.logsToMaster = []
     blockFn = lambda : True
+    fileStore = None
     listOfJobs = [jobName]
     try:
 
@@ -241,7 +241,11 @@ def workerScript(jobStore, config, jobName, jobStoreID, redirectOutputToLogFile=
         if jobGraph.command == None:
             logger.debug("Wrapper has no user job to run.")
             # Cleanup jobs already finished
-            f = lambda jobs : [z for z in [[y for y in x if jobStore.exists(y.jobStoreID)] for x in jobs] if len(z) > 0]
+            successors = [y for x in jobGraph.stack + jobGraph.services for y in x]
+            existing = {y.jobStoreID for y, exists
+                        in zip(successors, jobStore.existsMany([y.jobStoreID for y in successors]))
+                        if exists}
+            f = lambda jobs : [z for z in [[y for y in x if y.jobStoreID in existing] for x in jobs] if len(z) > 0]
             jobGraph.stack = f(jobGraph.stack)
             jobGraph.services = f(jobGraph.services)
             logger.debug("Cleaned up any references to completed successor jobs")
@@ -276,7 +280,7 @@ def workerScript(jobStore, config, jobName, jobStoreID, redirectOutputToLogFile=
             else:
                 logger.debug("The checkpoint jobs seems to have completed okay, removing any checkpoint files to delete.")
                 #Delete any remnant files
-                list(map(jobStore.deleteFile, list(filter(jobStore.fileExists, jobGraph.checkpointFilesToDelete))))
+                jobStore.deleteFiles(jobGraph.checkpointFilesToDelete)
 
         ##########################################
         #Setup the stats, if requested
@@ -385,6 +389,7 @@ def workerScript(jobStore, config, jobName, jobStoreID, redirectOutputToLogFile=
         ##########################################
         if config.stats:
             totalCPUTime, totalMemoryUsage = getTotalCpuTimeAndMemoryUsage()
+            statsDict.workers.start = str(startTime)
             statsDict.workers.time = str(time.time() - startTime)
             statsDict.workers.clock = str(totalCPUTime - startClock)
             statsDict.workers.memory = str(totalMemoryUsage)
@@ -416,7 +421,11 @@ def workerScript(jobStore, config, jobName, jobStoreID, redirectOutputToLogFile=
     
     if FileStore._terminateEvent.isSet():
         jobGraph = jobStore.load(jobStoreID)
-        jobGraph.setupJobAfterFailure(config)
+        # The job may well have failed because it ran out of the disk it was given
+        exitReason = None
+        if fileStore is not None and fileStore.diskExceeded:
+            exitReason = BatchJobExitReason.DISKLIMIT
+        jobGraph.setupJobAfterFailure(config, exitReason=exitReason)
         workerFailed = True
 
     ##########################################